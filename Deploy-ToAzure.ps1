@@ -229,7 +229,8 @@ az monitor log-analytics workspace table create `
     AoaiEndpoint=string `
     AoaiVirtualDeployment=string `
     AoaiStandinDeployment=string `
-    AoaiApiVersion=string
+    AoaiApiVersion=string `
+    IsCached=boolean
 # data collection endpoint
 Write-Host "Creating data collection endpoint..." -ForegroundColor Blue
 $DATA_COLLECTION_ENDPOINT_IMMUTABLE_ID = (az monitor data-collection endpoint create `
@@ -0,0 +1,191 @@
+"""Several methods and classes around balancing the load across targets."""
+
+import random
+import time
+
+import httpx
+
+
+class BalancingStrategy:
+    """
+    Base class for load balancing strategies, ordering the candidates within a priority tier.
+
+    The default implementation keeps the order given by the configuration (first fit).
+    """
+
+    name = "first_fit"
+
+    def __init__(self, balancing_configuration):
+        """Constructor."""
+        self.balancing_configuration = balancing_configuration
+
+    def order_tier(self, tier):
+        """Return the targets of the given priority tier in the order they shall be tried."""
+        return tier
+
+    @staticmethod
+    def get_strategy_class(strategy_name):
+        """Return the strategy class with the given name."""
+        strategy_classes = {
+            strategy_class.name: strategy_class for strategy_class in BalancingStrategy.__subclasses__()
+        }
+        strategy_classes[BalancingStrategy.name] = BalancingStrategy
+        if strategy_name not in strategy_classes:
+            raise ValueError(
+                f"Unknown load balancing strategy '{strategy_name}'. Supported strategies are: "
+                f"{', '.join(sorted(strategy_classes))}."
+            )
+        return strategy_classes[strategy_name]
+
+
+class EwmaLatencyStrategy(BalancingStrategy):
+    """
+    Prefers targets with the lowest exponentially weighted moving average (EWMA) of their latency.
+
+    The latency is weighted by the number of outstanding requests, so a fast target is not flooded until its latency
+    catches up. Targets without measurements yet are tried first, so every target gets measured.
+    """
+
+    name = "ewma_latency"
+
+    def order_tier(self, tier):
+        """Return the targets of the given priority tier in the order they shall be tried."""
+        if len(tier) == 1:
+            return tier
+        return sorted(
+            tier,
+            key=lambda target: (target.ewma_latency_ms or 0) * (target.outstanding_requests + 1),
+        )
+
+
+class LeastOutstandingRequestsStrategy(BalancingStrategy):
+    """Prefers targets with the least requests in flight."""
+
+    name = "least_outstanding_requests"
+
+    def order_tier(self, tier):
+        """Return the targets of the given priority tier in the order they shall be tried."""
+        if len(tier) == 1:
+            return tier
+        return sorted(tier, key=lambda target: target.outstanding_requests)
+
+
+class PowerOfTwoChoicesStrategy(BalancingStrategy):
+    """
+    Picks two random targets and prefers the one with fewer outstanding requests (then lower EWMA latency).
+
+    The other targets follow in configuration order, so they are available for failover.
+    """
+
+    name = "power_of_two_choices"
+
+    def order_tier(self, tier):
+        """Return the targets of the given priority tier in the order they shall be tried."""
+        if len(tier) == 1:
+            return tier
+        first_choice, second_choice = random.sample(tier, 2)
+        if PowerOfTwoChoicesStrategy._get_load(second_choice) < PowerOfTwoChoicesStrategy._get_load(first_choice):
+            first_choice, second_choice = second_choice, first_choice
+        return [first_choice, second_choice] + [
+            target for target in tier if target is not first_choice and target is not second_choice
+        ]
+
+    @staticmethod
+    def _get_load(target):
+        """Return a sortable load indicator for the given target."""
+        return (target.outstanding_requests, target.ewma_latency_ms or 0)
+
+
+class LoadBalancer:
+    """Orders candidate targets with the configured strategy and measures targets when requests are sent."""
+
+    def __init__(self, balancing_configuration):
+        """Constructor."""
+        strategy_name = balancing_configuration.get("strategy", BalancingStrategy.name)
+        self.strategy = BalancingStrategy.get_strategy_class(strategy_name)(balancing_configuration)
+        self.ewma_alpha = float(balancing_configuration.get("ewma_alpha", 0.3))
+        self.is_first_fit = type(self.strategy) is BalancingStrategy  # pylint: disable=unidiomatic-typecheck
+
+    def order_candidates(self, candidates, candidate_tiers):
+        """Return the given candidates in the order they shall be tried, respecting priority tiers."""
+        if self.is_first_fit:
+            return candidates
+        ordered_candidates = []
+        for tier in candidate_tiers:
+            ordered_candidates.extend(self.strategy.order_tier(tier))
+        return ordered_candidates
+
+    @staticmethod
+    def rotate_first_tier(candidates, rotation, is_available):
+        """
+        Return the given ordered candidates with the available candidates of the highest-priority tier that has any
+        rotated by the given number of targets, eg. so chunks of a request sent in parallel start at different targets.
+
+        All other candidates keep their places, so targets of lower priority are still only tried after that tier.
+        """
+        first_index = next(
+            (index for index, candidate in enumerate(candidates) if is_available(candidate)), len(candidates)
+        )
+        end_index = first_index
+        while end_index < len(candidates) and candidates[end_index].priority == candidates[first_index].priority:
+            end_index += 1
+        # note: unavailable candidates of the tier are moved to its end, so rotations do not skip to the same target
+        available_candidates = [candidate for candidate in candidates[first_index:end_index] if is_available(candidate)]
+        if len(available_candidates) < 2:
+            return candidates
+        rotation %= len(available_candidates)
+        return [
+            *candidates[:first_index],
+            *available_candidates[rotation:],
+            *available_candidates[:rotation],
+            *(candidate for candidate in candidates[first_index:end_index] if candidate not in available_candidates),
+            *candidates[end_index:],
+        ]
+
+    async def send(self, aoai_target, aoai_request, stream):
+        """Send the given request to the given target, measuring latency and outstanding requests."""
+        aoai_target.add_outstanding_requests(1)
+        start_time = time.perf_counter()
+        try:
+            aoai_response = await aoai_target.endpoint_client.send(aoai_request, stream=stream)
+        except BaseException:
+            aoai_target.add_outstanding_requests(-1)
+            raise
+        self.record_latency(aoai_target, (time.perf_counter() - start_time) * 1_000)
+
+        # the request is outstanding until its response has been read or closed
+        if aoai_response.is_closed:
+            aoai_target.add_outstanding_requests(-1)
+        else:
+            aoai_response.stream = OutstandingRequestStream(aoai_response.stream, aoai_target)
+        return aoai_response
+
+    def record_latency(self, aoai_target, latency_ms):
+        """Update the target's EWMA latency with the given latency."""
+        ewma_latency_ms = aoai_target.local_ewma_latency_ms
+        if ewma_latency_ms is None:
+            aoai_target.set_ewma_latency_ms(latency_ms)
+        else:
+            aoai_target.set_ewma_latency_ms(ewma_latency_ms + self.ewma_alpha * (latency_ms - ewma_latency_ms))
+
+
+class OutstandingRequestStream(httpx.AsyncByteStream):
+    """Wraps a response stream to count the request as outstanding until the stream is closed."""
+
+    def __init__(self, stream, aoai_target):
+        """Constructor."""
+        self.stream = stream
+        self.aoai_target = aoai_target
+        self.is_closed = False
+
+    async def __aiter__(self):
+        """Dunder method to iterate over the wrapped stream."""
+        async for chunk in self.stream:
+            yield chunk
+
+    async def aclose(self):
+        """Close the wrapped stream and end the outstanding request."""
+        if not self.is_closed:
+            self.is_closed = True
+            self.aoai_target.add_outstanding_requests(-1)
+        await self.stream.aclose()
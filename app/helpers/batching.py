@@ -0,0 +1,307 @@
+"""Several methods and classes around batching embeddings requests and splitting them into chunks."""
+
+import asyncio
+import json
+
+import httpx
+
+from .caching import ResponseCache
+from .circuit_breaker import FAILURE_STATUS_CODES
+from .embeddings import estimate_input_tokens, get_inputs, split_tokens
+
+# response headers which are not passed on with a response split from a batch or merged from chunks, as its body is
+# created anew
+UNBATCHED_HEADER_NAMES = frozenset(("content-length", "content-encoding", "transfer-encoding"))
+
+
+class EmbeddingsBatch:
+    """Embeddings requests with a single input each, collected to be sent to a target as a single request."""
+
+    __slots__ = ("inputs", "result", "is_full")
+
+    def __init__(self):
+        """Constructor."""
+        self.inputs = []
+        # note: the result is either a BatchedResponse, the exception raised when sending the batch, or None if the
+        #       requests need to be sent one by one
+        self.result = asyncio.get_running_loop().create_future()
+        self.is_full = asyncio.Event()
+
+    def __len__(self):
+        """Dunder method to return the number of requests in the batch."""
+        return len(self.inputs)
+
+    def add(self, single_input):
+        """Add a request with the given input to the batch and return its index in the batch."""
+        self.inputs.append(single_input)
+        return len(self.inputs) - 1
+
+
+class BatchedResponse:
+    """The response of a target to a batch of embeddings requests, split into the responses to the single requests."""
+
+    __slots__ = ("aoai_target", "status_code", "headers", "body_dict", "body", "prompt_tokens")
+
+    def __init__(self, aoai_target, aoai_response, batch):
+        """Constructor."""
+        self.aoai_target = aoai_target
+        self.status_code = aoai_response.status_code
+        self.headers = [
+            (name, value)
+            for name, value in aoai_response.headers.items()
+            if name.lower() not in UNBATCHED_HEADER_NAMES
+        ]
+        self.body = aoai_response.content
+        self.body_dict = None
+        self.prompt_tokens = None
+        if self.status_code == 200:
+            self.body_dict = json.loads(self.body)
+            embeddings = {embedding["index"]: embedding for embedding in self.body_dict["data"]}
+            self.body_dict["data"] = [embeddings[index] for index in range(len(batch))]
+            usage = self.body_dict.get("usage") or {}
+            self.prompt_tokens = split_tokens(
+                usage.get("prompt_tokens", 0), [estimate_input_tokens(single_input) for single_input in batch.inputs]
+            )
+
+    def create_response(self, index):
+        """Return the response to the request with the given index in the batch."""
+        if self.body_dict is None:
+            # note: responses other than embeddings, eg. 429s, are passed on to all requests of the batch as they are
+            return httpx.Response(self.status_code, headers=self.headers, stream=httpx.ByteStream(self.body))
+        embedding = {**self.body_dict["data"][index], "index": 0}
+        prompt_tokens = self.prompt_tokens[index]
+        body_dict = {
+            **self.body_dict,
+            "data": [embedding],
+            "usage": {"prompt_tokens": prompt_tokens, "total_tokens": prompt_tokens},
+        }
+        return httpx.Response(
+            self.status_code, headers=self.headers, stream=httpx.ByteStream(json.dumps(body_dict).encode())
+        )
+
+
+class EmbeddingsBatcher:
+    """
+    Batches concurrent embeddings requests with a single input each, so they are sent to a target as a single request
+    with multiple inputs, and splits the target's response into the responses to the single requests.
+
+    Requests are batched if their deployment, path, API version and body except the input (eg. the dimensions and the
+    encoding format) match. The first request of a batch waits up to max_wait_ms for further requests, or until the
+    batch has max_batch_size requests, and then sends the batch. The usage of the batch is split across its requests
+    proportionally to the estimated tokens of their inputs, so plugins counting usage per client stay accurate.
+
+    If the target rejects the batch as invalid (400), eg. because one of the inputs is too long, the requests are sent
+    one by one, so one invalid input does not fail the other requests. Other failures, eg. a 429 because no target has
+    capacity, are passed on to all requests of the batch. If the first request is cancelled, the other requests are sent
+    one by one as well.
+    """
+
+    def __init__(self, embeddings_batching_configuration):
+        """Constructor."""
+        self.max_wait_ms = float(embeddings_batching_configuration.get("max_wait_ms", 5))
+        self.max_batch_size = int(embeddings_batching_configuration.get("max_batch_size", 16))
+        self.open_batches = {}
+        self.metrics = {"batches": 0, "batched_requests": 0, "unbatched_requests": 0}
+
+    @staticmethod
+    def is_batchable(request_body_dict):
+        """Return True if the given embeddings request can be batched, ie. has a single input."""
+        inputs = get_inputs(request_body_dict)
+        return inputs is not None and len(inputs) == 1
+
+    @staticmethod
+    def get_key(client, virtual_deployment, path, api_version, request_body_dict):
+        """
+        Return the key of the batch a request of the given client with the given deployment, path, API version and body
+        belongs to.
+        """
+        return ResponseCache.get_key(
+            client,
+            virtual_deployment,
+            path,
+            api_version,
+            {name: value for name, value in request_body_dict.items() if name != "input"},
+        )
+
+    async def get_response(self, key, request_body_dict, get_response_from_targets):
+        """
+        Return the responding target and the response for the given request with the given key, sent as part of a batch
+        if there are concurrent requests with the same key.
+
+        get_response_from_targets is awaited with the body of the request to send, either the batch's or the given one.
+        It must return the responding target and a non-streamed response, or raise if there is no response.
+        """
+        single_input = get_inputs(request_body_dict)[0]
+        batch = self.open_batches.get(key)
+        if batch is not None:
+            # join the open batch and wait for its response
+            index = batch.add(single_input)
+            if len(batch) >= self.max_batch_size:
+                del self.open_batches[key]
+                batch.is_full.set()
+            # note: shielded, so a request being cancelled does not cancel the batch
+            batched_response = await asyncio.shield(batch.result)
+        else:
+            # open a new batch, wait for further requests and send the batch
+            batch = EmbeddingsBatch()
+            index = batch.add(single_input)
+            self.open_batches[key] = batch
+            try:
+                try:
+                    await asyncio.wait_for(batch.is_full.wait(), timeout=self.max_wait_ms / 1_000)
+                except asyncio.TimeoutError:
+                    pass
+                finally:
+                    if self.open_batches.get(key) is batch:
+                        del self.open_batches[key]
+                batched_response = (
+                    await self._send_batch(batch, request_body_dict, get_response_from_targets)
+                    if len(batch) > 1
+                    else None
+                )
+                batch.result.set_result(batched_response)
+            except Exception as exception:
+                # note: the exception is passed as result, so it is not reported as never retrieved if not awaited
+                batch.result.set_result(exception)
+                raise
+            finally:
+                # the first request was cancelled, so the other requests are sent one by one
+                if not batch.result.done():
+                    batch.result.set_result(None)
+
+        if isinstance(batched_response, Exception):
+            raise batched_response
+        if batched_response is None:
+            self.metrics["unbatched_requests"] += 1
+            return await get_response_from_targets(request_body_dict)
+        self.metrics["batched_requests"] += 1
+        return batched_response.aoai_target, batched_response.create_response(index)
+
+    async def _send_batch(self, batch, request_body_dict, get_response_from_targets):
+        """Send the given batch and return the response, or None if the requests need to be sent one by one."""
+        self.metrics["batches"] += 1
+        aoai_target, aoai_response = await get_response_from_targets({**request_body_dict, "input": batch.inputs})
+        await aoai_response.aread()
+        if aoai_response.status_code == 400:
+            return None
+        try:
+            return BatchedResponse(aoai_target, aoai_response, batch)
+        except (KeyError, IndexError, TypeError, ValueError):
+            return None
+
+    def get_stats(self):
+        """Return statistics about the batched requests."""
+        return {**self.metrics, "open_batches": len(self.open_batches)}
+
+
+class EmbeddingsFanOut:
+    """
+    Splits embeddings requests with many inputs into chunks, which are sent in parallel across the targets of the
+    requested deployment, and merges the responses to the chunks into the response to the request.
+
+    Requests with at least min_inputs inputs are split into chunks of chunk_size inputs. At most max_concurrent_chunks
+    chunks are sent at the same time. The n-th chunk starts with the n-th target, so the chunks are spread across the
+    targets, failing over to the other targets as usual. Chunks which fail, eg. with a 429 or a connection error, are
+    sent again (starting with the next target), up to max_attempts times, without sending the other chunks again. The
+    merged response has the embeddings in the order of the inputs, and the sum of the chunks' usage as usage.
+    """
+
+    def __init__(self, embeddings_fan_out_configuration):
+        """Constructor."""
+        self.chunk_size = int(embeddings_fan_out_configuration.get("chunk_size", 256))
+        self.min_inputs = int(embeddings_fan_out_configuration.get("min_inputs", 2 * self.chunk_size))
+        self.max_concurrent_chunks = int(embeddings_fan_out_configuration.get("max_concurrent_chunks", 8))
+        self.max_attempts = int(embeddings_fan_out_configuration.get("max_attempts", 3))
+        self.metrics = {"requests": 0, "chunks": 0, "retried_chunks": 0, "failed_requests": 0}
+
+    def applies_to(self, request_body_dict):
+        """Return True if the given embeddings request has enough inputs to be split into chunks."""
+        inputs = get_inputs(request_body_dict)
+        return inputs is not None and len(inputs) >= self.min_inputs and len(inputs) > self.chunk_size
+
+    async def get_response(self, request_body_dict, get_response_from_targets):
+        """
+        Return the responding target (of the first chunk) and the merged response for the given request, sent in chunks.
+
+        get_response_from_targets is awaited with the body of a chunk and the number of targets to rotate the candidates
+        by. It must return the responding target and a non-streamed response, or raise if there is no response.
+        """
+        inputs = get_inputs(request_body_dict)
+        chunk_request_body_dicts = [
+            {**request_body_dict, "input": inputs[start : start + self.chunk_size]}
+            for start in range(0, len(inputs), self.chunk_size)
+        ]
+        self.metrics["requests"] += 1
+        self.metrics["chunks"] += len(chunk_request_body_dicts)
+        semaphore = asyncio.Semaphore(self.max_concurrent_chunks)
+
+        async def send_chunk(chunk_index, attempt):
+            """Send the chunk with the given index and return the responding target and the response."""
+            async with semaphore:
+                aoai_target, aoai_response = await get_response_from_targets(
+                    chunk_request_body_dicts[chunk_index], chunk_index + attempt
+                )
+                await aoai_response.aread()
+                return aoai_target, aoai_response
+
+        chunk_results = [None] * len(chunk_request_body_dicts)
+        failed_chunk_indexes = list(range(len(chunk_request_body_dicts)))
+        last_failure = None
+        for attempt in range(self.max_attempts):
+            if attempt > 0:
+                self.metrics["retried_chunks"] += len(failed_chunk_indexes)
+            results = await asyncio.gather(
+                *[send_chunk(chunk_index, attempt) for chunk_index in failed_chunk_indexes], return_exceptions=True
+            )
+            still_failed_chunk_indexes = []
+            for chunk_index, result in zip(failed_chunk_indexes, results):
+                if isinstance(result, Exception):
+                    still_failed_chunk_indexes.append(chunk_index)
+                    last_failure = result
+                elif isinstance(result, BaseException):
+                    raise result
+                elif result[1].status_code == 200:
+                    chunk_results[chunk_index] = result
+                elif result[1].status_code in FAILURE_STATUS_CODES:
+                    still_failed_chunk_indexes.append(chunk_index)
+                    last_failure = result
+                else:
+                    # the chunk was rejected, eg. as invalid, so sending it again will not help
+                    self.metrics["failed_requests"] += 1
+                    return result
+            failed_chunk_indexes = still_failed_chunk_indexes
+            if not failed_chunk_indexes:
+                break
+
+        if failed_chunk_indexes:
+            self.metrics["failed_requests"] += 1
+            if isinstance(last_failure, Exception):
+                raise last_failure
+            return last_failure
+        return chunk_results[0][0], self._merge_responses([aoai_response for _, aoai_response in chunk_results])
+
+    @staticmethod
+    def _merge_responses(aoai_responses):
+        """Return the response merged from the given responses to the chunks, in the order of the chunks."""
+        embeddings = []
+        usage = {"prompt_tokens": 0, "total_tokens": 0}
+        for aoai_response in aoai_responses:
+            body_dict = json.loads(aoai_response.content)
+            for embedding in sorted(body_dict["data"], key=lambda embedding: embedding["index"]):
+                embeddings.append({**embedding, "index": len(embeddings)})
+            for name in usage:
+                usage[name] += (body_dict.get("usage") or {}).get(name, 0)
+        body_dict = {**body_dict, "data": embeddings, "usage": usage}
+        return httpx.Response(
+            200,
+            headers=[
+                (name, value)
+                for name, value in aoai_responses[0].headers.items()
+                if name.lower() not in UNBATCHED_HEADER_NAMES
+            ],
+            stream=httpx.ByteStream(json.dumps(body_dict).encode()),
+        )
+
+    def get_stats(self):
+        """Return statistics about the requests sent in chunks."""
+        return dict(self.metrics)
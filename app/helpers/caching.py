@@ -0,0 +1,319 @@
+"""Several methods and classes around caching responses of targets."""
+
+import hashlib
+import json
+from collections import OrderedDict
+
+from .embeddings import create_embeddings_response_body_dict, encode_embedding, get_inputs
+
+# header telling the client whether the response was served from the cache
+CACHE_STATUS_HEADER = "x-powerproxy-cache"
+# response headers which are not stored, as they depend on how the body is transferred
+UNCACHED_HEADER_NAMES = frozenset(("content-length", "content-encoding", "transfer-encoding", "date"))
+# estimated memory needed per entry besides its headers and body, eg. for the key and the entry's object
+ENTRY_OVERHEAD_BYTES = 200
+
+
+class CachedResponse:
+    """A response stored in the response cache."""
+
+    __slots__ = ("headers", "body", "stored_at_ms", "size_in_bytes")
+
+    def __init__(self, headers, body, stored_at_ms):
+        """Constructor."""
+        self.headers = {name: value for name, value in headers.items() if name.lower() not in UNCACHED_HEADER_NAMES}
+        self.body = body
+        self.stored_at_ms = stored_at_ms
+        self.size_in_bytes = (
+            len(body) + sum(len(name) + len(value) for name, value in self.headers.items()) + ENTRY_OVERHEAD_BYTES
+        )
+
+
+class CacheControl:
+    """
+    The directives of a request's 'Cache-Control' header which apply to the response cache.
+
+    no-cache = do not take the response from the cache, but store the new response
+    no-store = neither take the response from the cache nor store the new response
+    max-age  = only take responses from the cache which are not older than the given seconds
+    """
+
+    __slots__ = ("is_lookup_allowed", "is_store_allowed", "max_age_ms")
+
+    def __init__(self, header_value):
+        """Constructor."""
+        self.is_lookup_allowed = True
+        self.is_store_allowed = True
+        self.max_age_ms = None
+        for directive in (header_value or "").lower().split(","):
+            name, _, value = directive.strip().partition("=")
+            match name:
+                case "no-cache":
+                    self.is_lookup_allowed = False
+                case "no-store":
+                    self.is_lookup_allowed = False
+                    self.is_store_allowed = False
+                case "max-age":
+                    try:
+                        self.max_age_ms = int(value.strip('"')) * 1_000
+                    except ValueError:
+                        pass
+
+
+class ResponseCache:
+    """
+    Least recently used cache for the responses to deterministic completions, ie. with a temperature of 0.
+
+    Responses are stored under a hash of the requested deployment, path, API version and the request's body, with the
+    body normalized so the order of keys and whitespace do not matter. Non-streamed responses and event streams are
+    cached alike, an event stream is stored as a whole once it has been relayed completely. The cache holds at most
+    max_bytes, evicting the least recently used responses beyond that, and responses expire after ttl_ms.
+
+    All methods expect the current time in milliseconds, so the cache does not depend on a specific clock.
+    """
+
+    def __init__(self, response_cache_configuration):
+        """Constructor."""
+        self.max_bytes = int(response_cache_configuration.get("max_bytes", 64_000_000))
+        self.max_entry_bytes = min(int(response_cache_configuration.get("max_entry_bytes", 1_000_000)), self.max_bytes)
+        self.ttl_ms = int(response_cache_configuration.get("ttl_ms", 3_600_000))
+        self.entries = OrderedDict()
+        self.size_in_bytes = 0
+        self.metrics = {"hits": 0, "misses": 0, "bypasses": 0, "stores": 0, "evictions": 0, "expirations": 0}
+
+    def __len__(self):
+        """Dunder method to return the number of cached responses."""
+        return len(self.entries)
+
+    @staticmethod
+    def is_cacheable(path, request_body_dict):
+        """Return True if the response to a request with the given path and body can be cached."""
+        # note: False == 0 in Python, but a temperature of false is no temperature of 0
+        return (
+            path.endswith("completions")
+            and isinstance(request_body_dict, dict)
+            and type(request_body_dict.get("temperature")) in (int, float)
+            and request_body_dict["temperature"] == 0
+        )
+
+    @staticmethod
+    def get_key(client, virtual_deployment, path, api_version, request_body_dict):
+        """
+        Return the key of the response to a request of the given client with the given deployment, path, API version
+        and body.
+        """
+        normalized_request = json.dumps(
+            [client, virtual_deployment, path, api_version, request_body_dict],
+            sort_keys=True,
+            separators=(",", ":"),
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(normalized_request.encode()).digest()
+
+    def get(self, key, now_ms, max_age_ms=None):
+        """Return the cached response for the given key, or None if there is none or it is older than max_age_ms."""
+        cached_response = self.entries.get(key)
+        if cached_response is not None and now_ms - cached_response.stored_at_ms > self.ttl_ms:
+            self._remove(key)
+            self.metrics["expirations"] += 1
+            cached_response = None
+        if cached_response is None or (max_age_ms is not None and now_ms - cached_response.stored_at_ms > max_age_ms):
+            self.metrics["misses"] += 1
+            return None
+        self.entries.move_to_end(key)
+        self.metrics["hits"] += 1
+        return cached_response
+
+    def record_bypass(self):
+        """Record a request which bypassed the cache."""
+        self.metrics["bypasses"] += 1
+
+    def put(self, key, headers, body, now_ms):
+        """Store the given response under the given key, unless it is larger than max_entry_bytes."""
+        cached_response = CachedResponse(headers, body, now_ms)
+        if cached_response.size_in_bytes > self.max_entry_bytes:
+            return
+        if key in self.entries:
+            self._remove(key)
+        self.entries[key] = cached_response
+        self.size_in_bytes += cached_response.size_in_bytes
+        self.metrics["stores"] += 1
+        while self.size_in_bytes > self.max_bytes:
+            self._remove(next(iter(self.entries)))
+            self.metrics["evictions"] += 1
+
+    def get_stats(self):
+        """Return statistics about the cache."""
+        return {**self.metrics, "entries": len(self.entries), "size_in_bytes": self.size_in_bytes}
+
+    def _remove(self, key):
+        """Remove the response with the given key."""
+        self.size_in_bytes -= self.entries.pop(key).size_in_bytes
+
+
+class CachedEmbedding:
+    """An embedding stored in the embeddings cache."""
+
+    __slots__ = ("embedding_bytes", "model", "size_in_bytes")
+
+    def __init__(self, embedding_bytes, model):
+        """Constructor."""
+        self.embedding_bytes = embedding_bytes
+        # note: the model's name is the same object for all embeddings of a response
+        self.model = model
+        self.size_in_bytes = len(embedding_bytes) + ENTRY_OVERHEAD_BYTES
+
+
+class EmbeddingsCache:
+    """
+    Least recently used cache for the embeddings of single inputs of embeddings requests.
+
+    Embeddings are stored per input under a hash of the client, the requested deployment, the requested dimensions and
+    the input, so requests whose inputs have been embedded before, eg. when re-indexing mostly unchanged chunks, only
+    need to request the embeddings of the other inputs. Embeddings are stored as float32 bytes, like AOAI returns them
+    when requested in base64 encoding, which takes a fraction of the memory of lists of floats. The cache holds at most
+    max_bytes, evicting the least recently used embeddings beyond that. Embeddings do not expire, as they do not change
+    for the same deployment.
+    """
+
+    def __init__(self, embeddings_cache_configuration):
+        """Constructor."""
+        self.max_bytes = int(embeddings_cache_configuration.get("max_bytes", 64_000_000))
+        self.entries = OrderedDict()
+        self.size_in_bytes = 0
+        self.metrics = {"hits": 0, "misses": 0, "bypasses": 0, "stores": 0, "evictions": 0}
+
+    def __len__(self):
+        """Dunder method to return the number of cached embeddings."""
+        return len(self.entries)
+
+    @staticmethod
+    def get_key(client, virtual_deployment, dimensions, single_input):
+        """Return the key of the embedding of the given input for the given client, deployment and dimensions."""
+        return hashlib.sha256(
+            json.dumps([client, virtual_deployment, dimensions, single_input], ensure_ascii=False).encode()
+        ).digest()
+
+    def look_up(self, client, virtual_deployment, request_body_dict, cache_control):
+        """
+        Return the lookup of the given client's embeddings request's inputs in the cache, or None if the request has no
+        valid input.
+        """
+        inputs = get_inputs(request_body_dict)
+        if inputs is None:
+            return None
+        if not cache_control.is_lookup_allowed:
+            self.metrics["bypasses"] += 1
+        return EmbeddingsCacheLookup(self, client, virtual_deployment, request_body_dict, inputs, cache_control)
+
+    def get(self, key):
+        """Return the cached embedding for the given key, or None if there is none."""
+        cached_embedding = self.entries.get(key)
+        if cached_embedding is None:
+            self.metrics["misses"] += 1
+            return None
+        self.entries.move_to_end(key)
+        self.metrics["hits"] += 1
+        return cached_embedding
+
+    def put(self, key, embedding_bytes, model):
+        """Store the given embedding (float32 bytes) of the given model under the given key."""
+        if key in self.entries:
+            self._remove(key)
+        cached_embedding = CachedEmbedding(embedding_bytes, model)
+        self.entries[key] = cached_embedding
+        self.size_in_bytes += cached_embedding.size_in_bytes
+        self.metrics["stores"] += 1
+        while self.size_in_bytes > self.max_bytes:
+            self._remove(next(iter(self.entries)))
+            self.metrics["evictions"] += 1
+
+    def get_stats(self):
+        """Return statistics about the cache."""
+        return {**self.metrics, "entries": len(self.entries), "size_in_bytes": self.size_in_bytes}
+
+    def _remove(self, key):
+        """Remove the embedding with the given key."""
+        self.size_in_bytes -= self.entries.pop(key).size_in_bytes
+
+
+class EmbeddingsCacheLookup:
+    """
+    The embeddings of an embeddings request's inputs found in the embeddings cache, and the inputs still missing.
+
+    The missing inputs are requested from the target, see get_request_body_dict_for_missing_inputs(). Their embeddings
+    are then stored in the cache and merged with the cached ones into the response to the original request, see
+    complete_response_body_dict().
+    """
+
+    __slots__ = (
+        "embeddings_cache",
+        "keys",
+        "embeddings_bytes",
+        "missing_indexes",
+        "model",
+        "encoding_format",
+        "is_store_allowed",
+    )
+
+    def __init__(self, embeddings_cache, client, virtual_deployment, request_body_dict, inputs, cache_control):
+        """Constructor."""
+        self.embeddings_cache = embeddings_cache
+        dimensions = request_body_dict.get("dimensions")
+        self.keys = [
+            EmbeddingsCache.get_key(client, virtual_deployment, dimensions, single_input) for single_input in inputs
+        ]
+        self.embeddings_bytes = [None] * len(inputs)
+        self.model = None
+        if cache_control.is_lookup_allowed:
+            for index, key in enumerate(self.keys):
+                if (cached_embedding := embeddings_cache.get(key)) is not None:
+                    self.embeddings_bytes[index] = cached_embedding.embedding_bytes
+                    self.model = cached_embedding.model
+        self.missing_indexes = [
+            index for index, embedding_bytes in enumerate(self.embeddings_bytes) if embedding_bytes is None
+        ]
+        self.encoding_format = request_body_dict.get("encoding_format", "float")
+        self.is_store_allowed = cache_control.is_store_allowed
+
+    @property
+    def is_complete(self):
+        """Return True if all embeddings were found in the cache."""
+        return not self.missing_indexes
+
+    @property
+    def has_cached_embeddings(self):
+        """Return True if at least one embedding was found in the cache."""
+        return len(self.missing_indexes) < len(self.embeddings_bytes)
+
+    def get_request_body_dict_for_missing_inputs(self, request_body_dict):
+        """Return the given request's body, with the inputs whose embeddings were found in the cache removed."""
+        inputs = get_inputs(request_body_dict)
+        return {**request_body_dict, "input": [inputs[index] for index in self.missing_indexes]}
+
+    def create_response_body_dict(self):
+        """Return the body of the response to the request, if all embeddings were found in the cache."""
+        return create_embeddings_response_body_dict(self.embeddings_bytes, self.encoding_format, self.model, 0)
+
+    def complete_response_body_dict(self, response_body_dict):
+        """
+        Store the embeddings in the given response to the request for the missing inputs, and return the response's
+        body with the cached embeddings merged in, or None if the response can be passed on as is (eg. because no
+        embeddings were found in the cache) or is no valid embeddings response.
+
+        The usage in the response only counts the tokens of the inputs requested from the target.
+        """
+        try:
+            embeddings_from_target = response_body_dict["data"]
+            model = response_body_dict.get("model")
+            for embedding_from_target in embeddings_from_target:
+                index = self.missing_indexes[embedding_from_target["index"]]
+                self.embeddings_bytes[index] = encode_embedding(embedding_from_target["embedding"])
+                if self.is_store_allowed:
+                    self.embeddings_cache.put(self.keys[index], self.embeddings_bytes[index], model)
+        except (KeyError, IndexError, TypeError, ValueError):
+            return None
+        if not self.has_cached_embeddings or None in self.embeddings_bytes:
+            return None
+        prompt_tokens = (response_body_dict.get("usage") or {}).get("prompt_tokens", 0)
+        return create_embeddings_response_body_dict(self.embeddings_bytes, self.encoding_format, model, prompt_tokens)
@@ -0,0 +1,137 @@
+"""Several methods and classes around circuit breakers protecting targets."""
+
+from collections import deque
+
+# HTTP status codes for which a target is considered failing or throttling, and the next target is tried
+FAILURE_STATUS_CODES = frozenset([408, 429, 500])
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker for a target, with closed, open and half-open states.
+
+    - closed: requests pass. Outcomes are recorded in a time window, and the breaker opens once the failure rate in
+      the window reaches the threshold (given a minimum number of requests in the window).
+    - open: requests are blocked until the open period has passed. Consecutive openings double the open period, up to
+      a maximum. If the target tells how long to wait (eg. 'retry-after-ms' on a 429), that time is used instead.
+    - half-open: a single probe request is let through. If it succeeds, the breaker closes, otherwise it opens again.
+
+    All methods expect the current time in milliseconds, so the breaker does not depend on a specific clock.
+
+    If the breaker has a shared state, openings are shared with the other workers on the host, and a target blocked by
+    another worker is treated as open until the block ends. Half-open probing is left to the worker which opened.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, circuit_breaker_configuration):
+        """Constructor."""
+        self.failure_rate_threshold = float(circuit_breaker_configuration.get("failure_rate_threshold", 0.5))
+        self.minimum_requests = int(circuit_breaker_configuration.get("minimum_requests", 5))
+        self.window_ms = int(circuit_breaker_configuration.get("window_ms", 10_000))
+        self.open_ms = int(circuit_breaker_configuration.get("open_ms", 1_000))
+        self.max_open_ms = int(circuit_breaker_configuration.get("max_open_ms", 60_000))
+        self.state = CircuitBreaker.CLOSED
+        self.open_until_ms = 0
+        self.consecutive_openings = 0
+        self.is_probe_in_flight = False
+        self.outcomes = deque()
+        self.failures_in_window = 0
+        self.shared_state = None
+
+    def allows_request(self, now_ms):
+        """Return True if a request could be sent to the target now, without changing the breaker's state."""
+        if self.shared_state is not None and now_ms < self.shared_state.get_blocked_until_ms():
+            return False
+        match self.state:
+            case CircuitBreaker.CLOSED:
+                return True
+            case CircuitBreaker.OPEN:
+                return now_ms >= self.open_until_ms
+            case _:
+                return not self.is_probe_in_flight
+
+    def try_acquire(self, now_ms):
+        """Return True if a request may be sent to the target now. In half-open state, this acquires the probe."""
+        if self.shared_state is not None and now_ms < self.shared_state.get_blocked_until_ms():
+            return False
+        if self.state == CircuitBreaker.CLOSED:
+            return True
+        if self.state == CircuitBreaker.OPEN:
+            if now_ms < self.open_until_ms:
+                return False
+            self.state = CircuitBreaker.HALF_OPEN
+            self.is_probe_in_flight = False
+        if self.is_probe_in_flight:
+            return False
+        self.is_probe_in_flight = True
+        return True
+
+    def release(self):
+        """Release an acquired request without outcome, eg. because it was cancelled."""
+        self.is_probe_in_flight = False
+
+    def record_success(self, now_ms):
+        """Record a successful request."""
+        if self.state == CircuitBreaker.HALF_OPEN:
+            self._close()
+            return
+        self._record_outcome(now_ms, is_failure=False)
+
+    def record_failure(self, now_ms, retry_after_ms=None):
+        """Record a failed request, optionally with the time the target asked to wait before the next request."""
+        if retry_after_ms is not None:
+            # the target told us how long it is unavailable, so block it exactly that long
+            self._open(now_ms, retry_after_ms)
+            return
+        if self.state == CircuitBreaker.HALF_OPEN:
+            self.consecutive_openings += 1
+            self._open(now_ms, self._get_backoff_ms())
+            return
+        self._record_outcome(now_ms, is_failure=True)
+        if (
+            len(self.outcomes) >= self.minimum_requests
+            and self.failures_in_window / len(self.outcomes) >= self.failure_rate_threshold
+        ):
+            self.consecutive_openings += 1
+            self._open(now_ms, self._get_backoff_ms())
+
+    def get_unblocked_timestamp_ms(self, now_ms):
+        """Return the timestamp from which on the target accepts requests again (now if it does already)."""
+        unblocked_timestamp_ms = self.open_until_ms if self.state == CircuitBreaker.OPEN else now_ms
+        if self.shared_state is not None:
+            unblocked_timestamp_ms = max(unblocked_timestamp_ms, self.shared_state.get_blocked_until_ms())
+        return max(unblocked_timestamp_ms, now_ms)
+
+    def _record_outcome(self, now_ms, is_failure):
+        """Record the outcome of a request and evict outcomes which are outside the window."""
+        self.outcomes.append((now_ms, is_failure))
+        if is_failure:
+            self.failures_in_window += 1
+        while self.outcomes and self.outcomes[0][0] <= now_ms - self.window_ms:
+            if self.outcomes.popleft()[1]:
+                self.failures_in_window -= 1
+
+    def _get_backoff_ms(self):
+        """Return the open period for the current number of consecutive openings."""
+        return min(self.open_ms * 2 ** (self.consecutive_openings - 1), self.max_open_ms)
+
+    def _open(self, now_ms, open_ms):
+        """Open the breaker for the given time."""
+        self.state = CircuitBreaker.OPEN
+        self.open_until_ms = max(self.open_until_ms, now_ms + open_ms)
+        if self.shared_state is not None:
+            self.shared_state.block_until(self.open_until_ms)
+        self.is_probe_in_flight = False
+        self.outcomes.clear()
+        self.failures_in_window = 0
+
+    def _close(self):
+        """Close the breaker."""
+        self.state = CircuitBreaker.CLOSED
+        self.consecutive_openings = 0
+        self.is_probe_in_flight = False
+        self.outcomes.clear()
+        self.failures_in_window = 0
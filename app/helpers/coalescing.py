@@ -0,0 +1,112 @@
+"""Several methods and classes around coalescing identical requests in flight."""
+
+import asyncio
+
+import httpx
+
+from .caching import ResponseCache
+
+# response headers which are not passed on with a coalesced response, as its body is passed on decoded
+UNCOALESCED_HEADER_NAMES = frozenset(("content-length", "content-encoding", "transfer-encoding"))
+# whom the usage of a coalesced response is attributed to
+USAGE_ATTRIBUTIONS = ("each_caller", "leader")
+
+
+class CoalescedResponse:
+    """The response of a target to a request, shared with the identical requests coalesced with it."""
+
+    __slots__ = ("aoai_target", "status_code", "headers", "body")
+
+    def __init__(self, aoai_target, aoai_response):
+        """Constructor."""
+        self.aoai_target = aoai_target
+        self.status_code = aoai_response.status_code
+        self.headers = [
+            (name, value)
+            for name, value in aoai_response.headers.items()
+            if name.lower() not in UNCOALESCED_HEADER_NAMES
+        ]
+        self.body = aoai_response.content
+
+    def create_response(self):
+        """Return a new copy of the response, to be passed on to a coalesced request."""
+        return httpx.Response(self.status_code, headers=self.headers, stream=httpx.ByteStream(self.body))
+
+
+class RequestCoalescer:
+    """
+    Coalesces identical non-streaming requests in flight, so only the first of them (the leader) is sent to a target and
+    the others (the followers) get a copy of the leader's response.
+
+    Requests are identical if their deployment, path, API version and body match, with the body normalized like for the
+    response cache. Followers neither wait for the scheduler nor take capacity from a target. If the leader fails, eg.
+    with a 429 because no target has capacity, its followers fail alike. If the leader is cancelled, eg. because its
+    client disconnected, the first follower continues as leader.
+
+    The usage of a coalesced response is either attributed to each caller, as if each had sent its request to a target,
+    or only to the leader, which is the request actually sent.
+    """
+
+    def __init__(self, request_coalescing_configuration):
+        """Constructor."""
+        self.usage_attribution = request_coalescing_configuration.get("usage_attribution", "each_caller")
+        if self.usage_attribution not in USAGE_ATTRIBUTIONS:
+            raise ValueError(
+                f"Unknown usage attribution '{self.usage_attribution}' for request coalescing. Use one of: "
+                f"{', '.join(USAGE_ATTRIBUTIONS)}."
+            )
+        self.in_flight_requests = {}
+        self.metrics = {"leaders": 0, "followers": 0, "cancelled_leaders": 0}
+
+    def __len__(self):
+        """Dunder method to return the number of requests in flight which can be coalesced with."""
+        return len(self.in_flight_requests)
+
+    @property
+    def attributes_usage_to_each_caller(self):
+        """Return True if the usage of a coalesced response is attributed to each caller."""
+        return self.usage_attribution == "each_caller"
+
+    @staticmethod
+    def get_key(client, virtual_deployment, path, api_version, request_body_dict):
+        """Return the key of a request of the given client with the given deployment, path, API version and body."""
+        return ResponseCache.get_key(client, virtual_deployment, path, api_version, request_body_dict)
+
+    async def get_response(self, key, get_response_from_targets):
+        """
+        Return the responding target and the response for the request with the given key, and whether the response is
+        coalesced, ie. a copy of the response to an identical request in flight.
+
+        get_response_from_targets is awaited to send the request if there is no identical request in flight. It must
+        return the responding target and a non-streamed response, or raise if there is no response.
+        """
+        while (in_flight_request := self.in_flight_requests.get(key)) is not None:
+            # note: shielded, so a follower being cancelled does not cancel the leader's request
+            coalesced_response = await asyncio.shield(in_flight_request)
+            if isinstance(coalesced_response, Exception):
+                raise coalesced_response
+            if coalesced_response is not None:
+                self.metrics["followers"] += 1
+                return coalesced_response.aoai_target, coalesced_response.create_response(), True
+
+        in_flight_request = asyncio.get_running_loop().create_future()
+        self.in_flight_requests[key] = in_flight_request
+        self.metrics["leaders"] += 1
+        try:
+            aoai_target, aoai_response = await get_response_from_targets()
+            await aoai_response.aread()
+            in_flight_request.set_result(CoalescedResponse(aoai_target, aoai_response))
+            return aoai_target, aoai_response, False
+        except Exception as exception:
+            # note: the exception is passed as result, so it is not reported as never retrieved if there is no follower
+            in_flight_request.set_result(exception)
+            raise
+        finally:
+            if not in_flight_request.done():
+                self.metrics["cancelled_leaders"] += 1
+                in_flight_request.set_result(None)
+            del self.in_flight_requests[key]
+
+    def get_stats(self):
+        """Return statistics about the coalesced requests."""
+        return {**self.metrics, "in_flight": len(self.in_flight_requests)}
@@ -5,7 +5,7 @@ import os
 import jsonschema
 import yaml
 from jsonschema.exceptions import SchemaError, ValidationError
-from plugins.base import PowerProxyPlugin, foreach_plugin
+from plugins.base import PowerProxyPlugin, compile_plugin_hooks, foreach_plugin
 
 from .dicts import QueryDict
 
@@ -29,6 +29,7 @@ class Configuration:
             for plugin_config in self.get("plugins", [])
         ]
         foreach_plugin(self.plugins, "on_plugin_instantiated")
+        self.plugin_hooks = compile_plugin_hooks(self.plugins)
 
     @staticmethod
     def validate_from_file(config_file, config_schema_file="config.schema.json"):
@@ -0,0 +1,319 @@
+"""Several methods and classes around the connections to Azure OpenAI endpoints."""
+
+import asyncio
+import time
+import urllib.request
+from collections import deque
+
+import httpx
+
+
+class Http2ConnectionPool(httpx.AsyncBaseTransport):
+    """
+    Transport multiplexing requests as streams over a few HTTP/2 connections.
+
+    httpx sends all requests to an origin over the first HTTP/2 connection and queues requests exceeding the server's
+    stream limit on that connection. Instead, this pool spreads the requests over up to max_connections connections,
+    each carrying at most max_streams_per_connection concurrent streams. A new connection is opened only once all
+    connections are saturated, and requests are queued only if no more connections may be opened.
+    """
+
+    def __init__(
+        self, max_connections=10, max_streams_per_connection=100, keepalive_expiry=5.0, verify=True, proxy=None
+    ):
+        """Constructor."""
+        self.max_connections = max_connections
+        self.max_streams_per_connection = max_streams_per_connection
+        self.keepalive_expiry = keepalive_expiry
+        self.verify = verify
+        self.proxy = proxy
+        self.connections = []
+        self.waiters = deque()
+        self.metrics = {"requests": 0, "queued": 0, "timed_out": 0, "peak_streams": 0}
+
+    async def handle_async_request(self, request):
+        """Send the given request over the first opened connection with a free stream."""
+        connection = await self._acquire_stream(request)
+        try:
+            response = await connection.transport.handle_async_request(request)
+        except BaseException:
+            self._release_stream(connection)
+            raise
+        response.stream = StreamReleasingStream(response.stream, self, connection)
+        return response
+
+    async def _acquire_stream(self, request):
+        """Return a connection with a free stream for the given request, waiting for one if needed."""
+        self.metrics["requests"] += 1
+        for connection in self.connections:
+            if connection.active_streams < self.max_streams_per_connection:
+                break
+        else:
+            if len(self.connections) < self.max_connections:
+                connection = MultiplexedConnection(self)
+                self.connections.append(connection)
+            else:
+                # all connections are saturated, wait until a stream is released
+                # note: the stream is handed over by _release_stream() directly
+                waiter = asyncio.get_running_loop().create_future()
+                self.waiters.append(waiter)
+                self.metrics["queued"] += 1
+                try:
+                    return await asyncio.wait_for(waiter, timeout=request.extensions.get("timeout", {}).get("pool"))
+                except asyncio.TimeoutError as exception:
+                    self.metrics["timed_out"] += 1
+                    raise httpx.PoolTimeout(
+                        f"No free HTTP/2 stream on {self.max_connections} connection(s) with "
+                        f"{self.max_streams_per_connection} stream(s) each."
+                    ) from exception
+                except asyncio.CancelledError:
+                    if waiter.done() and not waiter.cancelled():
+                        self._release_stream(waiter.result())
+                    raise
+        connection.active_streams += 1
+        self.metrics["peak_streams"] = max(self.metrics["peak_streams"], self.get_active_streams())
+        return connection
+
+    def _release_stream(self, connection):
+        """Release a stream of the given connection, handing it over to the next waiting request, if any."""
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(connection)
+                return
+        connection.active_streams -= 1
+
+    async def open_connections(self, number_of_connections, build_ping_request):
+        """Open the given number of connections (at most max_connections) or keep them open, by pinging each."""
+        while len(self.connections) < min(number_of_connections, self.max_connections):
+            self.connections.append(MultiplexedConnection(self))
+        results = await asyncio.gather(
+            *[connection.ping(build_ping_request()) for connection in self.connections[:number_of_connections]],
+            return_exceptions=True,
+        )
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+
+    def get_active_streams(self):
+        """Return the number of streams currently in use."""
+        return sum(connection.active_streams for connection in self.connections)
+
+    def get_stats(self):
+        """Return statistics about the pool, eg. for monitoring."""
+        return {
+            "http2": True,
+            "connections": sum(connection.get_number_of_open_connections() for connection in self.connections),
+            "max_connections": self.max_connections,
+            "max_streams_per_connection": self.max_streams_per_connection,
+            "active_streams": self.get_active_streams(),
+            "active_streams_per_connection": [connection.active_streams for connection in self.connections],
+            "queued_requests": sum(1 for waiter in self.waiters if not waiter.done()),
+            **self.metrics,
+        }
+
+    async def aclose(self):
+        """Close all connections."""
+        for connection in self.connections:
+            await connection.transport.aclose()
+
+
+class MultiplexedConnection:
+    """
+    A connection of an Http2ConnectionPool, carrying multiple streams.
+
+    Uses an httpx transport of its own, which keeps a single HTTP/2 connection open. If the server does not support
+    HTTP/2, the transport falls back to HTTP/1.1 with a connection per stream.
+    """
+
+    __slots__ = ("transport", "active_streams")
+
+    def __init__(self, pool):
+        """Constructor."""
+        self.transport = httpx.AsyncHTTPTransport(
+            http2=True,
+            verify=pool.verify,
+            proxy=pool.proxy,
+            limits=httpx.Limits(
+                max_connections=pool.max_streams_per_connection,
+                max_keepalive_connections=pool.max_streams_per_connection,
+                keepalive_expiry=pool.keepalive_expiry,
+            ),
+        )
+        self.active_streams = 0
+
+    async def ping(self, request):
+        """Send the given (lightweight) request, to open the connection or to keep it open."""
+        # note: pings are not counted as streams, so they never delay requests waiting for a free stream
+        response = await self.transport.handle_async_request(request)
+        await response.aclose()
+
+    def get_number_of_open_connections(self):
+        """Return the number of network connections currently open."""
+        return count_open_connections(self.transport)
+
+
+class StreamReleasingStream(httpx.AsyncByteStream):
+    """Wraps a response stream to release its HTTP/2 stream in the pool when the response is closed."""
+
+    def __init__(self, stream, pool, connection):
+        """Constructor."""
+        self.stream = stream
+        self.pool = pool
+        self.connection = connection
+
+    async def __aiter__(self):
+        """Dunder method to iterate over the wrapped stream."""
+        async for chunk in self.stream:
+            yield chunk
+
+    async def aclose(self):
+        """Close the wrapped stream and release the HTTP/2 stream."""
+        if self.connection is not None:
+            self.pool._release_stream(self.connection)  # pylint: disable=protected-access
+            self.connection = None
+        await self.stream.aclose()
+
+
+class ConnectionWarmer:
+    """
+    Opens connections to an endpoint ahead of requests and keeps a minimum of them warm.
+
+    At start, opens the given number of connections by sending concurrent HEAD requests to the endpoint. Afterwards,
+    pings every keepalive_interval seconds as many connections as needed to keep min_warm_connections open during idle
+    times, so they are not closed after the keepalive expiry and re-handshaked on the next request. Any response counts,
+    as only the connection matters.
+    """
+
+    def __init__(self, endpoint_client, connections, min_warm_connections, keepalive_interval):
+        """Constructor."""
+        self.endpoint_client = endpoint_client
+        self.connections = connections
+        self.min_warm_connections = min_warm_connections
+        self.keepalive_interval = keepalive_interval
+        self.is_warm = False
+        self.task = None
+        self.keeping_warm = None
+        self.metrics = {"warm_up_ms": None, "pings": 0, "failed_pings": 0, "last_error": None}
+
+    def start(self):
+        """Start warming up in the background, followed by keeping connections warm."""
+        self.task = asyncio.create_task(self._run())
+
+    async def close(self):
+        """Stop keeping connections warm."""
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+        if self.keeping_warm is not None:
+            await asyncio.gather(self.keeping_warm, return_exceptions=True)
+
+    async def warm_up(self):
+        """Open the configured number of connections."""
+        start_time = time.perf_counter()
+        await self.open_connections(self.connections)
+        self.metrics["warm_up_ms"] = (time.perf_counter() - start_time) * 1_000
+        # note: the endpoint counts as warm also if warming up failed, so a single unavailable endpoint does not keep
+        #       the whole proxy from becoming ready
+        self.is_warm = True
+
+    async def keep_warm(self):
+        """Ping connections, so at least min_warm_connections stay open."""
+        if isinstance(self._get_transport(), Http2ConnectionPool):
+            await self.open_connections(self.min_warm_connections)
+            return
+        # note: connections busy with requests are kept open by the requests, so only as many pings are sent as there
+        #       are connections missing to min_warm_connections. the pings are sent concurrently, so the transport
+        #       sends each over an idle connection of its own or opens a new connection.
+        await self.open_connections(
+            self.min_warm_connections - count_open_connections(self._get_transport(), only_active=True)
+        )
+
+    async def open_connections(self, number_of_connections):
+        """Open the given number of connections or keep them open, by pinging them concurrently."""
+        if number_of_connections <= 0:
+            return
+        transport = self._get_transport()
+        try:
+            if isinstance(transport, Http2ConnectionPool):
+                self.metrics["pings"] += min(number_of_connections, transport.max_connections)
+                await transport.open_connections(number_of_connections, self._build_ping_request)
+            else:
+                self.metrics["pings"] += number_of_connections
+                # note: concurrent requests make the transport use a connection of its own for each request
+                await asyncio.gather(*[self.endpoint_client.head("/") for _ in range(number_of_connections)])
+        except httpx.HTTPError as exception:
+            self.metrics["failed_pings"] += 1
+            self.metrics["last_error"] = f"{type(exception).__name__}: {exception}"
+            print(f"Could not open connections to {self.endpoint_client.base_url}: {self.metrics['last_error']}")
+
+    def get_stats(self):
+        """Return statistics about warming up and keeping connections warm."""
+        return {
+            "is_warm": self.is_warm,
+            "connections": self.connections,
+            "min_warm_connections": self.min_warm_connections,
+            **self.metrics,
+        }
+
+    def _get_transport(self):
+        """Return the transport of the endpoint client, if it can be found."""
+        # note: httpx does not expose the transport of a client, so a client without one is treated like a client using
+        #       the default transport
+        return getattr(self.endpoint_client, "_transport", None)
+
+    def _build_ping_request(self):
+        """Return a new lightweight request to ping a connection with."""
+        return self.endpoint_client.build_request("HEAD", "/")
+
+    async def _run(self):
+        """Warm up, then keep connections warm until cancelled."""
+        await self.warm_up()
+        while True:
+            await asyncio.sleep(self.keepalive_interval)
+            # note: pings are not cancelled half-way, as this would close the connections they were sent over
+            self.keeping_warm = asyncio.ensure_future(self.keep_warm())
+            await asyncio.shield(self.keeping_warm)
+
+
+def get_proxy_url(url):
+    """
+    Return the proxy to send requests to the given URL through, as configured by the environment variables (eg.
+    HTTPS_PROXY, ALL_PROXY and NO_PROXY), or None if requests are sent to the URL directly.
+    """
+    # note: httpx clients take the proxy from the environment, but only for their default transport
+    url = httpx.URL(url)
+    proxies = urllib.request.getproxies()
+    proxy_url = proxies.get(url.scheme) or proxies.get("all")
+    if not proxy_url or urllib.request.proxy_bypass(url.host):
+        return None
+    return proxy_url
+
+
+def get_connection_stats(endpoint_client):
+    """Return statistics about the connections of the given endpoint client."""
+    transport = getattr(endpoint_client, "_transport", None)
+    if isinstance(transport, Http2ConnectionPool):
+        return transport.get_stats()
+    if isinstance(transport, httpx.AsyncHTTPTransport):
+        return {
+            "http2": False,
+            "connections": count_open_connections(transport),
+            "max_connections": getattr(getattr(transport, "_pool", None), "_max_connections", None),
+            "active_connections": count_open_connections(transport, only_active=True),
+        }
+    return {}
+
+
+def count_open_connections(transport, only_active=False):
+    """
+    Return the number of network connections currently open by the given transport, optionally only active ones, or 0
+    if they cannot be found.
+    """
+    # note: httpx does not expose its connection pool, but the pool's connections are public in httpcore
+    connection_pool = getattr(transport, "_pool", None)
+    return sum(
+        1
+        for connection in getattr(connection_pool, "connections", ())
+        if not connection.is_closed() and not (only_active and connection.is_idle())
+    )
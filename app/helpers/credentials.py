@@ -0,0 +1,123 @@
+"""Several methods and classes around acquiring access tokens for Azure OpenAI."""
+
+import asyncio
+import inspect
+import time
+
+COGNITIVE_SERVICES_SCOPE = "https://cognitiveservices.azure.com/.default"
+
+
+class AsyncTokenProvider:
+    """
+    Provides access tokens from a credential without blocking the event loop.
+
+    Tokens are cached per scope and refreshed in the background before they expire. Concurrent callers needing a token
+    for the same scope share a single refresh (single-flight) instead of each calling the credential.
+
+    The credential can be any object with a get_token(scope) method returning an object with 'token' and 'expires_on'
+    attributes, like the credentials from azure.identity. Synchronous credentials are run in a worker thread,
+    credentials with an async get_token method are awaited directly.
+    """
+
+    def __init__(self, credential, refresh_margin_seconds=300, clock=time.time):
+        """Constructor."""
+        self.credential = credential
+        self.refresh_margin_seconds = refresh_margin_seconds
+        self.clock = clock
+        self._tokens = {}
+        self._refresh_tasks = {}
+        self._scheduled_refresh_tasks = {}
+        self._is_credential_async = inspect.iscoroutinefunction(credential.get_token)
+        self.metrics = {
+            "cache_hits": 0,
+            "cache_misses": 0,
+            "refreshes": 0,
+            "background_refreshes": 0,
+            "refresh_failures": 0,
+            "refresh_latency_ms_total": 0.0,
+            "last_refresh_latency_ms": None,
+        }
+
+    async def get_token(self, scope=COGNITIVE_SERVICES_SCOPE):
+        """Return a valid access token for the given scope."""
+        access_token, refresh_at = self._tokens.get(scope, (None, None))
+        now = self.clock()
+        if access_token is not None and access_token.expires_on > now:
+            self.metrics["cache_hits"] += 1
+            # refresh in the background if the token expires soon, but keep serving the cached token meanwhile
+            if now >= refresh_at:
+                self._get_or_start_refresh(scope, is_background_refresh=True)
+            return access_token.token
+
+        # no (valid) token in cache, so wait for the refresh
+        # note: the refresh is shielded so a cancelled request does not cancel the refresh shared with others
+        self.metrics["cache_misses"] += 1
+        access_token = await asyncio.shield(self._get_or_start_refresh(scope))
+        return access_token.token
+
+    def prefetch(self, scope=COGNITIVE_SERVICES_SCOPE):
+        """Start fetching a token for the given scope in the background, eg. at startup."""
+        self._get_or_start_refresh(scope, is_background_refresh=True)
+
+    async def close(self):
+        """Cancel all pending refreshes."""
+        for task in [*self._refresh_tasks.values(), *self._scheduled_refresh_tasks.values()]:
+            task.cancel()
+        self._refresh_tasks.clear()
+        self._scheduled_refresh_tasks.clear()
+
+    def _get_or_start_refresh(self, scope, is_background_refresh=False):
+        """Return the running refresh task for the given scope or start a new one."""
+        refresh_task = self._refresh_tasks.get(scope)
+        if refresh_task is None:
+            if is_background_refresh:
+                self.metrics["background_refreshes"] += 1
+            refresh_task = asyncio.create_task(self._refresh(scope))
+            refresh_task.add_done_callback(AsyncTokenProvider._consume_exception)
+            self._refresh_tasks[scope] = refresh_task
+        return refresh_task
+
+    async def _refresh(self, scope):
+        """Get a new token for the given scope from the credential and cache it."""
+        start_time = time.perf_counter()
+        try:
+            if self._is_credential_async:
+                access_token = await self.credential.get_token(scope)
+            else:
+                access_token = await asyncio.to_thread(self.credential.get_token, scope)
+        except Exception:
+            self.metrics["refresh_failures"] += 1
+            raise
+        finally:
+            refresh_latency_ms = (time.perf_counter() - start_time) * 1_000
+            self.metrics["refreshes"] += 1
+            self.metrics["refresh_latency_ms_total"] += refresh_latency_ms
+            self.metrics["last_refresh_latency_ms"] = refresh_latency_ms
+            self._refresh_tasks.pop(scope, None)
+        # refresh ahead of expiry, but at the latest after half of the token's lifetime to avoid refreshing tokens
+        # with short lifetimes over and over again
+        now = self.clock()
+        refresh_at = access_token.expires_on - min(self.refresh_margin_seconds, (access_token.expires_on - now) / 2)
+        self._tokens[scope] = (access_token, refresh_at)
+        self._schedule_refresh(scope, refresh_at - now)
+        return access_token
+
+    def _schedule_refresh(self, scope, seconds_until_refresh):
+        """Schedule a background refresh in the given number of seconds."""
+        scheduled_refresh_task = self._scheduled_refresh_tasks.pop(scope, None)
+        if scheduled_refresh_task is not None:
+            scheduled_refresh_task.cancel()
+        if seconds_until_refresh <= 0:
+            return
+
+        async def refresh_later():
+            await asyncio.sleep(seconds_until_refresh)
+            self._get_or_start_refresh(scope, is_background_refresh=True)
+
+        self._scheduled_refresh_tasks[scope] = asyncio.create_task(refresh_later())
+
+    @staticmethod
+    def _consume_exception(task):
+        """Log the exception of a failed refresh task, so it is not reported as never retrieved."""
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Could not refresh access token: {task.exception()}")
@@ -0,0 +1,82 @@
+"""Several methods around the inputs and embeddings of embeddings requests."""
+
+import base64
+from array import array
+
+
+def is_embeddings_request(path):
+    """Return True if a request with the given path requests embeddings."""
+    return path.endswith("embeddings")
+
+
+def get_inputs(request_body_dict):
+    """
+    Return the inputs of the given embeddings request as list, or None if the request has no valid input.
+
+    An input is either a string or a list of tokens. The request's input is either a single input or a list of inputs.
+    """
+    if not isinstance(request_body_dict, dict):
+        return None
+    request_input = request_body_dict.get("input")
+    if isinstance(request_input, str):
+        return [request_input]
+    if not isinstance(request_input, list) or not request_input:
+        return None
+    if all(isinstance(token, int) for token in request_input):
+        return [request_input]
+    if all(isinstance(single_input, (str, list)) for single_input in request_input):
+        return request_input
+    return None
+
+
+def estimate_input_tokens(single_input):
+    """Return the estimated number of tokens of the given input (approx. 4 characters per token for strings)."""
+    if isinstance(single_input, list):
+        return len(single_input)
+    return max(len(single_input) // 4, 1)
+
+
+def split_tokens(tokens, weights):
+    """Return the given number of tokens split proportionally to the given weights, as integers summing up to tokens."""
+    total_weight = sum(weights)
+    if total_weight == 0:
+        return [0] * len(weights)
+    # note: rounding the cumulative shares, so the rounding errors do not add up
+    split = []
+    cumulative_weight = 0
+    previous_cumulative_tokens = 0
+    for weight in weights:
+        cumulative_weight += weight
+        cumulative_tokens = round(tokens * cumulative_weight / total_weight)
+        split.append(cumulative_tokens - previous_cumulative_tokens)
+        previous_cumulative_tokens = cumulative_tokens
+    return split
+
+
+def encode_embedding(embedding):
+    """Return the given embedding from a response (list of floats or base64 string) as float32 bytes."""
+    if isinstance(embedding, str):
+        return base64.b64decode(embedding)
+    return array("f", embedding).tobytes()
+
+
+def decode_embedding(embedding_bytes, encoding_format):
+    """Return the given float32 bytes as embedding in the given encoding format, as in a response."""
+    if encoding_format == "base64":
+        return base64.b64encode(embedding_bytes).decode()
+    embedding = array("f")
+    embedding.frombytes(embedding_bytes)
+    return embedding.tolist()
+
+
+def create_embeddings_response_body_dict(embeddings_bytes, encoding_format, model, prompt_tokens):
+    """Return the body of a response with the given embeddings (as float32 bytes, in order of the inputs)."""
+    return {
+        "object": "list",
+        "data": [
+            {"object": "embedding", "index": index, "embedding": decode_embedding(embedding_bytes, encoding_format)}
+            for index, embedding_bytes in enumerate(embeddings_bytes)
+        ],
+        "model": model,
+        "usage": {"prompt_tokens": prompt_tokens, "total_tokens": prompt_tokens},
+    }
@@ -0,0 +1,126 @@
+"""Several methods and classes around hedging requests across targets to reduce tail latencies."""
+
+import asyncio
+import time
+from collections import deque
+
+HEDGEABLE_PATH_ENDINGS = ("/chat/completions", "/completions", "/embeddings")
+
+
+class HedgingPolicy:
+    """
+    Hedging settings and live measurements for a virtual deployment.
+
+    If the first target has not returned headers within a delay derived from a percentile of recently observed
+    latencies, the request is additionally sent to the next eligible target and the first usable response wins. The
+    share of hedged requests is capped, so hedging cannot multiply the tokens consumed.
+    """
+
+    def __init__(self, virtual_deployment, hedging_configuration):
+        """Constructor."""
+        self.virtual_deployment = virtual_deployment
+        self.delay_percentile = float(hedging_configuration.get("delay_percentile", 95))
+        self.initial_delay_ms = float(hedging_configuration.get("initial_delay_ms", 2_000))
+        self.min_delay_ms = float(hedging_configuration.get("min_delay_ms", 100))
+        self.max_hedge_rate = float(hedging_configuration.get("max_hedge_rate", 0.1))
+        self.min_samples = int(hedging_configuration.get("min_samples", 20))
+        self.latencies_ms = deque(maxlen=int(hedging_configuration.get("window_size", 200)))
+        self.rate_window_seconds = 60
+        self.rate_window_start = time.monotonic()
+        self.requests_in_rate_window = 0
+        self.hedges_in_rate_window = 0
+        self.metrics = {"requests": 0, "hedges_fired": 0, "hedges_won": 0}
+
+    @staticmethod
+    def applies_to(path, is_non_streaming_response_requested):
+        """Return True if requests with the given path and streaming mode can be hedged."""
+        return bool(is_non_streaming_response_requested) and path.endswith(HEDGEABLE_PATH_ENDINGS)
+
+    def get_delay_seconds(self):
+        """Return the time to wait for the first target before a hedged request is sent."""
+        if len(self.latencies_ms) < self.min_samples:
+            return self.initial_delay_ms / 1_000
+        sorted_latencies_ms = sorted(self.latencies_ms)
+        index = min(int(len(sorted_latencies_ms) * self.delay_percentile / 100), len(sorted_latencies_ms) - 1)
+        return max(sorted_latencies_ms[index], self.min_delay_ms) / 1_000
+
+    def record_latency(self, latency_ms):
+        """Record the time it took a target to return headers."""
+        self.latencies_ms.append(latency_ms)
+
+    def record_request(self):
+        """Record a new request which might be hedged."""
+        self.metrics["requests"] += 1
+        now = time.monotonic()
+        if now - self.rate_window_start >= self.rate_window_seconds:
+            self.rate_window_start = now
+            self.requests_in_rate_window = 0
+            self.hedges_in_rate_window = 0
+        self.requests_in_rate_window += 1
+
+    def is_hedge_allowed(self):
+        """Return True if another hedged request stays within the maximum hedge rate."""
+        return self.hedges_in_rate_window + 1 <= self.max_hedge_rate * self.requests_in_rate_window
+
+    def record_hedge(self):
+        """Record a hedged request which has been fired."""
+        self.hedges_in_rate_window += 1
+        self.metrics["hedges_fired"] += 1
+
+
+async def send_hedged(hedging_policy, first_target, next_targets, send, check_response):
+    """
+    Send a request to the first target and, if needed, a hedged request to the next target from next_targets.
+
+    'send' is a coroutine function sending the request to a given target and returning the response, 'check_response'
+    is a coroutine function returning True if a target's response can be passed on to the client. Returns a tuple of
+    target, response and whether the response is usable. If no response is usable, the last unusable response is
+    returned, others are closed. Exceptions are only raised if no target returned a response at all.
+
+    The client's request must have been recorded at the hedging policy before, once even if sent with failovers.
+    """
+
+    async def send_timed(aoai_target):
+        start_time = time.perf_counter()
+        response = await send(aoai_target)
+        return response, (time.perf_counter() - start_time) * 1_000
+
+    pending = {asyncio.create_task(send_timed(first_target)): first_target}
+    hedge_task = None
+    last_target, last_response, last_exception = first_target, None, None
+    try:
+        done, _ = await asyncio.wait(pending, timeout=hedging_policy.get_delay_seconds())
+        if not done and hedging_policy.is_hedge_allowed():
+            hedge_target = next(next_targets, None)
+            if hedge_target is not None:
+                hedging_policy.record_hedge()
+                hedge_task = asyncio.create_task(send_timed(hedge_target))
+                pending[hedge_task] = hedge_target
+
+        while pending:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                aoai_target = pending.pop(task)
+                if task.exception() is not None:
+                    last_exception = task.exception()
+                    continue
+                response, latency_ms = task.result()
+                if await check_response(aoai_target, response):
+                    hedging_policy.record_latency(latency_ms)
+                    if task is hedge_task:
+                        hedging_policy.metrics["hedges_won"] += 1
+                    return aoai_target, response, True
+                if last_response is not None:
+                    await last_response.aclose()
+                last_target, last_response = aoai_target, response
+
+        if last_response is None and last_exception is not None:
+            raise last_exception
+        return last_target, last_response, False
+    finally:
+        # cancel the losing request, or close its response if it has completed meanwhile
+        for task in pending:
+            if task.done() and not task.cancelled() and task.exception() is None:
+                await task.result()[0].aclose()
+            else:
+                task.cancel()
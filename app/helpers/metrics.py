@@ -0,0 +1,379 @@
+"""Several methods and classes around metrics, aggregated across the worker processes on a host."""
+
+import asyncio
+import bisect
+import glob
+import json
+import os
+import re
+import time
+
+from .shared_state import SharedTargetStateTable, get_fingerprint, is_process_alive
+
+# media type of the Prometheus text exposition format
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# upper bounds of the histogram buckets for the latency of targets, in seconds
+LATENCY_BUCKETS = (0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+# upper bounds of the histogram buckets for the overhead of PowerProxy, in seconds
+OVERHEAD_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+# tokens reported in the usage of a response, in the format of the chat/completions/embeddings and the responses API
+PROMPT_TOKENS_REGEX = re.compile(rb'"(?:prompt|input)_tokens"\s*:\s*(\d+)')
+COMPLETION_TOKENS_REGEX = re.compile(rb'"(?:completion|output)_tokens"\s*:\s*(\d+)')
+# bytes after the '"usage"' key searched for the tokens, enough for the usage including its details
+USAGE_WINDOW_BYTES = 1_024
+
+
+class MetricDefinition:
+    """Definition of a metric: its name, type, help text and label names, plus the buckets of a histogram."""
+
+    __slots__ = ("name", "type", "help", "label_names", "buckets", "aggregation")
+
+    def __init__(self, name, metric_type, help_text, label_names=(), buckets=None, aggregation="sum"):
+        """Constructor."""
+        self.name = name
+        self.type = metric_type
+        self.help = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        # note: values of the workers are added up, except for gauges telling a state, which take the maximum
+        self.aggregation = aggregation
+
+
+METRIC_DEFINITIONS = (
+    MetricDefinition(
+        "powerproxy_requests_total",
+        "counter",
+        "Requests answered, by client, deployment, responding target (empty if none, eg. for a cached response) and "
+        "status code.",
+        ("client", "deployment", "target", "status"),
+    ),
+    MetricDefinition(
+        "powerproxy_upstream_requests_total",
+        "counter",
+        "Requests sent to targets, by target and status code of the response (or the error if there was none).",
+        ("target", "status"),
+    ),
+    MetricDefinition(
+        "powerproxy_upstream_latency_seconds",
+        "histogram",
+        "Time until the response headers of a target arrived.",
+        ("target",),
+        buckets=LATENCY_BUCKETS,
+    ),
+    MetricDefinition(
+        "powerproxy_overhead_seconds",
+        "histogram",
+        "Time spent in PowerProxy per request until the response is passed on, excluding the time waiting for targets "
+        "and for capacity.",
+        buckets=OVERHEAD_BUCKETS,
+    ),
+    MetricDefinition(
+        "powerproxy_tokens_total",
+        "counter",
+        "Tokens used by the requests answered by targets, by client, deployment and type (prompt or completion).",
+        ("client", "deployment", "type"),
+    ),
+    MetricDefinition(
+        "powerproxy_failovers_total",
+        "counter",
+        "Requests sent to another target because the previous target failed or throttled, by deployment.",
+        ("deployment",),
+    ),
+    MetricDefinition(
+        "powerproxy_hedging_requests_total",
+        "counter",
+        "Requests which might have been hedged, by deployment.",
+        ("deployment",),
+    ),
+    MetricDefinition(
+        "powerproxy_hedges_fired_total",
+        "counter",
+        "Hedged requests sent to another target because the first target was slow, by deployment.",
+        ("deployment",),
+    ),
+    MetricDefinition(
+        "powerproxy_hedges_won_total",
+        "counter",
+        "Hedged requests whose response was passed on instead of the first target's, by deployment.",
+        ("deployment",),
+    ),
+    MetricDefinition(
+        "powerproxy_streams_in_flight",
+        "gauge",
+        "Event streams currently relayed from targets to clients, by deployment.",
+        ("deployment",),
+    ),
+    MetricDefinition(
+        "powerproxy_target_blocked",
+        "gauge",
+        "1 if the target is blocked, eg. after a 429 or by its circuit breaker, otherwise 0.",
+        ("target",),
+        aggregation="max",
+    ),
+    MetricDefinition(
+        "powerproxy_target_requests_in_flight",
+        "gauge",
+        "Requests sent to the target which have not been answered completely yet.",
+        ("target",),
+    ),
+    MetricDefinition(
+        "powerproxy_access_token_requests_total",
+        "counter",
+        "Entra ID access tokens requested for targets without key, by whether they were cached (hit or miss).",
+        ("cache",),
+    ),
+    MetricDefinition(
+        "powerproxy_access_token_refreshes_total",
+        "counter",
+        "Access tokens fetched from the credential, by outcome (success or failure).",
+        ("outcome",),
+    ),
+    MetricDefinition(
+        "powerproxy_access_token_refresh_seconds_total",
+        "counter",
+        "Time spent fetching access tokens from the credential.",
+    ),
+    MetricDefinition(
+        "powerproxy_upstream_connections",
+        "gauge",
+        "Connections currently open to the endpoint.",
+        ("endpoint",),
+    ),
+    MetricDefinition(
+        "powerproxy_upstream_pool_in_use",
+        "gauge",
+        "Connections (HTTP/1.1) or streams (HTTP/2) to the endpoint currently in use by requests.",
+        ("endpoint",),
+    ),
+    MetricDefinition(
+        "powerproxy_upstream_pool_capacity",
+        "gauge",
+        "Maximum number of connections (HTTP/1.1) or streams (HTTP/2) to the endpoint.",
+        ("endpoint",),
+    ),
+    MetricDefinition(
+        "powerproxy_upstream_pool_queued",
+        "gauge",
+        "Requests waiting for a free stream to the endpoint (HTTP/2 only).",
+        ("endpoint",),
+    ),
+)
+
+
+class Metrics:
+    """
+    Counters, gauges and histograms of PowerProxy, rendered in the Prometheus text format.
+
+    Recording a value only updates a dict of this worker, so the hot path needs neither a lock nor I/O. To aggregate
+    across the worker processes on a host, every worker periodically writes a snapshot of its values into a file of its
+    own (replacing the file atomically), and the worker answering a scrape combines its current values with the latest
+    snapshots of the other workers. Snapshots of workers which have exited are removed, so Prometheus sees their
+    counters like those of a restarted process. The file names are derived from the target names, so proxies with
+    different configurations on the same host do not mix their metrics.
+
+    Values kept elsewhere, eg. gauges or the counters of other components, are collected by the given function right
+    before a snapshot is written or the metrics are rendered.
+    """
+
+    def __init__(self, metrics_configuration, target_names, collect=None):
+        """Constructor."""
+        self.definitions = {definition.name: definition for definition in METRIC_DEFINITIONS}
+        # note: values by metric name and label values. the value of a histogram is a list with the count per bucket
+        #       (including the +Inf bucket), followed by the sum of the values observed.
+        self.values = {name: {} for name in self.definitions}
+        self.collect = collect
+        self.flush_interval_ms = int(metrics_configuration.get("flush_interval_ms", 1_000))
+        # note: other platforms lack a safe way to check if a worker has exited, so the metrics stay per worker there
+        self.is_aggregated_across_workers = SharedTargetStateTable.is_supported()
+        directory = metrics_configuration.get("directory") or SharedTargetStateTable.get_default_directory()
+        self.path_prefix = os.path.join(directory, f"powerproxy-metrics-{get_fingerprint(target_names)}-")
+        self.path = f"{self.path_prefix}{os.getpid()}.json"
+        self.task = None
+
+    def increment(self, name, label_values=(), value=1):
+        """Add the given value to the counter or gauge with the given name and label values."""
+        series = self.values[name]
+        series[label_values] = series.get(label_values, 0) + value
+
+    def set(self, name, label_values, value):
+        """Set the gauge with the given name and label values to the given value."""
+        self.values[name][label_values] = value
+
+    def observe(self, name, label_values, value):
+        """Record the given value in the histogram with the given name and label values."""
+        series = self.values[name]
+        counts = series.get(label_values)
+        if counts is None:
+            counts = series[label_values] = [0] * (len(self.definitions[name].buckets) + 2)
+        # note: buckets are "less than or equal", so a value on a bucket's upper bound falls into that bucket
+        counts[bisect.bisect_left(self.definitions[name].buckets, value)] += 1
+        counts[-1] += value
+
+    def start(self):
+        """Start writing snapshots in the background, if the metrics are aggregated across workers."""
+        if self.is_aggregated_across_workers:
+            self.task = asyncio.create_task(self._run())
+
+    async def close(self):
+        """Stop writing snapshots and remove this worker's snapshot."""
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+    def flush(self):
+        """Write a snapshot of this worker's values, replacing the previous one atomically."""
+        if self.collect is not None:
+            self.collect(self)
+        snapshot = {
+            name: [[list(label_values), value] for label_values, value in series.items()]
+            for name, series in self.values.items()
+            if series
+        }
+        temporary_path = f"{self.path}.tmp"
+        with open(temporary_path, "w", encoding="utf-8") as file:
+            json.dump(snapshot, file, separators=(",", ":"))
+        os.replace(temporary_path, self.path)
+
+    def get_aggregated_values(self):
+        """Return this worker's current values combined with the latest snapshots of the other workers."""
+        if self.collect is not None:
+            self.collect(self)
+        aggregated_values = {
+            name: {
+                label_values: list(value) if isinstance(value, list) else value
+                for label_values, value in series.items()
+            }
+            for name, series in self.values.items()
+        }
+        if not self.is_aggregated_across_workers:
+            return aggregated_values
+        for path in glob.glob(f"{glob.escape(self.path_prefix)}*.json"):
+            pid = path[len(self.path_prefix) : -len(".json")]
+            if not pid.isdigit() or int(pid) == os.getpid():
+                continue
+            if not is_process_alive(int(pid)):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                continue
+            try:
+                with open(path, encoding="utf-8") as file:
+                    snapshot = json.load(file)
+            except (OSError, ValueError):
+                # note: the snapshot may have been removed meanwhile, eg. because its worker exited
+                continue
+            for name, series in snapshot.items():
+                if name in self.definitions:
+                    Metrics._merge_series(self.definitions[name], aggregated_values[name], series)
+        return aggregated_values
+
+    def render(self):
+        """Return the metrics of all workers in the Prometheus text format."""
+        lines = []
+        for name, series in self.get_aggregated_values().items():
+            definition = self.definitions[name]
+            lines.append(f"# HELP {name} {definition.help}")
+            lines.append(f"# TYPE {name} {definition.type}")
+            for label_values, value in sorted(series.items()):
+                labels = [
+                    f'{label_name}="{escape_label_value(label_value)}"'
+                    for label_name, label_value in zip(definition.label_names, label_values)
+                ]
+                if definition.type != "histogram":
+                    lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+                    continue
+                cumulative_count = 0
+                for upper_bound, count in zip(definition.buckets + ("+Inf",), value[:-1]):
+                    cumulative_count += count
+                    bucket_labels = labels + [f'le="{upper_bound}"']
+                    lines.append(f"{name}_bucket{format_labels(bucket_labels)} {cumulative_count}")
+                lines.append(f"{name}_sum{format_labels(labels)} {format_value(value[-1])}")
+                lines.append(f"{name}_count{format_labels(labels)} {cumulative_count}")
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _merge_series(definition, aggregated_series, series):
+        """Merge the given series from a snapshot into the given aggregated series."""
+        for label_values, value in series:
+            label_values = tuple(label_values)
+            aggregated_value = aggregated_series.get(label_values)
+            if aggregated_value is None:
+                aggregated_series[label_values] = value
+            elif definition.type == "histogram":
+                aggregated_series[label_values] = [a + b for a, b in zip(aggregated_value, value)]
+            elif definition.aggregation == "max":
+                aggregated_series[label_values] = max(aggregated_value, value)
+            else:
+                aggregated_series[label_values] = aggregated_value + value
+
+    async def _run(self):
+        """Write snapshots periodically until cancelled."""
+        while True:
+            await asyncio.sleep(self.flush_interval_ms / 1_000)
+            try:
+                self.flush()
+            except OSError as exception:
+                print(f"Could not write metrics snapshot to {self.path}: {type(exception).__name__}: {exception}")
+
+
+class RequestTimer:
+    """Measures the time PowerProxy spends on a request, excluding the time waiting for targets."""
+
+    __slots__ = ("start_time", "waiting_start_time", "waiting_time")
+
+    def __init__(self):
+        """Constructor."""
+        self.start_time = time.perf_counter()
+        self.waiting_start_time = None
+        self.waiting_time = 0.0
+
+    def start_waiting(self):
+        """Start waiting for targets."""
+        self.waiting_start_time = time.perf_counter()
+
+    def stop_waiting(self):
+        """Stop waiting for targets."""
+        self.waiting_time += time.perf_counter() - self.waiting_start_time
+
+    def get_overhead_seconds(self):
+        """Return the time spent on the request so far, excluding the time waiting for targets."""
+        return max(time.perf_counter() - self.start_time - self.waiting_time, 0.0)
+
+
+def get_usage_tokens(body):
+    """
+    Return the prompt and completion tokens of the last usage in the given response body or event stream, or None if
+    there is none.
+
+    Instead of parsing the whole body, only the bytes after the last '"usage"' key are searched, so this is cheap also
+    for large bodies, eg. of embeddings.
+    """
+    index = body.rfind(b'"usage"')
+    if index < 0:
+        return None
+    usage = body[index : index + USAGE_WINDOW_BYTES]
+    prompt_tokens_match = PROMPT_TOKENS_REGEX.search(usage)
+    if prompt_tokens_match is None:
+        return None
+    completion_tokens_match = COMPLETION_TOKENS_REGEX.search(usage)
+    return int(prompt_tokens_match[1]), (int(completion_tokens_match[1]) if completion_tokens_match else 0)
+
+
+def escape_label_value(label_value):
+    """Return the given label value escaped for the Prometheus text format."""
+    return str(label_value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labels):
+    """Return the given formatted labels as label set of a sample, or an empty string if there are none."""
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+def format_value(value):
+    """Return the given value formatted for the Prometheus text format."""
+    return str(value) if isinstance(value, int) else repr(float(value))
@@ -0,0 +1,354 @@
+"""Several methods and classes around simulating Azure OpenAI, so PowerProxy can be tested without Azure OpenAI."""
+
+import asyncio
+import json
+import math
+import random
+import time
+import uuid
+
+import httpx
+
+from .embeddings import estimate_input_tokens, get_inputs, is_embeddings_request
+from .rate_limits import REMAINING_TOKENS_HEADER, TokenBudget
+from .tokens import estimate_request_cost_in_tokens
+
+MOCK_CONTENT = "I'm a mock response and not a real answer from Azure OpenAI."
+MAX_TOKENS_PARAMETERS = ("max_completion_tokens", "max_output_tokens", "max_tokens")
+
+
+class LatencyDistribution:
+    """
+    Latencies in milliseconds, either fixed or log-normally distributed.
+
+    A latency is configured either as number (always the same latency) or as object with the median and the 95th
+    percentile of the latencies, from which a log-normal distribution is derived, which has the long tail typical for
+    latencies of Azure OpenAI.
+    """
+
+    def __init__(self, latency_configuration):
+        """Constructor."""
+        if isinstance(latency_configuration, dict):
+            self.median_ms = float(latency_configuration.get("median", 0))
+            p95_ms = float(latency_configuration.get("p95", self.median_ms))
+            # note: the 95th percentile of a log-normal distribution is its median times exp(1.645 * sigma)
+            self.sigma = math.log(p95_ms / self.median_ms) / 1.645 if 0 < self.median_ms < p95_ms else 0
+        else:
+            self.median_ms = float(latency_configuration or 0)
+            self.sigma = 0
+
+    def sample_ms(self, randomizer):
+        """Return a latency drawn from the distribution."""
+        if self.sigma == 0:
+            return self.median_ms
+        return randomizer.lognormvariate(math.log(self.median_ms), self.sigma)
+
+
+class MockUpstream:
+    """
+    Simulated Azure OpenAI endpoint, answering requests like Azure OpenAI without sending them anywhere. Its
+    handle_request method is meant as handler of a httpx.MockTransport, used as transport of an endpoint's client.
+
+    Chat completions, completions and embeddings get made-up responses, non-streaming requests get the configured json
+    instead if there is one. Non-streaming responses are returned after ms_to_wait_before_return plus the time to first
+    token plus the time to generate the completion tokens at tokens_per_second. Streaming responses are returned as
+    server-sent events, the first token after the time to first token and the others at tokens_per_second, followed by
+    a usage chunk if the request asks for one with stream_options/include_usage. Requests whose body is no valid JSON or
+    whose maximum number of tokens is no integer get a 400, like from Azure OpenAI.
+
+    Errors are injected into the given shares of the requests: 429s (with retry-after-ms), 500s, slow reads (pausing
+    for slow_read_ms halfway through the response body) and connection resets (halfway through the response body). If
+    tokens_per_minute is given, the estimated tokens of the requests are counted per deployment, and requests exceeding
+    the limit get a 429 telling when they would fit, like Azure OpenAI does. Every response then tells the remaining
+    tokens, so PowerProxy's remaining capacity estimation can be tested as well.
+    """
+
+    def __init__(self, mock_configuration):
+        """Constructor."""
+        self.json = mock_configuration.get("json")
+        self.ms_to_wait_before_return = float(mock_configuration.get("ms_to_wait_before_return") or 0)
+        self.time_to_first_token = LatencyDistribution(mock_configuration.get("time_to_first_token_ms"))
+        # note: 0 tokens per second means the completion is generated at once
+        self.tokens_per_second = float(mock_configuration.get("tokens_per_second") or 0)
+        self.completion_tokens = int(mock_configuration.get("completion_tokens", 16))
+        self.embedding_dimensions = int(mock_configuration.get("embedding_dimensions", 1536))
+        self.rate_limit_rate = float(mock_configuration.get("errors/rate_limit_rate", 0))
+        self.retry_after_ms = int(mock_configuration.get("errors/retry_after_ms", 1_000))
+        self.server_error_rate = float(mock_configuration.get("errors/server_error_rate", 0))
+        self.slow_read_rate = float(mock_configuration.get("errors/slow_read_rate", 0))
+        self.slow_read_ms = float(mock_configuration.get("errors/slow_read_ms", 5_000))
+        self.connection_reset_rate = float(mock_configuration.get("errors/connection_reset_rate", 0))
+        # note: tokens_per_minute is either a limit for each deployment or an object with the limit by deployment name
+        self.tokens_per_minute = mock_configuration.get("tokens_per_minute")
+        self.token_budgets = {}
+        self.randomizer = random.Random(mock_configuration.get("seed"))
+        self.metrics = {
+            "requests": 0,
+            "rate_limited_requests": 0,
+            "requests_over_tokens_per_minute": 0,
+            "server_errors": 0,
+            "slow_reads": 0,
+            "connection_resets": 0,
+        }
+
+    async def handle_request(self, request):
+        """Return the simulated response to the given request."""
+        self.metrics["requests"] += 1
+        path = request.url.path
+        # invalid requests get a 400 like from Azure OpenAI
+        try:
+            request_body_dict = json.loads(request.content) if request.content else {}
+        except ValueError:
+            return MockUpstream._create_bad_request_response(
+                "We could not parse the JSON body of your request. (HINT: This likely means you aren't using your "
+                "HTTP library correctly. The OpenAI API expects a JSON payload, but what was sent was not valid JSON.)"
+            )
+        if not isinstance(request_body_dict, dict):
+            request_body_dict = {}
+        for parameter in MAX_TOKENS_PARAMETERS:
+            value = request_body_dict.get(parameter)
+            if value is not None and (not isinstance(value, int) or isinstance(value, bool)):
+                return MockUpstream._create_bad_request_response(
+                    f"{value!r} is not of type 'integer' - '{parameter}'", parameter
+                )
+        stream = bool(request_body_dict.get("stream"))
+        if self.ms_to_wait_before_return:
+            await asyncio.sleep(self.ms_to_wait_before_return / 1_000)
+
+        # injected errors
+        # note: a single draw decides about the error, so the shares of the errors add up
+        draw = self.randomizer.random()
+        if draw < self.rate_limit_rate:
+            self.metrics["rate_limited_requests"] += 1
+            return MockUpstream._create_rate_limit_response(self.retry_after_ms)
+        if draw < self.rate_limit_rate + self.server_error_rate:
+            self.metrics["server_errors"] += 1
+            return httpx.Response(
+                500,
+                json={
+                    "error": {
+                        "code": "InternalServerError",
+                        "message": "The server had an error while processing your request. Sorry about that!",
+                    }
+                },
+            )
+        is_connection_reset = draw < self.rate_limit_rate + self.server_error_rate + self.connection_reset_rate
+        is_slow_read = not is_connection_reset and self.randomizer.random() < self.slow_read_rate
+
+        # tokens per minute of the requested deployment
+        headers = {}
+        token_budget = self._get_token_budget(MockUpstream._get_deployment(path, request_body_dict))
+        if token_budget is not None:
+            cost_in_tokens = estimate_request_cost_in_tokens(
+                request_body_dict, 0 if is_embeddings_request(path) else self.completion_tokens
+            )
+            now_ms = time.time() * 1_000
+            if not token_budget.can_absorb(cost_in_tokens, now_ms):
+                self.metrics["requests_over_tokens_per_minute"] += 1
+                return MockUpstream._create_rate_limit_response(
+                    max(int(token_budget.get_absorbable_timestamp_ms(cost_in_tokens, now_ms) - now_ms), 1)
+                )
+            token_budget.consume(cost_in_tokens, now_ms)
+            headers[REMAINING_TOKENS_HEADER] = str(
+                token_budget.tokens_per_minute - token_budget.get_consumed_tokens(now_ms)
+            )
+
+        if is_connection_reset:
+            self.metrics["connection_resets"] += 1
+        if is_slow_read:
+            self.metrics["slow_reads"] += 1
+        time_to_first_token_ms = self.time_to_first_token.sample_ms(self.randomizer)
+        if stream and not is_embeddings_request(path):
+            await asyncio.sleep(time_to_first_token_ms / 1_000)
+            return httpx.Response(
+                200,
+                headers={**headers, "content-type": "text/event-stream; charset=utf-8"},
+                content=self._stream_events(path, request_body_dict, is_slow_read, is_connection_reset),
+            )
+        if is_embeddings_request(path):
+            body_dict = self.json if self.json is not None else self._create_embeddings_body_dict(request_body_dict)
+            generation_ms = 0
+        else:
+            completion_tokens = self._get_completion_tokens(request_body_dict)
+            body_dict = (
+                self.json
+                if self.json is not None
+                else self._create_completion_body_dict(path, request_body_dict, completion_tokens)
+            )
+            generation_ms = completion_tokens * 1_000 / self.tokens_per_second if self.tokens_per_second else 0
+        await asyncio.sleep((time_to_first_token_ms + generation_ms) / 1_000)
+        return httpx.Response(
+            200,
+            headers={**headers, "content-type": "application/json"},
+            content=self._read_body_in_halves(json.dumps(body_dict).encode(), is_slow_read, is_connection_reset),
+        )
+
+    def get_stats(self):
+        """Return statistics about the simulated requests and injected errors."""
+        return dict(self.metrics)
+
+    async def _read_body_in_halves(self, body, is_slow_read, is_connection_reset):
+        """Yield the given body in two halves, pausing or resetting the connection in between if requested."""
+        yield body[: len(body) // 2]
+        if is_slow_read:
+            await asyncio.sleep(self.slow_read_ms / 1_000)
+        if is_connection_reset:
+            raise httpx.ReadError("Connection reset by peer (simulated)")
+        yield body[len(body) // 2 :]
+
+    async def _stream_events(self, path, request_body_dict, is_slow_read, is_connection_reset):
+        """Yield the server-sent events of a streamed completion, generating tokens at the configured rate."""
+        completion_tokens = self._get_completion_tokens(request_body_dict)
+        is_chat_completion = path.endswith("chat/completions")
+        include_usage = bool((request_body_dict.get("stream_options") or {}).get("include_usage"))
+        chunk_dict = {
+            "id": f"chatcmpl-{uuid.uuid4().hex}" if is_chat_completion else f"cmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion.chunk" if is_chat_completion else "text_completion",
+            "created": int(time.time()),
+            "model": request_body_dict.get("model") or MockUpstream._get_deployment(path, request_body_dict),
+        }
+        if include_usage:
+            chunk_dict["usage"] = None
+
+        def create_event(choice, usage=None):
+            """Return the event of a chunk with the given choice."""
+            event_dict = {**chunk_dict, "choices": [choice] if choice else []}
+            if usage is not None:
+                event_dict["usage"] = usage
+            return f"data: {json.dumps(event_dict)}\n\n".encode()
+
+        def create_choice(token, finish_reason=None):
+            """Return the choice of a chunk with the given token."""
+            if not is_chat_completion:
+                return {"index": 0, "text": token, "finish_reason": finish_reason}
+            return {"index": 0, "delta": {"content": token} if token else {}, "finish_reason": finish_reason}
+
+        if is_chat_completion:
+            yield create_event({"index": 0, "delta": {"role": "assistant", "content": ""}, "finish_reason": None})
+        for token_number, token in enumerate(MockUpstream._generate_tokens(completion_tokens)):
+            if token_number > 0 and self.tokens_per_second:
+                await asyncio.sleep(1 / self.tokens_per_second)
+            if token_number == completion_tokens // 2:
+                if is_slow_read:
+                    await asyncio.sleep(self.slow_read_ms / 1_000)
+                if is_connection_reset:
+                    raise httpx.ReadError("Connection reset by peer (simulated)")
+            yield create_event(create_choice(token))
+        yield create_event(create_choice("", finish_reason="stop"))
+        if include_usage:
+            prompt_tokens = MockUpstream._estimate_prompt_tokens(request_body_dict)
+            yield create_event(
+                None,
+                usage={
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": prompt_tokens + completion_tokens,
+                },
+            )
+        yield b"data: [DONE]\n\n"
+
+    def _create_completion_body_dict(self, path, request_body_dict, completion_tokens):
+        """Return the body of a non-streamed (chat) completion with the given number of tokens."""
+        content = "".join(MockUpstream._generate_tokens(completion_tokens))
+        prompt_tokens = MockUpstream._estimate_prompt_tokens(request_body_dict)
+        is_chat_completion = path.endswith("chat/completions")
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex}" if is_chat_completion else f"cmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion" if is_chat_completion else "text_completion",
+            "created": int(time.time()),
+            "model": request_body_dict.get("model") or MockUpstream._get_deployment(path, request_body_dict),
+            "choices": [
+                (
+                    {"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content}}
+                    if is_chat_completion
+                    else {"index": 0, "finish_reason": "stop", "text": content}
+                )
+            ],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        }
+
+    def _create_embeddings_body_dict(self, request_body_dict):
+        """Return the body of an embeddings response with an embedding for each input."""
+        inputs = get_inputs(request_body_dict) or []
+        dimensions = int(request_body_dict.get("dimensions") or self.embedding_dimensions)
+        prompt_tokens = sum(estimate_input_tokens(single_input) for single_input in inputs)
+        return {
+            "object": "list",
+            "data": [
+                {"object": "embedding", "index": index, "embedding": [round(1 / (index + 1), 6)] * dimensions}
+                for index in range(len(inputs))
+            ],
+            "model": request_body_dict.get("model") or "text-embedding-ada-002",
+            "usage": {"prompt_tokens": prompt_tokens, "total_tokens": prompt_tokens},
+        }
+
+    def _get_completion_tokens(self, request_body_dict):
+        """Return the number of tokens to generate for the given request, at most its maximum number of tokens."""
+        max_tokens = next(
+            (request_body_dict[parameter] for parameter in MAX_TOKENS_PARAMETERS if request_body_dict.get(parameter)),
+            None,
+        )
+        return min(self.completion_tokens, int(max_tokens)) if max_tokens else self.completion_tokens
+
+    def _get_token_budget(self, deployment):
+        """Return the token budget of the given deployment (created on demand), or None if it is not limited."""
+        if deployment not in self.token_budgets:
+            tokens_per_minute = (
+                self.tokens_per_minute.get(deployment)
+                if isinstance(self.tokens_per_minute, dict)
+                else self.tokens_per_minute
+            )
+            self.token_budgets[deployment] = TokenBudget(tokens_per_minute) if tokens_per_minute else None
+        return self.token_budgets[deployment]
+
+    @staticmethod
+    def _create_bad_request_response(message, parameter=None):
+        """Return a 400 response with the given message about the request (and the invalid parameter, if given)."""
+        return httpx.Response(
+            400,
+            json={"error": {"message": message, "type": "invalid_request_error", "param": parameter, "code": None}},
+        )
+
+    @staticmethod
+    def _create_rate_limit_response(retry_after_ms):
+        """Return a 429 response telling to retry after the given time."""
+        return httpx.Response(
+            429,
+            headers={"retry-after-ms": str(retry_after_ms), "retry-after": str(math.ceil(retry_after_ms / 1_000))},
+            json={
+                "error": {
+                    "code": "429",
+                    "message": (
+                        "Requests to the mock deployment have exceeded the rate limit. Please retry after "
+                        f"{math.ceil(retry_after_ms / 1_000)} seconds."
+                    ),
+                }
+            },
+        )
+
+    @staticmethod
+    def _get_deployment(path, request_body_dict):
+        """Return the name of the deployment requested, from the path or (for the v1 API) from the body."""
+        path_parts = path.strip("/").split("/")
+        if "deployments" in path_parts[:-1]:
+            return path_parts[path_parts.index("deployments") + 1]
+        return str(request_body_dict.get("model") or "mock")
+
+    @staticmethod
+    def _estimate_prompt_tokens(request_body_dict):
+        """Return the estimated number of tokens of the given request's prompt."""
+        prompt_dict = {key: value for key, value in request_body_dict.items() if key in ("messages", "prompt", "input")}
+        return max(estimate_request_cost_in_tokens(prompt_dict, 0), 1)
+
+    @staticmethod
+    def _generate_tokens(number_of_tokens):
+        """Return the given number of tokens of the mock content, repeating the content if needed."""
+        words = MOCK_CONTENT.split(" ")
+        return [
+            ("" if token_number == 0 else " ") + words[token_number % len(words)]
+            for token_number in range(number_of_tokens)
+        ]
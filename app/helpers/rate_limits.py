@@ -0,0 +1,249 @@
+"""Several methods and classes around the rate limits of targets."""
+
+# headers in which Azure OpenAI tells how many tokens and requests remain before the deployment throttles, and
+# (optionally) the limits per minute
+REMAINING_TOKENS_HEADER = "x-ratelimit-remaining-tokens"
+REMAINING_REQUESTS_HEADER = "x-ratelimit-remaining-requests"
+LIMIT_TOKENS_HEADER = "x-ratelimit-limit-tokens"
+LIMIT_REQUESTS_HEADER = "x-ratelimit-limit-requests"
+
+
+class RemainingCapacity:
+    """
+    Estimate of the tokens and requests a target accepts before it throttles, based on its rate limit headers.
+
+    Azure OpenAI tells on every response how many tokens and requests remain in the current rate limit window. The
+    estimated tokens of the requests sent after the request of that response are subtracted from these, so concurrent
+    requests do not all count on the same remaining tokens. If the target also tells its limits per minute, capacity is
+    replenished at that rate. Either way, an estimate expires after max_age_ms, after which the target's capacity is
+    unknown again and the target is tried as usual.
+
+    All methods expect the current time in milliseconds, so the estimate does not depend on a specific clock.
+    """
+
+    __slots__ = (
+        "max_age_ms",
+        "observed_at_ms",
+        "remaining_tokens",
+        "remaining_requests",
+        "limit_tokens",
+        "limit_requests",
+        "tokens_sent",
+        "requests_sent",
+        "tokens_sent_when_observed",
+        "requests_sent_when_observed",
+    )
+
+    def __init__(self, remaining_capacity_configuration):
+        """Constructor."""
+        self.max_age_ms = int(remaining_capacity_configuration.get("max_age_ms", 10_000))
+        self.observed_at_ms = None
+        self.remaining_tokens = None
+        self.remaining_requests = None
+        self.limit_tokens = None
+        self.limit_requests = None
+        # note: tokens and requests sent are running totals, the ones when observed are the totals up to (including)
+        #       the request of the response telling the remaining capacity
+        self.tokens_sent = 0
+        self.requests_sent = 0
+        self.tokens_sent_when_observed = 0
+        self.requests_sent_when_observed = 0
+
+    def record_request(self, cost_in_tokens):
+        """
+        Record a request with the given estimated cost sent to the target.
+
+        Returns a mark to be passed to record_headers with the headers of the request's response.
+        """
+        self.tokens_sent += cost_in_tokens
+        self.requests_sent += 1
+        return self.tokens_sent, self.requests_sent
+
+    def refund_request(self, cost_in_tokens):
+        """Take back a request recorded before which has not been answered, eg. a cancelled hedged request."""
+        # note: requests recorded when the remaining capacity was observed are included in the observation already
+        self.tokens_sent = max(self.tokens_sent - cost_in_tokens, self.tokens_sent_when_observed)
+        self.requests_sent = max(self.requests_sent - 1, self.requests_sent_when_observed)
+
+    def record_headers(self, headers, now_ms, mark=None):
+        """
+        Take the remaining tokens and requests from the given headers of a response from the target, if given.
+
+        The mark is the one returned by record_request for the response's request. Without mark, all requests sent are
+        expected to be included in the remaining tokens and requests already.
+        """
+        remaining_tokens = RemainingCapacity._parse_header(headers, REMAINING_TOKENS_HEADER)
+        remaining_requests = RemainingCapacity._parse_header(headers, REMAINING_REQUESTS_HEADER)
+        if remaining_tokens is None and remaining_requests is None:
+            return
+        tokens_sent_when_observed, requests_sent_when_observed = mark or (self.tokens_sent, self.requests_sent)
+        # note: a response to an earlier request than the one of the current estimate tells nothing new
+        if self.observed_at_ms is not None and requests_sent_when_observed < self.requests_sent_when_observed:
+            return
+        self.observed_at_ms = now_ms
+        self.remaining_tokens = remaining_tokens
+        self.remaining_requests = remaining_requests
+        self.limit_tokens = RemainingCapacity._parse_header(headers, LIMIT_TOKENS_HEADER)
+        self.limit_requests = RemainingCapacity._parse_header(headers, LIMIT_REQUESTS_HEADER)
+        self.tokens_sent_when_observed = tokens_sent_when_observed
+        self.requests_sent_when_observed = requests_sent_when_observed
+
+    def get_remaining_tokens(self, now_ms):
+        """Return the estimated number of tokens the target accepts now, or None if unknown."""
+        if self.remaining_tokens is None or not self._is_known(now_ms):
+            return None
+        return RemainingCapacity._replenish(
+            self.remaining_tokens - (self.tokens_sent - self.tokens_sent_when_observed),
+            self.limit_tokens,
+            now_ms - self.observed_at_ms,
+        )
+
+    def get_remaining_requests(self, now_ms):
+        """Return the estimated number of requests the target accepts now, or None if unknown."""
+        if self.remaining_requests is None or not self._is_known(now_ms):
+            return None
+        return RemainingCapacity._replenish(
+            self.remaining_requests - (self.requests_sent - self.requests_sent_when_observed),
+            self.limit_requests,
+            now_ms - self.observed_at_ms,
+        )
+
+    def is_expected_to_throttle(self, cost_in_tokens, now_ms):
+        """Return True if the target is expected to throttle a request with the given estimated cost."""
+        remaining_tokens = self.get_remaining_tokens(now_ms)
+        if remaining_tokens is not None and remaining_tokens < cost_in_tokens:
+            return True
+        remaining_requests = self.get_remaining_requests(now_ms)
+        return remaining_requests is not None and remaining_requests < 1
+
+    def _is_known(self, now_ms):
+        """Return True if there is an estimate which has not expired yet."""
+        return self.observed_at_ms is not None and now_ms - self.observed_at_ms <= self.max_age_ms
+
+    @staticmethod
+    def _replenish(remaining, limit_per_minute, elapsed_ms):
+        """Return the given remaining capacity, replenished over the given time if the limit per minute is known."""
+        if limit_per_minute is None:
+            return remaining
+        return min(remaining + limit_per_minute * elapsed_ms / 60_000, limit_per_minute)
+
+    @staticmethod
+    def _parse_header(headers, header_name):
+        """Return the given header as integer, or None if it is missing or invalid."""
+        try:
+            return int(float(headers[header_name]))
+        except (KeyError, ValueError):
+            return None
+
+
+class TokenBudget:
+    """
+    Tokens per minute a target accepts, as configured, against which the estimated tokens of requests sent are counted.
+
+    Tokens are counted in buckets of a second, so no timestamps need to be kept per request and the buckets can be
+    shared with other workers. The tokens consumed within the last minute are the tokens of the current bucket and the
+    60 buckets before. The bucket partially within the last minute is counted fully, so the tokens consumed are rather
+    overestimated (by up to a second of tokens) than underestimated, which would lead to 429s.
+
+    If the budget has a shared state, the tokens consumed by all workers on the host are counted against it.
+
+    All methods expect the current time in milliseconds, so the budget does not depend on a specific clock.
+    """
+
+    BUCKET_MS = 1_000
+    # note: buckets of the last minute, plus the bucket partially within the last minute
+    NUMBER_OF_BUCKETS = 61
+
+    __slots__ = ("tokens_per_minute", "bucket_index", "tokens_by_bucket", "shared_state")
+
+    def __init__(self, tokens_per_minute):
+        """Constructor."""
+        self.tokens_per_minute = int(tokens_per_minute)
+        # note: the tokens of bucket i are at tokens_by_bucket[i % NUMBER_OF_BUCKETS], for the latest bucket_index and
+        #       the buckets before
+        self.bucket_index = 0
+        self.tokens_by_bucket = [0] * TokenBudget.NUMBER_OF_BUCKETS
+        self.shared_state = None
+
+    def consume(self, tokens, now_ms):
+        """Count the given tokens against the budget. Negative tokens give tokens back, eg. for throttled requests."""
+        bucket_index = int(now_ms // TokenBudget.BUCKET_MS)
+        if bucket_index > self.bucket_index:
+            for passed_bucket_index in range(
+                max(self.bucket_index + 1, bucket_index - TokenBudget.NUMBER_OF_BUCKETS + 1), bucket_index + 1
+            ):
+                self.tokens_by_bucket[passed_bucket_index % TokenBudget.NUMBER_OF_BUCKETS] = 0
+            self.bucket_index = bucket_index
+        # note: tokens given back for a request sent in an earlier bucket are taken from the latest bucket
+        slot = self.bucket_index % TokenBudget.NUMBER_OF_BUCKETS
+        self.tokens_by_bucket[slot] = max(self.tokens_by_bucket[slot] + tokens, 0)
+        if self.shared_state is not None:
+            self.shared_state.set_token_buckets(self.bucket_index, self.tokens_by_bucket)
+
+    def get_consumed_tokens(self, now_ms):
+        """Return the estimated number of tokens consumed within the last minute."""
+        return sum(self._get_tokens_of_last_buckets(now_ms))
+
+    def can_absorb(self, cost_in_tokens, now_ms):
+        """Return True if a request with the given estimated cost fits into the budget now."""
+        return self.get_consumed_tokens(now_ms) + self._cap(cost_in_tokens) <= self.tokens_per_minute
+
+    def get_absorbable_timestamp_ms(self, cost_in_tokens, now_ms):
+        """Return the earliest time at which a request with the given estimated cost fits into the budget."""
+        tokens_of_last_buckets = self._get_tokens_of_last_buckets(now_ms)
+        tokens_left = self.tokens_per_minute - self._cap(cost_in_tokens)
+        if sum(tokens_of_last_buckets) <= tokens_left:
+            return now_ms
+        # with every bucket passing, the oldest bucket is no longer counted
+        bucket_index = int(now_ms // TokenBudget.BUCKET_MS)
+        buckets_passed = 1
+        while sum(tokens_of_last_buckets[buckets_passed:]) > tokens_left:
+            buckets_passed += 1
+        return (bucket_index + buckets_passed) * TokenBudget.BUCKET_MS
+
+    def _cap(self, cost_in_tokens):
+        """Return the given cost, capped to the budget, so requests larger than the budget need the whole budget."""
+        return min(cost_in_tokens, self.tokens_per_minute)
+
+    def _get_tokens_of_last_buckets(self, now_ms):
+        """Return the tokens of the buckets of the last minute, oldest first, by all workers if shared."""
+        bucket_index = int(now_ms // TokenBudget.BUCKET_MS)
+        worker_buckets = (
+            self.shared_state.get_token_buckets()
+            if self.shared_state is not None
+            else [(self.bucket_index, self.tokens_by_bucket)]
+        )
+        tokens_of_last_buckets = [0] * TokenBudget.NUMBER_OF_BUCKETS
+        # note: the oldest bucket of the last minute is in the slot after the current bucket's slot
+        oldest_slot = (bucket_index + 1) % TokenBudget.NUMBER_OF_BUCKETS
+        for worker_bucket_index, worker_tokens_by_bucket in worker_buckets:
+            # buckets after the worker's latest bucket have no tokens, their slots still hold older buckets
+            number_of_valid_buckets = TokenBudget.NUMBER_OF_BUCKETS - max(bucket_index - worker_bucket_index, 0)
+            if number_of_valid_buckets <= 0:
+                continue
+            for position in range(number_of_valid_buckets):
+                tokens_of_last_buckets[position] += worker_tokens_by_bucket[
+                    (oldest_slot + position) % TokenBudget.NUMBER_OF_BUCKETS
+                ]
+        return tokens_of_last_buckets
+
+
+def deprioritize_targets_expected_to_throttle(candidates, cost_in_tokens, now_ms):
+    """
+    Return the given candidates, with those expected to throttle a request of the given cost moved to the end.
+
+    The order is kept otherwise, so targets expected to throttle remain available as a last resort, eg. in case the
+    estimate is off.
+    """
+    targets_expected_to_throttle = [
+        aoai_target
+        for aoai_target in candidates
+        if aoai_target.remaining_capacity is not None
+        and aoai_target.remaining_capacity.is_expected_to_throttle(cost_in_tokens, now_ms)
+    ]
+    if not targets_expected_to_throttle:
+        return candidates
+    return [
+        *(aoai_target for aoai_target in candidates if aoai_target not in targets_expected_to_throttle),
+        *targets_expected_to_throttle,
+    ]
@@ -0,0 +1,199 @@
+"""Several methods and classes around routing requests to Azure OpenAI targets."""
+
+import re
+
+from .circuit_breaker import CircuitBreaker
+
+DEPLOYMENT_IN_PATH_REGEX = re.compile(r"(?<=deployments/)[^/]+")
+
+
+class AoaiTarget:
+    """A target (endpoint or virtual deployment standin) to which requests can be routed."""
+
+    __slots__ = (
+        "name",
+        "type",
+        "endpoint",
+        "virtual_deployment",
+        "standin",
+        "url",
+        "endpoint_key",
+        "endpoint_client",
+        "circuit_breaker",
+        "non_streaming_fraction",
+        "priority",
+        "local_outstanding_requests",
+        "local_ewma_latency_ms",
+        "shared_state",
+        "remaining_capacity",
+        "token_budget",
+    )
+
+    def __init__(
+        self,
+        name,
+        target_type,
+        endpoint,
+        url,
+        endpoint_client,
+        endpoint_key=None,
+        virtual_deployment=None,
+        standin=None,
+        non_streaming_fraction=1.0,
+        priority=0,
+        circuit_breaker=None,
+        token_budget=None,
+    ):
+        """Constructor."""
+        self.name = name
+        self.type = target_type
+        self.endpoint = endpoint
+        self.virtual_deployment = virtual_deployment
+        self.standin = standin
+        self.url = url
+        # note: None means that no key is configured for the endpoint, so Entra ID auth is used instead
+        self.endpoint_key = endpoint_key
+        self.endpoint_client = endpoint_client
+        self.circuit_breaker = circuit_breaker or CircuitBreaker({})
+        self.non_streaming_fraction = float(non_streaming_fraction)
+        # note: targets with lower priority values are preferred, targets with the same priority form a tier in
+        #       which the load balancing strategy decides
+        self.priority = int(priority)
+        # note: the local values are the ones of this worker, the shared state (if any) combines those of all workers
+        self.local_outstanding_requests = 0
+        self.local_ewma_latency_ms = None
+        self.shared_state = None
+        # note: None means that the remaining capacity of the target is not estimated
+        self.remaining_capacity = None
+        # note: None means that no tokens per minute are configured for the target
+        self.token_budget = token_budget
+
+    @property
+    def outstanding_requests(self):
+        """Return the number of requests in flight to the target, from all workers if the state is shared."""
+        if self.shared_state is None:
+            return self.local_outstanding_requests
+        return self.shared_state.get_outstanding_requests()
+
+    @property
+    def ewma_latency_ms(self):
+        """Return the EWMA latency of the target, over all workers if the state is shared."""
+        if self.shared_state is None:
+            return self.local_ewma_latency_ms
+        return self.shared_state.get_ewma_latency_ms()
+
+    def add_outstanding_requests(self, number_of_requests):
+        """Add the given number of requests (negative when requests end) to the requests in flight to the target."""
+        self.local_outstanding_requests += number_of_requests
+        if self.shared_state is not None:
+            self.shared_state.set_outstanding_requests(self.local_outstanding_requests)
+
+    def set_ewma_latency_ms(self, ewma_latency_ms):
+        """Set the EWMA latency of the target as measured by this worker."""
+        self.local_ewma_latency_ms = ewma_latency_ms
+        if self.shared_state is not None:
+            self.shared_state.set_ewma_latency_ms(ewma_latency_ms)
+
+    def attach_shared_state(self, shared_state):
+        """Share the state of the target with the other workers on the host, via the given shared state."""
+        self.shared_state = shared_state
+        self.circuit_breaker.shared_state = shared_state
+        if self.token_budget is not None:
+            self.token_budget.shared_state = shared_state
+        shared_state.set_outstanding_requests(self.local_outstanding_requests)
+        if self.local_ewma_latency_ms is not None:
+            shared_state.set_ewma_latency_ms(self.local_ewma_latency_ms)
+
+    @property
+    def is_virtual_deployment_standin(self):
+        """Return True if the target is a standin of a virtual deployment."""
+        return self.type == "virtual_deployment_standin"
+
+    def __repr__(self):
+        """Dunder method to return a string representation of the target."""
+        return f"AoaiTarget('{self.name}')"
+
+
+class RoutingTable:
+    """
+    Index over all targets, built once at startup.
+
+    For each virtual deployment, the table holds the ordered tuple of candidate targets, i.e. all endpoint targets and
+    all standins of that virtual deployment, ordered by priority and then by the order given in the configuration. This
+    way, handling a request only needs a single dict lookup instead of scanning and filtering all configured targets.
+    The candidates are also available grouped into priority tiers.
+    """
+
+    def __init__(self, targets):
+        """Constructor."""
+        targets = sorted(targets, key=lambda target: target.priority)
+        self.targets = {target.name: target for target in targets}
+        self.virtual_deployment_names = frozenset(
+            target.virtual_deployment for target in targets if target.is_virtual_deployment_standin
+        )
+        self.default_candidates = tuple(target for target in targets if not target.is_virtual_deployment_standin)
+        self.candidates_by_virtual_deployment = {
+            virtual_deployment_name: tuple(
+                target
+                for target in targets
+                if not target.is_virtual_deployment_standin or target.virtual_deployment == virtual_deployment_name
+            )
+            for virtual_deployment_name in self.virtual_deployment_names
+        }
+        self.default_candidate_tiers = RoutingTable._get_priority_tiers(self.default_candidates)
+        self.candidate_tiers_by_virtual_deployment = {
+            virtual_deployment_name: RoutingTable._get_priority_tiers(candidates)
+            for virtual_deployment_name, candidates in self.candidates_by_virtual_deployment.items()
+        }
+
+    def __iter__(self):
+        """Dunder method to iterate over all targets."""
+        return iter(self.targets.values())
+
+    def __len__(self):
+        """Dunder method to return the number of targets."""
+        return len(self.targets)
+
+    def get_candidates(self, virtual_deployment):
+        """Return the ordered candidate targets for the given virtual deployment."""
+        return self.candidates_by_virtual_deployment.get(virtual_deployment, self.default_candidates)
+
+    def get_candidate_tiers(self, virtual_deployment):
+        """Return the candidate targets for the given virtual deployment, grouped into tuples by priority."""
+        return self.candidate_tiers_by_virtual_deployment.get(virtual_deployment, self.default_candidate_tiers)
+
+    @staticmethod
+    def _get_priority_tiers(candidates):
+        """Group the given candidates, which are sorted by priority, into tuples of candidates with equal priority."""
+        tiers = []
+        for candidate in candidates:
+            if tiers and tiers[-1][-1].priority == candidate.priority:
+                tiers[-1].append(candidate)
+            else:
+                tiers.append([candidate])
+        return tuple(tuple(tier) for tier in tiers)
+
+
+class RequestPath:
+    """A request path, parsed once so the deployment in it can be replaced cheaply."""
+
+    __slots__ = ("path", "deployment", "_prefix", "_suffix")
+
+    def __init__(self, path):
+        """Constructor."""
+        self.path = path
+        deployment_match = DEPLOYMENT_IN_PATH_REGEX.search(path)
+        if deployment_match:
+            self.deployment = deployment_match.group(0)
+            self._prefix = path[: deployment_match.start()]
+            self._suffix = path[deployment_match.end() :]
+        else:
+            self.deployment = None
+            self._prefix = None
+            self._suffix = None
+
+    def with_deployment(self, deployment):
+        """Return the path with the deployment replaced by the given deployment."""
+        if self.deployment is None:
+            return self.path
+        return f"{self._prefix}{deployment}{self._suffix}"
@@ -0,0 +1,166 @@
+"""Declares the routing slip, which accompanies a request through PowerProxy and its plugins."""
+
+import json
+from datetime import datetime, timezone
+
+import httpx
+from fastapi import Request
+from plugins.base import PluginContext
+
+# marks a lazily parsed value which has not been parsed yet
+NOT_PARSED = object()
+
+
+class RoutingSlip:
+    """
+    Information about a request, collected while the request is processed and passed to the plugins.
+
+    Values are available as attributes. Values which have not been set (yet) are None. Bodies are only parsed into
+    dicts when they are accessed first. For existing plugins, values can also be accessed like in a dict, which also
+    allows plugins to store values of their own under keys not known here.
+    """
+
+    request_received_utc: datetime
+    incoming_request: Request
+    incoming_request_body: bytes
+    path: str
+    plugin_context: PluginContext
+    virtual_deployment: str | None
+    api_version: str | None
+    client: str | None
+    aoai_request_start_time: int | None
+    aoai_request_end_time: int | None
+    aoai_roundtrip_time_ms: int | None
+    aoai_endpoint: str | None
+    aoai_virtual_deployment: str | None
+    aoai_standin_deployment: str | None
+    headers_from_target: httpx.Headers | None
+    response_headers_from_target: dict | None
+    is_event_stream: bool | None
+    is_response_from_cache: bool | None
+    is_response_coalesced: bool | None
+    body_from_target: bytes | None
+    data_from_target: str | None
+
+    FIELD_NAMES = frozenset(
+        (
+            "request_received_utc",
+            "incoming_request",
+            "incoming_request_body",
+            "path",
+            "plugin_context",
+            "virtual_deployment",
+            "api_version",
+            "client",
+            "aoai_request_start_time",
+            "aoai_request_end_time",
+            "aoai_roundtrip_time_ms",
+            "aoai_endpoint",
+            "aoai_virtual_deployment",
+            "aoai_standin_deployment",
+            "headers_from_target",
+            "response_headers_from_target",
+            "is_event_stream",
+            "is_response_from_cache",
+            "is_response_coalesced",
+            "body_from_target",
+            "data_from_target",
+        )
+    )
+    PROPERTY_NAMES = frozenset(
+        ("incoming_request_body_dict", "is_non_streaming_response_requested", "body_dict_from_target")
+    )
+
+    __slots__ = tuple(sorted(FIELD_NAMES)) + ("_incoming_request_body_dict", "_body_dict_from_target", "extra_values")
+
+    def __init__(self, incoming_request, incoming_request_body, path):
+        """Constructor."""
+        self.request_received_utc = datetime.now(timezone.utc)
+        self.incoming_request = incoming_request
+        self.incoming_request_body = incoming_request_body
+        self.path = path
+        # state of the plugins for this request, see PowerProxyPlugin.get_request_state()
+        self.plugin_context = PluginContext()
+        self._incoming_request_body_dict = NOT_PARSED
+        self._body_dict_from_target = NOT_PARSED
+
+    def __getattr__(self, name):
+        """Dunder method to return None for fields which have not been set yet."""
+        # note: only called if the regular attribute lookup failed, so fields need not be initialized upfront
+        if name in RoutingSlip.FIELD_NAMES:
+            return None
+        raise AttributeError(f"'{self.__class__.__name__}' object has no attribute '{name}'")
+
+    @property
+    def incoming_request_body_dict(self):
+        """Return the incoming request's body as dict, or None if it is not JSON."""
+        if self._incoming_request_body_dict is NOT_PARSED:
+            try:
+                self._incoming_request_body_dict = json.loads(self.incoming_request_body)
+            except ValueError:
+                self._incoming_request_body_dict = None
+        return self._incoming_request_body_dict
+
+    @incoming_request_body_dict.setter
+    def incoming_request_body_dict(self, value):
+        """Set the incoming request's body as dict."""
+        self._incoming_request_body_dict = value
+
+    @property
+    def is_non_streaming_response_requested(self):
+        """Return if the client requested a response which is not streamed."""
+        incoming_request_body_dict = self.incoming_request_body_dict
+        return bool(incoming_request_body_dict) and not (
+            "stream" in incoming_request_body_dict and str(incoming_request_body_dict["stream"]).lower() == "true"
+        )
+
+    @property
+    def body_dict_from_target(self):
+        """Return the body received from the target as dict, or None if it is not JSON (non-streamed responses only)."""
+        if self._body_dict_from_target is NOT_PARSED:
+            if self.body_from_target is None:
+                return None
+            try:
+                self._body_dict_from_target = json.loads(self.body_from_target)
+            except ValueError:
+                self._body_dict_from_target = None
+        return self._body_dict_from_target
+
+    @body_dict_from_target.setter
+    def body_dict_from_target(self, value):
+        """Set the body received from the target as dict."""
+        self._body_dict_from_target = value
+
+    # dict-style access, for plugins written against the former dict routing slip
+
+    def __getitem__(self, key):
+        """Dunder method to return the value for the given key."""
+        if key in RoutingSlip.FIELD_NAMES or key in RoutingSlip.PROPERTY_NAMES:
+            return getattr(self, key)
+        try:
+            return self.extra_values[key]
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __setitem__(self, key, value):
+        """Dunder method to set the value for the given key."""
+        if key in RoutingSlip.FIELD_NAMES or key in RoutingSlip.PROPERTY_NAMES:
+            setattr(self, key, value)
+        else:
+            try:
+                self.extra_values[key] = value
+            except AttributeError:
+                self.extra_values = {key: value}
+
+    def __contains__(self, key):
+        """Dunder method to return if a value has been set for the given key."""
+        if key in RoutingSlip.FIELD_NAMES or key in RoutingSlip.PROPERTY_NAMES:
+            return getattr(self, key) is not None
+        try:
+            return key in self.extra_values
+        except AttributeError:
+            return False
+
+    def get(self, key, default=None):
+        """Return the value for the given key, or the given default if no value has been set."""
+        return self[key] if key in self else default
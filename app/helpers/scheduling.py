@@ -0,0 +1,157 @@
+"""Several methods and classes around scheduling requests fairly across clients."""
+
+import asyncio
+import heapq
+import itertools
+
+import httpx
+
+
+class FairQueue:
+    """
+    Weighted fair queue across clients, using self-clocked fair queuing.
+
+    Each queued item gets a virtual finish tag of max(virtual time, client's last finish tag) + cost / weight, and items
+    are taken out in the order of their finish tags. Hence, under saturation, every client receives a share of the
+    served cost proportional to its weight, no matter how many items it queues. A client which was idle does not gain
+    credit for the time it was idle. The virtual time is the finish tag of the item taken out last.
+    """
+
+    def __init__(self):
+        """Constructor."""
+        self.virtual_time = 0.0
+        self.last_finish_tags = {}
+        self.heap = []
+        self.sequence = itertools.count()
+
+    def __len__(self):
+        """Dunder method to return the number of queued items."""
+        return len(self.heap)
+
+    def get_finish_tag(self, client, weight, cost):
+        """Return the finish tag for the next item of the given client and remember it as the client's last one."""
+        finish_tag = max(self.virtual_time, self.last_finish_tags.get(client, 0.0)) + cost / weight
+        self.last_finish_tags[client] = finish_tag
+        return finish_tag
+
+    def push(self, client, weight, cost, item):
+        """Queue the given item for the given client."""
+        heapq.heappush(self.heap, (self.get_finish_tag(client, weight, cost), next(self.sequence), item))
+
+    def pop(self):
+        """Take the item with the lowest finish tag out of the queue and advance the virtual time."""
+        finish_tag, _, item = heapq.heappop(self.heap)
+        self.virtual_time = finish_tag
+        return item
+
+    def pass_by(self, client, weight, cost):
+        """Account for an item which is served right away without being queued, eg. because there is no saturation."""
+        self.virtual_time = self.get_finish_tag(client, weight, cost)
+
+
+class FairQueuingScheduler:
+    """
+    Limits the number of concurrent requests and lets waiting requests pass in weighted fair order.
+
+    As long as less than the maximum number of requests are in flight, requests pass right away. Once saturated,
+    requests are queued and passed through a FairQueue whenever a request in flight completes.
+    """
+
+    def __init__(self, max_concurrent_requests, max_queued_requests=1_000):
+        """Constructor."""
+        self.max_concurrent_requests = max_concurrent_requests
+        self.max_queued_requests = max_queued_requests
+        self.requests_in_flight = 0
+        self.fair_queue = FairQueue()
+        self.metrics = {"passed": 0, "queued": 0, "timed_out": 0, "rejected": 0}
+
+    async def acquire(self, client, weight, cost, timeout_seconds=None):
+        """
+        Wait until the request may be sent, and return a ticket to be released once the request has completed.
+
+        Returns None if the queue is full or the request could not pass within the given timeout.
+        """
+        if self.requests_in_flight < self.max_concurrent_requests and not self.fair_queue:
+            self.fair_queue.pass_by(client, weight, cost)
+            self.requests_in_flight += 1
+            self.metrics["passed"] += 1
+            return SchedulingTicket(self)
+        if len(self.fair_queue) >= self.max_queued_requests:
+            self.metrics["rejected"] += 1
+            return None
+        waiter = asyncio.get_running_loop().create_future()
+        self.fair_queue.push(client, weight, cost, waiter)
+        self.metrics["queued"] += 1
+        try:
+            await asyncio.wait_for(waiter, timeout=timeout_seconds)
+        except asyncio.TimeoutError:
+            self._release_if_passed(waiter)
+            self.metrics["timed_out"] += 1
+            return None
+        except asyncio.CancelledError:
+            self._release_if_passed(waiter)
+            raise
+        return SchedulingTicket(self)
+
+    def _release_if_passed(self, waiter):
+        """Give the slot of a waiter which passed right before it timed out or was cancelled to the next waiter."""
+        # note: waiters which have not passed are cancelled and skipped when taken out of the queue
+        if waiter.done() and not waiter.cancelled():
+            self._release()
+
+    def _release(self):
+        """Release a slot and pass it to the next waiter, if any."""
+        self.requests_in_flight -= 1
+        while self.fair_queue:
+            waiter = self.fair_queue.pop()
+            if not waiter.done():
+                waiter.set_result(True)
+                self.requests_in_flight += 1
+                self.metrics["passed"] += 1
+                return
+
+
+class SchedulingTicket:
+    """
+    Ticket of a request which passed the scheduler, to be released once the request has completed.
+
+    A ticket without scheduler can be used where no scheduling is needed, releasing it has no effect then.
+    """
+
+    __slots__ = ("scheduler",)
+
+    def __init__(self, scheduler):
+        """Constructor."""
+        self.scheduler = scheduler
+
+    def release(self):
+        """Release the ticket, so the next request can pass. Releasing a ticket again has no effect."""
+        if self.scheduler is not None:
+            self.scheduler._release()  # pylint: disable=protected-access
+            self.scheduler = None
+
+    def release_when_closed(self, aoai_response):
+        """Release the ticket once the given response is closed, ie. read completely or closed early."""
+        if aoai_response.is_closed:
+            self.release()
+        else:
+            aoai_response.stream = TicketReleasingStream(aoai_response.stream, self)
+
+
+class TicketReleasingStream(httpx.AsyncByteStream):
+    """Wraps a response stream to release a scheduling ticket when the stream is closed."""
+
+    def __init__(self, stream, scheduling_ticket):
+        """Constructor."""
+        self.stream = stream
+        self.scheduling_ticket = scheduling_ticket
+
+    async def __aiter__(self):
+        """Dunder method to iterate over the wrapped stream."""
+        async for chunk in self.stream:
+            yield chunk
+
+    async def aclose(self):
+        """Close the wrapped stream and release the ticket."""
+        self.scheduling_ticket.release()
+        await self.stream.aclose()
@@ -0,0 +1,221 @@
+"""Several methods and classes around sharing the state of targets across the worker processes on a host."""
+
+import hashlib
+import math
+import mmap
+import os
+import struct
+import tempfile
+
+from .rate_limits import TokenBudget
+
+try:
+    import fcntl
+except ImportError:  # eg. on Windows
+    fcntl = None
+
+# header of the table: magic bytes, max. number of workers, number of targets
+HEADER = struct.Struct("<8sII")
+MAGIC = b"PPXSTAT2"
+# pid of the worker owning a row, per worker
+WORKER = struct.Struct("<q")
+# state of a target as seen by a worker: blocked until (ms since epoch), requests in flight, EWMA latency (NaN if none),
+# index of the latest token bucket and the tokens consumed per bucket (see TokenBudget)
+TOKEN_BUCKETS_FORMAT = "q" * (1 + TokenBudget.NUMBER_OF_BUCKETS)
+TARGET_STATE_FORMAT = "qqd" + TOKEN_BUCKETS_FORMAT
+TARGET_STATE_VALUES = len(TARGET_STATE_FORMAT)
+TARGET_STATE = struct.Struct("<" + TARGET_STATE_FORMAT)
+TOKEN_BUCKETS = struct.Struct("<" + TOKEN_BUCKETS_FORMAT)
+BLOCKED_UNTIL_MS = struct.Struct("<q")
+OUTSTANDING_REQUESTS = struct.Struct("<q")
+EWMA_LATENCY_MS = struct.Struct("<d")
+
+
+class SharedTargetStateTable:
+    """
+    Table with the state of all targets, shared by the worker processes on a host via a memory-mapped file.
+
+    Every worker owns a row per target, which only this worker writes: the timestamp until which the target is blocked,
+    the number of requests in flight, the EWMA of the target's latency and the tokens consumed per bucket of the
+    target's token budget. Readers combine the rows of all workers (latest block, sum of requests in flight, mean
+    latency, sum of tokens consumed), so neither reading nor writing needs a lock. The rows of a
+    target are stored next to each other, so they are read at once.
+
+    Workers claim their rows when opening the table, which is the only time a (file) lock is taken. Rows of workers
+    which have exited are reclaimed, and their requests in flight are reset. The file name is derived from the target
+    names, so proxies with different configurations on the same host do not share a table.
+    """
+
+    def __init__(self, target_names, directory=None, max_workers=16):
+        """Constructor."""
+        if fcntl is None:
+            raise RuntimeError("Sharing the state of targets across workers is not supported on this platform.")
+        self.target_names = sorted(set(target_names))
+        self.target_indexes = {target_name: index for index, target_name in enumerate(self.target_names)}
+        self.max_workers = max_workers
+        self.workers_offset = HEADER.size
+        self.targets_offset = self.workers_offset + max_workers * WORKER.size
+        self.size = self.targets_offset + len(self.target_names) * max_workers * TARGET_STATE.size
+        self.path = os.path.join(
+            directory or SharedTargetStateTable.get_default_directory(),
+            f"powerproxy-{get_fingerprint(self.target_names)}.state",
+        )
+        self.file_descriptor = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(self.file_descriptor, fcntl.LOCK_EX)
+        try:
+            self._initialize_if_needed()
+            self.memory = mmap.mmap(self.file_descriptor, self.size)
+            self.worker_index = self._claim_worker_row()
+        finally:
+            fcntl.flock(self.file_descriptor, fcntl.LOCK_UN)
+
+    @staticmethod
+    def is_supported():
+        """Return True if the table is supported on this platform."""
+        return fcntl is not None
+
+    @staticmethod
+    def get_default_directory():
+        """Return the directory for the table, preferring a RAM-backed file system."""
+        return "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+
+    def get_target_state(self, target_name):
+        """Return the shared state of the given target."""
+        return SharedTargetState(self, self.target_indexes[target_name])
+
+    def close(self):
+        """Release the worker's rows and close the table."""
+        fcntl.flock(self.file_descriptor, fcntl.LOCK_EX)
+        try:
+            self._reset_worker_row(self.worker_index)
+        finally:
+            fcntl.flock(self.file_descriptor, fcntl.LOCK_UN)
+        self.memory.close()
+        os.close(self.file_descriptor)
+
+    def _initialize_if_needed(self):
+        """Initialize the file if it is new or has an unexpected layout."""
+        if os.fstat(self.file_descriptor).st_size == self.size:
+            header = os.pread(self.file_descriptor, HEADER.size, 0)
+            if header == HEADER.pack(MAGIC, self.max_workers, len(self.target_names)):
+                return
+        os.ftruncate(self.file_descriptor, 0)
+        os.ftruncate(self.file_descriptor, self.size)
+        os.pwrite(self.file_descriptor, HEADER.pack(MAGIC, self.max_workers, len(self.target_names)), 0)
+        # note: all targets start without measured latency
+        for target_index in range(len(self.target_names)):
+            for worker_index in range(self.max_workers):
+                os.pwrite(
+                    self.file_descriptor,
+                    TARGET_STATE.pack(0, 0, math.nan, *([0] * (TARGET_STATE_VALUES - 3))),
+                    self.get_target_state_offset(target_index, worker_index),
+                )
+
+    def _claim_worker_row(self):
+        """Claim a free row for this worker, freeing the rows of workers which have exited. Expects the lock held."""
+        free_worker_index = None
+        for worker_index in range(self.max_workers):
+            (pid,) = WORKER.unpack_from(self.memory, self.workers_offset + worker_index * WORKER.size)
+            if pid != 0 and not is_process_alive(pid):
+                self._reset_worker_row(worker_index)
+                pid = 0
+            if pid == 0 and free_worker_index is None:
+                free_worker_index = worker_index
+        if free_worker_index is None:
+            raise RuntimeError(
+                f"No free row in shared target state table '{self.path}' for more than {self.max_workers} workers."
+            )
+        WORKER.pack_into(self.memory, self.workers_offset + free_worker_index * WORKER.size, os.getpid())
+        return free_worker_index
+
+    def _reset_worker_row(self, worker_index):
+        """Reset the requests in flight of the given worker and free its row. Expects the lock held."""
+        # note: blocks, latencies and tokens consumed are kept, as they still tell something about the targets
+        for target_index in range(len(self.target_names)):
+            OUTSTANDING_REQUESTS.pack_into(
+                self.memory, self.get_target_state_offset(target_index, worker_index) + 8, 0
+            )
+        WORKER.pack_into(self.memory, self.workers_offset + worker_index * WORKER.size, 0)
+
+    def get_target_state_offset(self, target_index, worker_index):
+        """Return the offset of the given target's state as seen by the given worker."""
+        return self.targets_offset + (target_index * self.max_workers + worker_index) * TARGET_STATE.size
+
+
+class SharedTargetState:
+    """
+    State of a target, shared across the workers on a host.
+
+    Writes go to the row of the current worker only, reads combine the rows of all workers.
+    """
+
+    __slots__ = ("memory", "all_workers_offset", "all_workers_struct", "own_offset")
+
+    def __init__(self, table, target_index):
+        """Constructor."""
+        self.memory = table.memory
+        self.all_workers_offset = table.get_target_state_offset(target_index, 0)
+        self.all_workers_struct = struct.Struct("<" + TARGET_STATE_FORMAT * table.max_workers)
+        self.own_offset = table.get_target_state_offset(target_index, table.worker_index)
+
+    def block_until(self, timestamp_ms):
+        """Block the target for all workers until the given timestamp (ms since epoch)."""
+        # note: aligned 8-byte values are written at once, so other workers never read half-written values
+        (blocked_until_ms,) = BLOCKED_UNTIL_MS.unpack_from(self.memory, self.own_offset)
+        BLOCKED_UNTIL_MS.pack_into(self.memory, self.own_offset, max(blocked_until_ms, int(timestamp_ms)))
+
+    def set_outstanding_requests(self, outstanding_requests):
+        """Set the number of requests in flight from this worker to the target."""
+        OUTSTANDING_REQUESTS.pack_into(self.memory, self.own_offset + 8, outstanding_requests)
+
+    def set_ewma_latency_ms(self, ewma_latency_ms):
+        """Set the EWMA latency of the target as measured by this worker."""
+        EWMA_LATENCY_MS.pack_into(self.memory, self.own_offset + 16, ewma_latency_ms)
+
+    def set_token_buckets(self, bucket_index, tokens_by_bucket):
+        """Set the index of the latest token bucket and the tokens consumed per bucket by this worker."""
+        # note: a reader may see the values of different buckets for a moment, which only skews the estimate briefly
+        TOKEN_BUCKETS.pack_into(self.memory, self.own_offset + 24, bucket_index, *tokens_by_bucket)
+
+    def get_blocked_until_ms(self):
+        """Return the timestamp until which the target is blocked, as seen by any worker."""
+        return max(self.all_workers_struct.unpack_from(self.memory, self.all_workers_offset)[0::TARGET_STATE_VALUES])
+
+    def get_outstanding_requests(self):
+        """Return the number of requests in flight to the target from all workers."""
+        return sum(self.all_workers_struct.unpack_from(self.memory, self.all_workers_offset)[1::TARGET_STATE_VALUES])
+
+    def get_ewma_latency_ms(self):
+        """Return the mean EWMA latency of the target over all workers which measured it, or None if none did."""
+        ewma_latencies_ms = [
+            ewma_latency_ms
+            for ewma_latency_ms in self.all_workers_struct.unpack_from(self.memory, self.all_workers_offset)[
+                2::TARGET_STATE_VALUES
+            ]
+            if not math.isnan(ewma_latency_ms)
+        ]
+        return sum(ewma_latencies_ms) / len(ewma_latencies_ms) if ewma_latencies_ms else None
+
+    def get_token_buckets(self):
+        """Return the index of the latest token bucket and the tokens consumed per bucket, of all workers."""
+        values = self.all_workers_struct.unpack_from(self.memory, self.all_workers_offset)
+        return [
+            (values[offset + 3], values[offset + 4 : offset + TARGET_STATE_VALUES])
+            for offset in range(0, len(values), TARGET_STATE_VALUES)
+        ]
+
+
+def get_fingerprint(target_names):
+    """Return a short fingerprint of the given target names, to tell apart proxies with different configurations."""
+    return hashlib.blake2b("\n".join(sorted(set(target_names))).encode(), digest_size=8).hexdigest()
+
+
+def is_process_alive(pid):
+    """Return True if a process with the given pid is running."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
@@ -0,0 +1,117 @@
+"""Several methods and classes around relaying event streams (server-sent events) from targets to clients."""
+
+import asyncio
+import inspect
+from collections import deque
+
+
+class SseFramer:
+    """
+    Incremental parser for server-sent events, extracting the data of the events from arbitrarily split byte chunks.
+
+    Only 'data' fields are extracted, other fields and comments are skipped. Lines may end with '\\n' or '\\r\\n'.
+    Lines which are not 'data' lines are not copied.
+    """
+
+    def __init__(self):
+        """Constructor."""
+        self.buffer = bytearray()
+        self.data_lines = []
+
+    def feed(self, chunk):
+        """Add the given chunk and return the data of the events completed by it."""
+        buffer = self.buffer
+        buffer += chunk
+        events = []
+        start = 0
+        while (end := buffer.find(b"\n", start)) >= 0:
+            line_end = end - 1 if end > start and buffer[end - 1] == 0x0D else end
+            if line_end == start:
+                # an empty line ends the event
+                if self.data_lines:
+                    events.append("\n".join(self.data_lines))
+                    self.data_lines = []
+            elif buffer.startswith(b"data:", start, line_end):
+                value_start = start + 6 if buffer.startswith(b"data: ", start, line_end) else start + 5
+                self.data_lines.append(buffer[value_start:line_end].decode())
+            start = end + 1
+        del buffer[:start]
+        return events
+
+    def flush(self):
+        """Return the data of an event which has not been ended by an empty line, eg. at the end of the stream."""
+        return self.feed(b"\n\n" if self.buffer else b"\n")
+
+
+async def relay_event_stream(chunks, on_data_event):
+    """
+    Yield the given byte chunks unchanged, and pass the data of the events within them to on_data_event.
+
+    The events are extracted and passed on in a callback scheduled on the event loop (or a task, if on_data_event is
+    async), instead of before the next chunk is read. Hence, chunks which are available already are forwarded right
+    away, and the events are processed once the relay waits for further chunks. Events are passed on in order, and the
+    stream ends once all events have been processed. If on_data_event raises an exception, the remaining chunks are
+    still forwarded, and the exception is raised at the end of the stream.
+    """
+    loop = asyncio.get_running_loop()
+    is_on_data_event_async = inspect.iscoroutinefunction(on_data_event)
+    sse_framer = SseFramer()
+    pending_chunks = deque()
+    is_processing_scheduled = False
+    processing_task = None
+    processing_exceptions = []
+
+    def process_pending_chunks():
+        """Extract and pass on the events of the pending chunks."""
+        nonlocal is_processing_scheduled
+        is_processing_scheduled = False
+        try:
+            while pending_chunks:
+                for data in sse_framer.feed(pending_chunks.popleft()):
+                    on_data_event(data)
+        except Exception as exception:  # pylint: disable=broad-exception-caught
+            processing_exceptions.append(exception)
+            pending_chunks.clear()
+
+    async def process_pending_chunks_async():
+        """Extract and pass on the events of the pending chunks, including chunks added while processing."""
+        nonlocal is_processing_scheduled
+        try:
+            while pending_chunks:
+                for data in sse_framer.feed(pending_chunks.popleft()):
+                    await on_data_event(data)
+        except Exception as exception:  # pylint: disable=broad-exception-caught
+            processing_exceptions.append(exception)
+            pending_chunks.clear()
+        finally:
+            is_processing_scheduled = False
+
+    try:
+        async for chunk in chunks:
+            if not processing_exceptions:
+                pending_chunks.append(chunk)
+                if not is_processing_scheduled:
+                    is_processing_scheduled = True
+                    if is_on_data_event_async:
+                        processing_task = loop.create_task(process_pending_chunks_async())
+                    else:
+                        loop.call_soon(process_pending_chunks)
+            yield chunk
+        if is_on_data_event_async:
+            if processing_task is not None:
+                await processing_task
+            if not processing_exceptions:
+                for data in sse_framer.flush():
+                    await on_data_event(data)
+        else:
+            process_pending_chunks()
+            if not processing_exceptions:
+                for data in sse_framer.flush():
+                    on_data_event(data)
+    finally:
+        # do not process events anymore if the stream has been closed early, eg. because the client disconnected
+        pending_chunks.clear()
+        if processing_task is not None:
+            processing_task.cancel()
+    if processing_exceptions:
+        raise processing_exceptions[0]
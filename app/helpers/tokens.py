@@ -65,3 +65,32 @@ def estimate_tokens_from_messages(messages, model="gpt-3.5-turbo-0613"):
 
     num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
     return num_tokens
+
+
+def estimate_request_cost_in_tokens(request_body_dict, default_completion_tokens=256):
+    """
+    Return a cheap estimate of the total tokens a request will cost, ie. its prompt plus its expected completion.
+
+    The completion is expected to use the requested maximum number of tokens or, if not given, the given default
+    (should be 0 for requests not generating completions, eg. embeddings).
+
+    Unlike the tiktoken-based estimations above, this is based on the length of the request's text (approx. 4
+    characters per token), so it is fast enough to be computed before every request is scheduled.
+    """
+    # note: the body is the client's JSON, so it may be anything, eg. a list or a string, with values of any type
+    if not isinstance(request_body_dict, dict):
+        return default_completion_tokens
+    prompt_characters = 0
+    for key in ("messages", "prompt", "input"):
+        if key in request_body_dict:
+            prompt_characters += len(str(request_body_dict[key]))
+    completion_tokens = default_completion_tokens
+    for key in ("max_completion_tokens", "max_output_tokens", "max_tokens"):
+        try:
+            requested_completion_tokens = int(request_body_dict.get(key) or 0)
+        except (TypeError, ValueError, OverflowError):
+            continue
+        if requested_completion_tokens > 0:
+            completion_tokens = requested_completion_tokens
+            break
+    return prompt_characters // 4 + completion_tokens
@@ -0,0 +1,110 @@
+"""Several methods and classes around letting requests wait for capacity instead of rejecting them immediately."""
+
+import asyncio
+import time
+from collections import deque
+
+
+class CapacityWaitingQueue:
+    """
+    Bounded FIFO queue in which requests wait until a target is expected to be unblocked again.
+
+    A single timer wakes the queue up at the earliest time a target unblocks. Waiters are then released one by one in
+    FIFO order, paced by the release interval instead of all at once (no thundering herd). A released waiter which
+    still finds no capacity goes back to the head of the queue, which stops the release until the next wake-up.
+    Requests served successfully release the next waiter right away, since there seems to be capacity again.
+    """
+
+    def __init__(self, max_waiting_requests=1_000, release_interval_ms=10):
+        """Constructor."""
+        self.max_waiting_requests = max_waiting_requests
+        self.release_interval_ms = release_interval_ms
+        self.waiters = deque()
+        self.wake_up_timer = None
+        self.wake_up_timestamp_ms = None
+        self.metrics = {"waited": 0, "released": 0, "timed_out": 0, "rejected": 0}
+
+    def __len__(self):
+        """Dunder method to return the number of waiting requests."""
+        return len(self.waiters)
+
+    async def wait(self, unblocked_timestamp_ms, deadline_timestamp_ms, is_retry=False):
+        """
+        Wait until released or until the deadline has been reached.
+
+        Returns True if the waiter has been released and should try again, False if the queue is full or the deadline
+        has been reached. Waiters which have been released before but found no capacity should pass is_retry=True, so
+        they keep their place at the head of the queue.
+        """
+        if len(self.waiters) >= self.max_waiting_requests:
+            self.metrics["rejected"] += 1
+            return False
+        waiter = asyncio.get_running_loop().create_future()
+        if is_retry:
+            self.waiters.appendleft(waiter)
+            # stop releasing further waiters, there is no capacity yet
+            self._cancel_wake_up()
+        else:
+            self.waiters.append(waiter)
+            self.metrics["waited"] += 1
+        self._schedule_wake_up(unblocked_timestamp_ms)
+        try:
+            await asyncio.wait_for(waiter, timeout=max(deadline_timestamp_ms - get_timestamp_ms(), 0) / 1_000)
+            return True
+        except asyncio.TimeoutError:
+            self.metrics["timed_out"] += 1
+            return False
+        except asyncio.CancelledError:
+            # pass the release on if the request is cancelled right after it has been released
+            if waiter.done() and not waiter.cancelled():
+                self.release_next()
+            raise
+        finally:
+            if not waiter.done() or waiter.cancelled():
+                self._remove(waiter)
+
+    def release_next(self):
+        """Release the next waiter, if any."""
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(True)
+                self.metrics["released"] += 1
+                return True
+        return False
+
+    def _schedule_wake_up(self, wake_up_timestamp_ms):
+        """Ensure the queue wakes up at the given time at the latest."""
+        if self.wake_up_timer is not None and self.wake_up_timestamp_ms <= wake_up_timestamp_ms:
+            return
+        self._cancel_wake_up()
+        self.wake_up_timestamp_ms = wake_up_timestamp_ms
+        self.wake_up_timer = asyncio.get_running_loop().call_later(
+            max(wake_up_timestamp_ms - get_timestamp_ms(), 0) / 1_000, self._wake_up
+        )
+
+    def _cancel_wake_up(self):
+        """Cancel the scheduled wake-up."""
+        if self.wake_up_timer is not None:
+            self.wake_up_timer.cancel()
+            self.wake_up_timer = None
+            self.wake_up_timestamp_ms = None
+
+    def _wake_up(self):
+        """Release the next waiter and schedule the release of the one after."""
+        self.wake_up_timer = None
+        self.wake_up_timestamp_ms = None
+        if self.release_next() and self.waiters:
+            self._schedule_wake_up(get_timestamp_ms() + self.release_interval_ms)
+
+    def _remove(self, waiter):
+        """Remove the given waiter from the queue."""
+        try:
+            self.waiters.remove(waiter)
+        except ValueError:
+            pass
+
+
+def get_timestamp_ms():
+    """Return the current timestamp in millisecond resolution."""
+    return time.time_ns() // 1_000_000
@@ -41,10 +41,10 @@ class AllowDeployments(PowerProxyPlugin):
     def on_client_identified(self, routing_slip):
         """Run when the client has been identified."""
         super().on_client_identified(routing_slip)
-        client = routing_slip["client"]
+        client = routing_slip.client
 
         # get the deployment requested
-        deployment_requested = routing_slip["virtual_deployment"]
+        deployment_requested = routing_slip.virtual_deployment
 
         # get the deployments allowed for the client
         client_settings = self.app_configuration.get_client_settings(client)
@@ -3,11 +3,11 @@
 import json
 import time
 
-import redis
 from fastapi import status
 from fastapi.responses import Response
 from helpers.config import Configuration
 from plugins.base import ImmediateResponseException, TokenCountingPlugin
+from redis.asyncio import StrictRedis
 
 
 class LimitUsage(TokenCountingPlugin):
@@ -56,7 +56,7 @@ class LimitUsage(TokenCountingPlugin):
         if "redis" in self.plugin_configuration:
             self.redis_host = self.plugin_configuration["redis/redis_host"]
             self.redis_password = self.plugin_configuration["redis/redis_password"]
-            self.redis_cache = redis.StrictRedis(
+            self.redis_cache = StrictRedis(
                 host=self.redis_host,
                 port=6380,
                 db=0,
@@ -69,30 +69,32 @@ class LimitUsage(TokenCountingPlugin):
         super().on_print_configuration()
         Configuration.print_setting("Redis Host", self.redis_host or "(none)", 1)
 
-    def on_client_identified(self, routing_slip):
+    async def on_shutdown(self):
+        """Close the connections to Redis, after the pending budget updates have finished."""
+        await super().on_shutdown()
+        if self.redis_cache:
+            await self.redis_cache.aclose()
+
+    async def on_client_identified(self, routing_slip):
         """Run when the client has been identified."""
         super().on_client_identified(routing_slip)
-        client = routing_slip["client"]
-        virtual_deployment = routing_slip["virtual_deployment"]
+        client = routing_slip.client
+        virtual_deployment = routing_slip.virtual_deployment
+        minute_key = f"LimitUsage-{client}-{virtual_deployment}-minute"
+        budget_key = f"LimitUsage-{client}-{virtual_deployment}-budget"
 
         # ensure there is a budget for the current client and minute, leaving budget as is if it
         # pre-exists for the current minute
+        # note: minute and budget are read at once, so this needs a single roundtrip to Redis in most cases
         current_minute = int(time.time() / 60)
-        current_minute_from_cache = int(
-            self._get_cache_setting(f"LimitUsage-{client}-{virtual_deployment}-minute") or 0
-        )
-        if not current_minute_from_cache or current_minute_from_cache != current_minute:
-            self._set_cache_setting(f"LimitUsage-{client}-{virtual_deployment}-minute", current_minute)
-            self._set_cache_setting(
-                f"LimitUsage-{client}-{virtual_deployment}-budget",
-                self._get_max_tokens_per_minute_in_k_for_client(client, virtual_deployment),
-            )
+        current_minute_from_cache, current_budget_from_cache = await self._get_cache_settings(minute_key, budget_key)
+        if not current_minute_from_cache or int(current_minute_from_cache) != current_minute:
+            current_budget_from_cache = self._get_max_tokens_per_minute_in_k_for_client(client, virtual_deployment)
+            await self._set_cache_settings({minute_key: current_minute, budget_key: current_budget_from_cache})
 
         # ensure that the client has enough budget left for the current minute and return a 429
         # response if not
-        current_minute_from_cache = int(self._get_cache_setting(f"LimitUsage-{client}-{virtual_deployment}-minute"))
-        current_budget_from_cache = int(self._get_cache_setting(f"LimitUsage-{client}-{virtual_deployment}-budget"))
-        if current_minute_from_cache == current_minute and current_budget_from_cache <= 0:
+        if int(current_budget_from_cache) <= 0:
             raise ImmediateResponseException(
                 Response(
                     content=json.dumps(
@@ -112,25 +114,41 @@ class LimitUsage(TokenCountingPlugin):
         """Is invoked when token counts are available for the request."""
         super().on_token_counts_for_request_available(routing_slip)
 
+        # responses from the cache did not cost tokens, even though they tell the usage of the original response
+        if routing_slip.is_response_from_cache:
+            return
+
         # decrement the client's budget by the total tokens
-        client = routing_slip["client"]
-        virtual_deployment = routing_slip["virtual_deployment"]
-        old_budget = int(self._get_cache_setting(f"LimitUsage-{client}-{virtual_deployment}-budget"))
-        new_budget = old_budget - self.total_tokens
-        self._set_cache_setting(f"LimitUsage-{client}-{virtual_deployment}-budget", new_budget)
-
-    def _get_cache_setting(self, key, default=None):
-        """Return the setting with the given key from the cache."""
+        # note: this is done in the background, so the response is not held up by the roundtrip to Redis
+        client = routing_slip.client
+        virtual_deployment = routing_slip.virtual_deployment
+        self.start_background_task(
+            self._decrement_cache_setting(
+                f"LimitUsage-{client}-{virtual_deployment}-budget",
+                self.get_request_state(routing_slip).total_tokens,
+            )
+        )
+
+    async def _get_cache_settings(self, *keys):
+        """Return the settings with the given keys from the cache."""
         if self.redis_cache:
-            return self.redis_cache.get(key)
-        return self.local_cache.get(key, default)
+            return await self.redis_cache.mget(keys)
+        return [self.local_cache.get(key) for key in keys]
+
+    async def _set_cache_settings(self, settings):
+        """Set the given settings in the cache."""
+        if self.redis_cache:
+            await self.redis_cache.mset(settings)
+        else:
+            self.local_cache.update(settings)
 
-    def _set_cache_setting(self, key, value):
-        """Return the setting with the given key from the cache."""
+    async def _decrement_cache_setting(self, key, amount):
+        """Decrement the setting with the given key in the cache by the given amount."""
+        # note: decrementing in Redis is atomic, so concurrent requests of the same client do not overwrite each other
         if self.redis_cache:
-            self.redis_cache.set(key, value)
+            await self.redis_cache.decrby(key, amount)
         else:
-            self.local_cache[key] = value
+            self.local_cache[key] = int(self.local_cache[key]) - amount
 
     def _get_max_tokens_per_minute_in_k_for_client(self, client, virtual_deployment):
         """Return the number of maximum tokens per minute in thousands for the given client."""
@@ -20,6 +20,7 @@ class LogUsageToConsole(LogUsageBase):
         aoai_virtual_deployment,
         aoai_standin_deployment,
         aoai_api_version,
+        is_cached,
     ):
         """Append a new line with the given infos."""
         print(
@@ -36,4 +37,5 @@ class LogUsageToConsole(LogUsageBase):
             f"Azure OpenAI Virtual Deployment : {aoai_virtual_deployment}\n"
             f"Azure OpenAI Standin Deployment : {aoai_standin_deployment}\n"
             f"Azure OpenAI API Version        : {aoai_api_version}\n"
+            f"Is Cached                       : {is_cached}\n"
         )
@@ -26,6 +26,7 @@ class LogUsageToCsvFile(LogUsageBase):
         "aoai_virtual_deployment",
         "aoai_standin_deployment",
         "aoai_api_version",
+        "is_cached",
     ]
 
     def on_plugin_instantiated(self):
@@ -59,6 +60,7 @@ class LogUsageToCsvFile(LogUsageBase):
         aoai_virtual_deployment,
         aoai_standin_deployment,
         aoai_api_version,
+        is_cached,
     ):
         """Append a new line with the given infos."""
         with open(self.log_file_path, "a", encoding="utf-8") as log_file:
@@ -75,5 +77,6 @@ class LogUsageToCsvFile(LogUsageBase):
                 f"{aoai_endpoint},"
                 f"{aoai_virtual_deployment or ''},"
                 f"{aoai_standin_deployment or ''},"
-                f"{aoai_api_version or ''}"
+                f"{aoai_api_version or ''},"
+                f"{1 if is_cached else 0}"
             )
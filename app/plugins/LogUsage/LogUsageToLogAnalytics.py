@@ -1,7 +1,7 @@
 """Declares a plugin to log usage infos to a CSV file."""
 
-from azure.identity import ClientSecretCredential, DefaultAzureCredential, ManagedIdentityCredential
-from azure.monitor.ingestion import LogsIngestionClient
+from azure.identity.aio import ClientSecretCredential, DefaultAzureCredential, ManagedIdentityCredential
+from azure.monitor.ingestion.aio import LogsIngestionClient
 from helpers.config import Configuration
 from helpers.dicts import QueryDict
 from plugins.LogUsage.LogUsageBase import LogUsageBase
@@ -18,6 +18,7 @@ class LogUsageToLogAnalytics(LogUsageBase):
     stream_name = None
     auth_mechanism = None
 
+    credential = None
     log_analytics_client = None
 
     plugin_config_jsonschema = {
@@ -64,26 +65,31 @@ class LogUsageToLogAnalytics(LogUsageBase):
         super().on_plugin_instantiated()
 
         # get credentials for Log Analytics client
-        credential = None
         match self.auth_mechanism:
             case "ClientSecretCredential":
-                credential = ClientSecretCredential(
+                self.credential = ClientSecretCredential(
                     tenant_id=self.credential_tenant_id,
                     client_id=self.credential_client_id,
                     client_secret=self.credential_client_secret,
                 )
             case "UserAssignedManagedIdentityCredential":
-                credential = ManagedIdentityCredential(client_id=self.user_assigned_managed_identity_client_id)
+                self.credential = ManagedIdentityCredential(client_id=self.user_assigned_managed_identity_client_id)
             case _:
-                credential = DefaultAzureCredential()
+                self.credential = DefaultAzureCredential()
 
         # get Log Analytics client
         self.log_analytics_client = LogsIngestionClient(
             endpoint=self.log_ingestion_endpoint,
-            credential=credential,
+            credential=self.credential,
             logging_enable=True,
         )
 
+    async def on_shutdown(self):
+        """Close the Log Analytics client and its credential, after the pending uploads have finished."""
+        await super().on_shutdown()
+        await self.log_analytics_client.close()
+        await self.credential.close()
+
     def on_print_configuration(self):
         """Print plugin-specific configuration."""
         super().on_print_configuration()
@@ -114,27 +120,32 @@ class LogUsageToLogAnalytics(LogUsageBase):
         aoai_virtual_deployment,
         aoai_standin_deployment,
         aoai_api_version,
+        is_cached,
     ):
         """Append a new line with the given infos."""
+        # note: the upload is done in the background, so the response is not held up by the roundtrip to Log Analytics
         # pylint: disable=no-value-for-parameter
-        self.log_analytics_client.upload(
-            rule_id=self.data_collection_rule_id,
-            stream_name=self.stream_name,
-            logs=[
-                {
-                    "Client": client,
-                    "RequestReceivedUtc": f"{request_received_utc}",
-                    "IsStreaming": is_streaming,
-                    "PromptTokens": prompt_tokens,
-                    "CompletionTokens": completion_tokens,
-                    "TotalTokens": total_tokens,
-                    "AoaiRoundtripTimeMS": aoai_roundtrip_time_ms,
-                    "AoaiRegion": aoai_region,
-                    "AoaiEndpoint": aoai_endpoint,
-                    "AoaiVirtualDeployment": aoai_virtual_deployment,
-                    "AoaiStandinDeployment": aoai_standin_deployment,
-                    "AoaiApiVersion": aoai_api_version,
-                }
-            ],
+        self.start_background_task(
+            self.log_analytics_client.upload(
+                rule_id=self.data_collection_rule_id,
+                stream_name=self.stream_name,
+                logs=[
+                    {
+                        "Client": client,
+                        "RequestReceivedUtc": f"{request_received_utc}",
+                        "IsStreaming": is_streaming,
+                        "PromptTokens": prompt_tokens,
+                        "CompletionTokens": completion_tokens,
+                        "TotalTokens": total_tokens,
+                        "AoaiRoundtripTimeMS": aoai_roundtrip_time_ms,
+                        "AoaiRegion": aoai_region,
+                        "AoaiEndpoint": aoai_endpoint,
+                        "AoaiVirtualDeployment": aoai_virtual_deployment,
+                        "AoaiStandinDeployment": aoai_standin_deployment,
+                        "AoaiApiVersion": aoai_api_version,
+                        "IsCached": is_cached,
+                    }
+                ],
+            )
         )
         # pylint: enable=no-value-for-parameter
@@ -1,8 +1,11 @@
 """Defines the foundation for PowerProxy plugins."""
 
+import asyncio
 import importlib
+import inspect
 import json
 import re
+from types import SimpleNamespace
 
 from helpers.tokens import estimate_prompt_tokens_from_request_body_dict
 
@@ -18,8 +21,72 @@ def foreach_plugin(plugins, method_name, *args):
             )
 
 
+async def shut_down_plugins(plugins):
+    """Let the given plugins finish their background work, eg. logging usage, then have them release their resources."""
+    await asyncio.gather(
+        *[background_task for plugin in plugins for background_task in plugin.background_tasks],
+        return_exceptions=True,
+    )
+    await asyncio.gather(*[plugin.on_shutdown() for plugin in plugins], return_exceptions=True)
+
+
+def compile_plugin_hooks(plugins):
+    """
+    Return the hooks of the given plugins, with a tuple of bound methods per hook.
+
+    A hook's tuple only contains the methods of plugins which override the hook, so hooks which would just run the
+    empty default implementation are skipped, and no attributes need to be looked up when the hooks are run. Async hooks
+    are wrapped to time out if a hook timeout is configured for the plugin.
+    """
+    hooks = {}
+    for hook_name in PluginHooks.HOOK_NAMES:
+        hook_methods = []
+        for plugin in plugins:
+            if getattr(type(plugin), hook_name) is getattr(PowerProxyPlugin, hook_name):
+                continue
+            hook_method = getattr(plugin, hook_name)
+            if inspect.iscoroutinefunction(hook_method):
+                timeout_ms = plugin.get_hook_timeout_ms(hook_name)
+                if timeout_ms is not None:
+                    hook_method = with_timeout(hook_method, timeout_ms)
+            hook_methods.append(hook_method)
+        hooks[hook_name] = tuple(hook_methods)
+    return PluginHooks(**hooks)
+
+
+def with_timeout(hook_method, timeout_ms):
+    """Return the given async hook method, wrapped to give up after the given timeout."""
+
+    async def run_hook_method(*args):
+        try:
+            await asyncio.wait_for(hook_method(*args), timeout=timeout_ms / 1_000)
+        except asyncio.TimeoutError:
+            print(
+                f"Hook '{hook_method.__name__}' of plugin '{hook_method.__self__.__class__.__name__}' timed out after "
+                f"{timeout_ms} ms. Continuing without it."
+            )
+
+    return run_hook_method
+
+
+async def run_plugin_hooks(hooks, *args):
+    """Run the given compiled plugin hooks with the given arguments, awaiting async hooks."""
+    for hook in hooks:
+        # note: only async hooks return an awaitable. whatever sync hooks return is ignored.
+        if inspect.isawaitable(result := hook(*args)):
+            await result
+
+
 class PowerProxyPlugin:
-    """A plugin for PowerProxy, doing different things at different events."""
+    """
+    A plugin for PowerProxy, doing different things at different events.
+
+    The on_* hooks run per request can also be defined as async methods. Those are awaited before the request
+    continues, so they should be used for plugins doing I/O, instead of blocking the event loop.
+
+    A plugin instance is shared by all requests, which are processed concurrently. Hence, state about a request must
+    not be stored on the plugin instance but in the plugin's request state, see get_request_state().
+    """
 
     plugin_config_jsonschema = None
     client_config_jsonschema = None
@@ -28,14 +95,48 @@ class PowerProxyPlugin:
         """Constructor."""
         self.app_configuration = app_configuration
         self.plugin_configuration = plugin_configuration
+        self.background_tasks = set()
 
     def on_plugin_instantiated(self):
         """Run directly after the new plugin instance has been instantiated."""
 
+    def start_background_task(self, coroutine):
+        """Run the given coroutine in the background, eg. for I/O which does not need to finish before the response."""
+        background_task = asyncio.get_running_loop().create_task(coroutine)
+        self.background_tasks.add(background_task)
+        background_task.add_done_callback(self._on_background_task_done)
+
+    def _on_background_task_done(self, background_task):
+        """Forget the given finished background task and print its exception, if any."""
+        self.background_tasks.discard(background_task)
+        if not background_task.cancelled() and background_task.exception():
+            print(
+                f"Background task of plugin '{self.__class__.__name__}' failed: "
+                f"{background_task.exception().__class__.__name__}: {background_task.exception()}"
+            )
+
+    def create_request_state(self):
+        """Return a new object holding the plugin's state for a single request."""
+        return SimpleNamespace()
+
+    def get_request_state(self, routing_slip):
+        """Return the plugin's state for the request with the given routing slip."""
+        return routing_slip.plugin_context.get_plugin_state(self)
+
+    def get_hook_timeout_ms(self, hook_name):
+        """Return the timeout for the given async hook in ms as configured for the plugin, or None if there is none."""
+        hook_timeout_ms = self.plugin_configuration.get("hook_timeout_ms")
+        if isinstance(hook_timeout_ms, dict):
+            return hook_timeout_ms.get(hook_name)
+        return hook_timeout_ms
+
     def on_print_configuration(self):
         """Print plugin-specific configuration."""
         print(f"Plugin: {self.__class__.__name__}")
 
+    async def on_shutdown(self):
+        """Run when PowerProxy shuts down, after the plugin's background tasks have finished, eg. to close clients."""
+
     def on_new_request_received(self, routing_slip):
         """Run when a new request has been received."""
 
@@ -67,33 +168,74 @@ class PowerProxyPlugin:
         return plugin_class(app_configuration, plugin_configuration)
 
 
-class TokenCountingPlugin(PowerProxyPlugin):
-    """A plugin which counts tokens."""
+class PluginContext:
+    """Request-scoped state of the plugins, created with the routing slip of each request."""
 
-    prompt_tokens = None
-    completion_tokens = None
-    total_tokens = None
-    last_seen_usage_object_in_data_event = None
+    __slots__ = ("plugin_states",)
 
-    def on_new_request_received(self, routing_slip):
-        """Run when a new request is received."""
-        super().on_new_request_received(routing_slip)
+    def __init__(self):
+        """Constructor."""
+        self.plugin_states = {}
+
+    def get_plugin_state(self, plugin):
+        """Return the given plugin's state for the request, creating it on first access."""
+        plugin_state = self.plugin_states.get(plugin)
+        if plugin_state is None:
+            plugin_state = self.plugin_states[plugin] = plugin.create_request_state()
+        return plugin_state
+
+
+class PluginHooks:
+    """Compiled plugin hooks run per request, with a tuple of the bound methods to run per hook."""
+
+    # note: on_plugin_instantiated and on_print_configuration are run once only, use foreach_plugin for them.
+    #       on_shutdown is run once only as well, by shut_down_plugins
+    HOOK_NAMES = (
+        "on_new_request_received",
+        "on_client_identified",
+        "on_headers_from_target_received",
+        "on_body_dict_from_target_available",
+        "on_data_event_from_target_received",
+        "on_end_of_target_response_stream_reached",
+    )
+
+    __slots__ = HOOK_NAMES + ("async_hook_names",)
+
+    def __init__(self, **hooks):
+        """Constructor."""
+        for hook_name, hook_methods in hooks.items():
+            setattr(self, hook_name, hook_methods)
+        # names of the hooks with at least one async hook method, which hence need to be awaited
+        self.async_hook_names = frozenset(
+            hook_name
+            for hook_name, hook_methods in hooks.items()
+            if any(inspect.iscoroutinefunction(hook_method) for hook_method in hook_methods)
+        )
+
+
+class TokenCountingPlugin(PowerProxyPlugin):
+    """A plugin which counts tokens."""
 
-        self.prompt_tokens = None
-        self.completion_tokens = None
-        self.total_tokens = None
-        self.last_seen_usage_object_in_data_event = None
+    def create_request_state(self):
+        """Return a new object holding the plugin's state for a single request."""
+        request_state = super().create_request_state()
+        request_state.prompt_tokens = None
+        request_state.completion_tokens = None
+        request_state.total_tokens = None
+        request_state.last_seen_usage_object_in_data_event = None
+        return request_state
 
     def on_body_dict_from_target_available(self, routing_slip):
         """Run when the body was received from AOAI (only for one-time, non-streaming requests)."""
         super().on_body_dict_from_target_available(routing_slip)
 
+        request_state = self.get_request_state(routing_slip)
         usage = (
-            routing_slip["body_dict_from_target"]["usage"] if "usage" in routing_slip["body_dict_from_target"] else None
+            routing_slip.body_dict_from_target["usage"] if "usage" in routing_slip.body_dict_from_target else None
         )
-        self.completion_tokens = usage.get("completion_tokens", 0) if usage else 0
-        self.prompt_tokens = usage["prompt_tokens"] if usage else 0
-        self.total_tokens = usage["total_tokens"] if usage else 0
+        request_state.completion_tokens = usage.get("completion_tokens", 0) if usage else 0
+        request_state.prompt_tokens = usage["prompt_tokens"] if usage else 0
+        request_state.total_tokens = usage["total_tokens"] if usage else 0
 
         self.on_token_counts_for_request_available(routing_slip)
 
@@ -101,36 +243,38 @@ class TokenCountingPlugin(PowerProxyPlugin):
         """Run when a data event has been received by AOAI (needs streaming requested)."""
         super().on_data_event_from_target_received(routing_slip)
 
-        self.completion_tokens = self.completion_tokens + 1 if self.completion_tokens else 1
-        if "data_from_target" in routing_slip:
-            data_from_target_json = json.loads(routing_slip["data_from_target"])
+        request_state = self.get_request_state(routing_slip)
+        request_state.completion_tokens = request_state.completion_tokens + 1 if request_state.completion_tokens else 1
+        if routing_slip.data_from_target is not None:
+            data_from_target_json = json.loads(routing_slip.data_from_target)
             if "usage" in data_from_target_json:
-                self.last_seen_usage_object_in_data_event = data_from_target_json["usage"]
+                request_state.last_seen_usage_object_in_data_event = data_from_target_json["usage"]
 
     def on_end_of_target_response_stream_reached(self, routing_slip):
         """Process the end of a stream (needs streaming requested)."""
         super().on_end_of_target_response_stream_reached(routing_slip)
 
-        if self.last_seen_usage_object_in_data_event:
+        request_state = self.get_request_state(routing_slip)
+        if request_state.last_seen_usage_object_in_data_event:
             # use usage info from response
-            usage = self.last_seen_usage_object_in_data_event
-            self.completion_tokens = usage.get("completion_tokens", 0) if usage else 0
-            self.prompt_tokens = usage["prompt_tokens"] if usage else 0
-            self.total_tokens = usage["total_tokens"] if usage else 0
+            usage = request_state.last_seen_usage_object_in_data_event
+            request_state.completion_tokens = usage.get("completion_tokens", 0) if usage else 0
+            request_state.prompt_tokens = usage["prompt_tokens"] if usage else 0
+            request_state.total_tokens = usage["total_tokens"] if usage else 0
         else:
             # estimate usage
-            self.prompt_tokens = estimate_prompt_tokens_from_request_body_dict(
-                routing_slip["incoming_request_body_dict"]
+            request_state.prompt_tokens = estimate_prompt_tokens_from_request_body_dict(
+                routing_slip.incoming_request_body_dict
             )
-            self.total_tokens = (
-                self.prompt_tokens + self.completion_tokens
-                if self.prompt_tokens is not None and self.completion_tokens is not None
+            request_state.total_tokens = (
+                request_state.prompt_tokens + request_state.completion_tokens
+                if request_state.prompt_tokens is not None and request_state.completion_tokens is not None
                 else None
             )
         self.on_token_counts_for_request_available(routing_slip)
 
     def on_token_counts_for_request_available(self, routing_slip):
-        """Is invoked when token counts are available for the request."""
+        """Is invoked when token counts are available for the request, see get_request_state() for the counts."""
 
 
 class ImmediateResponseException(Exception):
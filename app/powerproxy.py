@@ -7,25 +7,50 @@ PowerProxy for AOAI - reverse proxy to process requests and responses to/from Az
 
 import argparse
 import asyncio
-import io
 import json
 import random
 import re
 import time
-from contextlib import asynccontextmanager
-from datetime import datetime, timezone
+from collections import deque
+from contextlib import aclosing, asynccontextmanager
 
 import httpx
 import uvicorn
 from azure.identity import DefaultAzureCredential
 from fastapi import FastAPI, Request, status
 from fastapi.responses import Response, StreamingResponse
+from helpers.balancing import LoadBalancer
+from helpers.batching import EmbeddingsBatcher, EmbeddingsFanOut
+from helpers.caching import CACHE_STATUS_HEADER, CacheControl, EmbeddingsCache, ResponseCache
+from helpers.circuit_breaker import FAILURE_STATUS_CODES, CircuitBreaker
+from helpers.coalescing import RequestCoalescer
 from helpers.config import Configuration
+from helpers.connections import ConnectionWarmer, Http2ConnectionPool, get_connection_stats, get_proxy_url
+from helpers.credentials import COGNITIVE_SERVICES_SCOPE, AsyncTokenProvider
 from helpers.dicts import QueryDict
+from helpers.embeddings import is_embeddings_request
 from helpers.header import print_header
-from plugins.base import ImmediateResponseException, foreach_plugin
+from helpers.hedging import HedgingPolicy, send_hedged
+from helpers.metrics import METRICS_CONTENT_TYPE, Metrics, RequestTimer, get_usage_tokens
+from helpers.mocking import MockUpstream
+from helpers.rate_limits import RemainingCapacity, TokenBudget, deprioritize_targets_expected_to_throttle
+from helpers.routing import AoaiTarget, RequestPath, RoutingTable
+from helpers.routing_slip import RoutingSlip
+from helpers.scheduling import FairQueuingScheduler, SchedulingTicket
+from helpers.shared_state import SharedTargetStateTable
+from helpers.streaming import relay_event_stream
+from helpers.tokens import estimate_request_cost_in_tokens
+from helpers.waiting import CapacityWaitingQueue
+from plugins.base import ImmediateResponseException, foreach_plugin, run_plugin_hooks, shut_down_plugins
 from version import VERSION
 
+# time after which a request checks again for capacity if it is unknown when targets become available again
+UNKNOWN_UNBLOCK_RETRY_MS = 1_000
+# default maximum time a request waits for capacity, if waiting for capacity is enabled
+DEFAULT_MAX_WAIT_FOR_CAPACITY_MS = 10_000
+# number of the last chunks of an event stream searched for the usage, which comes with the last event before [DONE]
+USAGE_SEARCH_CHUNKS = 4
+
 ## define script arguments
 parser = argparse.ArgumentParser()
 # --config-file
@@ -66,31 +91,26 @@ async def lifespan(app: FastAPI):
 
     # collect AOAI targets (endpoints or deployments) and corresponding clients
     app.state.aoai_endpoint_clients = {}
-    app.state.aoai_targets = {}
-    app.state.virtual_deployment_names = []
+    app.state.connection_warmers = {}
+    app.state.mock_upstreams = {}
+    aoai_targets = []
+    circuit_breaker_configuration = QueryDict(config.get("aoai/circuit_breaker") or {})
     if config.get("aoai/mock_response"):
-
-        async def get_mock_response(request):
-            ms_to_wait_before_return = config.get("aoai/mock_response/ms_to_wait_before_return")
-            if ms_to_wait_before_return:
-                ms_to_wait_before_return = float(ms_to_wait_before_return)
-                await asyncio.sleep(ms_to_wait_before_return / 1_000)
-            return httpx.Response(200, json=config.get("aoai/mock_response/json"))
-
+        app.state.mock_upstreams["mock"] = MockUpstream(QueryDict(config.get("aoai/mock_response")))
         app.state.aoai_endpoint_clients["mock"] = httpx.AsyncClient(
             base_url="https://mock/",
-            transport=httpx.MockTransport(get_mock_response),
+            transport=httpx.MockTransport(app.state.mock_upstreams["mock"].handle_request),
+        )
+        aoai_targets.append(
+            AoaiTarget(
+                name="mock",
+                target_type="endpoint",
+                endpoint="mock",
+                url="https://mock/",
+                endpoint_client=app.state.aoai_endpoint_clients["mock"],
+                endpoint_key="",
+            )
         )
-        app.state.aoai_targets["mock"] = {
-            "name": "mock",
-            "type": "endpoint",
-            "url": "https://mock/",
-            "endpoint": "mock",
-            "endpoint_key": "",
-            "endpoint_client": app.state.aoai_endpoint_clients["mock"],
-            "next_request_not_before_timestamp_ms": 0,
-            "non_streaming_fraction": 1,
-        }
     else:
         for endpoint in config["aoai/endpoints"]:
             endpoint_qd = QueryDict(endpoint)
@@ -119,42 +139,289 @@ async def lifespan(app: FastAPI):
                 if endpoint_qd["connections/timeouts/pool"]
                 else 120.0,
             )
-            app.state.aoai_endpoint_clients[endpoint["name"]] = httpx.AsyncClient(
-                base_url=endpoint["url"], timeout=timeout, limits=limits
-            )
+            if endpoint_qd["mock"]:
+                # answer the endpoint's requests with a simulated Azure OpenAI instead of sending them to the endpoint
+                # note: mock is either true (using defaults) or an object with settings
+                app.state.mock_upstreams[endpoint["name"]] = MockUpstream(
+                    QueryDict(endpoint["mock"] if isinstance(endpoint["mock"], dict) else {})
+                )
+                app.state.aoai_endpoint_clients[endpoint["name"]] = httpx.AsyncClient(
+                    base_url=endpoint["url"],
+                    timeout=timeout,
+                    transport=httpx.MockTransport(app.state.mock_upstreams[endpoint["name"]].handle_request),
+                )
+            elif endpoint_qd["connections/http2"]:
+                # multiplex requests as streams over a few HTTP/2 connections
+                # note: http2 is either true (using defaults) or an object with settings
+                app.state.aoai_endpoint_clients[endpoint["name"]] = httpx.AsyncClient(
+                    base_url=endpoint["url"],
+                    timeout=timeout,
+                    transport=Http2ConnectionPool(
+                        max_connections=int(endpoint_qd["connections/http2/max_connections"] or 10),
+                        max_streams_per_connection=int(
+                            endpoint_qd["connections/http2/max_streams_per_connection"] or 100
+                        ),
+                        keepalive_expiry=limits.keepalive_expiry,
+                        proxy=get_proxy_url(endpoint["url"]),
+                    ),
+                )
+            else:
+                app.state.aoai_endpoint_clients[endpoint["name"]] = httpx.AsyncClient(
+                    base_url=endpoint["url"], timeout=timeout, limits=limits
+                )
+            if endpoint_qd["connections/warm_up"] and not endpoint_qd["mock"]:
+                # open connections ahead of requests and keep some of them open during idle times
+                # note: warm_up is either true (using defaults) or an object with settings. with HTTP/1.1, connections
+                #       beyond max_keepalive_connections would be closed right away, so they are not opened.
+                max_warm_connections = (
+                    int(endpoint_qd["connections/http2/max_connections"] or 10)
+                    if endpoint_qd["connections/http2"]
+                    else limits.max_keepalive_connections
+                )
+                warm_up_connections = min(
+                    int(endpoint_qd["connections/warm_up/connections"] or 4), max_warm_connections
+                )
+                min_warm_connections = endpoint_qd["connections/warm_up/min_warm_connections"]
+                app.state.connection_warmers[endpoint["name"]] = ConnectionWarmer(
+                    app.state.aoai_endpoint_clients[endpoint["name"]],
+                    connections=warm_up_connections,
+                    min_warm_connections=min(
+                        int(min_warm_connections) if min_warm_connections is not None else warm_up_connections,
+                        max_warm_connections,
+                    ),
+                    keepalive_interval=float(
+                        endpoint_qd["connections/warm_up/keepalive_interval"] or limits.keepalive_expiry / 2
+                    ),
+                )
             if "virtual_deployments" in endpoint:
                 for virtual_deployment in endpoint["virtual_deployments"]:
-                    app.state.virtual_deployment_names.append(virtual_deployment["name"])
                     for standin in virtual_deployment["standins"]:
-                        target_name = f"{standin['name']}@{virtual_deployment['name']}@{endpoint['name']}"
-                        app.state.aoai_targets[target_name] = {
-                            "name": target_name,
-                            "type": "virtual_deployment_standin",
-                            "endpoint": endpoint["name"],
-                            "virtual_deployment": virtual_deployment["name"],
-                            "standin": standin["name"],
-                            "url": endpoint["url"],
-                            "endpoint_client": app.state.aoai_endpoint_clients[endpoint["name"]],
-                            "next_request_not_before_timestamp_ms": 0,
-                            "non_streaming_fraction": float(
-                                standin["non_streaming_fraction"] if "non_streaming_fraction" in standin else 1
-                            ),
-                        } | ({"endpoint_key": endpoint["key"]} if "key" in endpoint else {})
+                        aoai_targets.append(
+                            AoaiTarget(
+                                name=f"{standin['name']}@{virtual_deployment['name']}@{endpoint['name']}",
+                                target_type="virtual_deployment_standin",
+                                endpoint=endpoint["name"],
+                                url=endpoint["url"],
+                                endpoint_client=app.state.aoai_endpoint_clients[endpoint["name"]],
+                                endpoint_key=endpoint.get("key"),
+                                virtual_deployment=virtual_deployment["name"],
+                                standin=standin["name"],
+                                non_streaming_fraction=standin.get("non_streaming_fraction", 1),
+                                priority=standin.get("priority", endpoint.get("priority", 0)),
+                                circuit_breaker=CircuitBreaker(circuit_breaker_configuration),
+                                token_budget=(
+                                    TokenBudget(standin["tokens_per_minute"])
+                                    if "tokens_per_minute" in standin
+                                    else None
+                                ),
+                            )
+                        )
             else:
-                app.state.aoai_targets[endpoint["name"]] = {
-                    "name": endpoint["name"],
-                    "type": "endpoint",
-                    "endpoint": endpoint["name"],
-                    "url": endpoint["url"],
-                    "endpoint_client": app.state.aoai_endpoint_clients[endpoint["name"]],
-                    "next_request_not_before_timestamp_ms": 0,
-                    "non_streaming_fraction": float(
-                        endpoint["non_streaming_fraction"] if "non_streaming_fraction" in endpoint else 1
-                    ),
-                } | ({"endpoint_key": endpoint["key"]} if "key" in endpoint else {})
+                aoai_targets.append(
+                    AoaiTarget(
+                        name=endpoint["name"],
+                        target_type="endpoint",
+                        endpoint=endpoint["name"],
+                        url=endpoint["url"],
+                        endpoint_client=app.state.aoai_endpoint_clients[endpoint["name"]],
+                        endpoint_key=endpoint.get("key"),
+                        non_streaming_fraction=endpoint.get("non_streaming_fraction", 1),
+                        priority=endpoint.get("priority", 0),
+                        circuit_breaker=CircuitBreaker(circuit_breaker_configuration),
+                        token_budget=(
+                            TokenBudget(endpoint["tokens_per_minute"]) if "tokens_per_minute" in endpoint else None
+                        ),
+                    )
+                )
+
+    # collect hedging policies for virtual deployments which have hedging configured
+    app.state.hedging_policies = {}
+    for endpoint in config.get("aoai/endpoints") or []:
+        for virtual_deployment in endpoint.get("virtual_deployments", []):
+            if "hedging" in virtual_deployment and virtual_deployment["name"] not in app.state.hedging_policies:
+                app.state.hedging_policies[virtual_deployment["name"]] = HedgingPolicy(
+                    virtual_deployment["name"], QueryDict(virtual_deployment["hedging"])
+                )
+
+    # queues for requests waiting for capacity and fair queuing schedulers, by virtual deployment (created on demand)
+    app.state.waiting_queues = {}
+    app.state.schedulers = {}
+
+    # build the routing table, so requests do not need to scan all targets
+    app.state.routing_table = RoutingTable(aoai_targets)
+
+    # share the state of targets (blocks, requests in flight, latencies) with the other workers on this host, so a
+    # target throttling one worker is avoided by all workers
+    # note: shared_target_state is either true/false or an object with settings. it is disabled by default.
+    app.state.shared_target_state_table = None
+    if config.get("aoai/shared_target_state") and SharedTargetStateTable.is_supported():
+        app.state.shared_target_state_table = SharedTargetStateTable(
+            [aoai_target.name for aoai_target in app.state.routing_table],
+            directory=config.get("aoai/shared_target_state/directory"),
+            max_workers=int(config.get("aoai/shared_target_state/max_workers") or 16),
+        )
+        for aoai_target in app.state.routing_table:
+            aoai_target.attach_shared_state(app.state.shared_target_state_table.get_target_state(aoai_target.name))
+    Configuration.print_setting(
+        "Shared target state",
+        app.state.shared_target_state_table.path if app.state.shared_target_state_table else "(not enabled)",
+    )
+    # estimate the remaining capacity of targets from their rate limit headers, so targets expected to throttle a
+    # request are tried last, instead of costing a roundtrip for a 429
+    # note: remaining_capacity is either true/false or an object with settings. it is disabled by default.
+    is_remaining_capacity_estimated = bool(config.get("aoai/remaining_capacity"))
+    if is_remaining_capacity_estimated:
+        remaining_capacity_configuration = QueryDict(
+            config.get("aoai/remaining_capacity") if isinstance(config.get("aoai/remaining_capacity"), dict) else {}
+        )
+        for aoai_target in app.state.routing_table:
+            aoai_target.remaining_capacity = RemainingCapacity(remaining_capacity_configuration)
+    Configuration.print_setting(
+        "Remaining capacity estimation", "enabled" if is_remaining_capacity_estimated else "(not enabled)"
+    )
+    app.state.load_balancer = LoadBalancer(QueryDict(config.get("aoai/load_balancing") or {}))
+    Configuration.print_setting("Load balancing strategy", app.state.load_balancer.strategy.name)
+    Configuration.print_setting(
+        "Wait for capacity",
+        f"max. {get_max_wait_for_capacity_ms(None)} ms" if config.get("aoai/wait_for_capacity") else "(not enabled)",
+    )
+    Configuration.print_setting(
+        "Fair queuing",
+        (
+            f"max. {config.get('aoai/fair_queuing/max_concurrent_requests')} concurrent requests per deployment"
+            if config.get("aoai/fair_queuing")
+            else "(not enabled)"
+        ),
+    )
+    # cache the responses to deterministic completions, so repeated requests cost neither a roundtrip nor tokens
+    # note: response_cache is either true/false or an object with settings. it is disabled by default.
+    app.state.response_cache = None
+    if config.get("aoai/response_cache"):
+        app.state.response_cache = ResponseCache(
+            QueryDict(config.get("aoai/response_cache") if isinstance(config.get("aoai/response_cache"), dict) else {})
+        )
+    Configuration.print_setting(
+        "Response cache",
+        (
+            f"max. {app.state.response_cache.max_bytes} bytes, TTL {app.state.response_cache.ttl_ms} ms"
+            if app.state.response_cache is not None
+            else "(not enabled)"
+        ),
+    )
+    # cache the embeddings of single inputs, so only the inputs not embedded before are requested from the targets
+    # note: embeddings_cache is either true/false or an object with settings. it is disabled by default.
+    app.state.embeddings_cache = None
+    if config.get("aoai/embeddings_cache"):
+        app.state.embeddings_cache = EmbeddingsCache(
+            QueryDict(
+                config.get("aoai/embeddings_cache") if isinstance(config.get("aoai/embeddings_cache"), dict) else {}
+            )
+        )
+    Configuration.print_setting(
+        "Embeddings cache",
+        (
+            f"max. {app.state.embeddings_cache.max_bytes} bytes"
+            if app.state.embeddings_cache is not None
+            else "(not enabled)"
+        ),
+    )
+    # coalesce identical non-streaming requests in flight, so only one of them is sent to a target
+    # note: request_coalescing is either true/false or an object with settings. it is disabled by default.
+    app.state.request_coalescer = None
+    if config.get("aoai/request_coalescing"):
+        app.state.request_coalescer = RequestCoalescer(
+            QueryDict(
+                config.get("aoai/request_coalescing")
+                if isinstance(config.get("aoai/request_coalescing"), dict)
+                else {}
+            )
+        )
+    Configuration.print_setting(
+        "Request coalescing",
+        (
+            f"usage attributed to {app.state.request_coalescer.usage_attribution}"
+            if app.state.request_coalescer is not None
+            else "(not enabled)"
+        ),
+    )
+    # batch concurrent embeddings requests with a single input, so they are sent to a target as a single request
+    # note: embeddings_batching is either true/false or an object with settings. it is disabled by default.
+    app.state.embeddings_batcher = None
+    if config.get("aoai/embeddings_batching"):
+        app.state.embeddings_batcher = EmbeddingsBatcher(
+            QueryDict(
+                config.get("aoai/embeddings_batching")
+                if isinstance(config.get("aoai/embeddings_batching"), dict)
+                else {}
+            )
+        )
+    Configuration.print_setting(
+        "Embeddings batching",
+        (
+            f"max. {app.state.embeddings_batcher.max_batch_size} requests within "
+            f"{app.state.embeddings_batcher.max_wait_ms:g} ms"
+            if app.state.embeddings_batcher is not None
+            else "(not enabled)"
+        ),
+    )
+    # split embeddings requests with many inputs into chunks, which are sent in parallel across the targets
+    # note: embeddings_fan_out is either true/false or an object with settings. it is disabled by default.
+    app.state.embeddings_fan_out = None
+    if config.get("aoai/embeddings_fan_out"):
+        app.state.embeddings_fan_out = EmbeddingsFanOut(
+            QueryDict(
+                config.get("aoai/embeddings_fan_out")
+                if isinstance(config.get("aoai/embeddings_fan_out"), dict)
+                else {}
+            )
+        )
+    Configuration.print_setting(
+        "Embeddings fan-out",
+        (
+            f"chunks of {app.state.embeddings_fan_out.chunk_size} inputs for requests with "
+            f"{app.state.embeddings_fan_out.min_inputs}+ inputs"
+            if app.state.embeddings_fan_out is not None
+            else "(not enabled)"
+        ),
+    )
+    app.state.forward_http_header_regex = re.compile(
+        config.get("aoai/forward_http_header_only_if_name_matches", ".*"), flags=re.IGNORECASE
+    )
 
-    # get DefaultAzureCredential
-    app.state.default_azure_credential = DefaultAzureCredential()
+    # get token provider for targets without key, using DefaultAzureCredential
+    # note: the token is fetched ahead, so the first requests do not have to wait for it
+    app.state.token_provider = AsyncTokenProvider(DefaultAzureCredential())
+    if any(aoai_target.endpoint_key is None for aoai_target in app.state.routing_table):
+        app.state.token_provider.prefetch(COGNITIVE_SERVICES_SCOPE)
+
+    # open connections to the endpoints in the background, so the first requests do not have to wait for handshakes
+    # note: the readiness probe reports ready once all endpoints are warmed up
+    for connection_warmer in app.state.connection_warmers.values():
+        connection_warmer.start()
+    Configuration.print_setting(
+        "Connection warm-up",
+        ", ".join(app.state.connection_warmers.keys()) if app.state.connection_warmers else "(not enabled)",
+    )
+
+    # count requests, latencies, tokens etc. and expose them at /powerproxy/metrics, aggregated across the workers on
+    # this host
+    # note: metrics is either true/false or an object with settings. it is disabled by default.
+    app.state.metrics = None
+    if config.get("aoai/metrics"):
+        app.state.metrics = Metrics(
+            QueryDict(config.get("aoai/metrics") if isinstance(config.get("aoai/metrics"), dict) else {}),
+            [aoai_target.name for aoai_target in app.state.routing_table],
+            collect_metrics,
+        )
+        app.state.metrics.start()
+    Configuration.print_setting(
+        "Metrics",
+        (
+            f"/powerproxy/metrics, snapshots every {app.state.metrics.flush_interval_ms} ms"
+            if app.state.metrics is not None
+            else "(not enabled)"
+        ),
+    )
 
     # print serve notification
     print()
@@ -165,10 +432,26 @@ async def lifespan(app: FastAPI):
     yield
 
     # shutdown
-    # close AOAI endpoint connections
+    # let plugins finish their background work, eg. logging usage, and close their clients
+    await shut_down_plugins(config.plugins)
+
+    # stop token refreshes
+    await app.state.token_provider.close()
+
+    # stop keeping connections warm and close AOAI endpoint connections
+    for connection_warmer in app.state.connection_warmers.values():
+        await connection_warmer.close()
     for aoai_endpoint_client_name in app.state.aoai_endpoint_clients:
         await app.state.aoai_endpoint_clients[aoai_endpoint_client_name].aclose()
 
+    # stop writing metrics snapshots
+    if app.state.metrics is not None:
+        await app.state.metrics.close()
+
+    # release this worker's rows in the shared target state
+    if app.state.shared_target_state_table:
+        app.state.shared_target_state_table.close()
+
 
 ## define and run proxy app
 app = FastAPI(lifespan=lifespan)
@@ -177,6 +460,8 @@ app = FastAPI(lifespan=lifespan)
 @app.exception_handler(ImmediateResponseException)
 async def exception_callback(request: Request, exception: ImmediateResponseException):
     """Immediately return given response when an ImmediateResponseException is raised."""
+    if app.state.metrics is not None and hasattr(request.state, "routing_slip"):
+        record_request_metrics(request.state.routing_slip, None, exception.response.status_code)
     return exception.response
 
 
@@ -194,48 +479,144 @@ async def liveness_probe():
     return None
 
 
+# metrics
+@app.get(
+    "/powerproxy/metrics",
+    description="Metrics of all workers on this host, in the Prometheus text format",
+)
+async def prometheus_metrics():
+    """Return the metrics of all workers on this host in the Prometheus text format, if metrics are enabled."""
+    if app.state.metrics is None:
+        return Response(
+            content=json.dumps({"error": "Metrics are not enabled in the PowerProxy's configuration."}),
+            status_code=status.HTTP_404_NOT_FOUND,
+            media_type="application/json",
+        )
+    return Response(content=app.state.metrics.render(), media_type=METRICS_CONTENT_TYPE)
+
+
+# readiness probe
+@app.get(
+    "/powerproxy/health/readiness",
+    status_code=status.HTTP_204_NO_CONTENT,
+    description="Readiness probe for the PowerProxy",
+)
+async def readiness_probe():
+    """
+    Return a 204/No Content if the proxy is ready to serve requests, or a 503/Service Unavailable with the endpoints
+    whose connections are still being warmed up.
+    """
+    endpoints_warming_up = [
+        endpoint_name
+        for endpoint_name, connection_warmer in app.state.connection_warmers.items()
+        if not connection_warmer.is_warm
+    ]
+    if endpoints_warming_up:
+        return Response(
+            content=json.dumps({"endpoints_warming_up": endpoints_warming_up}),
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            media_type="application/json",
+        )
+    return None
+
+
+# connection statistics
+@app.get(
+    "/powerproxy/stats/connections",
+    description="Statistics about the connections to the Azure OpenAI endpoints",
+)
+async def connection_stats():
+    """Return statistics about the connections to the Azure OpenAI endpoints, per endpoint."""
+    return {
+        endpoint_name: {
+            **get_connection_stats(endpoint_client),
+            **(
+                {"warm_up": app.state.connection_warmers[endpoint_name].get_stats()}
+                if endpoint_name in app.state.connection_warmers
+                else {}
+            ),
+        }
+        for endpoint_name, endpoint_client in app.state.aoai_endpoint_clients.items()
+    }
+
+
+# cache statistics
+@app.get(
+    "/powerproxy/stats/cache",
+    description="Statistics about the response and embeddings caches",
+)
+async def cache_stats():
+    """Return statistics about the response and embeddings caches of this worker, for the caches enabled."""
+    return {
+        cache_name: cache.get_stats()
+        for cache_name, cache in [
+            ("response_cache", app.state.response_cache),
+            ("embeddings_cache", app.state.embeddings_cache),
+        ]
+        if cache is not None
+    }
+
+
+# coalescing statistics
+@app.get(
+    "/powerproxy/stats/coalescing",
+    description="Statistics about the requests coalesced with identical requests in flight",
+)
+async def coalescing_stats():
+    """Return statistics about the coalesced requests of this worker, if request coalescing is enabled."""
+    return app.state.request_coalescer.get_stats() if app.state.request_coalescer is not None else {}
+
+
+# batching statistics
+@app.get(
+    "/powerproxy/stats/batching",
+    description="Statistics about the embeddings requests batched with concurrent requests or split into chunks",
+)
+async def batching_stats():
+    """Return statistics about the batched and chunked embeddings requests of this worker, for the features enabled."""
+    return {
+        feature_name: feature.get_stats()
+        for feature_name, feature in [
+            ("embeddings_batching", app.state.embeddings_batcher),
+            ("embeddings_fan_out", app.state.embeddings_fan_out),
+        ]
+        if feature is not None
+    }
+
+
 # all other GETs and POSTs
 @app.get("/{path:path}")
 @app.post("/{path:path}")
 async def handle_request(request: Request, path: str):
     """Handle any incoming request."""
     # create a new routing slip, populate it with some variables and tell plugins about new request
-    routing_slip = {
-        "request_received_utc": datetime.now(timezone.utc),
-        "incoming_request": request,
-        "incoming_request_body": await request.body(),
-        "path": path,
-    }
+    routing_slip = RoutingSlip(request, await request.body(), path)
+    request_timer = RequestTimer()
+    metrics = app.state.metrics
+    if metrics is not None:
+        # note: for the metrics of requests answered by an ImmediateResponseException
+        request.state.routing_slip = routing_slip
     is_v1_request = False
-    routing_slip["virtual_deployment"] = None
-    deployment_match = re.search(r"(?<=deployments\/)[^\/]+", path)
-
-    if deployment_match:
-        routing_slip["virtual_deployment"] = deployment_match.group(0)
-    routing_slip["incoming_request_body_dict"] = None
-    try:
-        routing_slip["incoming_request_body_dict"] = await request.json()
-        # In case deployment id is not available in the request path, extract it from the body.
-        # Compliance with https://learn.microsoft.com/en-us/azure/ai-foundry/openai/latest V1 apis.
-        if not routing_slip.get("virtual_deployment") and routing_slip["incoming_request_body_dict"].get('model'):
-            routing_slip["virtual_deployment"] = routing_slip["incoming_request_body_dict"].get('model')
-            is_v1_request = True
-    except:
-        pass
-    routing_slip["is_non_streaming_response_requested"] = routing_slip["incoming_request_body_dict"] and not (
-        "stream" in routing_slip["incoming_request_body_dict"]
-        and str(routing_slip["incoming_request_body_dict"]["stream"]).lower() == "true"
-    )
-    routing_slip["api_version"] = request.query_params["api-version"] if "api-version" in request.query_params else ""
-    foreach_plugin(config.plugins, "on_new_request_received", routing_slip)
+    request_path = RequestPath(path)
+    routing_slip.virtual_deployment = request_path.deployment
+    # In case deployment id is not available in the request path, extract it from the body.
+    # Compliance with https://learn.microsoft.com/en-us/azure/ai-foundry/openai/latest V1 apis.
+    if (
+        not routing_slip.virtual_deployment
+        and isinstance(routing_slip.incoming_request_body_dict, dict)
+        and routing_slip.incoming_request_body_dict.get("model")
+    ):
+        routing_slip.virtual_deployment = routing_slip.incoming_request_body_dict.get("model")
+        is_v1_request = True
+    routing_slip.api_version = request.query_params.get("api-version", "")
+    await run_plugin_hooks(config.plugin_hooks.on_new_request_received, routing_slip)
 
     # remove undesired headers from request
-    forward_http_header_only_if_name_matches = config.get("aoai/forward_http_header_only_if_name_matches", ".*")
+    forward_http_header_regex = app.state.forward_http_header_regex
     headers = {
         header_name: request.headers[header_name]
         for header_name in request.headers.keys()
-        if re.match(forward_http_header_only_if_name_matches, header_name, flags=re.IGNORECASE)
-        and header_name.lower() not in ["host", "content-length"]
+        if forward_http_header_regex.match(header_name) and header_name.lower() not in ["host", "content-length"]
     }
 
     # identify client
@@ -281,20 +662,21 @@ async def handle_request(request: Request, path: str):
                     status_code=status.HTTP_400_BAD_REQUEST,
                 )
             )
-    routing_slip["client"] = client
+    routing_slip.client = client
     if client:
-        foreach_plugin(config.plugins, "on_client_identified", routing_slip)
+        await run_plugin_hooks(config.plugin_hooks.on_client_identified, routing_slip)
 
     # if virtual deployments are used, make sure the requested deployment is configured
+    routing_table = app.state.routing_table
     if (
-        app.state.virtual_deployment_names
-        and routing_slip["virtual_deployment"] not in app.state.virtual_deployment_names
+        routing_table.virtual_deployment_names
+        and routing_slip.virtual_deployment not in routing_table.virtual_deployment_names
     ):
         raise ImmediateResponseException(
             Response(
                 content=json.dumps(
                     {
-                        "error": f"The specified deployment '{routing_slip['virtual_deployment']}' is not available. "
+                        "error": f"The specified deployment '{routing_slip.virtual_deployment}' is not available. "
                         "Ensure that you send the request to an existing virtual deployment configured in PowerProxy."
                     }
                 ),
@@ -303,187 +685,796 @@ async def handle_request(request: Request, path: str):
             )
         )
 
-    # get response from AOAI by iterating through the configured targets (endpoints or deployments)
-    aoai_response: httpx.Response = None
-    for aoai_target_name in app.state.aoai_targets:
-        aoai_target = app.state.aoai_targets[aoai_target_name]
+    # update auth headers against real API key from AOAI/Entra ID bearer token for AOAI, but only if the request has
+    # a (previously successfully verified) API key
+    # note: intentionally not raising an exception here if an API key is missing to support requests using
+    #       Azure AD/Entra ID authentication. Entra ID requests miss an api-key header but have an Authorization
+    #       header, and we pass that as is, so AOAI will do the authentication then for us.
+    async def get_headers_for_target(aoai_target):
+        """Return the headers to send to the given target."""
+        if "api-key" not in headers:
+            return headers
+        target_headers = dict(headers)
+        if aoai_target.endpoint_key is not None:
+            target_headers["api-key"] = aoai_target.endpoint_key
+        else:
+            del target_headers["api-key"]
+            if "authorization" in target_headers:
+                del target_headers["authorization"]
+            if "Authorization" in target_headers:
+                del target_headers["Authorization"]
+            token = await app.state.token_provider.get_token(COGNITIVE_SERVICES_SCOPE)
+            target_headers["Authorization"] = f"Bearer {token}"
+        return target_headers
 
-        # try next target if this target is blocked
-        if aoai_target["next_request_not_before_timestamp_ms"] > get_current_timestamp_in_ms():
-            continue
+    def get_path_for_target(aoai_target):
+        """Return the path to send to the given target, replacing the deployment against the standin."""
+        if aoai_target.is_virtual_deployment_standin and not is_v1_request:
+            return request_path.with_deployment(aoai_target.standin)
+        return routing_slip.path
 
-        # try next target if target is virtual_deployment_standin and target's deployment does not match requested
-        # deployment
-        if (
-            aoai_target["type"] == "virtual_deployment_standin"
-            and "virtual_deployment" in routing_slip
-            and routing_slip["virtual_deployment"] != aoai_target["virtual_deployment"]
-        ):
-            continue
+    def get_path_and_body_for_target(aoai_target, request_body_dict=None):
+        """
+        Return the path and body to send to the given target, replacing the deployment against the standin. The body is
+        the request's body, unless another body is given, eg. for a batch or a chunk of embeddings inputs.
+        """
+        if request_body_dict is not None:
+            if aoai_target.is_virtual_deployment_standin and is_v1_request and "model" in request_body_dict:
+                request_body_dict = {**request_body_dict, "model": aoai_target.standin}
+            return get_path_for_target(aoai_target), json.dumps(request_body_dict).encode()
+        if not aoai_target.is_virtual_deployment_standin or not is_v1_request:
+            return get_path_for_target(aoai_target), routing_slip.incoming_request_body
+        if routing_slip.incoming_request_body_dict and "model" in routing_slip.incoming_request_body_dict:
+            routing_slip.incoming_request_body_dict["model"] = aoai_target.standin
+            return routing_slip.path, json.dumps(routing_slip.incoming_request_body_dict).encode()
+        return routing_slip.path, routing_slip.incoming_request_body
 
-        # try next target if the non-streaming filter is not passed
-        if not passes_non_streaming_filter(
-            routing_slip["is_non_streaming_response_requested"], aoai_target["non_streaming_fraction"]
-        ):
-            continue
+    async def send_request_to_target(aoai_target, stream, cost_in_tokens, request_body_dict=None):
+        """
+        Send the request (with the given body if there is one) to the given target and record the outcome at the
+        target's breaker, capacity and budget.
+        """
+        target_path, target_body = get_path_and_body_for_target(aoai_target, request_body_dict)
+        circuit_breaker = aoai_target.circuit_breaker
+        is_recorded_at_capacity_and_budget = False
 
-        # update auth headers against real API key from AOAI/Entra ID bearer token for AOAI, but only if the request has
-        # a (previously successfully verified) API key
-        # note: intentionally not raising an exception here if an API key is missing to support requests using
-        #       Azure AD/Entra ID authentication. Entra ID requests miss an api-key header but have an Authorization
-        #       header, and we pass that as is, so AOAI will do the authentication then for us.
-        if "api-key" in headers:
-            if "endpoint_key" in aoai_target:
-                headers["api-key"] = aoai_target["endpoint_key"] or ""
-            else:
-                del headers["api-key"]
-                if "authorization" in headers:
-                    del headers["authorization"]
-                if "Authorization" in headers:
-                    del headers["Authorization"]
-                token = app.state.default_azure_credential.get_token(
-                    "https://cognitiveservices.azure.com/.default"
-                ).token
-                headers["Authorization"] = f"Bearer {token}"
-
-        # replace deployment against standin in path if target is deployment standin
-        if aoai_target["type"] == "virtual_deployment_standin":
-            if not is_v1_request:
-                routing_slip["path"] = re.sub(
-                    r"/deployments/[^/]+", f"/deployments/{aoai_target['standin']}", routing_slip["path"]
+        def refund_at_capacity_and_budget():
+            """Give the request's tokens back to the target's capacity and budget."""
+            if aoai_target.remaining_capacity is not None:
+                aoai_target.remaining_capacity.refund_request(cost_in_tokens)
+            if aoai_target.token_budget is not None:
+                aoai_target.token_budget.consume(-cost_in_tokens, get_current_timestamp_in_ms())
+
+        try:
+            aoai_request = aoai_target.endpoint_client.build_request(
+                request.method,
+                target_path,
+                params=request.query_params,
+                headers=await get_headers_for_target(aoai_target),
+                content=target_body,
+            )
+            remaining_capacity_mark = (
+                aoai_target.remaining_capacity.record_request(cost_in_tokens)
+                if aoai_target.remaining_capacity is not None
+                else None
+            )
+            if aoai_target.token_budget is not None:
+                aoai_target.token_budget.consume(cost_in_tokens, get_current_timestamp_in_ms())
+            is_recorded_at_capacity_and_budget = True
+            upstream_start_time = time.perf_counter()
+            aoai_response = await app.state.load_balancer.send(aoai_target, aoai_request, stream)
+        except httpx.TransportError as exception:
+            # connection errors, timeouts etc. count as failures, so the next target is tried
+            print(
+                f"{exception.__class__.__name__} while using target '{aoai_target.name}'. Path: {target_path} "
+                f"Target Url: {aoai_target.url} Exception: {exception}"
+            )
+            circuit_breaker.record_failure(get_current_timestamp_in_ms())
+            # the request did not reach the target or got no answer, so it does not count against the target's
+            # capacity and tokens per minute either
+            if is_recorded_at_capacity_and_budget:
+                refund_at_capacity_and_budget()
+            if metrics is not None:
+                metrics.increment(
+                    "powerproxy_upstream_requests_total", (aoai_target.name, exception.__class__.__name__)
                 )
-            else:
-                if routing_slip["incoming_request_body_dict"] and "model" in routing_slip["incoming_request_body_dict"]:
-                    routing_slip["incoming_request_body_dict"]["model"] = aoai_target["standin"]
-                    # Update the request body content
-                    routing_slip["incoming_request_body"] = json.dumps(routing_slip["incoming_request_body_dict"]).encode()
-
-        # remember target and request start time
-        routing_slip["aoai_endpoint"] = aoai_target["endpoint"]
-        routing_slip["aoai_virtual_deployment"] = (
-            aoai_target["virtual_deployment"] if "virtual_deployment" in aoai_target else None
-        )
-        routing_slip["aoai_standin_deployment"] = aoai_target["standin"] if "standin" in aoai_target else None
-        routing_slip["aoai_request_start_time"] = get_current_timestamp_in_ms()
-
-        # send request
-        aoai_request = aoai_target["endpoint_client"].build_request(
-            request.method,
-            routing_slip["path"],
-            params=request.query_params,
-            headers=headers,
-            content=routing_slip["incoming_request_body"],
-        )
-        aoai_response = await aoai_target["endpoint_client"].send(
-            aoai_request,
-            stream=(not routing_slip["is_non_streaming_response_requested"]),
-        )
+            raise
+        except BaseException as exception:
+            circuit_breaker.release()
+            # a cancelled request, eg. the losing one of a hedged request, does not count against the target's capacity
+            # and tokens per minute
+            if isinstance(exception, asyncio.CancelledError) and is_recorded_at_capacity_and_budget:
+                refund_at_capacity_and_budget()
+            raise
+        if metrics is not None:
+            metrics.observe(
+                "powerproxy_upstream_latency_seconds", (aoai_target.name,), time.perf_counter() - upstream_start_time
+            )
+            metrics.increment("powerproxy_upstream_requests_total", (aoai_target.name, str(aoai_response.status_code)))
+
+        # update the target's remaining capacity from the rate limit headers, which come with every response
+        if aoai_target.remaining_capacity is not None:
+            aoai_target.remaining_capacity.record_headers(
+                aoai_response.headers, get_current_timestamp_in_ms(), remaining_capacity_mark
+            )
+
+        # got 408/Request Timeout, 429/Too Many Requests, or 500/Internal Server Error
+        # note: if AOAI tells us how long to wait, the target is blocked that long. otherwise, the circuit breaker
+        #       decides from the failure rate
+        if aoai_response.status_code in FAILURE_STATUS_CODES:
+            circuit_breaker.record_failure(
+                get_current_timestamp_in_ms(),
+                int(aoai_response.headers["retry-after-ms"]) if "retry-after-ms" in aoai_response.headers else None,
+            )
+            # throttled requests do not count against the target's tokens per minute
+            if aoai_response.status_code == 429 and aoai_target.token_budget is not None:
+                aoai_target.token_budget.consume(-cost_in_tokens, get_current_timestamp_in_ms())
+        else:
+            circuit_breaker.record_success(get_current_timestamp_in_ms())
+        return aoai_response
+
+    async def check_response_from_target(aoai_target, aoai_response):
+        """Return True if the response can be passed on to the client, otherwise False."""
         # got http code other than 200 or 401
         if aoai_response.status_code not in [200, 401]:
             # print infos to console
-            if not routing_slip["is_non_streaming_response_requested"]:
-                await aoai_response.aread()
+            await aoai_response.aread()
             print(
                 (
-                    f"Unexpected HTTP Code {aoai_response.status_code} while using target '{aoai_target['name']}'. "
-                    f"Path: {routing_slip['path']} "
-                    f"Target Url: {aoai_target['url']}"
+                    f"Unexpected HTTP Code {aoai_response.status_code} while using target '{aoai_target.name}'. "
+                    f"Path: {get_path_for_target(aoai_target)} "
+                    f"Target Url: {aoai_target.url}"
                     f"Response: {aoai_response.text}"
                 )
             )
-        # got 408/Request Timeout, 429/Too Many Requests, or 500/Internal Server Error
-        if aoai_response.status_code in [408, 429, 500]:
-            # block endpoint for some time, either according to the time given by AOAI or, if not
-            # available, for 10 seconds
-            waiting_time_ms_until_next_request = (
-                int(aoai_response.headers["retry-after-ms"]) if "retry-after-ms" in aoai_response.headers else 10_000
+        return aoai_response.status_code not in FAILURE_STATUS_CODES
+
+    # serve deterministic completions requested before from the response cache, if enabled for the client
+    # note: clients can bypass the cache with the request's 'Cache-Control' header (no-cache, no-store or max-age)
+    cache_control = CacheControl(request.headers.get("cache-control"))
+    response_cache_key = get_response_cache_key(routing_slip)
+    response_cache_status = None
+    if response_cache_key is not None:
+        if cache_control.is_lookup_allowed:
+            cached_response = app.state.response_cache.get(
+                response_cache_key, get_current_timestamp_in_ms(), cache_control.max_age_ms
             )
-            aoai_target["next_request_not_before_timestamp_ms"] = (
-                get_current_timestamp_in_ms() + waiting_time_ms_until_next_request
+            if cached_response is not None:
+                routing_slip.is_response_from_cache = True
+                routing_slip.aoai_request_start_time = get_current_timestamp_in_ms()
+                response = await pass_response_to_client(
+                    routing_slip,
+                    httpx.Response(200, headers=cached_response.headers, stream=httpx.ByteStream(cached_response.body)),
+                    request_timer,
+                    None,
+                    "HIT",
+                )
+                record_request_metrics(routing_slip, None, response.status_code, request_timer)
+                return response
+            response_cache_status = "MISS"
+        else:
+            app.state.response_cache.record_bypass()
+            response_cache_status = "BYPASS"
+        if not cache_control.is_store_allowed:
+            response_cache_key = None
+
+    # take the embeddings of inputs embedded before from the embeddings cache, and request only the other inputs
+    embeddings_cache_lookup = look_up_embeddings(routing_slip, cache_control)
+    if embeddings_cache_lookup is not None:
+        if embeddings_cache_lookup.is_complete:
+            routing_slip.is_response_from_cache = True
+            routing_slip.aoai_request_start_time = get_current_timestamp_in_ms()
+            response = await pass_response_to_client(
+                routing_slip,
+                httpx.Response(
+                    200,
+                    headers={"content-type": "application/json"},
+                    stream=httpx.ByteStream(json.dumps(embeddings_cache_lookup.create_response_body_dict()).encode()),
+                ),
+                request_timer,
+                None,
+                "HIT",
+            )
+            record_request_metrics(routing_slip, None, response.status_code, request_timer)
+            return response
+        if embeddings_cache_lookup.has_cached_embeddings:
+            routing_slip.incoming_request_body_dict = embeddings_cache_lookup.get_request_body_dict_for_missing_inputs(
+                routing_slip.incoming_request_body_dict
             )
+            routing_slip.incoming_request_body = json.dumps(routing_slip.incoming_request_body_dict).encode()
+            response_cache_status = "PARTIAL"
+        else:
+            response_cache_status = "MISS" if cache_control.is_lookup_allowed else "BYPASS"
 
-            # try next target
-            continue
+    # if the requested virtual deployment is saturated, let requests pass in weighted fair order across clients, where
+    # each request costs its estimated number of tokens
+    default_completion_tokens = (
+        0 if is_embeddings_request(path) else int(config.get("aoai/fair_queuing/default_completion_tokens", 256))
+    )
+    request_cost_in_tokens = estimate_request_cost_in_tokens(
+        routing_slip.incoming_request_body_dict, default_completion_tokens=default_completion_tokens
+    )
 
-        # if we reached here, we found a target which is able to serve our request
-        # -> go ahead
-        break
+    async def get_response_from_any_target(request_body_dict=None, candidate_rotation=0):
+        """
+        Return the responding target and its response, after passing the scheduler and waiting for capacity if
+        configured, or raise if no target can serve the request.
 
-    # raise 429 if we could not find any suitable target
-    if aoai_response is None:
-        raise ImmediateResponseException(
-            Response(
-                content=json.dumps(
-                    {"message": "Could not find any endpoint or deployment with remaining capacity. Try again later."}
-                ),
-                headers={"retry-after-ms": f"{10_000}"},
-                media_type="application/json",
-                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        The request is sent with the given body if there is one, eg. for a batch or a chunk of embeddings inputs. The
+        available candidates of the highest priority are rotated by the given number of targets, so chunks sent in
+        parallel start at different targets of that priority.
+        """
+        cost_in_tokens = (
+            request_cost_in_tokens
+            if request_body_dict is None
+            else estimate_request_cost_in_tokens(request_body_dict, default_completion_tokens=default_completion_tokens)
+        )
+        scheduling_ticket = await acquire_scheduling_ticket(routing_slip.virtual_deployment, client, cost_in_tokens)
+
+        # use hedging if configured for the requested virtual deployment and applicable to the request
+        hedging_policy = app.state.hedging_policies.get(routing_slip.virtual_deployment)
+        if hedging_policy and not HedgingPolicy.applies_to(path, routing_slip.is_non_streaming_response_requested):
+            hedging_policy = None
+        if hedging_policy:
+            # note: counted once per request, even if it is sent again after waiting for capacity
+            hedging_policy.record_request()
+
+        # get response from AOAI by iterating through the configured targets (endpoints or deployments)
+        # note: targets whose remaining capacity is expected to be too low for the request are tried last, regardless of
+        #       their priority
+        candidates = deprioritize_targets_expected_to_throttle(
+            app.state.load_balancer.order_candidates(
+                routing_table.get_candidates(routing_slip.virtual_deployment),
+                routing_table.get_candidate_tiers(routing_slip.virtual_deployment),
+            ),
+            cost_in_tokens,
+            get_current_timestamp_in_ms(),
+        )
+        if candidate_rotation:
+            # note: only the targets of the highest priority which are available are rotated, so lower priorities are
+            #       still used only if those are not
+            candidates = LoadBalancer.rotate_first_tier(
+                candidates,
+                candidate_rotation,
+                lambda aoai_target: is_target_available(aoai_target, cost_in_tokens),
             )
+
+        async def get_response_from_targets():
+            """Try the eligible targets and return the responding target, its response and whether it is usable."""
+            aoai_response: httpx.Response = None
+            responding_aoai_target = None
+            is_response_usable = False
+            nonlocal transport_exception
+            eligible_targets = get_eligible_targets(
+                candidates, routing_slip.is_non_streaming_response_requested, cost_in_tokens
+            )
+            for attempt, aoai_target in enumerate(eligible_targets):
+                if attempt and metrics is not None:
+                    # the previous target failed or throttled
+                    metrics.increment("powerproxy_failovers_total", (routing_slip.virtual_deployment or "",))
+                routing_slip.aoai_request_start_time = get_current_timestamp_in_ms()
+                try:
+                    if hedging_policy:
+                        # note: the next target for a hedged request is taken from the same iterator, so it is not tried
+                        #       again after a failed hedged request
+                        aoai_target, target_response, is_response_usable = await send_hedged(
+                            hedging_policy,
+                            aoai_target,
+                            eligible_targets,
+                            lambda hedged_target: send_request_to_target(
+                                hedged_target, True, cost_in_tokens, request_body_dict
+                            ),
+                            check_response_from_target,
+                        )
+                    else:
+                        target_response = await send_request_to_target(
+                            aoai_target,
+                            not routing_slip.is_non_streaming_response_requested,
+                            cost_in_tokens,
+                            request_body_dict,
+                        )
+                        is_response_usable = await check_response_from_target(aoai_target, target_response)
+                except httpx.TransportError as exception:
+                    # try next target
+                    transport_exception = exception
+                    continue
+
+                if aoai_response is not None:
+                    await aoai_response.aclose()
+                responding_aoai_target, aoai_response = aoai_target, target_response
+                if is_response_usable:
+                    # if we reached here, we found a target which is able to serve our request
+                    # -> go ahead
+                    break
+            return responding_aoai_target, aoai_response, is_response_usable
+
+        # if no target can serve the request, wait for capacity if configured, instead of failing immediately
+        # note: waiting requests are released in order. a released request not finding capacity keeps its place.
+        transport_exception = None
+        waiting_queue = get_waiting_queue(routing_slip.virtual_deployment)
+        waiting_deadline_timestamp_ms = (
+            get_current_timestamp_in_ms() + get_max_wait_for_capacity_ms(client) if waiting_queue is not None else None
         )
+        has_waited = False
+        try:
+            while True:
+                responding_aoai_target, aoai_response, is_response_usable = await get_response_from_targets()
+                if is_response_usable or waiting_queue is None:
+                    break
+                unblocked_timestamp_ms = get_earliest_unblocked_timestamp_ms(candidates, cost_in_tokens)
+                if unblocked_timestamp_ms > waiting_deadline_timestamp_ms or not await waiting_queue.wait(
+                    unblocked_timestamp_ms, waiting_deadline_timestamp_ms, is_retry=has_waited
+                ):
+                    break
+                has_waited = True
+                if aoai_response is not None:
+                    await aoai_response.aclose()
+            if is_response_usable and waiting_queue is not None:
+                # there seems to be capacity, so let the next waiting request try
+                waiting_queue.release_next()
+        except BaseException:
+            scheduling_ticket.release()
+            raise
+        # let the next request pass the scheduler once the response has been passed on to the client completely
+        if aoai_response is None:
+            scheduling_ticket.release()
+        else:
+            scheduling_ticket.release_when_closed(aoai_response)
 
+        # raise 502 if all targets tried failed with connection errors or timeouts
+        if aoai_response is None and transport_exception is not None:
+            raise ImmediateResponseException(
+                Response(
+                    content=json.dumps(
+                        {
+                            "message": "Could not get a response from any endpoint or deployment due to "
+                            f"{transport_exception.__class__.__name__}. Try again later."
+                        }
+                    ),
+                    media_type="application/json",
+                    status_code=status.HTTP_502_BAD_GATEWAY,
+                )
+            )
+
+        # raise 429 if we could not find any suitable target, telling the client when the first target unblocks
+        if aoai_response is None:
+            raise ImmediateResponseException(
+                Response(
+                    content=json.dumps(
+                        {
+                            "message": "Could not find any endpoint or deployment with remaining capacity. Try again "
+                            "later."
+                        }
+                    ),
+                    headers={"retry-after-ms": f"{get_retry_after_ms(candidates, cost_in_tokens)}"},
+                    media_type="application/json",
+                    status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                )
+            )
+
+        return responding_aoai_target, aoai_response
+
+    # if configured, split embeddings requests with many inputs into chunks sent in parallel across the targets, batch
+    # concurrent embeddings requests with a single input, and coalesce identical non-streaming requests in flight
+    # note: for chunked, batched and coalesced requests, the roundtrip is the time until all responses needed are there
+    request_timer.start_waiting()
+    if is_embeddings_fan_out_applicable(routing_slip, request.method):
+        routing_slip.aoai_request_start_time = get_current_timestamp_in_ms()
+        responding_aoai_target, aoai_response = await app.state.embeddings_fan_out.get_response(
+            routing_slip.incoming_request_body_dict, get_response_from_any_target
+        )
+    elif (embeddings_batching_key := get_embeddings_batching_key(routing_slip, request.method)) is not None:
+        routing_slip.aoai_request_start_time = get_current_timestamp_in_ms()
+        responding_aoai_target, aoai_response = await app.state.embeddings_batcher.get_response(
+            embeddings_batching_key, routing_slip.incoming_request_body_dict, get_response_from_any_target
+        )
+    elif (coalescing_key := get_coalescing_key(routing_slip, request.method)) is not None:
+        routing_slip.aoai_request_start_time = get_current_timestamp_in_ms()
+        responding_aoai_target, aoai_response, routing_slip.is_response_coalesced = (
+            await app.state.request_coalescer.get_response(coalescing_key, get_response_from_any_target)
+        )
+    else:
+        responding_aoai_target, aoai_response = await get_response_from_any_target()
+    request_timer.stop_waiting()
+
+    # remember target
+    routing_slip.path, routing_slip.incoming_request_body = get_path_and_body_for_target(responding_aoai_target)
+    routing_slip.aoai_endpoint = responding_aoai_target.endpoint
+    routing_slip.aoai_virtual_deployment = responding_aoai_target.virtual_deployment
+    routing_slip.aoai_standin_deployment = responding_aoai_target.standin
+
+    response = await pass_response_to_client(
+        routing_slip, aoai_response, request_timer, response_cache_key, response_cache_status, embeddings_cache_lookup
+    )
+    record_request_metrics(routing_slip, responding_aoai_target, response.status_code, request_timer)
+    return response
+
+
+async def pass_response_to_client(
+    routing_slip,
+    aoai_response,
+    request_timer,
+    response_cache_key,
+    response_cache_status,
+    embeddings_cache_lookup=None,
+):
+    """
+    Run the plugins on the given response and return it to the client, storing it in the response cache under the
+    given key if there is one, and merging it with the cached embeddings if there is an embeddings cache lookup. The
+    time reading the response's body counts as waiting for the target in the given request timer.
+    """
     # process received headers
-    routing_slip["headers_from_target"] = aoai_response.headers
-    foreach_plugin(config.plugins, "on_headers_from_target_received", routing_slip)
+    routing_slip.headers_from_target = aoai_response.headers
+    try:
+        await run_plugin_hooks(config.plugin_hooks.on_headers_from_target_received, routing_slip)
+    except BaseException:
+        await aoai_response.aclose()
+        raise
 
     # determine if it's actually an event stream or not
-    routing_slip["is_event_stream"] = (
+    routing_slip.is_event_stream = (
         "content-type" in aoai_response.headers and "text/event-stream" in aoai_response.headers["content-type"]
     )
 
     # return different response types depending if it's an event stream or not
-    routing_slip["response_headers_from_target"] = {
+    routing_slip.response_headers_from_target = {
         header_item[0].decode(): header_item[1].decode() for header_item in aoai_response.headers.raw
     }
-    match routing_slip["is_event_stream"]:
+    match routing_slip.is_event_stream:
         case False:
             # non-streamed response
+            request_timer.start_waiting()
             body = await aoai_response.aread()
+            request_timer.stop_waiting()
             measure_aoai_roundtrip_time_ms(routing_slip)
-            try:
-                routing_slip["body_dict_from_target"] = json.load(io.BytesIO(body))
-                foreach_plugin(config.plugins, "on_body_dict_from_target_available", routing_slip)
-            except:
-                # eat any exception in case the response cannot be parsed
-                pass
+            routing_slip.body_from_target = body
+            if embeddings_cache_lookup is not None and aoai_response.status_code == 200:
+                # store the embeddings received and merge them with the cached ones, if there are any
+                body_dict = embeddings_cache_lookup.complete_response_body_dict(routing_slip.body_dict_from_target)
+                if body_dict is not None:
+                    body = routing_slip.body_from_target = json.dumps(body_dict).encode()
+                    routing_slip.body_dict_from_target = body_dict
+                    routing_slip.response_headers_from_target = {
+                        name: value
+                        for name, value in routing_slip.response_headers_from_target.items()
+                        if name.lower() not in ["content-encoding", "content-length"]
+                    }
+            if routing_slip.is_response_coalesced and not app.state.request_coalescer.attributes_usage_to_each_caller:
+                # the usage is attributed to the leader only, so the plugins see no usage for the followers
+                body_dict = routing_slip.body_dict_from_target
+                if isinstance(body_dict, dict) and "usage" in body_dict:
+                    routing_slip.body_dict_from_target = {
+                        name: value for name, value in body_dict.items() if name != "usage"
+                    }
+            record_token_metrics(routing_slip, body)
+            # note: the body is only parsed into a dict if there are plugins needing it
+            if config.plugin_hooks.on_body_dict_from_target_available:
+                try:
+                    if routing_slip.body_dict_from_target is not None:
+                        await run_plugin_hooks(config.plugin_hooks.on_body_dict_from_target_available, routing_slip)
+                except:
+                    # eat any exception in case the response cannot be processed
+                    pass
+            if response_cache_key is not None and aoai_response.status_code == 200:
+                app.state.response_cache.put(
+                    response_cache_key, routing_slip.response_headers_from_target, body, get_current_timestamp_in_ms()
+                )
             response = Response(
                 content=body,
                 status_code=aoai_response.status_code,
-                headers=routing_slip["response_headers_from_target"],
+                headers=routing_slip.response_headers_from_target,
             )
             if "Transfer-Encoding" in response.headers and "Content-Length" in response.headers:
                 del response.headers["Content-Length"]
+            if response_cache_status is not None:
+                response.headers[CACHE_STATUS_HEADER] = response_cache_status
             return response
         case True:
             # event stream
-            # forward and process events as they come in
+            # forward the received bytes unchanged, while the events are extracted and processed by plugins off the
+            # forwarding path
             # note: see https://learn.microsoft.com/de-de/azure/ai-services/openai/reference
+            if "content-encoding" in aoai_response.headers:
+                # plugins need the decoded events, so forward the decoded stream in that case
+                chunks_from_target = aoai_response.aiter_bytes()
+                routing_slip.response_headers_from_target = {
+                    name: value
+                    for name, value in routing_slip.response_headers_from_target.items()
+                    if name.lower() not in ["content-encoding", "content-length"]
+                }
+            else:
+                chunks_from_target = aoai_response.aiter_raw()
+
+            data_event_hooks = config.plugin_hooks.on_data_event_from_target_received
+
+            def on_data_event(data):
+                """Invoke plugins for the given data event."""
+                if data != "[DONE]":
+                    routing_slip.data_from_target = data
+                    for hook in data_event_hooks:
+                        hook(routing_slip)
+
+            async def on_data_event_async(data):
+                """Invoke plugins for the given data event, awaiting async plugins."""
+                if data != "[DONE]":
+                    routing_slip.data_from_target = data
+                    await run_plugin_hooks(data_event_hooks, routing_slip)
+
+            # note: the stream is stored in the response cache once it has been relayed completely, unless it is
+            #       larger than the cache allows
+            body_to_cache = bytearray() if response_cache_key is not None and aoai_response.status_code == 200 else None
+
             async def yield_data_events():
                 """Stream response while invoking plugins."""
-                async for line in aoai_response.aiter_lines():
-                    yield f"{line}\r\n"
-                    routing_slip["data_from_target"] = None
-                    if line.startswith("data: "):
-                        data = line[6:]
-                        if data != "[DONE]":
-                            routing_slip["data_from_target"] = data
-                            foreach_plugin(
-                                config.plugins,
-                                "on_data_event_from_target_received",
-                                routing_slip,
-                            )
+                nonlocal body_to_cache
+                metrics = app.state.metrics
+                last_chunks = None
+                if metrics is not None:
+                    metrics.increment("powerproxy_streams_in_flight", (routing_slip.virtual_deployment or "",))
+                    last_chunks = deque(maxlen=USAGE_SEARCH_CHUNKS)
+                try:
+                    # note: events only need to be extracted if there are plugins processing them
+                    async with aclosing(
+                        relay_event_stream(
+                            chunks_from_target,
+                            (
+                                on_data_event_async
+                                if "on_data_event_from_target_received" in config.plugin_hooks.async_hook_names
+                                else on_data_event
+                            ),
+                        )
+                        if data_event_hooks
+                        else chunks_from_target
+                    ) as chunks:
+                        async for chunk in chunks:
+                            if body_to_cache is not None:
+                                body_to_cache += chunk
+                                if len(body_to_cache) > app.state.response_cache.max_entry_bytes:
+                                    body_to_cache = None
+                            if last_chunks is not None:
+                                last_chunks.append(chunk)
+                            yield chunk
+                    if last_chunks is not None:
+                        record_token_metrics(routing_slip, b"".join(last_chunks))
+                    if body_to_cache is not None:
+                        app.state.response_cache.put(
+                            response_cache_key,
+                            routing_slip.response_headers_from_target,
+                            bytes(body_to_cache),
+                            get_current_timestamp_in_ms(),
+                        )
+                finally:
+                    # ensure the connection is released also when the client disconnects early
+                    await aoai_response.aclose()
+                    if metrics is not None:
+                        metrics.increment("powerproxy_streams_in_flight", (routing_slip.virtual_deployment or "",), -1)
                 measure_aoai_roundtrip_time_ms(routing_slip)
-                foreach_plugin(
-                    config.plugins,
-                    "on_end_of_target_response_stream_reached",
-                    routing_slip,
-                )
+                await run_plugin_hooks(config.plugin_hooks.on_end_of_target_response_stream_reached, routing_slip)
 
-            return StreamingResponse(
+            response = StreamingResponse(
                 yield_data_events(),
                 status_code=aoai_response.status_code,
-                headers=routing_slip["response_headers_from_target"],
+                headers=routing_slip.response_headers_from_target,
             )
+            if response_cache_status is not None:
+                response.headers[CACHE_STATUS_HEADER] = response_cache_status
+            return response
+
+
+def get_response_cache_key(routing_slip):
+    """
+    Return the key under which the response to the given request is cached, or None if the response cache is not
+    enabled, not used by the request's client or the response is not cacheable. Responses are cached per client.
+    """
+    if (
+        app.state.response_cache is None
+        or not ResponseCache.is_cacheable(routing_slip.path, routing_slip.incoming_request_body_dict)
+        or not is_cache_used_by_client(routing_slip)
+    ):
+        return None
+    return ResponseCache.get_key(
+        routing_slip.client,
+        routing_slip.virtual_deployment,
+        routing_slip.path,
+        routing_slip.api_version,
+        routing_slip.incoming_request_body_dict,
+    )
+
+
+def get_coalescing_key(routing_slip, method):
+    """
+    Return the key under which the given request is coalesced with identical requests in flight of the same client, or
+    None if request coalescing is not enabled or the request cannot be coalesced, ie. is no POST request for a
+    non-streamed response or its client has not been authenticated by its API key.
+    """
+    if (
+        app.state.request_coalescer is None
+        or method != "POST"
+        or not routing_slip.is_non_streaming_response_requested
+        or not is_client_authenticated_by_key(routing_slip)
+    ):
+        return None
+    return RequestCoalescer.get_key(
+        routing_slip.client,
+        routing_slip.virtual_deployment,
+        routing_slip.path,
+        routing_slip.api_version,
+        routing_slip.incoming_request_body_dict,
+    )
+
+
+def get_embeddings_batching_key(routing_slip, method):
+    """
+    Return the key of the batch the given request is sent with, or None if embeddings batching is not enabled or the
+    request cannot be batched, ie. is no POST request for embeddings with a single input or its client has not been
+    authenticated by its API key. Requests are only batched with requests of the same client, as a batch is sent with
+    the credentials of its first request.
+    """
+    if (
+        app.state.embeddings_batcher is None
+        or method != "POST"
+        or not is_embeddings_request(routing_slip.path)
+        or not EmbeddingsBatcher.is_batchable(routing_slip.incoming_request_body_dict)
+        or not is_client_authenticated_by_key(routing_slip)
+    ):
+        return None
+    return EmbeddingsBatcher.get_key(
+        routing_slip.client,
+        routing_slip.virtual_deployment,
+        routing_slip.path,
+        routing_slip.api_version,
+        routing_slip.incoming_request_body_dict,
+    )
+
+
+def is_embeddings_fan_out_applicable(routing_slip, method):
+    """
+    Return True if the given request is split into chunks sent in parallel across the targets, ie. embeddings fan-out
+    is enabled and the request is a POST request for embeddings with enough inputs.
+    """
+    return (
+        app.state.embeddings_fan_out is not None
+        and method == "POST"
+        and is_embeddings_request(routing_slip.path)
+        and app.state.embeddings_fan_out.applies_to(routing_slip.incoming_request_body_dict)
+    )
+
+
+def look_up_embeddings(routing_slip, cache_control):
+    """
+    Return the lookup of the given embeddings request's inputs in the embeddings cache, or None if the embeddings cache
+    is not enabled, not used by the request's client or the request is no valid embeddings request. Embeddings are
+    cached per client.
+    """
+    if (
+        app.state.embeddings_cache is None
+        or not is_embeddings_request(routing_slip.path)
+        or not is_cache_used_by_client(routing_slip)
+    ):
+        return None
+    return app.state.embeddings_cache.look_up(
+        routing_slip.client, routing_slip.virtual_deployment, routing_slip.incoming_request_body_dict, cache_control
+    )
+
+
+def is_cache_used_by_client(routing_slip):
+    """
+    Return True if the given request's client is served from the response and embeddings caches, ie. the client has
+    been authenticated by its API key and does not opt out of the caches.
+    """
+    if not is_client_authenticated_by_key(routing_slip):
+        return False
+    return config.get_client_settings(routing_slip.client).get("uses_response_cache", True)
+
+
+def is_client_authenticated_by_key(routing_slip):
+    """
+    Return True if the given request's client has been identified by its PowerProxy API key, so the request is sent to
+    the targets with their credentials.
+
+    Other requests are passed on with their own credentials, if any, which only AOAI verifies. Hence, they must never
+    be answered with the response to another request.
+    """
+    return (
+        routing_slip.client is not None
+        and "api-key" in routing_slip.incoming_request.headers
+        and app.state.forward_http_header_regex.match("api-key") is not None
+    )
+
+
+def record_request_metrics(routing_slip, responding_aoai_target, status_code, request_timer=None):
+    """
+    Record a request answered with the given status code (by the given target, if any) in the metrics, if enabled,
+    including the time spent in PowerProxy if there is a request timer.
+    """
+    metrics = app.state.metrics
+    if metrics is None:
+        return
+    # note: the request references its routing slip and vice versa, so the reference is removed for both to be freed
+    #       right away instead of by the garbage collector, which matters for large bodies
+    del routing_slip.incoming_request.state.routing_slip
+    metrics.increment(
+        "powerproxy_requests_total",
+        (
+            routing_slip.client or "",
+            routing_slip.virtual_deployment or "",
+            responding_aoai_target.name if responding_aoai_target is not None else "",
+            str(status_code),
+        ),
+    )
+    if request_timer is not None:
+        metrics.observe("powerproxy_overhead_seconds", (), request_timer.get_overhead_seconds())
+
+
+def record_token_metrics(routing_slip, body):
+    """Record the tokens of the usage in the given response body or end of event stream in the metrics, if enabled."""
+    metrics = app.state.metrics
+    if metrics is None or routing_slip.is_response_from_cache:
+        return
+    if routing_slip.is_response_coalesced and not app.state.request_coalescer.attributes_usage_to_each_caller:
+        # the usage is attributed to the leader only
+        return
+    usage_tokens = get_usage_tokens(body)
+    if usage_tokens is None:
+        return
+    client, deployment = routing_slip.client or "", routing_slip.virtual_deployment or ""
+    metrics.increment("powerproxy_tokens_total", (client, deployment, "prompt"), usage_tokens[0])
+    metrics.increment("powerproxy_tokens_total", (client, deployment, "completion"), usage_tokens[1])
+
+
+def collect_metrics(metrics):
+    """
+    Set the values kept outside of the given metrics: the gauges about this worker's targets and connections to the
+    endpoints, and the counters of the access token provider and the hedging policies.
+    """
+    # note: the token provider is only used if there are targets without key
+    token_provider_metrics = app.state.token_provider.metrics
+    if token_provider_metrics["refreshes"] or token_provider_metrics["background_refreshes"]:
+        metrics.set("powerproxy_access_token_requests_total", ("hit",), token_provider_metrics["cache_hits"])
+        metrics.set("powerproxy_access_token_requests_total", ("miss",), token_provider_metrics["cache_misses"])
+        metrics.set(
+            "powerproxy_access_token_refreshes_total",
+            ("success",),
+            token_provider_metrics["refreshes"] - token_provider_metrics["refresh_failures"],
+        )
+        metrics.set(
+            "powerproxy_access_token_refreshes_total", ("failure",), token_provider_metrics["refresh_failures"]
+        )
+        metrics.set(
+            "powerproxy_access_token_refresh_seconds_total",
+            (),
+            token_provider_metrics["refresh_latency_ms_total"] / 1_000,
+        )
+    for virtual_deployment, hedging_policy in app.state.hedging_policies.items():
+        metrics.set("powerproxy_hedging_requests_total", (virtual_deployment,), hedging_policy.metrics["requests"])
+        metrics.set("powerproxy_hedges_fired_total", (virtual_deployment,), hedging_policy.metrics["hedges_fired"])
+        metrics.set("powerproxy_hedges_won_total", (virtual_deployment,), hedging_policy.metrics["hedges_won"])
+    now_ms = get_current_timestamp_in_ms()
+    for aoai_target in app.state.routing_table:
+        metrics.set(
+            "powerproxy_target_blocked",
+            (aoai_target.name,),
+            int(aoai_target.circuit_breaker.get_unblocked_timestamp_ms(now_ms) > now_ms),
+        )
+        metrics.set("powerproxy_target_requests_in_flight", (aoai_target.name,), aoai_target.local_outstanding_requests)
+    for endpoint_name, endpoint_client in app.state.aoai_endpoint_clients.items():
+        connection_stats = get_connection_stats(endpoint_client)
+        if not connection_stats:
+            # eg. mocked endpoints
+            continue
+        metrics.set("powerproxy_upstream_connections", (endpoint_name,), connection_stats["connections"])
+        if connection_stats["http2"]:
+            metrics.set("powerproxy_upstream_pool_in_use", (endpoint_name,), connection_stats["active_streams"])
+            metrics.set(
+                "powerproxy_upstream_pool_capacity",
+                (endpoint_name,),
+                connection_stats["max_connections"] * connection_stats["max_streams_per_connection"],
+            )
+            metrics.set("powerproxy_upstream_pool_queued", (endpoint_name,), connection_stats["queued_requests"])
+        else:
+            metrics.set("powerproxy_upstream_pool_in_use", (endpoint_name,), connection_stats["active_connections"])
+            if connection_stats["max_connections"] is not None:
+                metrics.set("powerproxy_upstream_pool_capacity", (endpoint_name,), connection_stats["max_connections"])
 
 
 def get_current_timestamp_in_ms():
@@ -493,12 +1484,129 @@ def get_current_timestamp_in_ms():
 
 def measure_aoai_roundtrip_time_ms(routing_slip):
     """Measure the roundtrip time from/to Azure OpenAI endpoint."""
-    routing_slip["aoai_request_end_time"] = get_current_timestamp_in_ms()
-    routing_slip["aoai_roundtrip_time_ms"] = int(
-        routing_slip["aoai_request_end_time"] - routing_slip["aoai_request_start_time"]
+    routing_slip.aoai_request_end_time = get_current_timestamp_in_ms()
+    routing_slip.aoai_roundtrip_time_ms = int(
+        routing_slip.aoai_request_end_time - routing_slip.aoai_request_start_time
     )
 
 
+def get_earliest_unblocked_timestamp_ms(candidates, cost_in_tokens):
+    """
+    Return the earliest time at which one of the given candidates is expected to accept a request of the given cost.
+    """
+    now_ms = get_current_timestamp_in_ms()
+    unblocked_timestamp_ms = min(
+        (
+            max(
+                aoai_target.circuit_breaker.get_unblocked_timestamp_ms(now_ms),
+                (
+                    aoai_target.token_budget.get_absorbable_timestamp_ms(cost_in_tokens, now_ms)
+                    if aoai_target.token_budget is not None
+                    else now_ms
+                ),
+            )
+            for aoai_target in candidates
+        ),
+        default=now_ms,
+    )
+    # note: if a target is not blocked but still not available, eg. because a probe request is in flight, check again
+    #       shortly
+    return unblocked_timestamp_ms if unblocked_timestamp_ms > now_ms else now_ms + UNKNOWN_UNBLOCK_RETRY_MS
+
+
+def get_retry_after_ms(candidates, cost_in_tokens):
+    """Return the time in ms a client should wait before retrying, based on when the first candidate unblocks."""
+    return get_earliest_unblocked_timestamp_ms(candidates, cost_in_tokens) - get_current_timestamp_in_ms()
+
+
+def get_waiting_queue(virtual_deployment):
+    """Return the queue to wait for capacity for the given virtual deployment, or None if waiting is not enabled."""
+    if not config.get("aoai/wait_for_capacity"):
+        return None
+    if virtual_deployment not in app.state.waiting_queues:
+        app.state.waiting_queues[virtual_deployment] = CapacityWaitingQueue(
+            max_waiting_requests=int(config.get("aoai/wait_for_capacity/max_waiting_requests", 1_000)),
+            release_interval_ms=int(config.get("aoai/wait_for_capacity/release_interval_ms", 10)),
+        )
+    return app.state.waiting_queues[virtual_deployment]
+
+
+async def acquire_scheduling_ticket(virtual_deployment, client, cost):
+    """Wait until the request may pass the virtual deployment's scheduler and return its ticket."""
+    if not config.get("aoai/fair_queuing"):
+        return SchedulingTicket(None)
+    if virtual_deployment not in app.state.schedulers:
+        app.state.schedulers[virtual_deployment] = FairQueuingScheduler(
+            max_concurrent_requests=int(config.get("aoai/fair_queuing/max_concurrent_requests")),
+            max_queued_requests=int(config.get("aoai/fair_queuing/max_queued_requests", 1_000)),
+        )
+    scheduling_ticket = await app.state.schedulers[virtual_deployment].acquire(
+        client,
+        get_fair_queuing_weight(client, virtual_deployment),
+        cost,
+        timeout_seconds=int(config.get("aoai/fair_queuing/max_queue_wait_ms", 30_000)) / 1_000,
+    )
+    if scheduling_ticket is None:
+        raise ImmediateResponseException(
+            Response(
+                content=json.dumps(
+                    {"message": f"Too many requests queued for deployment '{virtual_deployment}'. Try again later."}
+                ),
+                headers={"retry-after-ms": f"{UNKNOWN_UNBLOCK_RETRY_MS}"},
+                media_type="application/json",
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            )
+        )
+    return scheduling_ticket
+
+
+def get_fair_queuing_weight(client, virtual_deployment):
+    """Return the weight of the given client's requests for the given virtual deployment when queued fairly."""
+    fair_queuing_weight = (config.get_client_settings(client) if client else {}).get("fair_queuing_weight", 1)
+    if isinstance(fair_queuing_weight, dict):
+        return float(fair_queuing_weight.get(virtual_deployment, 1))
+    return float(fair_queuing_weight)
+
+
+def get_max_wait_for_capacity_ms(client):
+    """Return the maximum time the given client's requests may wait for capacity."""
+    client_settings = config.get_client_settings(client) if client else {}
+    return int(
+        client_settings.get("max_wait_for_capacity_ms")
+        or config.get("aoai/wait_for_capacity/max_wait_ms", DEFAULT_MAX_WAIT_FOR_CAPACITY_MS)
+    )
+
+
+def is_target_available(aoai_target, cost_in_tokens):
+    """Return True if the given target is currently not blocked and has tokens left for a request of the given cost."""
+    return aoai_target.circuit_breaker.allows_request(get_current_timestamp_in_ms()) and (
+        aoai_target.token_budget is None
+        or aoai_target.token_budget.can_absorb(cost_in_tokens, get_current_timestamp_in_ms())
+    )
+
+
+def get_eligible_targets(candidates, is_non_streaming_response_requested, cost_in_tokens):
+    """
+    Yield the candidates which are currently not blocked, pass the non-streaming filter and have tokens left for a
+    request of the given cost.
+    """
+    for aoai_target in candidates:
+        # try next target if this target is blocked or the request does not fit into the tokens per minute left at the
+        # target
+        if not is_target_available(aoai_target, cost_in_tokens):
+            continue
+
+        # try next target if the non-streaming filter is not passed
+        if not passes_non_streaming_filter(is_non_streaming_response_requested, aoai_target.non_streaming_fraction):
+            continue
+
+        # acquire the target at its circuit breaker, which lets only a single probe request pass in half-open state
+        if not aoai_target.circuit_breaker.try_acquire(get_current_timestamp_in_ms()):
+            continue
+
+        yield aoai_target
+
+
 def passes_non_streaming_filter(is_non_streaming_response_requested, non_streaming_fraction):
     """Determines by chance if a request should be processed or not."""
     return (
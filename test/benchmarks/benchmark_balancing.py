@@ -0,0 +1,109 @@
+"""
+Simulation benchmark for the load balancing strategies.
+
+Sends requests through the load balancer to mock targets with heterogeneous latencies. Each mock target slows down
+the more requests it has in flight, similar to a deployment getting close to its capacity. Reports latency percentiles
+and the share of requests each target received per strategy.
+
+Example: python benchmark_balancing.py --requests 1000 --concurrency 32
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+import httpx
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "app"))
+
+from helpers.balancing import LoadBalancer  # pylint: disable=wrong-import-position
+from helpers.dicts import QueryDict  # pylint: disable=wrong-import-position
+from helpers.routing import AoaiTarget, RoutingTable  # pylint: disable=wrong-import-position
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--requests", type=int, default=1000, help="Number of requests per strategy")
+parser.add_argument("--concurrency", type=int, default=32, help="Number of concurrent requests")
+parser.add_argument(
+    "--latencies-ms", type=str, default="20,40,80,160", help="Comma-separated base latencies of the mock targets"
+)
+parser.add_argument(
+    "--capacity", type=int, default=4, help="Requests in flight after which a mock target's latency doubles"
+)
+args = parser.parse_args()
+
+STRATEGIES = ["first_fit", "ewma_latency", "least_outstanding_requests", "power_of_two_choices"]
+
+
+def create_mock_target(index, base_latency_ms):
+    """Return a target backed by a mock upstream which slows down under load."""
+    requests_in_flight = [0]
+
+    async def handle(request):
+        requests_in_flight[0] += 1
+        try:
+            load_factor = 1 + (requests_in_flight[0] - 1) / args.capacity
+            await asyncio.sleep(base_latency_ms * load_factor * random.uniform(0.9, 1.1) / 1_000)
+            return httpx.Response(200, json={})
+        finally:
+            requests_in_flight[0] -= 1
+
+    return AoaiTarget(
+        name=f"target-{index} ({base_latency_ms:g} ms)",
+        target_type="virtual_deployment_standin",
+        endpoint=f"e{index}",
+        url=f"https://e{index}/",
+        endpoint_client=httpx.AsyncClient(base_url=f"https://e{index}/", transport=httpx.MockTransport(handle)),
+        endpoint_key="",
+        virtual_deployment="gpt-4o",
+        standin=f"s{index}",
+    )
+
+
+async def run(strategy):
+    """Send all requests with the given strategy and return latencies and requests per target."""
+    random.seed(42)
+    targets = [
+        create_mock_target(index, float(latency_ms)) for index, latency_ms in enumerate(args.latencies_ms.split(","))
+    ]
+    routing_table = RoutingTable(targets)
+    load_balancer = LoadBalancer(QueryDict({"strategy": strategy}))
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies_ms = []
+    requests_per_target = {target.name: 0 for target in targets}
+
+    async def send_one():
+        async with semaphore:
+            start_time = time.perf_counter()
+            aoai_target = load_balancer.order_candidates(
+                routing_table.get_candidates("gpt-4o"), routing_table.get_candidate_tiers("gpt-4o")
+            )[0]
+            requests_per_target[aoai_target.name] += 1
+            aoai_request = aoai_target.endpoint_client.build_request("POST", "chat/completions", content=b"{}")
+            await load_balancer.send(aoai_target, aoai_request, stream=False)
+            latencies_ms.append((time.perf_counter() - start_time) * 1_000)
+
+    await asyncio.gather(*[send_one() for _ in range(args.requests)])
+    for target in targets:
+        await target.endpoint_client.aclose()
+    return sorted(latencies_ms), requests_per_target
+
+
+def percentile(sorted_values, percent):
+    """Return the given percentile of the given sorted values."""
+    return sorted_values[min(int(len(sorted_values) * percent / 100), len(sorted_values) - 1)]
+
+
+for strategy in STRATEGIES:
+    start_time = time.perf_counter()
+    latencies_ms, requests_per_target = asyncio.run(run(strategy))
+    duration_s = time.perf_counter() - start_time
+    print(
+        f"{strategy:<27} mean {sum(latencies_ms) / len(latencies_ms):7.1f} ms"
+        f" | p95 {percentile(latencies_ms, 95):7.1f} ms | p99 {percentile(latencies_ms, 99):7.1f} ms"
+        f" | {len(latencies_ms) / duration_s:7.1f} req/s"
+    )
+    for target_name, requests in requests_per_target.items():
+        print(f"    {target_name:<20} {requests / len(latencies_ms):6.1%}")
@@ -0,0 +1,120 @@
+"""
+Benchmark for single-input embeddings requests with and without batching concurrent requests, at various batch windows.
+
+Many clients send embeddings requests with a single input each. A mock upstream answers with a latency growing slightly
+with the number of inputs, and processes only a limited number of requests at the same time, like a deployment limited
+by its requests per minute. Requests are sent either one by one or batched like PowerProxy does with embeddings
+batching. Reports throughput, latency percentiles, upstream calls and the average batch size per batch window.
+
+Example: python benchmark_embeddings_batching.py --requests 2000 --concurrency 100 --windows 1 2 5 10
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+import httpx
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "app"))
+
+from helpers.batching import EmbeddingsBatcher  # pylint: disable=wrong-import-position
+from helpers.embeddings import get_inputs  # pylint: disable=wrong-import-position
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--requests", type=int, default=2_000, help="Number of requests per run")
+parser.add_argument("--concurrency", type=int, default=100, help="Number of concurrent requests")
+parser.add_argument("--windows", type=float, nargs="+", default=[1, 2, 5, 10], help="Batch windows (max_wait_ms)")
+parser.add_argument("--max-batch-size", type=int, default=16, help="Maximum number of requests per batch")
+parser.add_argument("--base-ms", type=float, default=30, help="Latency of an upstream call in ms")
+parser.add_argument("--per-input-ms", type=float, default=0.5, help="Additional upstream latency per input in ms")
+parser.add_argument("--upstream-concurrency", type=int, default=20, help="Requests the upstream processes at once")
+parser.add_argument("--dimensions", type=int, default=256, help="Dimensions of an embedding")
+args = parser.parse_args()
+
+PATH = "openai/deployments/ada/embeddings"
+
+
+def create_upstream_client(upstream_stats):
+    """Return a client for a mock upstream with limited concurrency, counting the calls and inputs sent."""
+    semaphore = asyncio.Semaphore(args.upstream_concurrency)
+    embedding = [0.01] * args.dimensions
+
+    async def handle(request):
+        inputs = get_inputs(json.loads(request.content))
+        async with semaphore:
+            upstream_stats["calls"] += 1
+            upstream_stats["inputs"] += len(inputs)
+            await asyncio.sleep((args.base_ms + args.per_input_ms * len(inputs)) / 1_000)
+        return httpx.Response(
+            200,
+            json={
+                "object": "list",
+                "data": [
+                    {"object": "embedding", "index": index, "embedding": embedding} for index in range(len(inputs))
+                ],
+                "model": "text-embedding-ada-002",
+                "usage": {"prompt_tokens": 10 * len(inputs), "total_tokens": 10 * len(inputs)},
+            },
+        )
+
+    return httpx.AsyncClient(base_url="https://upstream/", transport=httpx.MockTransport(handle))
+
+
+async def run(embeddings_batcher):
+    """Send all requests and return the latencies, the run's duration and the upstream statistics."""
+    upstream_stats = {"calls": 0, "inputs": 0}
+    upstream_client = create_upstream_client(upstream_stats)
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies_ms = []
+
+    async def get_response_from_targets(request_body_dict):
+        return None, await upstream_client.post(PATH, content=json.dumps(request_body_dict).encode())
+
+    async def send(request_number):
+        request_body_dict = {"input": f"chunk {request_number}"}
+        async with semaphore:
+            start_time = time.perf_counter()
+            if embeddings_batcher is None:
+                _, response = await get_response_from_targets(request_body_dict)
+            else:
+                _, response = await embeddings_batcher.get_response(
+                    EmbeddingsBatcher.get_key("Benchmark", "ada", PATH, "2024-10-21", request_body_dict),
+                    request_body_dict,
+                    get_response_from_targets,
+                )
+            json.loads(await response.aread())
+            latencies_ms.append((time.perf_counter() - start_time) * 1_000)
+
+    start_time = time.perf_counter()
+    await asyncio.gather(*[send(request_number) for request_number in range(args.requests)])
+    duration_seconds = time.perf_counter() - start_time
+    await upstream_client.aclose()
+    return sorted(latencies_ms), duration_seconds, upstream_stats
+
+
+def percentile(sorted_values, percent):
+    """Return the given percentile of the given sorted values."""
+    return sorted_values[min(int(len(sorted_values) * percent / 100), len(sorted_values) - 1)]
+
+
+print(
+    f"{args.requests} requests, concurrency {args.concurrency}, upstream latency {args.base_ms:.0f} ms + "
+    f"{args.per_input_ms} ms per input, upstream concurrency {args.upstream_concurrency}"
+)
+print(f"{'mode':<16} {'req/s':>8} {'p50 (ms)':>9} {'p95 (ms)':>9} {'p99 (ms)':>9} {'calls':>7} {'batch size':>11}")
+for max_wait_ms in [None] + args.windows:
+    embeddings_batcher = (
+        EmbeddingsBatcher({"max_wait_ms": max_wait_ms, "max_batch_size": args.max_batch_size})
+        if max_wait_ms is not None
+        else None
+    )
+    latencies_ms, duration_seconds, upstream_stats = asyncio.run(run(embeddings_batcher))
+    mode = f"window {max_wait_ms:g} ms" if max_wait_ms is not None else "no batching"
+    print(
+        f"{mode:<16} {args.requests / duration_seconds:>8.1f} {percentile(latencies_ms, 50):>9.1f} "
+        f"{percentile(latencies_ms, 95):>9.1f} {percentile(latencies_ms, 99):>9.1f} {upstream_stats['calls']:>7} "
+        f"{upstream_stats['inputs'] / upstream_stats['calls']:>11.1f}"
+    )
@@ -0,0 +1,155 @@
+"""
+Benchmark for embeddings requests with and without caching the embeddings of their inputs.
+
+Simulates a re-indexing job: batches of chunks are embedded, and a given share of the chunks has been embedded before
+(unchanged chunks), while the others are new. A mock upstream answers with a latency growing with the number of inputs
+and counts the inputs and tokens it was sent. Requests are processed like PowerProxy does with an embeddings cache:
+inputs found in the cache are taken from there, only the other inputs are sent upstream, and the response is merged
+in the order of the inputs. Reports latency percentiles, inputs and tokens sent upstream, and the memory taken by the
+cached embeddings compared to keeping them as lists of floats.
+
+Example: python benchmark_embeddings_cache.py --requests 500 --batch-size 16 --repeated-share 0.8
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+
+import httpx
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "app"))
+
+from helpers.caching import CacheControl, EmbeddingsCache  # pylint: disable=wrong-import-position
+from helpers.embeddings import get_inputs  # pylint: disable=wrong-import-position
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--requests", type=int, default=500, help="Number of requests per run")
+parser.add_argument("--concurrency", type=int, default=10, help="Number of concurrent requests")
+parser.add_argument("--batch-size", type=int, default=16, help="Inputs per request")
+parser.add_argument("--repeated-share", type=float, default=0.8, help="Share of inputs embedded before (0..1)")
+parser.add_argument("--dimensions", type=int, default=1536, help="Dimensions of an embedding")
+parser.add_argument("--encoding-format", choices=["float", "base64"], default="float", help="Requested encoding")
+parser.add_argument("--base-ms", type=float, default=20, help="Latency of an upstream call in ms")
+parser.add_argument("--per-input-ms", type=float, default=2, help="Additional upstream latency per input in ms")
+args = parser.parse_args()
+
+
+def create_chunk(chunk_number):
+    """Return the text of the chunk with the given number, about 200 tokens long."""
+    return f"chunk {chunk_number}: " + " ".join(f"word{(chunk_number * 31 + i) % 997}" for i in range(150))
+
+
+def create_requests():
+    """Return the request bodies, with the given share of inputs repeated from earlier requests."""
+    random.seed(42)
+    request_body_dicts = []
+    embedded_chunk_numbers = list(range(args.batch_size * 10))
+    next_chunk_number = len(embedded_chunk_numbers)
+    for _ in range(args.requests):
+        inputs = []
+        for _ in range(args.batch_size):
+            if random.random() < args.repeated_share:
+                inputs.append(create_chunk(random.choice(embedded_chunk_numbers)))
+            else:
+                inputs.append(create_chunk(next_chunk_number))
+                embedded_chunk_numbers.append(next_chunk_number)
+                next_chunk_number += 1
+        request_body_dicts.append({"input": inputs, "encoding_format": args.encoding_format})
+    return request_body_dicts
+
+
+def create_upstream_client(upstream_stats):
+    """Return a client for a mock upstream returning embeddings, counting the inputs and tokens sent."""
+    embedding = [random.uniform(-0.1, 0.1) for _ in range(args.dimensions)]
+
+    async def handle(request):
+        request_body_dict = json.loads(request.content)
+        inputs = get_inputs(request_body_dict)
+        prompt_tokens = sum(len(single_input) // 4 for single_input in inputs)
+        upstream_stats["calls"] += 1
+        upstream_stats["inputs"] += len(inputs)
+        upstream_stats["tokens"] += prompt_tokens
+        await asyncio.sleep((args.base_ms + args.per_input_ms * len(inputs)) / 1_000)
+        return httpx.Response(
+            200,
+            json={
+                "object": "list",
+                "data": [
+                    {"object": "embedding", "index": index, "embedding": embedding} for index in range(len(inputs))
+                ],
+                "model": "text-embedding-ada-002",
+                "usage": {"prompt_tokens": prompt_tokens, "total_tokens": prompt_tokens},
+            },
+        )
+
+    return httpx.AsyncClient(base_url="https://upstream/", transport=httpx.MockTransport(handle))
+
+
+async def run(request_body_dicts, embeddings_cache):
+    """Send all requests and return the latencies and upstream statistics."""
+    upstream_stats = {"calls": 0, "inputs": 0, "tokens": 0}
+    upstream_client = create_upstream_client(upstream_stats)
+    cache_control = CacheControl(None)
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies_ms = []
+
+    async def send(request_body_dict):
+        async with semaphore:
+            start_time = time.perf_counter()
+            embeddings_cache_lookup = (
+                embeddings_cache.look_up("Benchmark", "ada", request_body_dict, cache_control)
+                if embeddings_cache is not None
+                else None
+            )
+            if embeddings_cache_lookup is not None and embeddings_cache_lookup.is_complete:
+                json.dumps(embeddings_cache_lookup.create_response_body_dict()).encode()
+            else:
+                if embeddings_cache_lookup is not None and embeddings_cache_lookup.has_cached_embeddings:
+                    request_body_dict = embeddings_cache_lookup.get_request_body_dict_for_missing_inputs(
+                        request_body_dict
+                    )
+                response = await upstream_client.post("openai/deployments/ada/embeddings", json=request_body_dict)
+                if embeddings_cache_lookup is not None:
+                    body_dict = embeddings_cache_lookup.complete_response_body_dict(response.json())
+                    if body_dict is not None:
+                        json.dumps(body_dict).encode()
+            latencies_ms.append((time.perf_counter() - start_time) * 1_000)
+
+    start_time = time.perf_counter()
+    await asyncio.gather(*[send(request_body_dict) for request_body_dict in request_body_dicts])
+    duration_seconds = time.perf_counter() - start_time
+    await upstream_client.aclose()
+    return sorted(latencies_ms), upstream_stats, duration_seconds
+
+
+def percentile(sorted_values, percent):
+    """Return the given percentile of the given sorted values."""
+    return sorted_values[min(int(len(sorted_values) * percent / 100), len(sorted_values) - 1)]
+
+
+request_body_dicts = create_requests()
+print(
+    f"{args.requests} requests with {args.batch_size} inputs each, {args.repeated_share:.0%} embedded before, "
+    f"{args.dimensions} dimensions, encoding format {args.encoding_format}"
+)
+print(
+    f"{'mode':<10} {'p50 (ms)':>9} {'p95 (ms)':>9} {'req/s':>8} {'calls':>7} {'inputs':>8} {'tokens':>10} "
+    f"{'cached':>8} {'cache MB':>9}"
+)
+for mode in ["no cache", "cache"]:
+    embeddings_cache = EmbeddingsCache({"max_bytes": 1_000_000_000}) if mode == "cache" else None
+    latencies_ms, upstream_stats, duration_seconds = asyncio.run(run(request_body_dicts, embeddings_cache))
+    print(
+        f"{mode:<10} {percentile(latencies_ms, 50):>9.1f} {percentile(latencies_ms, 95):>9.1f} "
+        f"{args.requests / duration_seconds:>8.1f} {upstream_stats['calls']:>7} {upstream_stats['inputs']:>8} "
+        f"{upstream_stats['tokens']:>10} {len(embeddings_cache) if embeddings_cache is not None else 0:>8} "
+        f"{(embeddings_cache.size_in_bytes if embeddings_cache is not None else 0) / 1_000_000:>9.1f}"
+    )
+if embeddings_cache is not None:
+    # note: a list of floats takes a pointer per value plus a float object (24 bytes) per value
+    list_bytes = len(embeddings_cache) * (sys.getsizeof([0.0] * args.dimensions) + 24 * args.dimensions)
+    print(f"the cached embeddings would take {list_bytes / 1_000_000:.1f} MB as lists of floats")
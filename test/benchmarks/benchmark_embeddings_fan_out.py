@@ -0,0 +1,126 @@
+"""
+Benchmark for embeddings requests with many inputs, with and without splitting them into chunks sent in parallel.
+
+A client sends embeddings requests with thousands of inputs each, eg. to index documents. Several mock targets answer
+with a latency growing with the number of inputs, and answer a share of the requests with a 429, like deployments
+close to their tokens per minute. Without fan-out, a request is sent to one target at a time, failing over to the next
+target after a 429. With fan-out, the request is split into chunks like PowerProxy does, which are sent in parallel
+across the targets, and only the failed chunks are sent again. Reports latency percentiles, upstream calls and the
+inputs sent upstream.
+
+Example: python benchmark_embeddings_fan_out.py --requests 20 --inputs 4096 --targets 4 --chunk-size 256
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+
+import httpx
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "app"))
+
+from helpers.batching import EmbeddingsFanOut  # pylint: disable=wrong-import-position
+from helpers.embeddings import get_inputs  # pylint: disable=wrong-import-position
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--requests", type=int, default=20, help="Number of requests per run, sent one after another")
+parser.add_argument("--inputs", type=int, default=4_096, help="Number of inputs per request")
+parser.add_argument("--targets", type=int, default=4, help="Number of targets")
+parser.add_argument("--chunk-size", type=int, default=256, help="Number of inputs per chunk")
+parser.add_argument("--max-concurrent-chunks", type=int, default=8, help="Chunks sent at the same time")
+parser.add_argument("--base-ms", type=float, default=50, help="Latency of an upstream call in ms")
+parser.add_argument("--per-input-ms", type=float, default=0.2, help="Additional upstream latency per input in ms")
+parser.add_argument("--throttle-rate", type=float, default=0.1, help="Share of upstream calls answered with a 429")
+parser.add_argument("--seed", type=int, default=42, help="Seed for the random 429s")
+args = parser.parse_args()
+
+PATH = "openai/deployments/ada/embeddings"
+
+
+def create_upstream_clients(upstream_stats):
+    """Return clients for the mock targets, counting the calls, 429s and inputs sent."""
+    randomizer = random.Random(args.seed)
+
+    async def handle(request):
+        inputs = get_inputs(json.loads(request.content))
+        upstream_stats["calls"] += 1
+        upstream_stats["inputs"] += len(inputs)
+        await asyncio.sleep((args.base_ms + args.per_input_ms * len(inputs)) / 1_000)
+        if randomizer.random() < args.throttle_rate:
+            upstream_stats["throttled"] += 1
+            return httpx.Response(429, json={"error": {"code": "429", "message": "Rate limit exceeded."}})
+        return httpx.Response(
+            200,
+            json={
+                "object": "list",
+                "data": [{"object": "embedding", "index": index, "embedding": [0.01]} for index in range(len(inputs))],
+                "model": "text-embedding-ada-002",
+                "usage": {"prompt_tokens": 10 * len(inputs), "total_tokens": 10 * len(inputs)},
+            },
+        )
+
+    return [
+        httpx.AsyncClient(base_url=f"https://target-{number}/", transport=httpx.MockTransport(handle))
+        for number in range(args.targets)
+    ]
+
+
+async def run(embeddings_fan_out):
+    """Send all requests and return the latencies and the upstream statistics."""
+    upstream_stats = {"calls": 0, "throttled": 0, "inputs": 0}
+    upstream_clients = create_upstream_clients(upstream_stats)
+    latencies_ms = []
+
+    async def get_response_from_targets(request_body_dict, candidate_rotation=0):
+        # like PowerProxy, try the targets one after another until one does not respond with a 429
+        candidates = upstream_clients[candidate_rotation % len(upstream_clients) :]
+        candidates += upstream_clients[: candidate_rotation % len(upstream_clients)]
+        for upstream_client in candidates:
+            response = await upstream_client.post(PATH, content=json.dumps(request_body_dict).encode())
+            if response.status_code != 429:
+                return upstream_client, response
+        return upstream_client, response
+
+    for _ in range(args.requests):
+        request_body_dict = {"input": [f"chunk {number}" for number in range(args.inputs)]}
+        start_time = time.perf_counter()
+        if embeddings_fan_out is None:
+            _, response = await get_response_from_targets(request_body_dict)
+        else:
+            _, response = await embeddings_fan_out.get_response(request_body_dict, get_response_from_targets)
+        assert response.status_code == 200 and len(json.loads(await response.aread())["data"]) == args.inputs
+        latencies_ms.append((time.perf_counter() - start_time) * 1_000)
+
+    for upstream_client in upstream_clients:
+        await upstream_client.aclose()
+    return sorted(latencies_ms), upstream_stats
+
+
+def percentile(sorted_values, percent):
+    """Return the given percentile of the given sorted values."""
+    return sorted_values[min(int(len(sorted_values) * percent / 100), len(sorted_values) - 1)]
+
+
+print(
+    f"{args.requests} requests with {args.inputs} inputs, {args.targets} targets, upstream latency "
+    f"{args.base_ms:.0f} ms + {args.per_input_ms} ms per input, {args.throttle_rate:.0%} of calls throttled"
+)
+print(f"{'mode':<12} {'p50 (ms)':>9} {'p95 (ms)':>9} {'max (ms)':>9} {'calls':>7} {'429s':>6} {'inputs sent':>12}")
+for mode in ["no fan-out", "fan-out"]:
+    embeddings_fan_out = (
+        EmbeddingsFanOut(
+            {"chunk_size": args.chunk_size, "min_inputs": 1, "max_concurrent_chunks": args.max_concurrent_chunks}
+        )
+        if mode == "fan-out"
+        else None
+    )
+    latencies_ms, upstream_stats = asyncio.run(run(embeddings_fan_out))
+    print(
+        f"{mode:<12} {percentile(latencies_ms, 50):>9.1f} {percentile(latencies_ms, 95):>9.1f} "
+        f"{latencies_ms[-1]:>9.1f} {upstream_stats['calls']:>7} {upstream_stats['throttled']:>6} "
+        f"{upstream_stats['inputs']:>12}"
+    )
@@ -0,0 +1,385 @@
+"""
+End-to-end benchmark for the latency and resources PowerProxy adds to requests, for various scenarios.
+
+Each scenario starts PowerProxy in a separate process, serving at a local port, with endpoints answering by simulated
+Azure OpenAI (the endpoints' mock setting), so no requests leave the machine. The scenario's requests are sent at the
+given concurrency, first directly to the same simulated Azure OpenAI (in this process, without network) and then
+through PowerProxy. The differences are the latency added by PowerProxy:
+
+- non_streaming: chat completions
+- streaming: streamed chat completions, with a usage chunk
+- embeddings: embeddings requests with several inputs
+- failover: chat completions to an endpoint failing with 500s and connection resets, failing over to a second endpoint
+  (the added latency includes the roundtrips to the failing endpoint)
+
+Reports per scenario the requests per second, the latency percentiles added by PowerProxy (latency through PowerProxy
+minus the median latency of the direct requests), for streamed responses the added time to the first event and to
+every event, PowerProxy's CPU time per request and its resident memory (RSS) after starting, after the requests and at
+its peak (Linux only). Each scenario is run several times, reporting the median of each metric, as tail latencies vary
+from run to run. Client and PowerProxy share the machine, so the requests per second depend on its cores.
+
+Results can be written as JSON and compared against the results of an earlier run (the baseline), flagging regressions
+beyond the given tolerance. The exit code is 1 if there are regressions. A baseline recorded on a single-core
+development machine is stored in the baselines directory. Record a baseline on the machine to compare on for
+meaningful comparisons.
+
+Example: python benchmark_end_to_end.py --requests 1000 --concurrency 50 --output results.json
+         python benchmark_end_to_end.py --baseline baselines/end_to_end.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "app"))
+
+from helpers.dicts import QueryDict  # pylint: disable=wrong-import-position
+from helpers.mocking import MockUpstream  # pylint: disable=wrong-import-position
+from helpers.streaming import SseFramer  # pylint: disable=wrong-import-position
+
+APP_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "app")
+API_KEY = "benchmark"
+CHAT_PATH = "openai/deployments/gpt-4o/chat/completions?api-version=2024-10-21"
+CHAT_BODY = {"messages": [{"role": "user", "content": "Tell me a joke about proxies."}], "max_tokens": 50}
+CHAT_MOCK = {"time_to_first_token_ms": 50, "completion_tokens": 50}
+SCENARIOS = {
+    "non_streaming": {"path": CHAT_PATH, "body": CHAT_BODY, "mocks": [CHAT_MOCK]},
+    "streaming": {
+        "path": CHAT_PATH,
+        "body": {**CHAT_BODY, "stream": True, "stream_options": {"include_usage": True}},
+        "mocks": [{**CHAT_MOCK, "tokens_per_second": 500}],
+    },
+    "embeddings": {
+        "path": "openai/deployments/text-embedding-ada-002/embeddings?api-version=2024-10-21",
+        "body": {"input": [f"This is sentence number {number} of the document." for number in range(16)]},
+        "mocks": [{"time_to_first_token_ms": 20}],
+    },
+    "failover": {
+        "path": CHAT_PATH,
+        "body": CHAT_BODY,
+        "mocks": [
+            {**CHAT_MOCK, "errors": {"server_error_rate": 0.2, "connection_reset_rate": 0.05}, "seed": 42},
+            CHAT_MOCK,
+        ],
+    },
+}
+# metrics compared against the baseline, and if higher values are better
+# note: the 99th percentiles are reported but not compared, they vary too much from run to run at these numbers of
+#       requests
+COMPARED_METRICS = [
+    ("requests_per_second", True),
+    ("proxy_cpu_ms_per_request", False),
+    ("proxy_added_latency_ms/p50", False),
+    ("proxy_added_latency_ms/p95", False),
+    ("ttfb_overhead_ms/p50", False),
+    ("ttfb_overhead_ms/p95", False),
+    ("chunk_overhead_ms/p50", False),
+    ("chunk_overhead_ms/p95", False),
+    ("rss_mb/peak", False),
+]
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS.keys(), default=list(SCENARIOS), help="Scenarios")
+parser.add_argument("--requests", type=int, default=500, help="Number of requests per scenario")
+parser.add_argument("--concurrency", type=int, default=50, help="Number of concurrent requests")
+parser.add_argument("--runs", type=int, default=3, help="Measured runs per scenario, the median of each is reported")
+parser.add_argument("--warm-up-requests", type=int, default=50, help="Requests sent before measuring")
+parser.add_argument("--output", help="File to write the results to, as JSON")
+parser.add_argument("--baseline", help="File with the results of an earlier run to compare against")
+parser.add_argument(
+    "--tolerance", type=float, default=25, help="Change in percent from the baseline tolerated before a regression"
+)
+args = parser.parse_args()
+
+
+def get_free_port():
+    """Return a free local port."""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as free_socket:
+        free_socket.bind(("127.0.0.1", 0))
+        return free_socket.getsockname()[1]
+
+
+def get_rss_mb(pid):
+    """Return the current and peak resident memory of the given process in MB, or None if unknown (not Linux)."""
+    try:
+        with open(f"/proc/{pid}/status", "r", encoding="utf-8") as status_file:
+            values = dict(line.split(":", 1) for line in status_file if ":" in line)
+        return int(values["VmRSS"].split()[0]) / 1_024, int(values["VmHWM"].split()[0]) / 1_024
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def get_cpu_ms(pid):
+    """Return the CPU time (user and system) used by the given process so far in ms, or None if unknown (not Linux)."""
+    try:
+        with open(f"/proc/{pid}/stat", "r", encoding="utf-8") as stat_file:
+            # note: the process name may contain spaces, the fields after it are separated by spaces
+            fields = stat_file.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) * 1_000 / os.sysconf("SC_CLK_TCK")
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def percentiles(values):
+    """Return the 50th, 95th and 99th percentile of the given values, or None if there are no values."""
+    if not values:
+        return None
+    sorted_values = sorted(values)
+    return {
+        f"p{percent}": round(sorted_values[min(int(len(sorted_values) * percent / 100), len(sorted_values) - 1)], 2)
+        for percent in (50, 95, 99)
+    }
+
+
+async def start_proxy(config_file_path, port):
+    """Start PowerProxy with the given configuration at the given port and return its process once it is ready."""
+    process = subprocess.Popen(
+        [sys.executable, "powerproxy.py", "--config-file", config_file_path, "--port", str(port)],
+        cwd=APP_DIRECTORY,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}/") as client:
+        for _ in range(300):
+            try:
+                if (await client.get("powerproxy/health/readiness")).status_code == 204:
+                    return process
+            except httpx.TransportError:
+                pass
+            if process.poll() is not None:
+                break
+            await asyncio.sleep(0.1)
+    process.kill()
+    raise RuntimeError(f"PowerProxy did not start with configuration {config_file_path}.")
+
+
+async def send_requests(clients, scenario, number_of_requests):
+    """
+    Send the given number of requests of the scenario, one at a time per given client, and return per request the
+    status code (None if the request failed), its latency and, for event streams, the time of every event, in ms.
+    """
+    results = []
+    requests_left = number_of_requests
+
+    async def send(client):
+        nonlocal requests_left
+        while requests_left > 0:
+            requests_left -= 1
+            start_time = time.perf_counter()
+            event_times_ms = []
+            try:
+                async with client.stream("POST", scenario["path"], json=scenario["body"]) as response:
+                    sse_framer = SseFramer()
+                    async for chunk in response.aiter_raw():
+                        now_ms = (time.perf_counter() - start_time) * 1_000
+                        event_times_ms += [now_ms] * len(sse_framer.feed(chunk))
+                status_code = response.status_code
+            except httpx.TransportError:
+                status_code = None
+            results.append((status_code, (time.perf_counter() - start_time) * 1_000, event_times_ms))
+
+    await asyncio.gather(*[send(client) for client in clients])
+    return results
+
+
+def create_clients(**client_arguments):
+    """
+    Return a client with the given arguments for each concurrent request.
+
+    note: a client per concurrent request with a single connection each, because the connection pool of a client takes
+          time growing with its number of connections for every request, which would be measured otherwise.
+    """
+    return [
+        httpx.AsyncClient(limits=httpx.Limits(max_connections=1), timeout=60, **client_arguments)
+        for _ in range(args.concurrency)
+    ]
+
+
+async def close_clients(clients):
+    """Close the given clients."""
+    await asyncio.gather(*[client.aclose() for client in clients])
+
+
+async def run_scenario(scenario_name):
+    """Run the given scenario and return its results."""
+    scenario = SCENARIOS[scenario_name]
+
+    # requests sent directly to the simulated Azure OpenAI (the endpoint answering, for the failover scenario)
+    mock_upstream = MockUpstream(QueryDict(scenario["mocks"][-1]))
+    direct_clients = create_clients(
+        base_url="https://mock/", transport=httpx.MockTransport(mock_upstream.handle_request)
+    )
+    direct_results = await send_requests(direct_clients, scenario, args.requests)
+    await close_clients(direct_clients)
+    direct_latency_ms = statistics.median(latency_ms for _, latency_ms, _ in direct_results)
+    direct_event_times_ms = [
+        statistics.median(event_times_ms[index] for _, _, event_times_ms in direct_results)
+        for index in range(min(len(event_times_ms) for _, _, event_times_ms in direct_results))
+    ]
+
+    # requests sent through PowerProxy
+    with tempfile.NamedTemporaryFile("w", suffix=".yaml", delete=False) as config_file:
+        # note: JSON is valid YAML
+        json.dump(
+            {
+                "clients": [{"name": "Benchmark", "key": API_KEY}],
+                "aoai": {
+                    "endpoints": [
+                        {
+                            "name": f"Mock {number}",
+                            "url": f"https://mock-{number}.openai.azure.com/",
+                            "key": "mock",
+                            "mock": mock,
+                        }
+                        for number, mock in enumerate(scenario["mocks"], start=1)
+                    ],
+                },
+            },
+            config_file,
+        )
+    port = get_free_port()
+    process = await start_proxy(config_file.name, port)
+    proxy_clients = create_clients(base_url=f"http://127.0.0.1:{port}/", headers={"api-key": API_KEY})
+    try:
+        await send_requests(proxy_clients, scenario, args.warm_up_requests)
+        idle_rss_mb, _ = get_rss_mb(process.pid)
+        run_results = []
+        for _ in range(args.runs):
+            start_cpu_ms = get_cpu_ms(process.pid)
+            start_time = time.perf_counter()
+            proxy_results = await send_requests(proxy_clients, scenario, args.requests)
+            duration_seconds = time.perf_counter() - start_time
+            end_cpu_ms = get_cpu_ms(process.pid)
+            successful_results = [result for result in proxy_results if result[0] == 200]
+            run_results.append(
+                {
+                    "failed_requests": len(proxy_results) - len(successful_results),
+                    "requests_per_second": len(proxy_results) / duration_seconds,
+                    "proxy_cpu_ms_per_request": (
+                        (end_cpu_ms - start_cpu_ms) / len(proxy_results) if start_cpu_ms is not None else None
+                    ),
+                    "proxy_added_latency_ms": percentiles(
+                        [latency_ms - direct_latency_ms for _, latency_ms, _ in successful_results]
+                    ),
+                    "ttfb_overhead_ms": percentiles(
+                        [
+                            event_times_ms[0] - direct_event_times_ms[0]
+                            for _, _, event_times_ms in successful_results
+                            if event_times_ms and direct_event_times_ms
+                        ]
+                    ),
+                    "chunk_overhead_ms": percentiles(
+                        [
+                            event_time_ms - direct_event_time_ms
+                            for _, _, event_times_ms in successful_results
+                            for event_time_ms, direct_event_time_ms in zip(event_times_ms, direct_event_times_ms)
+                        ]
+                    ),
+                }
+            )
+        rss_mb, peak_rss_mb = get_rss_mb(process.pid)
+    finally:
+        await close_clients(proxy_clients)
+        process.terminate()
+        process.wait()
+        os.remove(config_file.name)
+
+    return {
+        "requests": args.requests,
+        "runs": args.runs,
+        "direct_latency_ms": round(direct_latency_ms, 2),
+        **get_median_of_runs(run_results),
+        "rss_mb": {
+            "idle": round(idle_rss_mb, 1) if idle_rss_mb is not None else None,
+            "after": round(rss_mb, 1) if rss_mb is not None else None,
+            "peak": round(peak_rss_mb, 1) if peak_rss_mb is not None else None,
+        },
+    }
+
+
+def get_median_of_runs(run_results):
+    """Return the median of every metric over the given results of runs, keeping the structure of the results."""
+    if isinstance(run_results[0], dict):
+        return {name: get_median_of_runs([run_result[name] for run_result in run_results]) for name in run_results[0]}
+    values = [value for value in run_results if value is not None]
+    return round(statistics.median(values), 2) if values else None
+
+
+def compare(results, baseline):
+    """Print the changes of the results compared to the given baseline and return the number of regressions."""
+    regressions = 0
+    print(f"\ncompared to baseline (tolerance {args.tolerance:g}%)")
+    print(f"{'scenario':<14} {'metric':<28} {'baseline':>10} {'current':>10} {'change':>8}")
+    for scenario_name, scenario_results in results["scenarios"].items():
+        baseline_results = QueryDict(baseline.get("scenarios", {}).get(scenario_name) or {})
+        for metric, is_higher_better in COMPARED_METRICS:
+            value = QueryDict(scenario_results).get(metric)
+            baseline_value = baseline_results.get(metric)
+            if value is None or baseline_value is None:
+                continue
+            change = value - baseline_value
+            change_percent = change / abs(baseline_value) * 100 if baseline_value else 0
+            # note: changes of less than 1 (ms, MB or requests per second) are noise for small values
+            is_regression = (
+                abs(change) > 1
+                and (change < 0 if is_higher_better else change > 0)
+                and abs(change_percent) > args.tolerance
+            )
+            regressions += is_regression
+            print(
+                f"{scenario_name:<14} {metric:<28} {baseline_value:>10.2f} {value:>10.2f} {change_percent:>+7.1f}%"
+                f"{'  ❌ regression' if is_regression else ''}"
+            )
+    return regressions
+
+
+results = {
+    "settings": {"requests": args.requests, "concurrency": args.concurrency, "runs": args.runs},
+    "scenarios": {scenario_name: asyncio.run(run_scenario(scenario_name)) for scenario_name in args.scenarios},
+}
+
+print(f"{args.requests} requests per scenario, concurrency {args.concurrency}")
+print(
+    f"{'scenario':<14} {'req/s':>8} {'failed':>7} {'CPU/req':>8} {'added p50':>10} {'added p95':>10} {'added p99':>10} "
+    f"{'ttfb p95':>9} {'chunk p95':>10} {'RSS peak':>9}"
+)
+for scenario_name, scenario_results in results["scenarios"].items():
+    scenario_results = QueryDict(scenario_results)
+    columns = [
+        scenario_results.get(metric)
+        for metric in [
+            "proxy_cpu_ms_per_request",
+            "proxy_added_latency_ms/p50",
+            "proxy_added_latency_ms/p95",
+            "proxy_added_latency_ms/p99",
+            "ttfb_overhead_ms/p95",
+            "chunk_overhead_ms/p95",
+            "rss_mb/peak",
+        ]
+    ]
+    print(
+        f"{scenario_name:<14} {scenario_results['requests_per_second']:>8.1f} "
+        f"{scenario_results['failed_requests']:>7} "
+        + " ".join(
+            f"{column:>{width}.1f}" if column is not None else f"{'-':>{width}}"
+            for column, width in zip(columns, [8, 10, 10, 10, 9, 10, 9])
+        )
+    )
+print("(latencies in ms, RSS in MB)")
+
+if args.output:
+    with open(args.output, "w", encoding="utf-8") as output_file:
+        json.dump(results, output_file, indent=2)
+if args.baseline:
+    with open(args.baseline, "r", encoding="utf-8") as baseline_file:
+        if compare(results, json.load(baseline_file)):
+            sys.exit(1)
@@ -0,0 +1,113 @@
+"""
+Benchmark for hedged requests against a slow mock upstream.
+
+Two mock targets answer most requests quickly but a share of requests very slowly (tail latency). The benchmark sends
+the same requests once without and once with hedging and reports latency percentiles, hedges fired/won and the number
+of upstream calls (which drive token consumption).
+
+Example: python benchmark_hedging.py --requests 500 --slow-share 0.05
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+import httpx
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "app"))
+
+from helpers.dicts import QueryDict  # pylint: disable=wrong-import-position
+from helpers.hedging import HedgingPolicy, send_hedged  # pylint: disable=wrong-import-position
+from helpers.routing import AoaiTarget  # pylint: disable=wrong-import-position
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--requests", type=int, default=500, help="Number of requests per run")
+parser.add_argument("--concurrency", type=int, default=20, help="Number of concurrent requests")
+parser.add_argument("--fast-ms", type=float, default=30, help="Latency of a fast response in ms")
+parser.add_argument("--slow-ms", type=float, default=800, help="Latency of a slow response in ms")
+parser.add_argument("--slow-share", type=float, default=0.05, help="Share of slow responses (0..1)")
+parser.add_argument("--max-hedge-rate", type=float, default=0.1, help="Maximum share of hedged requests")
+args = parser.parse_args()
+
+
+def create_mock_target(name, upstream_calls):
+    """Return a target backed by a mock upstream with a slow tail."""
+
+    async def handle(request):
+        upstream_calls[name] = upstream_calls.get(name, 0) + 1
+        is_slow = random.random() < args.slow_share
+        await asyncio.sleep((args.slow_ms if is_slow else args.fast_ms * random.uniform(0.8, 1.2)) / 1_000)
+        return httpx.Response(200, json={"usage": {"prompt_tokens": 10, "completion_tokens": 5, "total_tokens": 15}})
+
+    return AoaiTarget(
+        name=name,
+        target_type="virtual_deployment_standin",
+        endpoint=name,
+        url=f"https://{name}/",
+        endpoint_client=httpx.AsyncClient(base_url=f"https://{name}/", transport=httpx.MockTransport(handle)),
+        endpoint_key="",
+        virtual_deployment="gpt-4o",
+        standin=name,
+    )
+
+
+async def run(use_hedging):
+    """Send all requests and return latencies, upstream calls and the hedging policy."""
+    random.seed(42)
+    upstream_calls = {}
+    targets = [create_mock_target("ptu", upstream_calls), create_mock_target("paygo", upstream_calls)]
+    hedging_policy = HedgingPolicy(
+        "gpt-4o",
+        QueryDict(
+            {"delay_percentile": 90, "initial_delay_ms": args.fast_ms * 3, "max_hedge_rate": args.max_hedge_rate}
+        ),
+    )
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies_ms = []
+
+    async def send(aoai_target):
+        return await aoai_target.endpoint_client.send(
+            aoai_target.endpoint_client.build_request("POST", "openai/deployments/x/chat/completions", content=b"{}"),
+            stream=True,
+        )
+
+    async def check_response(aoai_target, response):
+        return response.status_code == 200
+
+    async def send_one():
+        async with semaphore:
+            start_time = time.perf_counter()
+            if use_hedging:
+                hedging_policy.record_request()
+                _, response, _ = await send_hedged(hedging_policy, targets[0], iter(targets[1:]), send, check_response)
+            else:
+                response = await send(targets[0])
+            await response.aread()
+            latencies_ms.append((time.perf_counter() - start_time) * 1_000)
+
+    await asyncio.gather(*[send_one() for _ in range(args.requests)])
+    for aoai_target in targets:
+        await aoai_target.endpoint_client.aclose()
+    return sorted(latencies_ms), upstream_calls, hedging_policy
+
+
+def percentile(sorted_values, percent):
+    """Return the given percentile of the given sorted values."""
+    return sorted_values[min(int(len(sorted_values) * percent / 100), len(sorted_values) - 1)]
+
+
+print(
+    f"{'mode':<12} {'p50 (ms)':>9} {'p95 (ms)':>9} {'p99 (ms)':>9} {'max (ms)':>9} "
+    f"{'upstream calls':>15} {'hedges fired':>13} {'hedges won':>11}"
+)
+for mode, use_hedging in [("no hedging", False), ("hedging", True)]:
+    latencies_ms, upstream_calls, hedging_policy = asyncio.run(run(use_hedging))
+    print(
+        f"{mode:<12} {percentile(latencies_ms, 50):>9.1f} {percentile(latencies_ms, 95):>9.1f} "
+        f"{percentile(latencies_ms, 99):>9.1f} {latencies_ms[-1]:>9.1f} {sum(upstream_calls.values()):>15} "
+        f"{hedging_policy.metrics['hedges_fired'] if use_hedging else 0:>13} "
+        f"{hedging_policy.metrics['hedges_won'] if use_hedging else 0:>11}"
+    )
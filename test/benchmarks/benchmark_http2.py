@@ -0,0 +1,251 @@
+"""
+Benchmark for the number of connections and the latency of many concurrent streams, with HTTP/1.1 and HTTP/2.
+
+Starts a local stand-in for Azure OpenAI in a separate process, serving TLS with HTTP/2 or HTTP/1.1 (negotiated via
+ALPN) and allowing 100 concurrent streams per HTTP/2 connection, like common servers do. Every request is answered with
+an event stream of the given number of events. Compares:
+- HTTP/1.1 with PowerProxy's default connection limits (max. 100 connections)
+- HTTP/1.1 with a connection per stream
+- HTTP/2 as provided by httpx (all streams over the first connection, exceeding streams wait on that connection)
+- HTTP/2 via Http2ConnectionPool (streams spread over multiple connections, max. 100 streams per connection)
+
+Example: python benchmark_http2.py --streams 2000 --events 20 --event-interval-ms 25
+"""
+
+import argparse
+import asyncio
+import datetime
+import ipaddress
+import multiprocessing
+import os
+import socket
+import ssl
+import sys
+import tempfile
+import time
+
+import h2.config
+import h2.connection
+import h2.events
+import h2.settings
+import httpx
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "app"))
+
+from helpers.connections import Http2ConnectionPool  # pylint: disable=wrong-import-position
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--streams", type=int, default=2_000, help="Number of concurrent streams")
+parser.add_argument("--events", type=int, default=20, help="Number of events per stream")
+parser.add_argument("--event-interval-ms", type=float, default=25, help="Time between the events of a stream")
+parser.add_argument("--max-streams-per-connection", type=int, default=100, help="Max. streams per HTTP/2 connection")
+args = parser.parse_args()
+
+EVENT = b'data: {"choices": [{"index": 0, "delta": {"content": " token"}, "finish_reason": null}]}\n\n'
+
+
+def create_certificate(directory):
+    """Create a self-signed certificate for localhost in the given directory, and return the paths to it and its key."""
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "localhost")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(days=1))
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .add_extension(
+            x509.SubjectAlternativeName([x509.DNSName("localhost"), x509.IPAddress(ipaddress.ip_address("127.0.0.1"))]),
+            critical=False,
+        )
+        .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+        .sign(key, hashes.SHA256())
+    )
+    certificate_path = os.path.join(directory, "certificate.pem")
+    key_path = os.path.join(directory, "key.pem")
+    with open(certificate_path, "wb") as file:
+        file.write(certificate.public_bytes(serialization.Encoding.PEM))
+    with open(key_path, "wb") as file:
+        file.write(
+            key.private_bytes(
+                serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+            )
+        )
+    return certificate_path, key_path
+
+
+def run_stand_in(port, certificate_path, key_path, accepted_connections):
+    """Run the stand-in for Azure OpenAI, counting the accepted connections in the given shared value."""
+
+    async def serve_http2(reader, writer):
+        connection = h2.connection.H2Connection(h2.config.H2Configuration(client_side=False))
+        connection.local_settings = h2.settings.Settings(
+            client=False,
+            initial_values={h2.settings.SettingCodes.MAX_CONCURRENT_STREAMS: args.max_streams_per_connection},
+        )
+        connection.initiate_connection()
+        writer.write(connection.data_to_send())
+        window_updated = asyncio.Event()
+        responding_tasks = set()
+
+        async def respond(stream_id):
+            connection.send_headers(stream_id, [(":status", "200"), ("content-type", "text/event-stream")])
+            writer.write(connection.data_to_send())
+            for index in range(args.events):
+                await asyncio.sleep(args.event_interval_ms / 1_000)
+                while connection.local_flow_control_window(stream_id) < len(EVENT):
+                    window_updated.clear()
+                    await window_updated.wait()
+                connection.send_data(stream_id, EVENT, end_stream=index == args.events - 1)
+                writer.write(connection.data_to_send())
+
+        while data := await reader.read(65_536):
+            for event in connection.receive_data(data):
+                if isinstance(event, h2.events.DataReceived):
+                    connection.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+                elif isinstance(event, h2.events.StreamEnded):
+                    responding_task = asyncio.create_task(respond(event.stream_id))
+                    responding_tasks.add(responding_task)
+                    responding_task.add_done_callback(responding_tasks.discard)
+                elif isinstance(event, h2.events.WindowUpdated):
+                    window_updated.set()
+            writer.write(connection.data_to_send())
+
+    async def serve_http1(reader, writer):
+        while True:
+            request_head = await reader.readuntil(b"\r\n\r\n")
+            content_length = next(
+                (
+                    int(line.split(b":", 1)[1])
+                    for line in request_head.split(b"\r\n")
+                    if line.lower().startswith(b"content-length:")
+                ),
+                0,
+            )
+            await reader.readexactly(content_length)
+            writer.write(
+                b"HTTP/1.1 200 OK\r\ncontent-type: text/event-stream\r\ntransfer-encoding: chunked\r\n\r\n"
+            )
+            for _ in range(args.events):
+                await asyncio.sleep(args.event_interval_ms / 1_000)
+                writer.write(f"{len(EVENT):x}\r\n".encode() + EVENT + b"\r\n")
+            writer.write(b"0\r\n\r\n")
+            await writer.drain()
+
+    async def handle_connection(reader, writer):
+        with accepted_connections.get_lock():
+            accepted_connections.value += 1
+        try:
+            if writer.get_extra_info("ssl_object").selected_alpn_protocol() == "h2":
+                await serve_http2(reader, writer)
+            else:
+                await serve_http1(reader, writer)
+        except (ConnectionError, asyncio.IncompleteReadError, ssl.SSLError):
+            pass
+        writer.close()
+
+    async def serve():
+        ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        ssl_context.load_cert_chain(certificate_path, key_path)
+        ssl_context.set_alpn_protocols(["h2", "http/1.1"])
+        server = await asyncio.start_server(handle_connection, "127.0.0.1", port, ssl=ssl_context, backlog=4_096)
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(serve())
+
+
+async def measure(create_client):
+    """Send all streams at once with the given client and return the latencies until headers and until completion."""
+    async with create_client() as client:
+        latencies_to_headers_ms = []
+        latencies_ms = []
+
+        async def send_stream():
+            start_time = time.perf_counter()
+            async with client.stream(
+                "POST", "/openai/deployments/gpt-4o/chat/completions", json={"stream": True}
+            ) as response:
+                latencies_to_headers_ms.append((time.perf_counter() - start_time) * 1_000)
+                async for _ in response.aiter_raw():
+                    pass
+            latencies_ms.append((time.perf_counter() - start_time) * 1_000)
+
+        await asyncio.gather(*[send_stream() for _ in range(args.streams)])
+        return sorted(latencies_to_headers_ms), sorted(latencies_ms)
+
+
+def percentile(sorted_values, percent):
+    """Return the given percentile of the given sorted values."""
+    return sorted_values[min(int(len(sorted_values) * percent / 100), len(sorted_values) - 1)]
+
+
+if __name__ == "__main__":
+    with socket.socket() as free_socket:
+        free_socket.bind(("127.0.0.1", 0))
+        stand_in_port = free_socket.getsockname()[1]
+    base_url = f"https://127.0.0.1:{stand_in_port}"
+    timeout = httpx.Timeout(connect=60, read=600, write=600, pool=None)
+    with tempfile.TemporaryDirectory() as certificate_directory:
+        certificate_path, key_path = create_certificate(certificate_directory)
+        accepted_connections = multiprocessing.Value("i", 0)
+        stand_in = multiprocessing.Process(
+            target=run_stand_in, args=(stand_in_port, certificate_path, key_path, accepted_connections), daemon=True
+        )
+        stand_in.start()
+        time.sleep(1)
+
+        clients = {
+            "HTTP/1.1, 100 connections": lambda: httpx.AsyncClient(
+                base_url=base_url,
+                timeout=timeout,
+                verify=ssl.create_default_context(cafile=certificate_path),
+                limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+            ),
+            f"HTTP/1.1, {args.streams} connections": lambda: httpx.AsyncClient(
+                base_url=base_url,
+                timeout=timeout,
+                verify=ssl.create_default_context(cafile=certificate_path),
+                limits=httpx.Limits(max_connections=args.streams, max_keepalive_connections=args.streams),
+            ),
+            "HTTP/2, httpx": lambda: httpx.AsyncClient(
+                base_url=base_url,
+                timeout=timeout,
+                verify=ssl.create_default_context(cafile=certificate_path),
+                http1=False,
+                http2=True,
+            ),
+            "HTTP/2, pool": lambda: httpx.AsyncClient(
+                base_url=base_url,
+                timeout=timeout,
+                transport=Http2ConnectionPool(
+                    max_connections=args.streams // args.max_streams_per_connection + 1,
+                    max_streams_per_connection=args.max_streams_per_connection,
+                    verify=ssl.create_default_context(cafile=certificate_path),
+                ),
+            ),
+        }
+        print(
+            f"{args.streams} concurrent streams with {args.events} events every {args.event_interval_ms:g} ms "
+            f"(ideal latency {args.events * args.event_interval_ms:g} ms)"
+        )
+        for client_name, create_client in clients.items():
+            accepted_connections.value = 0
+            start_time = time.perf_counter()
+            latencies_to_headers_ms, latencies_ms = asyncio.run(measure(create_client))
+            duration_s = time.perf_counter() - start_time
+            print(
+                f"{client_name:<28} {accepted_connections.value:5} connections"
+                f" | headers p50 {percentile(latencies_to_headers_ms, 50):7.0f} ms"
+                f" p99 {percentile(latencies_to_headers_ms, 99):7.0f} ms"
+                f" | complete p50 {percentile(latencies_ms, 50):7.0f} ms p99 {percentile(latencies_ms, 99):7.0f} ms"
+                f" | {duration_s:5.1f} s"
+            )
+        stand_in.terminate()
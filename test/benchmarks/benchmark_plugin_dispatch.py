@@ -0,0 +1,75 @@
+"""
+Micro-benchmark for the cost of running plugin hooks, per streamed event and per request.
+
+Compares foreach_plugin (looking up the hook on every plugin on every call, and running the empty default hooks) against
+the hooks compiled at configuration load, using the five plugins of the example configuration. Plugins are configured
+to not access the network (no Redis, Log Analytics is only instantiated).
+
+Example: python benchmark_plugin_dispatch.py --events 200000
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import yaml
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "app"))
+
+from helpers.config import Configuration  # pylint: disable=wrong-import-position
+from helpers.routing_slip import RoutingSlip  # pylint: disable=wrong-import-position
+from plugins.base import foreach_plugin  # pylint: disable=wrong-import-position
+
+APP_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "app")
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--events", type=int, default=200_000, help="Number of hook runs per measurement")
+args = parser.parse_args()
+
+# load the example configuration, with a mock instead of real endpoints and without Redis
+with open(os.path.join(APP_DIRECTORY, "..", "config", "config.example.yaml"), "r", encoding="utf-8") as file:
+    config_values = yaml.safe_load(file)
+config_values["aoai"] = {"mock_response": {"json": {}}}
+for plugin_config in config_values["plugins"]:
+    plugin_config.pop("redis", None)
+os.chdir(APP_DIRECTORY)
+config = Configuration(config_values)
+print(f"Plugins: {', '.join(plugin.__class__.__name__ for plugin in config.plugins)}")
+
+routing_slip = RoutingSlip(None, b"{}", "openai/deployments/gpt-4o/chat/completions")
+routing_slip.data_from_target = json.dumps(
+    {"choices": [{"index": 0, "delta": {"content": " token"}, "finish_reason": None}]}
+)
+routing_slip.headers_from_target = {"x-ms-region": "Sweden Central"}
+for plugin in config.plugins:
+    plugin.on_new_request_received(routing_slip)
+
+
+def run_compiled_hooks(hooks):
+    """Run the given compiled hooks like the per-event loop does."""
+    for hook in hooks:
+        hook(routing_slip)
+
+
+def measure(run_hook):
+    """Return the average time per hook run in nanoseconds."""
+    start = time.perf_counter()
+    for _ in range(args.events):
+        run_hook()
+    return (time.perf_counter() - start) / args.events * 1_000_000_000
+
+
+for hook_name in ["on_data_event_from_target_received", "on_headers_from_target_received"]:
+    compiled_hooks = getattr(config.plugin_hooks, hook_name)
+    results = {
+        "foreach_plugin": measure(lambda hook_name=hook_name: foreach_plugin(config.plugins, hook_name, routing_slip)),
+        "compiled": measure(lambda compiled_hooks=compiled_hooks: run_compiled_hooks(compiled_hooks)),
+    }
+    print(f"{hook_name} ({len(compiled_hooks)} of {len(config.plugins)} plugins override it)")
+    for dispatch_name, nanoseconds in results.items():
+        print(
+            f"    {dispatch_name:<15} {nanoseconds:8.0f} ns per run"
+            f" | {results['foreach_plugin'] / nanoseconds:5.2f}x"
+        )
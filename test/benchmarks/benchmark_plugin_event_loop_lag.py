@@ -0,0 +1,195 @@
+"""
+Benchmark for the event loop lag and throughput caused by plugins doing I/O, before and after async plugin hooks.
+
+Simulates concurrent requests running the hooks of the LimitUsage plugin against a local Redis stand-in (a minimal
+Redis protocol server in a separate process, answering after the given network latency). Compares the former
+synchronous Redis client, which blocks the event loop during every roundtrip, against the async hooks. The event loop
+lag is measured by a ticker task which should wake up every millisecond.
+
+Example: python benchmark_plugin_event_loop_lag.py --requests 1000 --concurrency 50 --redis-latency-ms 1
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import socket
+import sys
+import time
+
+import redis
+from redis.asyncio import StrictRedis
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "app"))
+
+from helpers.dicts import QueryDict  # pylint: disable=wrong-import-position
+from helpers.routing_slip import RoutingSlip  # pylint: disable=wrong-import-position
+from plugins.base import compile_plugin_hooks, run_plugin_hooks  # pylint: disable=wrong-import-position
+from plugins.LimitUsage.LimitUsage import LimitUsage  # pylint: disable=wrong-import-position
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--requests", type=int, default=1_000, help="Number of simulated requests")
+parser.add_argument("--concurrency", type=int, default=50, help="Number of concurrent requests")
+parser.add_argument("--redis-latency-ms", type=float, default=1, help="Simulated network latency of Redis")
+parser.add_argument("--upstream-latency-ms", type=float, default=50, help="Simulated latency of Azure OpenAI")
+args = parser.parse_args()
+
+
+def run_redis_stand_in(port, latency_ms):
+    """Run a minimal server speaking the Redis protocol, supporting the commands used by LimitUsage."""
+    values = {}
+
+    def encode(value):
+        if value is None:
+            return b"$-1\r\n"
+        if isinstance(value, int):
+            return f":{value}\r\n".encode()
+        if isinstance(value, list):
+            return f"*{len(value)}\r\n".encode() + b"".join(encode(item) for item in value)
+        value = str(value).encode() if not isinstance(value, bytes) else value
+        return f"${len(value)}\r\n".encode() + value + b"\r\n"
+
+    def execute(command, arguments):
+        match command:
+            case b"GET":
+                return encode(values.get(arguments[0]))
+            case b"MGET":
+                return encode([values.get(key) for key in arguments])
+            case b"SET":
+                values[arguments[0]] = arguments[1]
+                return b"+OK\r\n"
+            case b"MSET":
+                values.update(zip(arguments[::2], arguments[1::2]))
+                return b"+OK\r\n"
+            case b"DECRBY":
+                values[arguments[0]] = int(values.get(arguments[0], 0)) - int(arguments[1])
+                return encode(values[arguments[0]])
+            case _:
+                return b"+OK\r\n"
+
+    async def handle_connection(reader, writer):
+        try:
+            while line := await reader.readline():
+                parts = []
+                for _ in range(int(line[1:])):
+                    length = int((await reader.readline())[1:])
+                    parts.append((await reader.readexactly(length + 2))[:-2])
+                await asyncio.sleep(latency_ms / 1_000)
+                writer.write(execute(parts[0].upper(), parts[1:]))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        writer.close()
+
+    async def serve():
+        server = await asyncio.start_server(handle_connection, "127.0.0.1", port)
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(serve())
+
+
+class FormerLimitUsage(LimitUsage):
+    """LimitUsage as it was before async hooks, using a synchronous Redis client."""
+
+    def on_client_identified(self, routing_slip):
+        """Run when the client has been identified."""
+        client = routing_slip.client
+        virtual_deployment = routing_slip.virtual_deployment
+        current_minute = int(time.time() / 60)
+        current_minute_from_cache = int(self.redis_cache.get(f"LimitUsage-{client}-{virtual_deployment}-minute") or 0)
+        if not current_minute_from_cache or current_minute_from_cache != current_minute:
+            self.redis_cache.set(f"LimitUsage-{client}-{virtual_deployment}-minute", current_minute)
+            self.redis_cache.set(
+                f"LimitUsage-{client}-{virtual_deployment}-budget",
+                self._get_max_tokens_per_minute_in_k_for_client(client, virtual_deployment),
+            )
+        int(self.redis_cache.get(f"LimitUsage-{client}-{virtual_deployment}-minute"))
+        int(self.redis_cache.get(f"LimitUsage-{client}-{virtual_deployment}-budget"))
+
+    def on_token_counts_for_request_available(self, routing_slip):
+        """Is invoked when token counts are available for the request."""
+        client = routing_slip.client
+        virtual_deployment = routing_slip.virtual_deployment
+        old_budget = int(self.redis_cache.get(f"LimitUsage-{client}-{virtual_deployment}-budget"))
+        self.redis_cache.set(
+            f"LimitUsage-{client}-{virtual_deployment}-budget",
+            old_budget - self.get_request_state(routing_slip).total_tokens,
+        )
+
+
+class AppConfiguration:
+    """Minimal app configuration providing the client settings needed by LimitUsage."""
+
+    def get_client_settings(self, client):
+        """Return the settings of the given client."""
+        return {"name": client, "max_tokens_per_minute_in_k": 1_000_000}
+
+
+async def run(plugin_class, port):
+    """Simulate all requests with the given plugin class and return event loop lags and the duration."""
+    plugin = plugin_class(AppConfiguration(), QueryDict({"name": "LimitUsage"}))
+    plugin.redis_cache = (
+        redis.StrictRedis(host="127.0.0.1", port=port) if plugin_class is FormerLimitUsage else StrictRedis(port=port)
+    )
+    plugin_hooks = compile_plugin_hooks([plugin])
+    semaphore = asyncio.Semaphore(args.concurrency)
+    lags_ms = []
+    is_running = True
+
+    async def measure_lag():
+        while is_running:
+            start_time = time.perf_counter()
+            await asyncio.sleep(0.001)
+            lags_ms.append((time.perf_counter() - start_time) * 1_000 - 1)
+
+    async def simulate_request(index):
+        async with semaphore:
+            routing_slip = RoutingSlip(None, b"{}", "openai/deployments/gpt-4o/chat/completions")
+            routing_slip.client = f"client-{index % 5}"
+            routing_slip.virtual_deployment = "gpt-4o"
+            routing_slip.body_from_target = json.dumps(
+                {"usage": {"prompt_tokens": 10, "completion_tokens": 5, "total_tokens": 15}}
+            ).encode()
+            await run_plugin_hooks(plugin_hooks.on_new_request_received, routing_slip)
+            await run_plugin_hooks(plugin_hooks.on_client_identified, routing_slip)
+            await asyncio.sleep(args.upstream_latency_ms / 1_000)
+            await run_plugin_hooks(plugin_hooks.on_body_dict_from_target_available, routing_slip)
+
+    lag_measuring_task = asyncio.create_task(measure_lag())
+    start_time = time.perf_counter()
+    await asyncio.gather(*[simulate_request(index) for index in range(args.requests)])
+    await asyncio.gather(*plugin.background_tasks)
+    duration_s = time.perf_counter() - start_time
+    is_running = False
+    await lag_measuring_task
+    return sorted(lags_ms), duration_s
+
+
+def percentile(sorted_values, percent):
+    """Return the given percentile of the given sorted values."""
+    return sorted_values[min(int(len(sorted_values) * percent / 100), len(sorted_values) - 1)]
+
+
+if __name__ == "__main__":
+    with socket.socket() as free_socket:
+        free_socket.bind(("127.0.0.1", 0))
+        redis_port = free_socket.getsockname()[1]
+    redis_stand_in = multiprocessing.Process(
+        target=run_redis_stand_in, args=(redis_port, args.redis_latency_ms), daemon=True
+    )
+    redis_stand_in.start()
+    time.sleep(0.5)
+
+    print(
+        f"{args.requests} requests, concurrency {args.concurrency}, Redis latency {args.redis_latency_ms:g} ms, "
+        f"upstream latency {args.upstream_latency_ms:g} ms"
+    )
+    for name, plugin_class in [("sync hooks (former)", FormerLimitUsage), ("async hooks", LimitUsage)]:
+        lags_ms, duration_s = asyncio.run(run(plugin_class, redis_port))
+        print(
+            f"{name:<20} event loop lag: p50 {percentile(lags_ms, 50):6.2f} ms | p99 {percentile(lags_ms, 99):6.2f} ms"
+            f" | max {lags_ms[-1]:6.2f} ms | {args.requests / duration_s:7.1f} req/s"
+        )
+    redis_stand_in.terminate()
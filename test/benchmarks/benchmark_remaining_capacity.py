@@ -0,0 +1,204 @@
+"""
+Simulation of routing with and without estimating the remaining capacity of targets from their rate limit headers.
+
+A mock PTU deployment with a tokens-per-minute limit and a mock pay-as-you-go deployment without limit are served via
+httpx's MockTransport. The PTU's limit is a token bucket refilled continuously and holding the tokens of 10 seconds, as
+Azure OpenAI evaluates its limits over short periods. The PTU answers with its remaining tokens in the
+'x-ratelimit-remaining-tokens' header, and with a 429 and 'retry-after-ms' if a request exceeds its remaining tokens.
+Requests with mostly small and some large prompts arrive at a rate exceeding the PTU's limit, and are routed like
+PowerProxy does: PTU first, failing over to pay-as-you-go on a 429, with a circuit breaker per target. Note that the
+mock PTU counts tokens like PowerProxy estimates them, which Azure OpenAI does only approximately.
+Compares:
+- no estimation: the PTU is tried until it returns a 429
+- estimation: targets expected to throttle a request are tried last
+- estimation + limit headers: same, with the PTU telling its limits per minute, so the estimate is replenished
+
+Time runs faster than real time (by --time-scale), so the minutes of the rate limit pass within seconds.
+
+Example: python benchmark_remaining_capacity.py --ptu-tpm 1000000 --load 1.2 --large-share 0.1
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import sys
+import time
+
+import httpx
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "app"))
+
+from helpers.rate_limits import (  # pylint: disable=wrong-import-position
+    RemainingCapacity,
+    deprioritize_targets_expected_to_throttle,
+)
+from helpers.routing import AoaiTarget  # pylint: disable=wrong-import-position
+from helpers.tokens import estimate_request_cost_in_tokens  # pylint: disable=wrong-import-position
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--ptu-tpm", type=int, default=1_000_000, help="Tokens per minute the PTU deployment accepts")
+parser.add_argument(
+    "--burst-seconds", type=float, default=10, help="Seconds of tokens the PTU accepts at once (AOAI limits per 10 s)"
+)
+parser.add_argument("--load", type=float, default=1.2, help="Tokens requested per minute relative to the PTU's limit")
+parser.add_argument("--minutes", type=float, default=5, help="Simulated minutes")
+parser.add_argument("--time-scale", type=float, default=60, help="Simulated time per real time")
+parser.add_argument("--small-tokens", type=int, default=500, help="Prompt tokens of a small request")
+parser.add_argument("--large-tokens", type=int, default=8_000, help="Prompt tokens of a large request")
+parser.add_argument("--large-share", type=float, default=0.1, help="Share of large requests (0..1)")
+parser.add_argument("--max-tokens", type=int, default=250, help="Max. completion tokens of a request")
+parser.add_argument("--response-ms", type=float, default=20, help="Real time a deployment takes to respond")
+parser.add_argument("--throttle-ms", type=float, default=5, help="Real time a deployment takes to return a 429")
+args = parser.parse_args()
+
+
+class Clock:
+    """Simulated clock, running faster than real time."""
+
+    def __init__(self):
+        """Constructor."""
+        self.start_time = time.perf_counter()
+
+    def now_ms(self):
+        """Return the simulated time in milliseconds since the start."""
+        return (time.perf_counter() - self.start_time) * 1_000 * args.time_scale
+
+
+def create_ptu_handler(clock, sends_limit_headers):
+    """Return a mock PTU deployment, limited to the given tokens per minute via a continuously refilled bucket."""
+    max_tokens_in_bucket = args.ptu_tpm * args.burst_seconds / 60
+    bucket = {"tokens": max_tokens_in_bucket, "updated_at_ms": 0.0}
+
+    async def handle(request):
+        now_ms = clock.now_ms()
+        bucket["tokens"] = min(
+            bucket["tokens"] + (now_ms - bucket["updated_at_ms"]) * args.ptu_tpm / 60_000, max_tokens_in_bucket
+        )
+        bucket["updated_at_ms"] = now_ms
+        cost_in_tokens = estimate_request_cost_in_tokens(json.loads(request.content))
+        is_admitted = bucket["tokens"] >= cost_in_tokens
+        if is_admitted:
+            bucket["tokens"] -= cost_in_tokens
+        headers = {"x-ratelimit-remaining-tokens": f"{int(bucket['tokens'])}"}
+        if sends_limit_headers:
+            headers["x-ratelimit-limit-tokens"] = f"{args.ptu_tpm}"
+        if not is_admitted:
+            await asyncio.sleep(args.throttle_ms / 1_000)
+            retry_after_ms = math.ceil((cost_in_tokens - bucket["tokens"]) * 60_000 / args.ptu_tpm)
+            return httpx.Response(429, headers={**headers, "retry-after-ms": f"{retry_after_ms}"})
+        await asyncio.sleep(args.response_ms / 1_000)
+        return httpx.Response(200, headers=headers, json={"choices": []})
+
+    return handle
+
+
+async def handle_paygo(request):
+    """Mock pay-as-you-go deployment, without limit."""
+    await asyncio.sleep(args.response_ms / 1_000)
+    return httpx.Response(200, json={"choices": []})
+
+
+def create_target(name, handler, estimates_remaining_capacity):
+    """Return a target backed by the given mock deployment."""
+    aoai_target = AoaiTarget(
+        name=name,
+        target_type="endpoint",
+        endpoint=name,
+        url=f"https://{name}/",
+        endpoint_client=httpx.AsyncClient(base_url=f"https://{name}/", transport=httpx.MockTransport(handler)),
+    )
+    if estimates_remaining_capacity:
+        aoai_target.remaining_capacity = RemainingCapacity({})
+    return aoai_target
+
+
+def create_requests():
+    """Return the arrival times (simulated ms) and bodies of the requests."""
+    random.seed(42)
+    mean_cost_in_tokens = (
+        args.large_share * args.large_tokens + (1 - args.large_share) * args.small_tokens + args.max_tokens
+    )
+    requests_per_ms = args.load * args.ptu_tpm / mean_cost_in_tokens / 60_000
+    requests = []
+    arrival_ms = 0.0
+    while (arrival_ms := arrival_ms + random.expovariate(requests_per_ms)) < args.minutes * 60_000:
+        prompt_tokens = args.large_tokens if random.random() < args.large_share else args.small_tokens
+        requests.append((arrival_ms, {"prompt": "x" * (prompt_tokens * 4), "max_tokens": args.max_tokens}))
+    return requests
+
+
+async def run(estimates_remaining_capacity, sends_limit_headers):
+    """Send all requests and return the statistics."""
+    clock = Clock()
+    ptu = create_target("ptu", create_ptu_handler(clock, sends_limit_headers), estimates_remaining_capacity)
+    paygo = create_target("paygo", handle_paygo, estimates_remaining_capacity)
+    stats = {"requests": 0, "upstream_calls": 0, "429s": 0, "failovers": 0, "ptu_tokens": 0, "paygo_tokens": 0}
+    latencies_ms = []
+
+    async def send(request_body):
+        start_time = time.perf_counter()
+        cost_in_tokens = estimate_request_cost_in_tokens(request_body)
+        candidates = deprioritize_targets_expected_to_throttle((ptu, paygo), cost_in_tokens, clock.now_ms())
+        has_failed_over = False
+        for aoai_target in candidates:
+            if not aoai_target.circuit_breaker.try_acquire(clock.now_ms()):
+                continue
+            if aoai_target.remaining_capacity is not None:
+                mark = aoai_target.remaining_capacity.record_request(cost_in_tokens)
+            stats["upstream_calls"] += 1
+            response = await aoai_target.endpoint_client.post(
+                "openai/deployments/gpt-4o/completions", json=request_body
+            )
+            if aoai_target.remaining_capacity is not None:
+                aoai_target.remaining_capacity.record_headers(response.headers, clock.now_ms(), mark)
+            if response.status_code == 429:
+                aoai_target.circuit_breaker.record_failure(clock.now_ms(), int(response.headers["retry-after-ms"]))
+                stats["429s"] += 1
+                has_failed_over = True
+                continue
+            aoai_target.circuit_breaker.record_success(clock.now_ms())
+            stats[f"{aoai_target.name}_tokens"] += cost_in_tokens
+            break
+        stats["requests"] += 1
+        stats["failovers"] += has_failed_over
+        latencies_ms.append((time.perf_counter() - start_time) * 1_000)
+
+    tasks = []
+    for arrival_ms, request_body in create_requests():
+        if (delay_ms := arrival_ms - clock.now_ms()) > 0:
+            await asyncio.sleep(delay_ms / args.time_scale / 1_000)
+        tasks.append(asyncio.create_task(send(request_body)))
+    await asyncio.gather(*tasks)
+    for aoai_target in [ptu, paygo]:
+        await aoai_target.endpoint_client.aclose()
+    return stats, sorted(latencies_ms)
+
+
+def percentile(sorted_values, percent):
+    """Return the given percentile of the given sorted values."""
+    return sorted_values[min(int(len(sorted_values) * percent / 100), len(sorted_values) - 1)]
+
+
+print(
+    f"{args.minutes:g} simulated minutes, PTU limit {args.ptu_tpm} tokens per minute, load {args.load:g}x, "
+    f"{args.large_share:.0%} large requests ({args.large_tokens} prompt tokens)"
+)
+print(
+    f"{'mode':<28} {'requests':>9} {'429s':>6} {'429 rate':>9} {'failovers':>10} {'PTU used':>9} "
+    f"{'PTU share':>10} {'p50 (ms)':>9} {'p99 (ms)':>9}"
+)
+for mode, estimates_remaining_capacity, sends_limit_headers in [
+    ("no estimation", False, False),
+    ("estimation", True, False),
+    ("estimation + limit headers", True, True),
+]:
+    stats, latencies_ms = asyncio.run(run(estimates_remaining_capacity, sends_limit_headers))
+    print(
+        f"{mode:<28} {stats['requests']:>9} {stats['429s']:>6} {stats['429s'] / stats['upstream_calls']:>9.1%} "
+        f"{stats['failovers']:>10} {stats['ptu_tokens'] / (args.ptu_tpm * args.minutes):>9.1%} "
+        f"{stats['ptu_tokens'] / (stats['ptu_tokens'] + stats['paygo_tokens']):>10.1%} "
+        f"{percentile(latencies_ms, 50):>9.1f} {percentile(latencies_ms, 99):>9.1f}"
+    )
@@ -0,0 +1,108 @@
+"""
+Benchmark for a burst of identical requests with and without coalescing identical requests in flight.
+
+Simulates warm-up calls after a service restart: many non-streaming requests arrive at once, spread over only a few
+distinct prompts. A mock upstream answers with a fixed latency and processes only a limited number of requests at the
+same time, like a deployment at its capacity. Reports latency percentiles, the duration of the burst and the requests
+and tokens sent upstream.
+
+Example: python benchmark_request_coalescing.py --requests 1000 --distinct-prompts 5
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+import httpx
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "app"))
+
+from helpers.coalescing import RequestCoalescer  # pylint: disable=wrong-import-position
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--requests", type=int, default=1_000, help="Number of requests in the burst")
+parser.add_argument("--distinct-prompts", type=int, default=5, help="Number of distinct prompts among the requests")
+parser.add_argument("--latency-ms", type=float, default=200, help="Latency of an upstream call in ms")
+parser.add_argument("--upstream-concurrency", type=int, default=50, help="Requests the upstream processes at once")
+args = parser.parse_args()
+
+PATH = "openai/deployments/gpt-4o/chat/completions"
+
+
+def create_upstream_client(upstream_stats):
+    """Return a client for a mock upstream with limited concurrency, counting the requests and tokens sent."""
+    semaphore = asyncio.Semaphore(args.upstream_concurrency)
+
+    async def handle(request):
+        async with semaphore:
+            upstream_stats["requests"] += 1
+            upstream_stats["tokens"] += 150
+            await asyncio.sleep(args.latency_ms / 1_000)
+        return httpx.Response(
+            200,
+            json={
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "ready"}}],
+                "usage": {"prompt_tokens": 100, "completion_tokens": 50, "total_tokens": 150},
+            },
+        )
+
+    return httpx.AsyncClient(base_url="https://upstream/", transport=httpx.MockTransport(handle))
+
+
+async def run(request_coalescer):
+    """Send the burst of requests and return the latencies, the burst's duration and the upstream statistics."""
+    upstream_stats = {"requests": 0, "tokens": 0}
+    upstream_client = create_upstream_client(upstream_stats)
+    latencies_ms = []
+
+    async def send(request_number):
+        request_body_dict = {
+            "messages": [{"role": "user", "content": f"warm-up prompt {request_number % args.distinct_prompts}"}]
+        }
+
+        async def get_response_from_targets():
+            response = await upstream_client.post(PATH, content=json.dumps(request_body_dict).encode())
+            return None, response
+
+        start_time = time.perf_counter()
+        if request_coalescer is None:
+            _, response = await get_response_from_targets()
+        else:
+            _, response, _ = await request_coalescer.get_response(
+                RequestCoalescer.get_key("Benchmark", "gpt-4o", PATH, "2024-10-21", request_body_dict),
+                get_response_from_targets,
+            )
+        json.loads(await response.aread())
+        latencies_ms.append((time.perf_counter() - start_time) * 1_000)
+
+    start_time = time.perf_counter()
+    await asyncio.gather(*[send(request_number) for request_number in range(args.requests)])
+    duration_ms = (time.perf_counter() - start_time) * 1_000
+    await upstream_client.aclose()
+    return sorted(latencies_ms), duration_ms, upstream_stats
+
+
+def percentile(sorted_values, percent):
+    """Return the given percentile of the given sorted values."""
+    return sorted_values[min(int(len(sorted_values) * percent / 100), len(sorted_values) - 1)]
+
+
+print(
+    f"{args.requests} requests over {args.distinct_prompts} distinct prompts, upstream latency "
+    f"{args.latency_ms:.0f} ms, upstream concurrency {args.upstream_concurrency}"
+)
+print(
+    f"{'mode':<14} {'p50 (ms)':>9} {'p95 (ms)':>9} {'p99 (ms)':>9} {'burst (ms)':>11} {'upstream requests':>18} "
+    f"{'upstream tokens':>16}"
+)
+for mode in ["no coalescing", "coalescing"]:
+    request_coalescer = RequestCoalescer({}) if mode == "coalescing" else None
+    latencies_ms, duration_ms, upstream_stats = asyncio.run(run(request_coalescer))
+    print(
+        f"{mode:<14} {percentile(latencies_ms, 50):>9.1f} {percentile(latencies_ms, 95):>9.1f} "
+        f"{percentile(latencies_ms, 99):>9.1f} {duration_ms:>11.1f} {upstream_stats['requests']:>18} "
+        f"{upstream_stats['tokens']:>16}"
+    )
@@ -0,0 +1,116 @@
+"""
+Micro-benchmark for the per-request cost of finding a target for a request.
+
+Compares the former linear scan over all targets (re-checking type, virtual deployment and block timestamp, and running
+re.search/re.sub over the path for every request) against the routing table built once at startup.
+
+Example: python benchmark_routing.py --requests 20000
+"""
+
+import argparse
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "app"))
+
+from helpers.routing import AoaiTarget, RequestPath, RoutingTable  # pylint: disable=wrong-import-position
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--requests", type=int, default=20_000, help="Number of simulated requests per configuration")
+parser.add_argument("--standins", type=int, default=2, help="Number of standins per virtual deployment")
+args = parser.parse_args()
+
+
+def build_targets(endpoints, virtual_deployments, standins):
+    """Return the targets for the given numbers of endpoints, virtual deployments and standins."""
+    targets = []
+    for endpoint_index in range(endpoints):
+        for virtual_deployment_index in range(virtual_deployments):
+            for standin_index in range(standins):
+                targets.append(
+                    AoaiTarget(
+                        name=f"s{standin_index}@vd{virtual_deployment_index}@e{endpoint_index}",
+                        target_type="virtual_deployment_standin",
+                        endpoint=f"e{endpoint_index}",
+                        url=f"https://e{endpoint_index}.openai.azure.com/",
+                        endpoint_client=None,
+                        endpoint_key="",
+                        virtual_deployment=f"vd{virtual_deployment_index}",
+                        standin=f"s{standin_index}",
+                    )
+                )
+    return targets
+
+
+def to_legacy_dicts(targets):
+    """Return the targets in the dict-based form used before the routing table was introduced."""
+    return {
+        target.name: {
+            "name": target.name,
+            "type": target.type,
+            "endpoint": target.endpoint,
+            "virtual_deployment": target.virtual_deployment,
+            "standin": target.standin,
+            "url": target.url,
+            "endpoint_key": target.endpoint_key,
+            "next_request_not_before_timestamp_ms": 0,
+            "non_streaming_fraction": 1.0,
+        }
+        for target in targets
+    }
+
+
+def route_legacy(aoai_targets, path, now_ms):
+    """Find the first eligible target the way the former linear scan did."""
+    virtual_deployment = re.search(r"(?<=deployments\/)[^\/]+", path).group(0)
+    for aoai_target_name in aoai_targets:
+        aoai_target = aoai_targets[aoai_target_name]
+        if aoai_target["next_request_not_before_timestamp_ms"] > now_ms:
+            continue
+        if (
+            aoai_target["type"] == "virtual_deployment_standin"
+            and virtual_deployment != aoai_target["virtual_deployment"]
+        ):
+            continue
+        return aoai_target, re.sub(r"/deployments/[^/]+", f"/deployments/{aoai_target['standin']}", path)
+    return None, path
+
+
+def route_indexed(routing_table, path, now_ms):
+    """Find the first eligible target by using the routing table."""
+    request_path = RequestPath(path)
+    for aoai_target in routing_table.get_candidates(request_path.deployment):
+        if not aoai_target.circuit_breaker.allows_request(now_ms):
+            continue
+        return aoai_target, request_path.with_deployment(aoai_target.standin)
+    return None, path
+
+
+def measure(route, targets_index, paths):
+    """Return the average time per routed request in microseconds."""
+    now_ms = time.time_ns() // 1_000_000
+    start = time.perf_counter()
+    for path in paths:
+        route(targets_index, path, now_ms)
+    return (time.perf_counter() - start) / len(paths) * 1_000_000
+
+
+print(
+    f"{'endpoints':>9} {'virt. depl.':>11} {'targets':>8} {'linear scan (µs)':>17} {'indexed (µs)':>13} "
+    f"{'speedup':>8}"
+)
+for endpoints, virtual_deployments in [(1, 2), (2, 5), (5, 10), (10, 20), (20, 50)]:
+    targets = build_targets(endpoints, virtual_deployments, args.standins)
+    paths = [
+        f"openai/deployments/vd{random.randrange(virtual_deployments)}/chat/completions"
+        for _ in range(args.requests)
+    ]
+    legacy_us = measure(route_legacy, to_legacy_dicts(targets), paths)
+    indexed_us = measure(route_indexed, RoutingTable(targets), paths)
+    print(
+        f"{endpoints:>9} {virtual_deployments:>11} {len(targets):>8} {legacy_us:>17.2f} {indexed_us:>13.2f} "
+        f"{legacy_us / indexed_us:>7.1f}x"
+    )
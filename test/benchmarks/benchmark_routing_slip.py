@@ -0,0 +1,159 @@
+"""
+Benchmark for the cost of the routing slip per 10,000 requests: time, memory retained and memory blocks allocated.
+
+Compares the former dict routing slip (string keys, request and response bodies always parsed) against the slotted
+RoutingSlip (attributes, bodies parsed on first access), accessed like PowerProxy and the TokenCountingPlugin access it.
+All routing slips are kept alive until measured, like with many concurrent requests. Also measures the dict-style
+access of RoutingSlip, as used by plugins written against the former dict routing slip.
+
+Example: python benchmark_routing_slip.py --requests 10000 --events 50
+"""
+
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "app"))
+
+from helpers.routing_slip import RoutingSlip  # pylint: disable=wrong-import-position
+from plugins.base import PluginContext  # pylint: disable=wrong-import-position
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--requests", type=int, default=10_000, help="Number of requests per measurement")
+parser.add_argument("--events", type=int, default=50, help="Number of data events per streamed response")
+parser.add_argument("--runs", type=int, default=5, help="Number of runs per measurement, the fastest is reported")
+args = parser.parse_args()
+
+REQUEST_BODY = json.dumps(
+    {"messages": [{"role": "user", "content": "Tell me something about Azure OpenAI. " * 20}], "max_tokens": 800}
+).encode()
+STREAMING_REQUEST_BODY = json.dumps({**json.loads(REQUEST_BODY), "stream": True}).encode()
+RESPONSE_BODY = json.dumps(
+    {
+        "id": "chatcmpl-123",
+        "object": "chat.completion",
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": "Azure OpenAI is... " * 40}}],
+        "usage": {"prompt_tokens": 180, "completion_tokens": 200, "total_tokens": 380},
+    }
+).encode()
+DATA_EVENT = json.dumps({"choices": [{"index": 0, "delta": {"content": " token"}, "finish_reason": None}]})
+HEADERS_FROM_TARGET = {"x-ms-region": "Sweden Central", "content-type": "application/json"}
+
+
+def process_with_dict(is_streaming):
+    """Process a request with the former dict routing slip."""
+    routing_slip = {
+        "request_received_utc": datetime.now(timezone.utc),
+        "incoming_request": None,
+        "incoming_request_body": STREAMING_REQUEST_BODY if is_streaming else REQUEST_BODY,
+        "path": "openai/deployments/gpt-4o/chat/completions",
+        "plugin_context": PluginContext(),
+    }
+    routing_slip["virtual_deployment"] = "gpt-4o"
+    routing_slip["incoming_request_body_dict"] = json.loads(routing_slip["incoming_request_body"])
+    routing_slip["is_non_streaming_response_requested"] = routing_slip["incoming_request_body_dict"] and not (
+        "stream" in routing_slip["incoming_request_body_dict"]
+        and str(routing_slip["incoming_request_body_dict"]["stream"]).lower() == "true"
+    )
+    routing_slip["api_version"] = "2024-10-21"
+    routing_slip["client"] = "Team 1"
+    routing_slip["aoai_request_start_time"] = 0
+    routing_slip["aoai_endpoint"] = "https://mock.openai.azure.com"
+    routing_slip["aoai_virtual_deployment"] = routing_slip["virtual_deployment"]
+    routing_slip["aoai_standin_deployment"] = "gpt-4o"
+    routing_slip["headers_from_target"] = HEADERS_FROM_TARGET
+    routing_slip["is_event_stream"] = not routing_slip["is_non_streaming_response_requested"]
+    routing_slip["response_headers_from_target"] = HEADERS_FROM_TARGET
+    if routing_slip["is_event_stream"]:
+        for _ in range(args.events):
+            routing_slip["data_from_target"] = DATA_EVENT
+            if "data_from_target" in routing_slip:
+                len(routing_slip["data_from_target"])
+    else:
+        routing_slip["body_dict_from_target"] = json.loads(RESPONSE_BODY)
+    routing_slip["aoai_request_end_time"] = 1
+    routing_slip["aoai_roundtrip_time_ms"] = int(
+        routing_slip["aoai_request_end_time"] - routing_slip["aoai_request_start_time"]
+    )
+    return routing_slip
+
+
+def process_with_routing_slip(is_streaming):
+    """Process a request with the slotted routing slip, like PowerProxy does without plugins needing the body dict."""
+    routing_slip = RoutingSlip(
+        None, STREAMING_REQUEST_BODY if is_streaming else REQUEST_BODY, "openai/deployments/gpt-4o/chat/completions"
+    )
+    routing_slip.virtual_deployment = "gpt-4o"
+    routing_slip.api_version = "2024-10-21"
+    routing_slip.client = "Team 1"
+    routing_slip.aoai_request_start_time = 0
+    routing_slip.aoai_endpoint = "https://mock.openai.azure.com"
+    routing_slip.aoai_virtual_deployment = routing_slip.virtual_deployment
+    routing_slip.aoai_standin_deployment = "gpt-4o"
+    routing_slip.headers_from_target = HEADERS_FROM_TARGET
+    routing_slip.is_event_stream = not routing_slip.is_non_streaming_response_requested
+    routing_slip.response_headers_from_target = HEADERS_FROM_TARGET
+    if routing_slip.is_event_stream:
+        for _ in range(args.events):
+            routing_slip.data_from_target = DATA_EVENT
+            if routing_slip.data_from_target is not None:
+                len(routing_slip.data_from_target)
+    else:
+        routing_slip.body_from_target = RESPONSE_BODY
+    routing_slip.aoai_request_end_time = 1
+    routing_slip.aoai_roundtrip_time_ms = int(routing_slip.aoai_request_end_time - routing_slip.aoai_request_start_time)
+    return routing_slip
+
+
+def process_with_routing_slip_as_dict(is_streaming):
+    """Process a request with the slotted routing slip, accessed like a dict by a plugin."""
+    routing_slip = process_with_routing_slip(is_streaming)
+    if routing_slip["is_event_stream"]:
+        for _ in range(args.events):
+            routing_slip["data_from_target"] = DATA_EVENT
+            if "data_from_target" in routing_slip:
+                len(routing_slip["data_from_target"])
+    else:
+        len(routing_slip["body_dict_from_target"])
+    return routing_slip
+
+
+def measure(process, is_streaming):
+    """Return the time in ms, the memory retained in KiB and the memory blocks allocated for all requests."""
+    durations_ms = []
+    for _ in range(args.runs):
+        gc.collect()
+        gc.disable()
+        blocks_before = sys.getallocatedblocks()
+        start_time = time.perf_counter()
+        routing_slips = [process(is_streaming) for _ in range(args.requests)]
+        durations_ms.append((time.perf_counter() - start_time) * 1_000)
+        blocks = sys.getallocatedblocks() - blocks_before
+        gc.enable()
+        del routing_slips
+
+    tracemalloc.start()
+    routing_slips = [process(is_streaming) for _ in range(args.requests)]
+    retained_kib = tracemalloc.get_traced_memory()[0] / 1_024
+    tracemalloc.stop()
+    del routing_slips
+    return min(durations_ms), retained_kib, blocks
+
+
+print(f"{args.requests} requests, {args.events} data events per streamed response")
+for is_streaming in [False, True]:
+    print("streamed responses" if is_streaming else "non-streamed responses")
+    results = {
+        "dict (former)": measure(process_with_dict, is_streaming),
+        "RoutingSlip": measure(process_with_routing_slip, is_streaming),
+        "RoutingSlip as dict": measure(process_with_routing_slip_as_dict, is_streaming),
+    }
+    for name, (duration_ms, retained_kib, blocks) in results.items():
+        print(
+            f"    {name:<20} {duration_ms:8.1f} ms | {retained_kib:9.0f} KiB retained | {blocks:9,} blocks allocated"
+        )
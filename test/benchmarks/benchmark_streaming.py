@@ -0,0 +1,145 @@
+"""
+Benchmark for the latency added to each chunk of an event stream while relaying it to the client.
+
+Compares the former line-based relay (decoding every line, re-encoding it with '\\r\\n' and invoking the plugins before
+the next line is read) against the raw byte passthrough with the events being processed off the forwarding path. A
+mock upstream emits one chunk per token at the given rate, and the time from emitting a chunk upstream until it is
+received downstream completely is measured. Plugin work per event is simulated by parsing the event's JSON plus the
+given busy time.
+
+Example: python benchmark_streaming.py --tokens 2000 --tokens-per-second 0 --plugin-work-us 100
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+import httpx
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "app"))
+
+from helpers.streaming import relay_event_stream  # pylint: disable=wrong-import-position
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--tokens", type=int, default=2_000, help="Number of tokens (chunks) per stream")
+parser.add_argument(
+    "--tokens-per-second", type=float, default=0, help="Rate at which the upstream emits tokens (0 = unlimited)"
+)
+parser.add_argument("--plugin-work-us", type=float, default=100, help="Simulated plugin work per event")
+parser.add_argument("--runs", type=int, default=5, help="Number of streams per relay")
+args = parser.parse_args()
+
+
+class MockUpstream(httpx.AsyncByteStream):
+    """
+    Upstream emitting one event per token at the given rate, remembering when each chunk was emitted.
+
+    Chunks are emitted by a separate task, independent of when the relay reads them, like a real upstream does.
+    """
+
+    def __init__(self):
+        """Constructor."""
+        self.emitted = []
+        self.chunks = asyncio.Queue()
+        self.emitting_task = asyncio.create_task(self.emit())
+
+    async def emit(self):
+        """Emit the chunks at the given rate."""
+        emitted_bytes = 0
+        start_time = time.perf_counter()
+        for index in range(args.tokens):
+            chunk = (
+                "data: "
+                + json.dumps(
+                    {
+                        "id": "chatcmpl-123",
+                        "object": "chat.completion.chunk",
+                        "choices": [{"index": 0, "delta": {"content": f" token{index}"}, "finish_reason": None}],
+                    }
+                )
+                + "\n\n"
+            ).encode()
+            if args.tokens_per_second:
+                await asyncio.sleep(max(start_time + index / args.tokens_per_second - time.perf_counter(), 0))
+            emitted_bytes += len(chunk)
+            self.emitted.append((emitted_bytes, time.perf_counter()))
+            self.chunks.put_nowait(chunk)
+        self.chunks.put_nowait(b"data: [DONE]\n\n")
+        self.chunks.put_nowait(None)
+
+    async def __aiter__(self):
+        """Dunder method to return the emitted chunks."""
+        while (chunk := await self.chunks.get()) is not None:
+            yield chunk
+
+
+def process_event(data):
+    """Simulate the plugins processing an event."""
+    if data != "[DONE]":
+        json.loads(data)
+        busy_until = time.perf_counter() + args.plugin_work_us / 1_000_000
+        while time.perf_counter() < busy_until:
+            pass
+
+
+async def relay_line_based(aoai_response):
+    """Relay the stream the way the former implementation did."""
+    async for line in aoai_response.aiter_lines():
+        yield f"{line}\r\n"
+        if line.startswith("data: "):
+            process_event(line[6:])
+
+
+async def relay_raw(aoai_response):
+    """Relay the stream as raw bytes, processing events off the forwarding path."""
+    async for chunk in relay_event_stream(aoai_response.aiter_raw(), process_event):
+        yield chunk
+
+
+async def measure(relay):
+    """Return the latencies added per chunk in microseconds for a single stream."""
+    upstream = MockUpstream()
+    async with httpx.AsyncClient(
+        transport=httpx.MockTransport(
+            lambda request: httpx.Response(200, headers={"content-type": "text/event-stream"}, stream=upstream)
+        )
+    ) as client:
+        async with client.stream("POST", "https://mock/chat/completions") as aoai_response:
+            received_bytes = 0
+            latencies_us = []
+            async for piece in relay(aoai_response):
+                # like the server does, encode str pieces before sending
+                received_bytes += len(piece.encode() if isinstance(piece, str) else piece)
+                now = time.perf_counter()
+                while (
+                    len(latencies_us) < len(upstream.emitted)
+                    and upstream.emitted[len(latencies_us)][0] <= received_bytes
+                ):
+                    latencies_us.append((now - upstream.emitted[len(latencies_us)][1]) * 1_000_000)
+            return latencies_us
+
+
+def percentile(sorted_values, percent):
+    """Return the given percentile of the given sorted values."""
+    return sorted_values[min(int(len(sorted_values) * percent / 100), len(sorted_values) - 1)]
+
+
+print(
+    f"{args.tokens} tokens per stream at {args.tokens_per_second or 'unlimited'} tokens/s, "
+    f"{args.plugin_work_us:g} µs plugin work per event"
+)
+for relay_name, relay in [("line-based (former)", relay_line_based), ("raw passthrough", relay_raw)]:
+    latencies_us = []
+    start_time = time.perf_counter()
+    for _ in range(args.runs):
+        latencies_us += asyncio.run(measure(relay))
+    duration_s = time.perf_counter() - start_time
+    latencies_us.sort()
+    print(
+        f"{relay_name:<20} added latency per chunk: mean {sum(latencies_us) / len(latencies_us):8.1f} µs"
+        f" | p50 {percentile(latencies_us, 50):8.1f} µs | p99 {percentile(latencies_us, 99):8.1f} µs"
+        f" | {len(latencies_us) / duration_s:8.0f} chunks/s"
+    )
@@ -0,0 +1,225 @@
+"""
+Replay benchmark for the PTU utilization and 429s with and without counting tokens against the PTU's tokens per minute.
+
+Replays the requests of a usage log written by the LogUsageToCsvFile plugin (arrival times, prompt and completion
+tokens) or, if no log is given, a synthetic trace with a load oscillating around the PTU's limit and prompt sizes with
+a long tail. A mock PTU deployment limiting the tokens within the last minute and a mock pay-as-you-go deployment
+without limit are served via httpx's MockTransport. Requests are routed like PowerProxy does: PTU first, failing over
+to pay-as-you-go on a 429, with a circuit breaker per target. Compares:
+- no budget: the PTU is tried until it returns a 429
+- remaining capacity: the PTU is tried last when its rate limit headers suggest it would throttle the request
+- token budget: the PTU is skipped when the request does not fit into its configured tokens per minute
+- both: remaining capacity and token budget combined
+
+Time runs faster than real time (by --time-scale), so the minutes of the rate limit pass within seconds.
+
+Example: python benchmark_token_budget.py --ptu-tpm 300000 --log-file ../../logs/20240101-120000.logs.csv
+"""
+
+import argparse
+import asyncio
+import collections
+import csv
+import datetime
+import json
+import math
+import os
+import random
+import sys
+import time
+
+import httpx
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "app"))
+
+from helpers.rate_limits import (  # pylint: disable=wrong-import-position
+    RemainingCapacity,
+    TokenBudget,
+    deprioritize_targets_expected_to_throttle,
+)
+from helpers.routing import AoaiTarget  # pylint: disable=wrong-import-position
+from helpers.tokens import estimate_request_cost_in_tokens  # pylint: disable=wrong-import-position
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--ptu-tpm", type=int, default=300_000, help="Tokens per minute the PTU deployment accepts")
+parser.add_argument("--log-file", help="Usage log (CSV) of the LogUsageToCsvFile plugin to replay")
+parser.add_argument("--load", type=float, default=1.1, help="Mean load of the synthetic trace relative to the PTU")
+parser.add_argument("--minutes", type=float, default=10, help="Minutes of the synthetic trace")
+parser.add_argument("--time-scale", type=float, default=60, help="Simulated time per real time")
+parser.add_argument("--response-ms", type=float, default=20, help="Real time a deployment takes to respond")
+parser.add_argument("--throttle-ms", type=float, default=5, help="Real time a deployment takes to return a 429")
+args = parser.parse_args()
+
+
+class Clock:
+    """Simulated clock, running faster than real time."""
+
+    def __init__(self):
+        """Constructor."""
+        self.start_time = time.perf_counter()
+
+    def now_ms(self):
+        """Return the simulated time in milliseconds since the start."""
+        return (time.perf_counter() - self.start_time) * 1_000 * args.time_scale
+
+
+def read_trace_from_log_file(log_file_path):
+    """Return the arrival times (ms since the first request), prompt and completion tokens from the given usage log."""
+    trace = []
+    with open(log_file_path, encoding="utf-8") as log_file:
+        for row in csv.DictReader(log_file):
+            if not row["prompt_tokens"] or row["prompt_tokens"] == "None":
+                continue
+            received_timestamp_ms = datetime.datetime.fromisoformat(row["request_received_utc"]).timestamp() * 1_000
+            trace.append((received_timestamp_ms, int(row["prompt_tokens"]), int(row["completion_tokens"] or 0)))
+    trace.sort()
+    return [(timestamp_ms - trace[0][0], *tokens) for timestamp_ms, *tokens in trace]
+
+
+def create_synthetic_trace():
+    """Return arrival times (ms), prompt and completion tokens of requests with a load oscillating around the PTU's."""
+    random.seed(42)
+    # note: prompts are log-normally distributed (median 1,500 tokens, long tail), completions up to 500 tokens
+    mean_cost_in_tokens = 1_500 * math.exp(1.0**2 / 2) + 500
+    trace = []
+    arrival_ms = 0.0
+    while arrival_ms < args.minutes * 60_000:
+        # the load oscillates between 50% and 150% of the mean load, with a period of 4 minutes
+        load = args.load * (1 + 0.5 * math.sin(2 * math.pi * arrival_ms / 240_000))
+        arrival_ms += random.expovariate(load * args.ptu_tpm / mean_cost_in_tokens / 60_000)
+        prompt_tokens = min(int(random.lognormvariate(math.log(1_500), 1.0)), 32_000)
+        trace.append((arrival_ms, prompt_tokens, 500))
+    return trace
+
+
+def create_ptu_handler(clock):
+    """Return a mock PTU deployment, limiting the tokens admitted within the last minute."""
+    admitted = collections.deque()
+    admitted_tokens = {"sum": 0}
+
+    async def handle(request):
+        now_ms = clock.now_ms()
+        while admitted and admitted[0][0] <= now_ms - 60_000:
+            admitted_tokens["sum"] -= admitted.popleft()[1]
+        cost_in_tokens = estimate_request_cost_in_tokens(json.loads(request.content))
+        if admitted_tokens["sum"] + cost_in_tokens > args.ptu_tpm:
+            # tell when enough tokens have left the window
+            tokens_to_free = admitted_tokens["sum"] + cost_in_tokens - args.ptu_tpm
+            for admitted_at_ms, tokens in admitted:
+                tokens_to_free -= tokens
+                if tokens_to_free <= 0:
+                    break
+            await asyncio.sleep(args.throttle_ms / 1_000)
+            return httpx.Response(
+                429,
+                headers={
+                    "x-ratelimit-remaining-tokens": f"{args.ptu_tpm - admitted_tokens['sum']}",
+                    "retry-after-ms": f"{max(math.ceil(admitted_at_ms + 60_000 - now_ms), 1)}",
+                },
+            )
+        admitted.append((now_ms, cost_in_tokens))
+        admitted_tokens["sum"] += cost_in_tokens
+        remaining_tokens = args.ptu_tpm - admitted_tokens["sum"]
+        await asyncio.sleep(args.response_ms / 1_000)
+        return httpx.Response(200, headers={"x-ratelimit-remaining-tokens": f"{remaining_tokens}"}, json={})
+
+    return handle
+
+
+async def handle_paygo(request):
+    """Mock pay-as-you-go deployment, without limit."""
+    await asyncio.sleep(args.response_ms / 1_000)
+    return httpx.Response(200, json={})
+
+
+def create_target(name, handler):
+    """Return a target backed by the given mock deployment."""
+    return AoaiTarget(
+        name=name,
+        target_type="endpoint",
+        endpoint=name,
+        url=f"https://{name}/",
+        endpoint_client=httpx.AsyncClient(base_url=f"https://{name}/", transport=httpx.MockTransport(handler)),
+    )
+
+
+async def run(trace, estimates_remaining_capacity, has_token_budget):
+    """Replay the given trace and return the statistics."""
+    clock = Clock()
+    ptu = create_target("ptu", create_ptu_handler(clock))
+    paygo = create_target("paygo", handle_paygo)
+    if estimates_remaining_capacity:
+        ptu.remaining_capacity = RemainingCapacity({})
+    if has_token_budget:
+        ptu.token_budget = TokenBudget(args.ptu_tpm)
+    stats = {"requests": 0, "upstream_calls": 0, "429s": 0, "failovers": 0, "ptu_tokens": 0, "paygo_tokens": 0}
+
+    async def send(request_body):
+        cost_in_tokens = estimate_request_cost_in_tokens(request_body)
+        has_failed_over = False
+        for aoai_target in deprioritize_targets_expected_to_throttle((ptu, paygo), cost_in_tokens, clock.now_ms()):
+            if aoai_target.token_budget is not None and not aoai_target.token_budget.can_absorb(
+                cost_in_tokens, clock.now_ms()
+            ):
+                continue
+            if not aoai_target.circuit_breaker.try_acquire(clock.now_ms()):
+                continue
+            mark = None
+            if aoai_target.remaining_capacity is not None:
+                mark = aoai_target.remaining_capacity.record_request(cost_in_tokens)
+            if aoai_target.token_budget is not None:
+                aoai_target.token_budget.consume(cost_in_tokens, clock.now_ms())
+            stats["upstream_calls"] += 1
+            response = await aoai_target.endpoint_client.post(
+                "openai/deployments/gpt-4o/completions", json=request_body
+            )
+            if aoai_target.remaining_capacity is not None:
+                aoai_target.remaining_capacity.record_headers(response.headers, clock.now_ms(), mark)
+            if response.status_code == 429:
+                aoai_target.circuit_breaker.record_failure(clock.now_ms(), int(response.headers["retry-after-ms"]))
+                if aoai_target.token_budget is not None:
+                    aoai_target.token_budget.consume(-cost_in_tokens, clock.now_ms())
+                stats["429s"] += 1
+                has_failed_over = True
+                continue
+            aoai_target.circuit_breaker.record_success(clock.now_ms())
+            stats[f"{aoai_target.name}_tokens"] += cost_in_tokens
+            break
+        stats["requests"] += 1
+        stats["failovers"] += has_failed_over
+
+    tasks = []
+    for arrival_ms, prompt_tokens, completion_tokens in trace:
+        if (delay_ms := arrival_ms - clock.now_ms()) > 0:
+            await asyncio.sleep(delay_ms / args.time_scale / 1_000)
+        tasks.append(
+            asyncio.create_task(send({"prompt": "x" * (prompt_tokens * 4), "max_tokens": max(completion_tokens, 1)}))
+        )
+    await asyncio.gather(*tasks)
+    for aoai_target in [ptu, paygo]:
+        await aoai_target.endpoint_client.aclose()
+    stats["minutes"] = clock.now_ms() / 60_000
+    return stats
+
+
+trace = read_trace_from_log_file(args.log_file) if args.log_file else create_synthetic_trace()
+trace_minutes = trace[-1][0] / 60_000
+trace_tokens = sum(prompt_tokens + completion_tokens for _, prompt_tokens, completion_tokens in trace)
+print(
+    f"{len(trace)} requests over {trace_minutes:.1f} minutes "
+    f"({'replayed from ' + args.log_file if args.log_file else 'synthetic'}), "
+    f"{trace_tokens / trace_minutes:.0f} tokens per minute on average, PTU limit {args.ptu_tpm} tokens per minute"
+)
+print(f"{'mode':<20} {'429s':>6} {'429 rate':>9} {'failovers':>10} {'PTU used':>9} {'PTU share':>10}")
+for mode, estimates_remaining_capacity, has_token_budget in [
+    ("no budget", False, False),
+    ("remaining capacity", True, False),
+    ("token budget", False, True),
+    ("both", True, True),
+]:
+    stats = asyncio.run(run(trace, estimates_remaining_capacity, has_token_budget))
+    print(
+        f"{mode:<20} {stats['429s']:>6} {stats['429s'] / stats['upstream_calls']:>9.1%} {stats['failovers']:>10} "
+        f"{stats['ptu_tokens'] / (args.ptu_tpm * stats['minutes']):>9.1%} "
+        f"{stats['ptu_tokens'] / (stats['ptu_tokens'] + stats['paygo_tokens']):>10.1%}"
+    )
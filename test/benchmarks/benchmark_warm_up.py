@@ -0,0 +1,210 @@
+"""
+Benchmark for the latency of the first requests after a (re)start and after idle gaps, with and without warm-up.
+
+Starts a local TLS stand-in for Azure OpenAI in a separate process, which delays every TLS handshake by the given time
+to simulate the round trips of DNS, TCP and TLS to a remote endpoint. Sends bursts of concurrent requests with
+PowerProxy's default connection limits and compares:
+- cold: the burst right after startup, without warm-up
+- warmed up: the burst right after startup, after the ConnectionWarmer warmed up the connections
+- idle gap: a burst after an idle gap longer than the keepalive expiry, without and with keeping connections warm (the
+  burst is sent between two pings, bursts overlapping with pings open a few more connections)
+
+Example: python benchmark_warm_up.py --burst 20 --runs 10 --handshake-delay-ms 60
+"""
+
+import argparse
+import asyncio
+import datetime
+import ipaddress
+import multiprocessing
+import os
+import socket
+import ssl
+import sys
+import tempfile
+import time
+
+import httpx
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "app"))
+
+from helpers.connections import ConnectionWarmer  # pylint: disable=wrong-import-position
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--burst", type=int, default=20, help="Number of concurrent requests per burst")
+parser.add_argument("--runs", type=int, default=10, help="Number of bursts per scenario")
+parser.add_argument("--handshake-delay-ms", type=float, default=60, help="Simulated delay of opening a connection")
+parser.add_argument("--response-ms", type=float, default=20, help="Time the stand-in takes to respond")
+parser.add_argument("--keepalive-expiry", type=float, default=1, help="Keepalive expiry of connections in seconds")
+args = parser.parse_args()
+
+RESPONSE_BODY = b'{"choices": [{"index": 0, "message": {"role": "assistant", "content": "Hello!"}}]}'
+
+
+def create_certificate(directory):
+    """Create a self-signed certificate for localhost in the given directory, and return the paths to it and its key."""
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "localhost")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(days=1))
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .add_extension(
+            x509.SubjectAlternativeName([x509.DNSName("localhost"), x509.IPAddress(ipaddress.ip_address("127.0.0.1"))]),
+            critical=False,
+        )
+        .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+        .sign(key, hashes.SHA256())
+    )
+    certificate_path = os.path.join(directory, "certificate.pem")
+    key_path = os.path.join(directory, "key.pem")
+    with open(certificate_path, "wb") as file:
+        file.write(certificate.public_bytes(serialization.Encoding.PEM))
+    with open(key_path, "wb") as file:
+        file.write(
+            key.private_bytes(
+                serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+            )
+        )
+    return certificate_path, key_path
+
+
+def run_stand_in(port, certificate_path, key_path, accepted_connections):
+    """Run the stand-in for Azure OpenAI, counting the accepted connections in the given shared value."""
+    ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    ssl_context.load_cert_chain(certificate_path, key_path)
+
+    async def handle_connection(reader, writer):
+        with accepted_connections.get_lock():
+            accepted_connections.value += 1
+        try:
+            # note: delaying the handshake delays opening the connection on the client side. reading is paused, so the
+            #       client's hello is left to the TLS upgrade, which resumes reading.
+            writer.transport.pause_reading()
+            await asyncio.sleep(args.handshake_delay_ms / 1_000)
+            await writer.start_tls(ssl_context)
+            while True:
+                request_head = await reader.readuntil(b"\r\n\r\n")
+                content_length = next(
+                    (
+                        int(line.split(b":", 1)[1])
+                        for line in request_head.split(b"\r\n")
+                        if line.lower().startswith(b"content-length:")
+                    ),
+                    0,
+                )
+                await reader.readexactly(content_length)
+                if request_head.startswith(b"HEAD "):
+                    writer.write(b"HTTP/1.1 404 Not Found\r\ncontent-length: 0\r\n\r\n")
+                else:
+                    await asyncio.sleep(args.response_ms / 1_000)
+                    writer.write(
+                        b"HTTP/1.1 200 OK\r\ncontent-type: application/json\r\n"
+                        + f"content-length: {len(RESPONSE_BODY)}\r\n\r\n".encode()
+                        + RESPONSE_BODY
+                    )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, ssl.SSLError):
+            pass
+        writer.close()
+
+    async def serve():
+        server = await asyncio.start_server(handle_connection, "127.0.0.1", port, backlog=1_024)
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(serve())
+
+
+async def send_burst(client):
+    """Send a burst of concurrent requests with the given client and return their latencies."""
+
+    async def send_request():
+        start_time = time.perf_counter()
+        response = await client.post("/openai/deployments/gpt-4o/chat/completions", json={"messages": []})
+        response.raise_for_status()
+        return (time.perf_counter() - start_time) * 1_000
+
+    return await asyncio.gather(*[send_request() for _ in range(args.burst)])
+
+
+async def measure(create_client, scenario):
+    """Run the given scenario with a new client per run and return the latencies and the connections opened."""
+    latencies_ms = []
+    connections_opened = 0
+    for _ in range(args.runs):
+        async with create_client() as client:
+            connection_warmer = ConnectionWarmer(
+                client,
+                connections=args.burst,
+                min_warm_connections=args.burst,
+                keepalive_interval=args.keepalive_expiry / 2,
+            )
+            # note: the idle gap ends between two pings, as bursts overlapping with pings find connections busy
+            idle_gap = args.keepalive_expiry * 1.5 + connection_warmer.keepalive_interval / 4
+            if scenario == "warmed up":
+                await connection_warmer.warm_up()
+            elif scenario == "idle gap":
+                await connection_warmer.warm_up()
+                await asyncio.sleep(idle_gap)
+            elif scenario == "idle gap, kept warm":
+                connection_warmer.start()
+                while not connection_warmer.is_warm:
+                    await asyncio.sleep(0.001)
+                await asyncio.sleep(idle_gap)
+            accepted_connections_before_burst = accepted_connections.value
+            latencies_ms.extend(await send_burst(client))
+            connections_opened += accepted_connections.value - accepted_connections_before_burst
+            await connection_warmer.close()
+    return sorted(latencies_ms), connections_opened
+
+
+def percentile(sorted_values, percent):
+    """Return the given percentile of the given sorted values."""
+    return sorted_values[min(int(len(sorted_values) * percent / 100), len(sorted_values) - 1)]
+
+
+if __name__ == "__main__":
+    with socket.socket() as free_socket:
+        free_socket.bind(("127.0.0.1", 0))
+        stand_in_port = free_socket.getsockname()[1]
+    with tempfile.TemporaryDirectory() as certificate_directory:
+        certificate_path, key_path = create_certificate(certificate_directory)
+        accepted_connections = multiprocessing.Value("i", 0)
+        stand_in = multiprocessing.Process(
+            target=run_stand_in, args=(stand_in_port, certificate_path, key_path, accepted_connections), daemon=True
+        )
+        stand_in.start()
+        time.sleep(1)
+
+        def create_client():
+            """Return a new client with PowerProxy's default connection limits."""
+            return httpx.AsyncClient(
+                base_url=f"https://127.0.0.1:{stand_in_port}",
+                verify=ssl.create_default_context(cafile=certificate_path),
+                limits=httpx.Limits(
+                    max_connections=100, max_keepalive_connections=20, keepalive_expiry=args.keepalive_expiry
+                ),
+            )
+
+        print(
+            f"{args.runs} bursts of {args.burst} concurrent requests, {args.handshake_delay_ms:g} ms handshake delay, "
+            f"{args.response_ms:g} ms response time, {args.keepalive_expiry:g} s keepalive expiry"
+        )
+        for scenario in ["cold", "warmed up", "idle gap", "idle gap, kept warm"]:
+            latencies_ms, connections_opened = asyncio.run(measure(create_client, scenario))
+            print(
+                f"{scenario:<20} p50 {percentile(latencies_ms, 50):6.1f} ms"
+                f" | p99 {percentile(latencies_ms, 99):6.1f} ms"
+                f" | {connections_opened / args.runs:5.1f} connections opened per burst"
+            )
+        stand_in.terminate()
@@ -0,0 +1,100 @@
+"""
+Tests the circuit breaker protecting targets.
+
+Runs without PowerProxy or Azure OpenAI. Run directly or via pytest.
+"""
+
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "app"))
+
+from helpers.circuit_breaker import CircuitBreaker  # pylint: disable=wrong-import-position
+
+CONFIGURATION = {"failure_rate_threshold": 0.5, "minimum_requests": 4, "window_ms": 10_000, "open_ms": 1_000}
+
+
+def test_opens_when_failure_rate_is_reached():
+    """The breaker stays closed below the failure rate threshold and opens when it is reached."""
+    circuit_breaker = CircuitBreaker(CONFIGURATION)
+    circuit_breaker.record_success(0)
+    circuit_breaker.record_success(1)
+    circuit_breaker.record_failure(2)
+    assert circuit_breaker.state == CircuitBreaker.CLOSED
+    circuit_breaker.record_failure(3)
+    assert circuit_breaker.state == CircuitBreaker.OPEN
+    assert not circuit_breaker.allows_request(4)
+    assert not circuit_breaker.try_acquire(4)
+    assert circuit_breaker.get_unblocked_timestamp_ms(4) == 1_003
+
+
+def test_outcomes_outside_window_are_ignored():
+    """Failures older than the window do not count towards the failure rate."""
+    circuit_breaker = CircuitBreaker(CONFIGURATION)
+    for now_ms in range(3):
+        circuit_breaker.record_failure(now_ms)
+    for now_ms in range(20_000, 20_004):
+        circuit_breaker.record_success(now_ms)
+    circuit_breaker.record_failure(20_005)
+    assert circuit_breaker.state == CircuitBreaker.CLOSED
+
+
+def test_retry_after_blocks_exactly_that_long():
+    """A failure with a retry-after time opens the breaker for exactly that time, regardless of the failure rate."""
+    circuit_breaker = CircuitBreaker(CONFIGURATION)
+    circuit_breaker.record_failure(0, retry_after_ms=300)
+    assert circuit_breaker.state == CircuitBreaker.OPEN
+    assert not circuit_breaker.allows_request(299)
+    assert circuit_breaker.allows_request(300)
+
+
+def test_half_open_lets_a_single_probe_pass():
+    """After the open period, only one probe is let through until its outcome is known."""
+    circuit_breaker = CircuitBreaker(CONFIGURATION)
+    circuit_breaker.record_failure(0, retry_after_ms=100)
+    assert circuit_breaker.try_acquire(100)
+    assert circuit_breaker.state == CircuitBreaker.HALF_OPEN
+    assert not circuit_breaker.allows_request(101)
+    assert not circuit_breaker.try_acquire(101)
+    circuit_breaker.record_success(150)
+    assert circuit_breaker.state == CircuitBreaker.CLOSED
+    assert circuit_breaker.try_acquire(151)
+
+
+def test_released_probe_can_be_acquired_again():
+    """A probe cancelled without outcome frees the half-open breaker for the next probe."""
+    circuit_breaker = CircuitBreaker(CONFIGURATION)
+    circuit_breaker.record_failure(0, retry_after_ms=100)
+    assert circuit_breaker.try_acquire(100)
+    circuit_breaker.release()
+    assert circuit_breaker.try_acquire(101)
+
+
+def test_failed_probes_back_off_exponentially():
+    """Each failed probe doubles the open period, up to the maximum."""
+    circuit_breaker = CircuitBreaker(CONFIGURATION | {"max_open_ms": 5_000})
+    for now_ms in range(4):
+        circuit_breaker.record_failure(now_ms)
+    now_ms = 3
+    expected_open_periods_ms = [1_000, 2_000, 4_000, 5_000, 5_000]
+    assert circuit_breaker.open_until_ms == now_ms + expected_open_periods_ms[0]
+    for expected_open_period_ms in expected_open_periods_ms[1:]:
+        now_ms = circuit_breaker.open_until_ms
+        assert circuit_breaker.try_acquire(now_ms)
+        circuit_breaker.record_failure(now_ms)
+        assert circuit_breaker.state == CircuitBreaker.OPEN
+        assert circuit_breaker.open_until_ms == now_ms + expected_open_period_ms
+
+    # a successful probe closes the breaker and resets the backoff
+    now_ms = circuit_breaker.open_until_ms
+    assert circuit_breaker.try_acquire(now_ms)
+    circuit_breaker.record_success(now_ms)
+    assert circuit_breaker.state == CircuitBreaker.CLOSED
+    assert circuit_breaker.consecutive_openings == 0
+
+
+if __name__ == "__main__":
+    for test_name, test_function in list(globals().items()):
+        if test_name.startswith("test_") and callable(test_function):
+            test_function()
+            print(f"✅ {test_name}")
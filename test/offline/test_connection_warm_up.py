@@ -0,0 +1,152 @@
+"""
+Tests opening connections ahead of requests and keeping them warm with the ConnectionWarmer.
+
+Runs against a local HTTP server, without PowerProxy or Azure OpenAI. Run directly or via pytest.
+"""
+
+import asyncio
+import os
+import sys
+
+import httpx
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "app"))
+
+from helpers import connections  # pylint: disable=wrong-import-position
+from helpers.connections import (  # pylint: disable=wrong-import-position
+    ConnectionWarmer,
+    Http2ConnectionPool,
+    count_open_connections,
+)
+
+
+async def start_server(accepted_connections):
+    """Start a local HTTP/1.1 server answering all requests with a 404, counting the accepted connections."""
+
+    async def handle_connection(reader, writer):
+        accepted_connections.append(writer)
+        try:
+            while await reader.readuntil(b"\r\n\r\n"):
+                writer.write(b"HTTP/1.1 404 Not Found\r\ncontent-length: 0\r\n\r\n")
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        writer.close()
+
+    return await asyncio.start_server(handle_connection, "127.0.0.1", 0)
+
+
+def test_warm_up_opens_connections():
+    """Warming up opens the given number of connections, which are then used by requests."""
+
+    async def test():
+        accepted_connections = []
+        server = await start_server(accepted_connections)
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{server.sockets[0].getsockname()[1]}") as client:
+            connection_warmer = ConnectionWarmer(client, connections=3, min_warm_connections=3, keepalive_interval=1)
+            assert not connection_warmer.is_warm
+            await connection_warmer.warm_up()
+            assert connection_warmer.is_warm
+            assert len(accepted_connections) == 3 and count_open_connections(client._transport) == 3
+            for _ in range(3):
+                await client.post("/")
+            assert len(accepted_connections) == 3
+        server.close()
+
+    asyncio.run(test())
+
+
+def test_connections_are_kept_warm_beyond_keepalive_expiry():
+    """Idle connections are kept open, but only as many as min_warm_connections."""
+
+    async def test():
+        accepted_connections = []
+        server = await start_server(accepted_connections)
+        async with httpx.AsyncClient(
+            base_url=f"http://127.0.0.1:{server.sockets[0].getsockname()[1]}",
+            limits=httpx.Limits(keepalive_expiry=0.2),
+        ) as client:
+            connection_warmer = ConnectionWarmer(client, connections=3, min_warm_connections=2, keepalive_interval=0.05)
+            connection_warmer.start()
+            await asyncio.sleep(0.6)
+            await connection_warmer.close()
+            assert connection_warmer.is_warm and connection_warmer.task.cancelled()
+            assert len(accepted_connections) == 3
+            for _ in range(2):
+                await client.post("/")
+            assert len(accepted_connections) == 3 and count_open_connections(client._transport) == 2
+        server.close()
+
+    asyncio.run(test())
+
+
+def test_failed_warm_up_does_not_block_readiness():
+    """An endpoint which cannot be reached counts as warm, so it does not keep the proxy from becoming ready."""
+
+    async def test():
+        server = await start_server([])
+        port = server.sockets[0].getsockname()[1]
+        server.close()
+        await server.wait_closed()
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}") as client:
+            connection_warmer = ConnectionWarmer(client, connections=2, min_warm_connections=2, keepalive_interval=1)
+            await connection_warmer.warm_up()
+            stats = connection_warmer.get_stats()
+            assert stats["is_warm"] and stats["failed_pings"] == 1 and stats["last_error"].startswith("ConnectError")
+
+    asyncio.run(test())
+
+
+def test_connections_are_kept_warm_with_other_transports():
+    """With a transport whose connections cannot be counted, keeping warm pings min_warm_connections times."""
+    pings = []
+
+    def handler(request):
+        pings.append(request.method)
+        return httpx.Response(404)
+
+    async def test():
+        async with httpx.AsyncClient(base_url="https://mock", transport=httpx.MockTransport(handler)) as client:
+            connection_warmer = ConnectionWarmer(client, connections=3, min_warm_connections=2, keepalive_interval=1)
+            await connection_warmer.keep_warm()
+            assert pings == ["HEAD", "HEAD"] and connection_warmer.get_stats()["pings"] == 2
+
+    asyncio.run(test())
+
+
+def test_warm_up_opens_http2_connections():
+    """With HTTP/2, warming up opens up to max_connections connections and pings each once."""
+    pinged_connections = []
+    original_constructor = connections.MultiplexedConnection.__init__
+
+    def constructor(self, pool):
+        original_constructor(self, pool)
+
+        def handler(request):
+            pinged_connections.append(self)
+            return httpx.Response(404)
+
+        self.transport = httpx.MockTransport(handler)
+
+    async def test():
+        pool = Http2ConnectionPool(max_connections=2)
+        async with httpx.AsyncClient(base_url="https://mock", transport=pool) as client:
+            connection_warmer = ConnectionWarmer(client, connections=3, min_warm_connections=1, keepalive_interval=1)
+            await connection_warmer.warm_up()
+            assert len(pool.connections) == 2 and pinged_connections == pool.connections
+            await connection_warmer.keep_warm()
+            assert pinged_connections == [*pool.connections, pool.connections[0]]
+            assert pool.get_active_streams() == 0 and connection_warmer.get_stats()["pings"] == 3
+
+    connections.MultiplexedConnection.__init__ = constructor
+    try:
+        asyncio.run(test())
+    finally:
+        connections.MultiplexedConnection.__init__ = original_constructor
+
+
+if __name__ == "__main__":
+    for test_name, test_function in list(globals().items()):
+        if test_name.startswith("test_") and callable(test_function):
+            test_function()
+            print(f"✅ {test_name}")
@@ -0,0 +1,146 @@
+"""
+Tests batching concurrent embeddings requests with a single input.
+
+Runs without PowerProxy or Azure OpenAI. Run directly or via pytest.
+"""
+
+import asyncio
+import json
+import os
+import sys
+
+import httpx
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "app"))
+
+from helpers.batching import EmbeddingsBatcher  # pylint: disable=wrong-import-position
+from helpers.embeddings import get_inputs, split_tokens  # pylint: disable=wrong-import-position
+
+PATH = "openai/deployments/ada/embeddings"
+
+
+class MockTarget:
+    """A target returning made-up embeddings, recording the inputs of the requests it received."""
+
+    def __init__(self, status_code=200, delay_seconds=0.01):
+        """Constructor."""
+        self.status_code = status_code
+        self.delay_seconds = delay_seconds
+        self.requested_inputs = []
+
+    async def get_response(self, request_body_dict):
+        """Return the target and its response to a request with the given body."""
+        inputs = get_inputs(request_body_dict)
+        self.requested_inputs.append(inputs)
+        await asyncio.sleep(self.delay_seconds)
+        if self.status_code != 200:
+            return self, httpx.Response(self.status_code, json={"error": "failed"})
+        if "invalid" in inputs:
+            return self, httpx.Response(400, json={"error": "invalid input"})
+        prompt_tokens = sum(len(single_input) for single_input in inputs)
+        return self, httpx.Response(
+            200,
+            json={
+                "object": "list",
+                # note: the embeddings are returned in reverse order, to check they are assigned by their index
+                "data": [
+                    {"object": "embedding", "index": index, "embedding": [float(len(single_input))]}
+                    for index, single_input in reversed(list(enumerate(inputs)))
+                ],
+                "model": "text-embedding-3-small",
+                "usage": {"prompt_tokens": prompt_tokens, "total_tokens": prompt_tokens},
+            },
+        )
+
+
+async def request_embeddings(embeddings_batcher, mock_target, request_body_dicts):
+    """Send the given requests concurrently and return the status codes and bodies of their responses."""
+    results = await asyncio.gather(
+        *[
+            embeddings_batcher.get_response(
+                EmbeddingsBatcher.get_key("Team 1", "ada", PATH, "2024-10-21", request_body_dict),
+                request_body_dict,
+                mock_target.get_response,
+            )
+            for request_body_dict in request_body_dicts
+        ]
+    )
+    return [(aoai_response.status_code, json.loads(await aoai_response.aread())) for _, aoai_response in results]
+
+
+def test_concurrent_requests_are_sent_as_one_batch():
+    """Concurrent single-input requests are sent as one request, and each gets its embedding and share of the usage."""
+
+    async def run():
+        embeddings_batcher = EmbeddingsBatcher({"max_wait_ms": 20})
+        mock_target = MockTarget()
+        inputs = ["aaaa", "bbbbbbbb", "cccccccccccc"]
+        responses = await request_embeddings(embeddings_batcher, mock_target, [{"input": x} for x in inputs])
+        assert mock_target.requested_inputs == [inputs]
+        for single_input, (status_code, body_dict) in zip(inputs, responses):
+            assert status_code == 200
+            assert body_dict["data"] == [{"object": "embedding", "index": 0, "embedding": [float(len(single_input))]}]
+        assert [body_dict["usage"]["prompt_tokens"] for _, body_dict in responses] == [4, 8, 12]
+        assert embeddings_batcher.get_stats() == {
+            "batches": 1,
+            "batched_requests": 3,
+            "unbatched_requests": 0,
+            "open_batches": 0,
+        }
+
+    asyncio.run(run())
+
+
+def test_batches_are_sent_when_full_and_only_contain_matching_requests():
+    """Batches are sent once they have max_batch_size requests, and requests with other settings are batched apart."""
+
+    async def run():
+        embeddings_batcher = EmbeddingsBatcher({"max_wait_ms": 1_000, "max_batch_size": 2})
+        mock_target = MockTarget()
+        await asyncio.wait_for(
+            request_embeddings(
+                embeddings_batcher,
+                mock_target,
+                [{"input": "a"}, {"input": "b", "dimensions": 2}, {"input": ["c"]}, {"input": "d", "dimensions": 2}],
+            ),
+            timeout=0.5,
+        )
+        assert sorted(mock_target.requested_inputs) == [["a", "c"], ["b", "d"]]
+
+    asyncio.run(run())
+
+
+def test_requests_are_sent_one_by_one_if_the_batch_is_rejected():
+    """If a batch is rejected as invalid, its requests are sent one by one, so only the invalid request fails."""
+
+    async def run():
+        embeddings_batcher = EmbeddingsBatcher({})
+        mock_target = MockTarget()
+        responses = await request_embeddings(
+            embeddings_batcher, mock_target, [{"input": "a"}, {"input": "invalid"}, {"input": "b"}]
+        )
+        assert len(mock_target.requested_inputs) == 4
+        assert [status_code for status_code, _ in responses] == [200, 400, 200]
+        assert embeddings_batcher.metrics["unbatched_requests"] == 3
+
+        # other failures are passed on to all requests of the batch
+        mock_target = MockTarget(status_code=429)
+        responses = await request_embeddings(embeddings_batcher, mock_target, [{"input": "a"}, {"input": "b"}])
+        assert len(mock_target.requested_inputs) == 1
+        assert [status_code for status_code, _ in responses] == [429, 429]
+
+    asyncio.run(run())
+
+
+def test_usage_is_split_proportionally():
+    """Tokens are split proportionally to the weights, and the split tokens add up to the tokens split."""
+    assert split_tokens(100, [1, 1, 2]) == [25, 25, 50]
+    assert sum(split_tokens(10, [1, 1, 1])) == 10
+    assert split_tokens(5, [0, 0]) == [0, 0]
+
+
+if __name__ == "__main__":
+    for test_name, test_function in list(globals().items()):
+        if test_name.startswith("test_") and callable(test_function):
+            test_function()
+            print(f"✅ {test_name}")
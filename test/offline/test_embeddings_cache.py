@@ -0,0 +1,144 @@
+"""
+Tests caching the embeddings of the inputs of embeddings requests.
+
+Runs without PowerProxy or Azure OpenAI. Run directly or via pytest.
+"""
+
+import base64
+import os
+import sys
+from array import array
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "app"))
+
+from helpers.caching import (  # pylint: disable=wrong-import-position
+    ENTRY_OVERHEAD_BYTES,
+    CacheControl,
+    EmbeddingsCache,
+)
+from helpers.embeddings import get_inputs  # pylint: disable=wrong-import-position
+
+NO_CACHE_CONTROL = CacheControl(None)
+
+
+def get_embedding(single_input):
+    """Return a made-up embedding of the given input, exactly representable as float32."""
+    return [float(len(single_input)), 0.5, -0.25]
+
+
+def create_response_body_dict(inputs):
+    """Return the body of a response from a target to an embeddings request with the given inputs."""
+    return {
+        "object": "list",
+        "data": [
+            {"object": "embedding", "index": index, "embedding": get_embedding(single_input)}
+            for index, single_input in enumerate(inputs)
+        ],
+        "model": "text-embedding-3-small",
+        "usage": {"prompt_tokens": 2 * len(inputs), "total_tokens": 2 * len(inputs)},
+    }
+
+
+def request_embeddings(embeddings_cache, request_body_dict, cache_control=NO_CACHE_CONTROL, client="Team 1"):
+    """Return the response body to the given request, requesting the inputs missing in the cache from the target."""
+    embeddings_cache_lookup = embeddings_cache.look_up(client, "embeddings", request_body_dict, cache_control)
+    if embeddings_cache_lookup.is_complete:
+        return embeddings_cache_lookup.create_response_body_dict(), []
+    if embeddings_cache_lookup.has_cached_embeddings:
+        request_body_dict = embeddings_cache_lookup.get_request_body_dict_for_missing_inputs(request_body_dict)
+    requested_inputs = get_inputs(request_body_dict)
+    response_body_dict = create_response_body_dict(requested_inputs)
+    return (
+        embeddings_cache_lookup.complete_response_body_dict(response_body_dict) or response_body_dict,
+        requested_inputs,
+    )
+
+
+def test_inputs():
+    """Single inputs, lists of inputs and token arrays are recognized as inputs."""
+    assert get_inputs({"input": "a"}) == ["a"]
+    assert get_inputs({"input": ["a", "b"]}) == ["a", "b"]
+    assert get_inputs({"input": [1, 2, 3]}) == [[1, 2, 3]]
+    assert get_inputs({"input": [[1, 2], [3]]}) == [[1, 2], [3]]
+    assert get_inputs({"input": []}) is None
+    assert get_inputs({"input": {"a": 1}}) is None
+    assert get_inputs({"messages": []}) is None
+
+
+def test_only_missing_inputs_are_requested():
+    """Inputs embedded before are taken from the cache, and the response is merged in the order of the inputs."""
+    embeddings_cache = EmbeddingsCache({})
+    response_body_dict, requested_inputs = request_embeddings(embeddings_cache, {"input": ["a", "bb"]})
+    assert requested_inputs == ["a", "bb"]
+    assert response_body_dict["usage"]["prompt_tokens"] == 4
+
+    response_body_dict, requested_inputs = request_embeddings(embeddings_cache, {"input": ["ccc", "bb", "dddd", "a"]})
+    assert requested_inputs == ["ccc", "dddd"]
+    assert [embedding["index"] for embedding in response_body_dict["data"]] == [0, 1, 2, 3]
+    assert [embedding["embedding"] for embedding in response_body_dict["data"]] == [
+        get_embedding(single_input) for single_input in ["ccc", "bb", "dddd", "a"]
+    ]
+    assert response_body_dict["usage"] == {"prompt_tokens": 4, "total_tokens": 4}
+    assert response_body_dict["model"] == "text-embedding-3-small"
+
+    # requests whose inputs are all cached do not need the target, and cost no tokens
+    response_body_dict, requested_inputs = request_embeddings(embeddings_cache, {"input": "dddd"})
+    assert requested_inputs == []
+    assert response_body_dict["data"] == [{"object": "embedding", "index": 0, "embedding": get_embedding("dddd")}]
+    assert response_body_dict["usage"] == {"prompt_tokens": 0, "total_tokens": 0}
+    assert embeddings_cache.get_stats() | {"size_in_bytes": None} == {
+        "hits": 3,
+        "misses": 4,
+        "bypasses": 0,
+        "stores": 4,
+        "evictions": 0,
+        "entries": 4,
+        "size_in_bytes": None,
+    }
+
+
+def test_embeddings_are_cached_per_client_and_dimensions_and_in_any_encoding():
+    """Embeddings are cached per client and requested dimensions, and returned in the requested encoding format."""
+    embeddings_cache = EmbeddingsCache({})
+    request_embeddings(embeddings_cache, {"input": ["a"]})
+    _, requested_inputs = request_embeddings(embeddings_cache, {"input": ["a"], "dimensions": 2})
+    assert requested_inputs == ["a"]
+    _, requested_inputs = request_embeddings(embeddings_cache, {"input": ["a"]}, client="Team 2")
+    assert requested_inputs == ["a"]
+    response_body_dict, requested_inputs = request_embeddings(
+        embeddings_cache, {"input": ["a"], "encoding_format": "base64"}
+    )
+    assert requested_inputs == []
+    assert base64.b64decode(response_body_dict["data"][0]["embedding"]) == array("f", get_embedding("a")).tobytes()
+
+
+def test_least_recently_used_embeddings_are_evicted_beyond_max_bytes():
+    """Embeddings are stored as float32 and evicted in least recently used order once the cache exceeds max_bytes."""
+    embeddings_cache = EmbeddingsCache({"max_bytes": 2 * (ENTRY_OVERHEAD_BYTES + 3 * 4)})
+    request_embeddings(embeddings_cache, {"input": ["a", "b"]})
+    assert embeddings_cache.size_in_bytes == 2 * (ENTRY_OVERHEAD_BYTES + 3 * 4)
+    request_embeddings(embeddings_cache, {"input": ["a"]})
+    request_embeddings(embeddings_cache, {"input": ["c"]})
+    _, requested_inputs = request_embeddings(embeddings_cache, {"input": ["a", "b", "c"]})
+    assert requested_inputs == ["b"]
+    assert embeddings_cache.metrics["evictions"] == 2
+
+
+def test_cache_control():
+    """no-cache requests all inputs but stores their embeddings, no-store neither uses nor stores the cache."""
+    embeddings_cache = EmbeddingsCache({})
+    request_embeddings(embeddings_cache, {"input": ["a"]})
+    _, requested_inputs = request_embeddings(embeddings_cache, {"input": ["a", "b"]}, CacheControl("no-cache"))
+    assert requested_inputs == ["a", "b"]
+    _, requested_inputs = request_embeddings(embeddings_cache, {"input": ["c"]}, CacheControl("no-store"))
+    assert requested_inputs == ["c"]
+    _, requested_inputs = request_embeddings(embeddings_cache, {"input": ["a", "b", "c"]})
+    assert requested_inputs == ["c"]
+    assert embeddings_cache.metrics["bypasses"] == 2
+
+
+if __name__ == "__main__":
+    for test_name, test_function in list(globals().items()):
+        if test_name.startswith("test_") and callable(test_function):
+            test_function()
+            print(f"✅ {test_name}")
@@ -0,0 +1,154 @@
+"""
+Tests splitting embeddings requests with many inputs into chunks sent in parallel across targets.
+
+Runs without PowerProxy or Azure OpenAI. Run directly or via pytest.
+"""
+
+import asyncio
+import json
+import os
+import sys
+
+import httpx
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "app"))
+
+from helpers.balancing import LoadBalancer  # pylint: disable=wrong-import-position
+from helpers.batching import EmbeddingsFanOut  # pylint: disable=wrong-import-position
+from helpers.embeddings import get_inputs  # pylint: disable=wrong-import-position
+from helpers.routing import AoaiTarget  # pylint: disable=wrong-import-position
+
+
+class MockTargets:
+    """Targets returning made-up embeddings, recording which target received which inputs."""
+
+    def __init__(self, target_names, failures=None):
+        """Constructor."""
+        self.target_names = target_names
+        # status code or exception per target name, returned for the first request to the target
+        self.failures = dict(failures or {})
+        self.requests = []
+        self.max_concurrent_requests = 0
+        self.concurrent_requests = 0
+
+    async def get_response(self, request_body_dict, candidate_rotation):
+        """Return the first candidate after rotating the targets by the given number, and its response."""
+        target_name = self.target_names[candidate_rotation % len(self.target_names)]
+        inputs = get_inputs(request_body_dict)
+        self.requests.append((target_name, inputs))
+        self.concurrent_requests += 1
+        self.max_concurrent_requests = max(self.max_concurrent_requests, self.concurrent_requests)
+        try:
+            await asyncio.sleep(0.02)
+        finally:
+            self.concurrent_requests -= 1
+        failure = self.failures.pop(target_name, None)
+        if isinstance(failure, Exception):
+            raise failure
+        if failure is not None:
+            return target_name, httpx.Response(failure, json={"error": "failed"})
+        return target_name, httpx.Response(
+            200,
+            json={
+                "object": "list",
+                "data": [
+                    {"object": "embedding", "index": index, "embedding": [float(single_input)]}
+                    for index, single_input in enumerate(inputs)
+                ],
+                "model": "text-embedding-3-small",
+                "usage": {"prompt_tokens": len(inputs), "total_tokens": len(inputs)},
+            },
+        )
+
+
+async def request_embeddings(embeddings_fan_out, mock_targets, number_of_inputs):
+    """Send an embeddings request with the given number of inputs and return the response's status code and body."""
+    _, aoai_response = await embeddings_fan_out.get_response(
+        {"input": [str(number) for number in range(number_of_inputs)]}, mock_targets.get_response
+    )
+    return aoai_response.status_code, json.loads(await aoai_response.aread())
+
+
+def test_chunks_are_spread_across_targets_and_merged_in_order():
+    """Chunks are sent in parallel, starting at different targets, and their embeddings are merged in order."""
+
+    async def run():
+        embeddings_fan_out = EmbeddingsFanOut({"chunk_size": 3, "min_inputs": 4})
+        assert not embeddings_fan_out.applies_to({"input": ["a", "b", "c"]})
+        assert embeddings_fan_out.applies_to({"input": ["a", "b", "c", "d"]})
+        mock_targets = MockTargets(["t1", "t2", "t3"])
+        status_code, body_dict = await request_embeddings(embeddings_fan_out, mock_targets, 10)
+        assert status_code == 200
+        assert [embedding["index"] for embedding in body_dict["data"]] == list(range(10))
+        assert [embedding["embedding"] for embedding in body_dict["data"]] == [[float(n)] for n in range(10)]
+        assert body_dict["usage"] == {"prompt_tokens": 10, "total_tokens": 10}
+        assert [target_name for target_name, _ in mock_targets.requests] == ["t1", "t2", "t3", "t1"]
+        assert mock_targets.max_concurrent_requests == 4
+
+    asyncio.run(run())
+
+
+def test_only_failed_chunks_are_sent_again():
+    """Chunks failing with a 429 or a connection error are sent again starting at the next target, the others not."""
+
+    async def run():
+        embeddings_fan_out = EmbeddingsFanOut({"chunk_size": 2, "min_inputs": 2})
+        mock_targets = MockTargets(["t1", "t2", "t3"], {"t2": 429, "t3": httpx.ConnectError("reset")})
+        status_code, body_dict = await request_embeddings(embeddings_fan_out, mock_targets, 6)
+        assert status_code == 200
+        assert [embedding["embedding"] for embedding in body_dict["data"]] == [[float(n)] for n in range(6)]
+        assert mock_targets.requests[3:] == [("t3", ["2", "3"]), ("t1", ["4", "5"])]
+        assert embeddings_fan_out.metrics["retried_chunks"] == 2
+
+    asyncio.run(run())
+
+
+def test_requests_fail_if_a_chunk_fails():
+    """If a chunk is rejected, or keeps failing for max_attempts, the request fails without sending chunks again."""
+
+    async def run():
+        embeddings_fan_out = EmbeddingsFanOut({"chunk_size": 2, "min_inputs": 2, "max_attempts": 2})
+        mock_targets = MockTargets(["t1", "t2"], {"t2": 400})
+        status_code, _ = await request_embeddings(embeddings_fan_out, mock_targets, 4)
+        assert status_code == 400
+        assert len(mock_targets.requests) == 2
+
+        embeddings_fan_out = EmbeddingsFanOut({"chunk_size": 2, "min_inputs": 2, "max_attempts": 1})
+        mock_targets = MockTargets(["t1", "t2"], {"t1": httpx.ConnectError("reset")})
+        try:
+            await request_embeddings(embeddings_fan_out, mock_targets, 4)
+            assert False
+        except httpx.ConnectError:
+            pass
+        assert len(mock_targets.requests) == 2
+        assert embeddings_fan_out.metrics["failed_requests"] == 1
+
+    asyncio.run(run())
+
+
+def test_chunks_start_at_different_targets_of_the_highest_priority_only():
+    """Chunks are spread across the available targets of the highest priority, lower priorities stay behind them."""
+    ptu_1, ptu_2, ptu_3, paygo_1, paygo_2 = [
+        AoaiTarget(name, "endpoint", name, f"https://{name}/", None, priority=0 if name.startswith("ptu") else 1)
+        for name in ["ptu-1", "ptu-2", "ptu-3", "paygo-1", "paygo-2"]
+    ]
+    candidates = [ptu_1, ptu_2, ptu_3, paygo_1, paygo_2]
+    first_targets = [LoadBalancer.rotate_first_tier(candidates, rotation, lambda _: True)[0] for rotation in range(4)]
+    assert first_targets == [ptu_1, ptu_2, ptu_3, ptu_1]
+    assert LoadBalancer.rotate_first_tier(candidates, 1, lambda _: True) == [ptu_2, ptu_3, ptu_1, paygo_1, paygo_2]
+
+    # unavailable targets of the tier are moved to its end
+    rotated_candidates = LoadBalancer.rotate_first_tier(candidates, 1, lambda target: target is not ptu_2)
+    assert rotated_candidates == [ptu_3, ptu_1, ptu_2, paygo_1, paygo_2]
+
+    # if no target of the highest priority is available, the chunks are spread across the next priority
+    rotated_candidates = LoadBalancer.rotate_first_tier(candidates, 1, lambda target: target.priority == 1)
+    assert rotated_candidates == [ptu_1, ptu_2, ptu_3, paygo_2, paygo_1]
+    assert LoadBalancer.rotate_first_tier(candidates, 1, lambda _: False) == candidates
+
+
+if __name__ == "__main__":
+    for test_name, test_function in list(globals().items()):
+        if test_name.startswith("test_") and callable(test_function):
+            test_function()
+            print(f"✅ {test_name}")
@@ -0,0 +1,121 @@
+"""
+Tests relaying event streams and extracting their events.
+
+Runs without PowerProxy or Azure OpenAI. Run directly or via pytest.
+"""
+
+import asyncio
+import json
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "app"))
+
+from helpers.streaming import (  # pylint: disable=wrong-import-position
+    SseFramer,
+    relay_event_stream,
+)
+
+EVENT_STREAM = (
+    b": keep-alive comment\r\n\r\n"
+    + b"".join(f"data: {json.dumps({'index': index})}\r\n\r\n".encode() for index in range(3))
+    + b"event: other\ndata:no-space\n\n"
+    + b"data: first line\ndata: second line\n\n"
+    + "data: ümlaut\n\n".encode()
+    + b"data: [DONE]\n\n"
+)
+EXPECTED_EVENTS = [
+    '{"index": 0}',
+    '{"index": 1}',
+    '{"index": 2}',
+    "no-space",
+    "first line\nsecond line",
+    "ümlaut",
+    "[DONE]",
+]
+
+
+def test_framer_extracts_events_regardless_of_chunking():
+    """The same events are extracted no matter where the stream is split, even within multi-byte characters."""
+    for chunk_size in [1, 2, 3, 7, 64, len(EVENT_STREAM)]:
+        sse_framer = SseFramer()
+        events = []
+        for index in range(0, len(EVENT_STREAM), chunk_size):
+            events += sse_framer.feed(EVENT_STREAM[index : index + chunk_size])
+        events += sse_framer.flush()
+        assert events == EXPECTED_EVENTS, chunk_size
+
+
+def test_framer_flushes_unterminated_event():
+    """An event not ended by an empty line at the end of the stream is still extracted."""
+    sse_framer = SseFramer()
+    assert sse_framer.feed(b"data: a\n\ndata: b") == ["a"]
+    assert sse_framer.flush() == ["b"]
+    assert sse_framer.flush() == []
+
+
+def test_relay_forwards_chunks_unchanged_and_processes_all_events():
+    """Chunks are forwarded as they are (same objects), and all events are processed before the stream ends."""
+
+    async def chunks():
+        for index in range(0, len(EVENT_STREAM), 5):
+            yield EVENT_STREAM[index : index + 5]
+
+    async def run():
+        received_events = []
+        forwarded_chunks = [chunk async for chunk in relay_event_stream(chunks(), received_events.append)]
+        assert b"".join(forwarded_chunks) == EVENT_STREAM
+        assert received_events == EXPECTED_EVENTS
+
+    asyncio.run(run())
+
+
+def test_relay_does_not_wait_for_event_processing():
+    """A chunk is forwarded before the events of the previous chunk have been processed."""
+
+    async def run():
+        processing_started = asyncio.Event()
+        forwarded_before_processing = []
+
+        async def chunks():
+            yield b"data: 1\n\n"
+            yield b"data: 2\n\n"
+
+        def on_data_event(_):
+            processing_started.set()
+
+        async for chunk in relay_event_stream(chunks(), on_data_event):
+            forwarded_before_processing.append(not processing_started.is_set())
+        assert forwarded_before_processing == [True, True]
+        assert processing_started.is_set()
+
+    asyncio.run(run())
+
+
+def test_relay_awaits_async_event_processing_in_order():
+    """Async event processing runs in the order of the events, and has finished when the stream ends."""
+
+    async def chunks():
+        for index in range(0, len(EVENT_STREAM), 9):
+            await asyncio.sleep(0)
+            yield EVENT_STREAM[index : index + 9]
+
+    async def run():
+        received_events = []
+
+        async def on_data_event(data):
+            await asyncio.sleep(0.001)
+            received_events.append(data)
+
+        forwarded_chunks = [chunk async for chunk in relay_event_stream(chunks(), on_data_event)]
+        assert b"".join(forwarded_chunks) == EVENT_STREAM
+        assert received_events == EXPECTED_EVENTS
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    for test_name, test_function in list(globals().items()):
+        if test_name.startswith("test_") and callable(test_function):
+            test_function()
+            print(f"✅ {test_name}")
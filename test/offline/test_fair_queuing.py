@@ -0,0 +1,144 @@
+"""
+Tests the weighted fair queuing of requests across clients.
+
+Runs without PowerProxy or Azure OpenAI. Run directly or via pytest.
+"""
+
+import asyncio
+import heapq
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "app"))
+
+from helpers.scheduling import (  # pylint: disable=wrong-import-position
+    FairQueue,
+    FairQueuingScheduler,
+)
+
+# simulated clients: (name, weight, number of requests, estimated tokens per request)
+# all requests arrive at once, so the upstream is overloaded and every client stays backlogged during the measurement
+CLIENTS = [
+    ("batch", 1, 2_000, 4_000),
+    ("interactive-1", 1, 2_000, 500),
+    ("interactive-2", 2, 2_000, 500),
+]
+SLOTS = 8
+TOKENS_PER_SECOND_PER_SLOT = 1_000
+MEASUREMENT_SECONDS = 60
+
+
+def simulate(is_fair):
+    """Simulate the overload and return the share of tokens each client got served within the measurement."""
+    fair_queue = FairQueue()
+    fifo_queue = []
+    for name, weight, requests, tokens in CLIENTS:
+        for _ in range(requests):
+            if is_fair:
+                fair_queue.push(name, weight, tokens, (name, tokens))
+            else:
+                fifo_queue.append((name, tokens))
+    fifo_queue.reverse()
+
+    def take_next():
+        if is_fair:
+            return fair_queue.pop() if fair_queue else None
+        return fifo_queue.pop() if fifo_queue else None
+
+    served_tokens = {name: 0 for name, _, _, _ in CLIENTS}
+    completions = []
+    for slot in range(SLOTS):
+        request = take_next()
+        heapq.heappush(completions, (request[1] / TOKENS_PER_SECOND_PER_SLOT, slot, request))
+    while completions:
+        now, slot, (name, tokens) = heapq.heappop(completions)
+        if now > MEASUREMENT_SECONDS:
+            break
+        served_tokens[name] += tokens
+        request = take_next()
+        if request:
+            heapq.heappush(completions, (now + request[1] / TOKENS_PER_SECOND_PER_SLOT, slot, request))
+    total_tokens = sum(served_tokens.values())
+    return {name: tokens / total_tokens for name, tokens in served_tokens.items()}
+
+
+def test_share_of_tokens_is_proportional_to_weight_under_overload():
+    """Under overload, each client gets a share of the served tokens proportional to its weight."""
+    fifo_shares = simulate(is_fair=False)
+    fair_shares = simulate(is_fair=True)
+
+    # without fair queuing, the batch client sending first and most starves the interactive clients
+    assert fifo_shares["batch"] == 1.0
+
+    # with fair queuing, shares follow the weights 1:1:2, regardless of the number and size of requests
+    total_weight = sum(weight for _, weight, _, _ in CLIENTS)
+    for name, weight, _, _ in CLIENTS:
+        assert abs(fair_shares[name] - weight / total_weight) < 0.02, fair_shares
+
+
+def test_idle_client_gains_no_credit():
+    """A client which was idle does not get to send a burst ahead of everybody else when it comes back."""
+    fair_queue = FairQueue()
+    for index in range(10):
+        fair_queue.push("busy", 1, 100, f"busy-{index}")
+    for _ in range(5):
+        fair_queue.pop()
+    for index in range(3):
+        fair_queue.push("returning", 1, 100, f"returning-{index}")
+    order = [fair_queue.pop() for _ in range(len(fair_queue))]
+    assert order[:4] == ["busy-5", "returning-0", "busy-6", "returning-1"]
+
+
+def test_scheduler_limits_concurrency_and_passes_in_fair_order():
+    """The scheduler lets requests pass right away until saturated, then in weighted fair order as tickets return."""
+
+    async def run():
+        scheduler = FairQueuingScheduler(max_concurrent_requests=1)
+        first_ticket = await scheduler.acquire("batch", 1, 100)
+        passed = []
+
+        async def acquire(client, cost):
+            ticket = await scheduler.acquire(client, 1, cost)
+            passed.append(client)
+            ticket.release()
+
+        tasks = [asyncio.create_task(acquire("batch", 1_000)) for _ in range(3)]
+        await asyncio.sleep(0)
+        tasks.append(asyncio.create_task(acquire("interactive", 100)))
+        await asyncio.sleep(0)
+        assert scheduler.requests_in_flight == 1 and not passed
+        first_ticket.release()
+        first_ticket.release()
+        await asyncio.gather(*tasks)
+        assert passed == ["interactive", "batch", "batch", "batch"]
+        assert scheduler.requests_in_flight == 0
+
+    asyncio.run(run())
+
+
+def test_scheduler_times_out_and_rejects():
+    """Requests which cannot pass in time or arrive at a full queue get no ticket."""
+
+    async def run():
+        scheduler = FairQueuingScheduler(max_concurrent_requests=1, max_queued_requests=1)
+        ticket = await scheduler.acquire("a", 1, 1)
+        waiting_task = asyncio.create_task(scheduler.acquire("a", 1, 1, timeout_seconds=0.05))
+        await asyncio.sleep(0)
+        assert await scheduler.acquire("b", 1, 1) is None
+        assert await waiting_task is None
+        assert scheduler.metrics["rejected"] == 1 and scheduler.metrics["timed_out"] == 1
+        ticket.release()
+        assert scheduler.requests_in_flight == 0
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    for test_name, test_function in list(globals().items()):
+        if test_name.startswith("test_") and callable(test_function):
+            test_function()
+            print(f"✅ {test_name}")
+    for is_fair in [False, True]:
+        shares = simulate(is_fair)
+        print(f"{'weighted fair queuing' if is_fair else 'first come, first served':<25}", end="")
+        print(" | ".join(f"{name} {share:6.1%}" for name, share in shares.items()))
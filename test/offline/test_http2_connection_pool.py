@@ -0,0 +1,132 @@
+"""
+Tests multiplexing requests over the connections of an Http2ConnectionPool.
+
+Runs without PowerProxy or Azure OpenAI. Run directly or via pytest.
+"""
+
+import asyncio
+import os
+import sys
+
+import httpx
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "app"))
+
+from helpers import connections  # pylint: disable=wrong-import-position
+from helpers.connections import Http2ConnectionPool, get_proxy_url  # pylint: disable=wrong-import-position
+
+
+class OpenStream(httpx.AsyncByteStream):
+    """Response stream which stays open until it is closed."""
+
+    async def __aiter__(self):
+        """Dunder method to return the chunks of the stream."""
+        yield b"data: [DONE]\n\n"
+
+
+def run_with_mock_connections(test, handler):
+    """Run the given test with a pool whose connections send requests to the given handler instead of the network."""
+    original_constructor = connections.MultiplexedConnection.__init__
+
+    def constructor(self, pool):
+        original_constructor(self, pool)
+        self.transport = httpx.MockTransport(handler)
+
+    connections.MultiplexedConnection.__init__ = constructor
+    try:
+        asyncio.run(test())
+    finally:
+        connections.MultiplexedConnection.__init__ = original_constructor
+
+
+def test_streams_are_spread_over_connections_and_queued_when_saturated():
+    """Connections are opened only when the others carry the maximum of streams, then requests are queued."""
+
+    async def test():
+        pool = Http2ConnectionPool(max_connections=3, max_streams_per_connection=2)
+        async with httpx.AsyncClient(base_url="https://mock", transport=pool) as client:
+            responses = []
+            for expected_streams_per_connection in [[1], [2], [2, 1], [2, 2], [2, 2, 1], [2, 2, 2]]:
+                responses.append(await client.send(client.build_request("POST", "/"), stream=True))
+                assert pool.get_stats()["active_streams_per_connection"] == expected_streams_per_connection
+
+            queued_response = asyncio.create_task(client.send(client.build_request("POST", "/"), stream=True))
+            await asyncio.sleep(0.01)
+            assert not queued_response.done() and pool.get_stats()["queued_requests"] == 1
+
+            await responses.pop(2).aclose()
+            responses.append(await asyncio.wait_for(queued_response, 1))
+            assert pool.get_stats()["active_streams_per_connection"] == [2, 2, 2]
+            for response in responses:
+                await response.aclose()
+            stats = pool.get_stats()
+            assert stats["active_streams"] == 0 and stats["queued_requests"] == 0
+            assert stats["requests"] == 7 and stats["queued"] == 1 and stats["peak_streams"] == 6
+
+    run_with_mock_connections(test, lambda request: httpx.Response(200, stream=OpenStream()))
+
+
+def test_queued_requests_time_out_after_pool_timeout():
+    """A request waiting for a free stream longer than the pool timeout fails with a PoolTimeout."""
+
+    async def test():
+        pool = Http2ConnectionPool(max_connections=1, max_streams_per_connection=1)
+        timeout = httpx.Timeout(5, pool=0.05)
+        async with httpx.AsyncClient(base_url="https://mock", transport=pool, timeout=timeout) as client:
+            response = await client.send(client.build_request("POST", "/"), stream=True)
+            try:
+                await client.post("/")
+                assert False, "no PoolTimeout raised"
+            except httpx.PoolTimeout:
+                pass
+            await response.aclose()
+            assert (await client.post("/")).status_code == 200
+            assert pool.get_stats()["timed_out"] == 1 and pool.get_active_streams() == 0
+
+    run_with_mock_connections(test, lambda request: httpx.Response(200, stream=OpenStream()))
+
+
+def test_streams_are_released_on_errors():
+    """Streams of requests failing with an exception are released."""
+
+    def handler(request):
+        raise httpx.ConnectError("connection refused")
+
+    async def test():
+        pool = Http2ConnectionPool(max_connections=1, max_streams_per_connection=1)
+        async with httpx.AsyncClient(base_url="https://mock", transport=pool) as client:
+            for _ in range(3):
+                try:
+                    await client.post("/")
+                    assert False, "no ConnectError raised"
+                except httpx.ConnectError:
+                    pass
+            assert pool.get_active_streams() == 0
+
+    run_with_mock_connections(test, handler)
+
+
+def test_proxy_is_taken_from_the_environment():
+    """The proxy configured by the environment is used, unless the endpoint's host is excluded from it."""
+    proxy_variables = [f"{prefix}_proxy" for prefix in ["http", "https", "all", "no"]]
+    proxy_variables += [name.upper() for name in proxy_variables]
+    original_environment = {name: os.environ.pop(name, None) for name in proxy_variables}
+    try:
+        assert get_proxy_url("https://endpoint.openai.azure.com/") is None
+        os.environ["HTTPS_PROXY"] = "http://proxy.example.com:3128"
+        os.environ["NO_PROXY"] = "localhost,.internal.example.com"
+        assert get_proxy_url("https://endpoint.openai.azure.com/") == "http://proxy.example.com:3128"
+        assert get_proxy_url("https://endpoint.internal.example.com/") is None
+        assert get_proxy_url("http://endpoint.openai.azure.com/") is None
+    finally:
+        for name, value in original_environment.items():
+            os.environ.pop(name, None)
+            if value is not None:
+                os.environ[name] = value
+
+
+if __name__ == "__main__":
+    for test_name, test_function in list(globals().items()):
+        if test_name.startswith("test_") and callable(test_function):
+            test_function()
+            print(f"✅ {test_name}")
@@ -0,0 +1,168 @@
+"""
+Tests the metrics exposed at /powerproxy/metrics, incl. their aggregation across workers.
+
+Runs without PowerProxy or Azure OpenAI. Run directly or via pytest.
+"""
+
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "app"))
+
+from helpers.dicts import QueryDict  # pylint: disable=wrong-import-position
+from helpers.metrics import Metrics, RequestTimer, get_usage_tokens  # pylint: disable=wrong-import-position
+
+TARGET_NAMES = ["target-1", "target-2"]
+
+
+def create_metrics(directory, collect=None):
+    """Return metrics writing their snapshots to the given directory."""
+    return Metrics(QueryDict({"directory": directory, "flush_interval_ms": 10}), TARGET_NAMES, collect)
+
+
+def get_samples(text):
+    """Return the samples in the given text in the Prometheus text format, by name and labels."""
+    return {
+        line.rsplit(" ", 1)[0]: float(line.rsplit(" ", 1)[1])
+        for line in text.splitlines()
+        if line and not line.startswith("#")
+    }
+
+
+def test_counters_and_histograms_are_rendered():
+    """Counters add up, histograms count values per bucket (cumulative when rendered), labels are escaped."""
+    with tempfile.TemporaryDirectory() as directory:
+        metrics = create_metrics(directory)
+        labels = ("client-a", "gpt-4o", "target-1", "200")
+        metrics.increment("powerproxy_requests_total", labels)
+        metrics.increment("powerproxy_requests_total", labels)
+        metrics.increment("powerproxy_tokens_total", ('say "hi"\n', "gpt-4o", "prompt"), 25)
+        for value in [0.02, 0.025, 0.3, 500]:
+            metrics.observe("powerproxy_upstream_latency_seconds", ("target-1",), value)
+        text = metrics.render()
+
+        assert "# TYPE powerproxy_requests_total counter" in text
+        assert "# TYPE powerproxy_upstream_latency_seconds histogram" in text
+        samples = get_samples(text)
+        assert (
+            samples['powerproxy_requests_total{client="client-a",deployment="gpt-4o",target="target-1",status="200"}']
+            == 2
+        )
+        assert samples['powerproxy_tokens_total{client="say \\"hi\\"\\n",deployment="gpt-4o",type="prompt"}'] == 25
+        # note: a value on a bucket's upper bound falls into that bucket
+        assert samples['powerproxy_upstream_latency_seconds_bucket{target="target-1",le="0.025"}'] == 2
+        assert samples['powerproxy_upstream_latency_seconds_bucket{target="target-1",le="0.5"}'] == 3
+        assert samples['powerproxy_upstream_latency_seconds_bucket{target="target-1",le="120.0"}'] == 3
+        assert samples['powerproxy_upstream_latency_seconds_bucket{target="target-1",le="+Inf"}'] == 4
+        assert samples['powerproxy_upstream_latency_seconds_count{target="target-1"}'] == 4
+        assert abs(samples['powerproxy_upstream_latency_seconds_sum{target="target-1"}'] - 500.345) < 1e-9
+
+
+def test_metrics_are_aggregated_across_workers():
+    """A scrape adds up the snapshots of the live workers, takes the maximum of state gauges, and drops exited ones."""
+    with tempfile.TemporaryDirectory() as directory:
+        metrics = create_metrics(directory)
+        metrics.increment("powerproxy_failovers_total", ("gpt-4o",))
+        metrics.observe("powerproxy_overhead_seconds", (), 0.001)
+        metrics.set("powerproxy_target_blocked", ("target-1",), 0)
+
+        # another worker, which is alive (the parent process stands in for it)
+        other_worker_metrics = create_metrics(
+            directory, lambda metrics: metrics.set("powerproxy_target_blocked", ("target-1",), 1)
+        )
+        other_worker_metrics.path = f"{other_worker_metrics.path_prefix}{os.getppid()}.json"
+        other_worker_metrics.increment("powerproxy_failovers_total", ("gpt-4o",), 2)
+        other_worker_metrics.increment("powerproxy_failovers_total", ("gpt-35",))
+        other_worker_metrics.observe("powerproxy_overhead_seconds", (), 0.002)
+        other_worker_metrics.flush()
+
+        # a worker which has exited
+        exited_process = subprocess.Popen([sys.executable, "-c", "pass"])
+        exited_process.wait()
+        exited_worker_path = f"{metrics.path_prefix}{exited_process.pid}.json"
+        with open(exited_worker_path, "w", encoding="utf-8") as file:
+            json.dump({"powerproxy_failovers_total": [[["gpt-4o"], 100]]}, file)
+
+        # a proxy with other targets
+        other_proxy_metrics = Metrics(QueryDict({"directory": directory}), ["other"])
+        other_proxy_metrics.path = f"{other_proxy_metrics.path_prefix}{os.getppid()}.json"
+        other_proxy_metrics.increment("powerproxy_failovers_total", ("gpt-4o",), 1_000)
+        other_proxy_metrics.flush()
+
+        samples = get_samples(metrics.render())
+        assert samples['powerproxy_failovers_total{deployment="gpt-4o"}'] == 3
+        assert samples['powerproxy_failovers_total{deployment="gpt-35"}'] == 1
+        assert samples['powerproxy_target_blocked{target="target-1"}'] == 1
+        assert samples['powerproxy_overhead_seconds_bucket{le="0.001"}'] == 1
+        assert samples['powerproxy_overhead_seconds_bucket{le="0.0025"}'] == 2
+        assert samples["powerproxy_overhead_seconds_count"] == 2
+        assert not os.path.exists(exited_worker_path)
+        # the own values are not taken from the snapshot, so they are not counted twice
+        metrics.flush()
+        assert get_samples(metrics.render())['powerproxy_failovers_total{deployment="gpt-4o"}'] == 3
+
+
+def test_snapshots_are_written_in_the_background():
+    """Snapshots are written periodically with the gauges collected, and removed when closing."""
+
+    async def run():
+        with tempfile.TemporaryDirectory() as directory:
+            metrics = create_metrics(
+                directory, lambda metrics: metrics.set("powerproxy_streams_in_flight", ("gpt-4o",), 3)
+            )
+            metrics.start()
+            await asyncio.sleep(0.05)
+            with open(metrics.path, encoding="utf-8") as file:
+                assert json.load(file) == {"powerproxy_streams_in_flight": [[["gpt-4o"], 3]]}
+            await metrics.close()
+            assert not os.path.exists(metrics.path)
+
+    asyncio.run(run())
+
+
+def test_usage_tokens_are_found_without_parsing():
+    """The tokens are taken from the last usage in a body or event stream, in the formats of the APIs."""
+    body = json.dumps(
+        {
+            "choices": [{"message": {"content": "The usage is in the body."}}],
+            "usage": {
+                "completion_tokens": 7,
+                "completion_tokens_details": {"reasoning_tokens": 0},
+                "prompt_tokens": 12,
+                "prompt_tokens_details": {"cached_tokens": 0},
+                "total_tokens": 19,
+            },
+        }
+    ).encode()
+    assert get_usage_tokens(body) == (12, 7)
+    assert get_usage_tokens(b'{"data": [], "usage": {"prompt_tokens": 8, "total_tokens": 8}}') == (8, 0)
+    assert get_usage_tokens(b'{"usage": {"input_tokens": 3, "output_tokens": 4, "total_tokens": 7}}') == (3, 4)
+    event_stream = (
+        b'data: {"choices": [{"delta": {"content": "Hi"}}], "usage": null}\n\n'
+        b'data: {"choices": [], "usage": {"completion_tokens": 1, "prompt_tokens": 5, "total_tokens": 6}}\n\n'
+        b"data: [DONE]\n\n"
+    )
+    assert get_usage_tokens(event_stream) == (5, 1)
+    assert get_usage_tokens(b'data: {"choices": [], "usage": null}\n\ndata: [DONE]\n\n') is None
+    assert get_usage_tokens(b'{"error": {"code": "429"}}') is None
+
+
+def test_request_timer_excludes_waiting_for_targets():
+    """The overhead of a request is the time spent on it, minus the time waiting for targets."""
+    request_timer = RequestTimer()
+    request_timer.start_waiting()
+    time.sleep(0.05)
+    request_timer.stop_waiting()
+    assert 0 <= request_timer.get_overhead_seconds() < 0.02
+
+
+if __name__ == "__main__":
+    for test_name, test_function in list(globals().items()):
+        if test_name.startswith("test_") and callable(test_function):
+            test_function()
+            print(f"✅ {test_name}")
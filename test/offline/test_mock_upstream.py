@@ -0,0 +1,203 @@
+"""
+Tests the simulated Azure OpenAI upstream used for mock responses.
+
+Runs without PowerProxy or Azure OpenAI. Run directly or via pytest.
+"""
+
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+
+import httpx
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "app"))
+
+from helpers.dicts import QueryDict  # pylint: disable=wrong-import-position
+from helpers.mocking import LatencyDistribution, MockUpstream  # pylint: disable=wrong-import-position
+from helpers.streaming import SseFramer  # pylint: disable=wrong-import-position
+
+CHAT_PATH = "/openai/deployments/gpt-4o/chat/completions"
+
+
+async def send(mock_upstream, path, request_body_dict):
+    """Send a request with the given path and body to the mock upstream and return the response, read fully."""
+    async with httpx.AsyncClient(
+        base_url="https://mock/", transport=httpx.MockTransport(mock_upstream.handle_request)
+    ) as client:
+        response = await client.post(path, json=request_body_dict)
+        await response.aread()
+        return response
+
+
+def get_events(response):
+    """Return the data of the events in the given event stream response, parsed as JSON except the [DONE] event."""
+    sse_framer = SseFramer()
+    events = sse_framer.feed(response.content) + sse_framer.flush()
+    return [json.loads(event) if event != "[DONE]" else event for event in events]
+
+
+def test_made_up_responses():
+    """Chat completions and embeddings get made-up responses with usage, unless a json is configured."""
+
+    async def run():
+        mock_upstream = MockUpstream(QueryDict({"completion_tokens": 5, "embedding_dimensions": 3}))
+        response = await send(mock_upstream, CHAT_PATH, {"messages": [{"role": "user", "content": "Hi"}]})
+        body_dict = response.json()
+        assert response.status_code == 200
+        assert body_dict["object"] == "chat.completion"
+        assert body_dict["choices"][0]["message"]["content"] == "I'm a mock response and"
+        assert body_dict["usage"]["completion_tokens"] == 5
+        assert body_dict["usage"]["total_tokens"] == body_dict["usage"]["prompt_tokens"] + 5
+
+        # max_tokens caps the completion
+        response = await send(mock_upstream, CHAT_PATH, {"messages": [], "max_tokens": 2})
+        assert response.json()["usage"]["completion_tokens"] == 2
+
+        response = await send(mock_upstream, "/openai/deployments/ada/embeddings", {"input": ["a", "b"]})
+        body_dict = response.json()
+        assert [embedding["index"] for embedding in body_dict["data"]] == [0, 1]
+        assert len(body_dict["data"][0]["embedding"]) == 3
+
+        mock_upstream = MockUpstream(QueryDict({"json": {"answer": 42}}))
+        assert (await send(mock_upstream, CHAT_PATH, {"messages": []})).json() == {"answer": 42}
+
+    asyncio.run(run())
+
+
+def test_streamed_completions():
+    """Streamed completions are sent as events at the configured rate, with a usage chunk if requested."""
+
+    async def run():
+        mock_upstream = MockUpstream(
+            QueryDict({"time_to_first_token_ms": 50, "tokens_per_second": 200, "completion_tokens": 10})
+        )
+        start_time = time.perf_counter()
+        response = await send(
+            mock_upstream, CHAT_PATH, {"messages": [], "stream": True, "stream_options": {"include_usage": True}}
+        )
+        duration_ms = (time.perf_counter() - start_time) * 1_000
+        assert response.headers["content-type"].startswith("text/event-stream")
+        events = get_events(response)
+        assert events[-1] == "[DONE]"
+        # role, 10 tokens, finish reason, usage
+        assert len(events) == 1 + 10 + 1 + 1 + 1
+        assert "".join(event["choices"][0]["delta"].get("content", "") for event in events[:-2]).startswith("I'm a")
+        assert events[-3]["choices"][0]["finish_reason"] == "stop"
+        assert events[-2]["choices"] == [] and events[-2]["usage"]["completion_tokens"] == 10
+        # time to first token plus 9 tokens at 200 tokens per second
+        assert duration_ms >= 50 + 45 - 5
+
+        response = await send(mock_upstream, "/openai/deployments/gpt-35/completions", {"prompt": "Hi", "stream": True})
+        events = get_events(response)
+        assert events[1]["object"] == "text_completion" and "usage" not in events[1]
+
+    asyncio.run(run())
+
+
+def test_injected_errors():
+    """Shares of the requests get 429s, 500s, slow reads or connection resets, as configured."""
+
+    async def run():
+        mock_upstream = MockUpstream(QueryDict({"errors": {"rate_limit_rate": 1, "retry_after_ms": 1500}}))
+        response = await send(mock_upstream, CHAT_PATH, {"messages": []})
+        assert response.status_code == 429
+        assert response.headers["retry-after-ms"] == "1500" and response.headers["retry-after"] == "2"
+
+        mock_upstream = MockUpstream(QueryDict({"errors": {"server_error_rate": 1}}))
+        assert (await send(mock_upstream, CHAT_PATH, {"messages": []})).status_code == 500
+
+        mock_upstream = MockUpstream(QueryDict({"errors": {"connection_reset_rate": 1}}))
+        for request_body_dict in [{"messages": []}, {"messages": [], "stream": True}]:
+            try:
+                await send(mock_upstream, CHAT_PATH, request_body_dict)
+                assert False
+            except httpx.ReadError:
+                pass
+
+        mock_upstream = MockUpstream(QueryDict({"errors": {"slow_read_rate": 1, "slow_read_ms": 100}}))
+        start_time = time.perf_counter()
+        assert (await send(mock_upstream, CHAT_PATH, {"messages": []})).status_code == 200
+        assert time.perf_counter() - start_time >= 0.095
+
+        # the shares add up, and the same seed gives the same errors
+        status_codes = []
+        for _ in range(2):
+            mock_upstream = MockUpstream(
+                QueryDict({"errors": {"rate_limit_rate": 0.2, "server_error_rate": 0.3}, "seed": 7})
+            )
+            status_codes.append([(await send(mock_upstream, CHAT_PATH, {})).status_code for _ in range(200)])
+        assert status_codes[0] == status_codes[1]
+        assert 20 <= status_codes[0].count(429) <= 60 and 40 <= status_codes[0].count(500) <= 80
+        assert mock_upstream.get_stats()["rate_limited_requests"] == status_codes[0].count(429)
+
+    asyncio.run(run())
+
+
+def test_invalid_requests():
+    """Requests whose body is no JSON or whose maximum number of tokens is no integer get a 400 like from AOAI."""
+
+    async def run():
+        mock_upstream = MockUpstream(QueryDict({}))
+        async with httpx.AsyncClient(
+            base_url="https://mock/", transport=httpx.MockTransport(mock_upstream.handle_request)
+        ) as client:
+            response = await client.post(CHAT_PATH, content=b"{not json")
+        assert response.status_code == 400
+        assert response.json()["error"]["type"] == "invalid_request_error"
+        assert "could not parse the JSON body" in response.json()["error"]["message"]
+
+        # streaming requests are checked before their response starts
+        for stream in [False, True]:
+            response = await send(mock_upstream, CHAT_PATH, {"messages": [], "max_tokens": "abc", "stream": stream})
+            assert response.status_code == 400
+            assert response.json()["error"] == {
+                "message": "'abc' is not of type 'integer' - 'max_tokens'",
+                "type": "invalid_request_error",
+                "param": "max_tokens",
+                "code": None,
+            }
+        response = await send(mock_upstream, CHAT_PATH, {"messages": [], "max_completion_tokens": 1.5})
+        assert response.status_code == 400 and response.json()["error"]["param"] == "max_completion_tokens"
+
+    asyncio.run(run())
+
+
+def test_tokens_per_minute_are_limited_per_deployment():
+    """Requests exceeding the tokens per minute of their deployment get a 429 telling when they would fit."""
+
+    async def run():
+        mock_upstream = MockUpstream(QueryDict({"tokens_per_minute": {"gpt-4o": 1_000}}))
+        request_body_dict = {"messages": [], "max_tokens": 600}
+        response = await send(mock_upstream, CHAT_PATH, request_body_dict)
+        assert response.status_code == 200
+        assert 0 < int(response.headers["x-ratelimit-remaining-tokens"]) <= 400
+        response = await send(mock_upstream, CHAT_PATH, request_body_dict)
+        assert response.status_code == 429
+        assert 0 < int(response.headers["retry-after-ms"]) <= 61_000
+        # other deployments are not limited
+        response = await send(mock_upstream, "/openai/deployments/gpt-35/chat/completions", request_body_dict)
+        assert response.status_code == 200 and "x-ratelimit-remaining-tokens" not in response.headers
+        assert mock_upstream.get_stats()["requests_over_tokens_per_minute"] == 1
+
+    asyncio.run(run())
+
+
+def test_latency_distribution():
+    """Latencies are either fixed or log-normally distributed with the configured median and 95th percentile."""
+    assert LatencyDistribution(250).sample_ms(random.Random()) == 250
+    assert LatencyDistribution(None).sample_ms(random.Random()) == 0
+    randomizer = random.Random(1)
+    latency_distribution = LatencyDistribution({"median": 300, "p95": 1_200})
+    latencies_ms = sorted(latency_distribution.sample_ms(randomizer) for _ in range(10_000))
+    assert 270 <= latencies_ms[5_000] <= 330
+    assert 1_080 <= latencies_ms[9_500] <= 1_320
+
+
+if __name__ == "__main__":
+    for test_name, test_function in list(globals().items()):
+        if test_name.startswith("test_") and callable(test_function):
+            test_function()
+            print(f"✅ {test_name}")
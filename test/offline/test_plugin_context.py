@@ -0,0 +1,191 @@
+"""
+Tests that plugins keep their state per request, so token counts are exact when many requests are processed at once.
+
+Runs without PowerProxy or Azure OpenAI. Run directly or via pytest.
+"""
+
+import asyncio
+import json
+import os
+import random
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "app"))
+
+from helpers.routing_slip import RoutingSlip  # pylint: disable=wrong-import-position
+from helpers.streaming import relay_event_stream  # pylint: disable=wrong-import-position
+from plugins.base import (  # pylint: disable=wrong-import-position
+    PowerProxyPlugin,
+    compile_plugin_hooks,
+    run_plugin_hooks,
+)
+from plugins.LimitUsage.LimitUsage import LimitUsage  # pylint: disable=wrong-import-position
+from plugins.LogUsage.LogUsageBase import LogUsageBase  # pylint: disable=wrong-import-position
+
+REQUESTS = 500
+
+
+class RecordingLogUsage(LogUsageBase):
+    """Plugin recording the lines it would log, per client."""
+
+    def __init__(self, app_configuration, plugin_configuration):
+        """Constructor."""
+        super().__init__(app_configuration, plugin_configuration)
+        self.lines = {}
+
+    def _append_line(self, client, **kwargs):
+        assert client not in self.lines, f"Logged twice for client '{client}'."
+        self.lines[client] = kwargs
+
+
+class AsyncHeadersPlugin(PowerProxyPlugin):
+    """Plugin with an async hook, giving other requests a chance to run in between the hooks of a request."""
+
+    async def on_headers_from_target_received(self, routing_slip):
+        """Run when the headers from the target have been received."""
+        await asyncio.sleep(0)
+
+
+def get_expected_line(index):
+    """Return the kind of response for the request with the given index and the line expected to be logged for it."""
+    events = 1 + index % 17
+    kind = ["stream with usage", "stream without usage", "non-streaming"][index % 3]
+    prompt_tokens = 0 if kind == "stream without usage" else 100 + index
+    completion_tokens = events if kind == "stream without usage" else 1_000 + index
+    return kind, events, {
+        "is_streaming": kind != "non-streaming",
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+        "aoai_region": f"region-{index}",
+    }
+
+
+async def simulate_request(index, plugin_hooks, random_generator, active_streams):
+    """Simulate the request with the given index, like PowerProxy processes it."""
+    kind, events, expected_line = get_expected_line(index)
+    routing_slip = RoutingSlip(
+        None, b'{"prompt": "no messages, so no tokens are estimated for the prompt"}', "openai/deployments/gpt-4o"
+    )
+    routing_slip.client = f"client-{index}"
+    routing_slip.api_version = "2024-10-21"
+    routing_slip.aoai_roundtrip_time_ms = 0
+    routing_slip.aoai_endpoint = "mock"
+    routing_slip.aoai_virtual_deployment = "gpt-4o"
+    routing_slip.aoai_standin_deployment = "gpt-4o"
+    await run_plugin_hooks(plugin_hooks.on_new_request_received, routing_slip)
+    await run_plugin_hooks(plugin_hooks.on_client_identified, routing_slip)
+    routing_slip.headers_from_target = {"x-ms-region": expected_line["aoai_region"]}
+    await run_plugin_hooks(plugin_hooks.on_headers_from_target_received, routing_slip)
+
+    if kind == "non-streaming":
+        await asyncio.sleep(0)
+        routing_slip.body_from_target = json.dumps(
+            {"usage": {key: expected_line[key] for key in ["prompt_tokens", "completion_tokens", "total_tokens"]}}
+        ).encode()
+        await run_plugin_hooks(plugin_hooks.on_body_dict_from_target_available, routing_slip)
+        return
+
+    event_stream = b"".join(
+        f"data: {json.dumps({'choices': [{'delta': {'content': f'token {event}'}}]})}\n\n".encode()
+        for event in range(events - 1)
+    )
+    last_event = {"choices": [{"delta": {"content": "last token"}}]}
+    if kind == "stream with usage":
+        last_event["usage"] = {
+            key: expected_line[key] for key in ["prompt_tokens", "completion_tokens", "total_tokens"]
+        }
+    event_stream += f"data: {json.dumps(last_event)}\n\ndata: [DONE]\n\n".encode()
+
+    async def chunks():
+        # split the stream at random positions and let other requests run in between the chunks
+        active_streams[0] += 1
+        active_streams[1] = max(active_streams[0], active_streams[1])
+        position = 0
+        while position < len(event_stream):
+            chunk_size = random_generator.randint(1, 64)
+            await asyncio.sleep(0)
+            yield event_stream[position : position + chunk_size]
+            position += chunk_size
+        active_streams[0] -= 1
+
+    def on_data_event(data):
+        if data != "[DONE]":
+            routing_slip.data_from_target = data
+            for hook in plugin_hooks.on_data_event_from_target_received:
+                hook(routing_slip)
+
+    async for _ in relay_event_stream(chunks(), on_data_event):
+        pass
+    await run_plugin_hooks(plugin_hooks.on_end_of_target_response_stream_reached, routing_slip)
+
+
+def test_token_counts_are_exact_for_concurrent_interleaved_requests():
+    """Each request's token counts and region are logged exactly, while hundreds of streams interleave."""
+    plugins = [
+        RecordingLogUsage(None, {"name": "RecordingLogUsage"}),
+        AsyncHeadersPlugin(None, {"name": "AsyncHeadersPlugin"}),
+        RecordingLogUsage(None, {"name": "RecordingLogUsage"}),
+    ]
+    plugin_hooks = compile_plugin_hooks(plugins)
+    random_generator = random.Random(42)
+    active_streams = [0, 0]
+
+    async def run():
+        await asyncio.gather(
+            *[simulate_request(index, plugin_hooks, random_generator, active_streams) for index in range(REQUESTS)]
+        )
+
+    asyncio.run(run())
+    assert active_streams[1] > REQUESTS / 2
+    for plugin in [plugins[0], plugins[2]]:
+        assert len(plugin.lines) == REQUESTS
+        for index in range(REQUESTS):
+            line = plugin.lines[f"client-{index}"]
+            assert {key: line[key] for key in get_expected_line(index)[2]} == get_expected_line(index)[2], index
+
+
+def test_plugin_state_is_created_once_per_plugin_and_request():
+    """Each plugin gets its own state per request, created on first access only."""
+    first_plugin = RecordingLogUsage(None, {"name": "first"})
+    second_plugin = RecordingLogUsage(None, {"name": "second"})
+    first_routing_slip = RoutingSlip(None, b"", "")
+    second_routing_slip = RoutingSlip(None, b"", "")
+    assert not first_routing_slip.plugin_context.plugin_states
+
+    first_request_state = first_plugin.get_request_state(first_routing_slip)
+    assert first_request_state.total_tokens is None and first_request_state.aoai_region is None
+    first_request_state.total_tokens = 1
+    assert first_plugin.get_request_state(first_routing_slip) is first_request_state
+    assert second_plugin.get_request_state(first_routing_slip).total_tokens is None
+    assert first_plugin.get_request_state(second_routing_slip).total_tokens is None
+
+
+def test_responses_from_cache_do_not_count_against_usage_limits():
+    """LimitUsage charges the tokens of responses from Azure OpenAI to the client's budget, not those from the cache."""
+    plugin = LimitUsage(None, {"name": "LimitUsage"})
+    plugin_hooks = compile_plugin_hooks([plugin])
+    budget_key = "LimitUsage-client-with-cached-responses-gpt-4o-budget"
+
+    async def run():
+        plugin.local_cache[budget_key] = 1_000
+        for is_response_from_cache in [True, False]:
+            routing_slip = RoutingSlip(None, b"{}", "openai/deployments/gpt-4o")
+            routing_slip.client = "client-with-cached-responses"
+            routing_slip.virtual_deployment = "gpt-4o"
+            routing_slip.is_response_from_cache = is_response_from_cache
+            routing_slip.body_from_target = json.dumps(
+                {"usage": {"prompt_tokens": 70, "completion_tokens": 30, "total_tokens": 100}}
+            ).encode()
+            await run_plugin_hooks(plugin_hooks.on_body_dict_from_target_available, routing_slip)
+        await asyncio.gather(*plugin.background_tasks)
+
+    asyncio.run(run())
+    assert plugin.local_cache[budget_key] == 900
+
+
+if __name__ == "__main__":
+    for test_name, test_function in list(globals().items()):
+        if test_name.startswith("test_") and callable(test_function):
+            test_function()
+            print(f"✅ {test_name}")
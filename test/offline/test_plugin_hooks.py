@@ -0,0 +1,134 @@
+"""
+Tests compiling the plugin hooks.
+
+Runs without PowerProxy or Azure OpenAI. Run directly or via pytest.
+"""
+
+import asyncio
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "app"))
+
+from plugins.base import (  # pylint: disable=wrong-import-position
+    PluginHooks,
+    PowerProxyPlugin,
+    TokenCountingPlugin,
+    compile_plugin_hooks,
+    run_plugin_hooks,
+    shut_down_plugins,
+)
+
+
+class RecordingPlugin(PowerProxyPlugin):
+    """Plugin recording the headers hook only."""
+
+    def on_headers_from_target_received(self, routing_slip):
+        """Run when the headers from the target have been received."""
+        routing_slip["calls"].append(self.plugin_configuration["name"])
+
+
+def test_only_overridden_hooks_are_compiled():
+    """Hooks only contain the plugins overriding them, in the order the plugins are configured."""
+    plugins = [
+        RecordingPlugin(None, {"name": "first"}),
+        PowerProxyPlugin(None, {"name": "default"}),
+        TokenCountingPlugin(None, {"name": "counting"}),
+        RecordingPlugin(None, {"name": "second"}),
+    ]
+    plugin_hooks = compile_plugin_hooks(plugins)
+    assert plugin_hooks.on_headers_from_target_received == (
+        plugins[0].on_headers_from_target_received,
+        plugins[3].on_headers_from_target_received,
+    )
+    assert plugin_hooks.on_client_identified == ()
+    assert plugin_hooks.on_data_event_from_target_received == (plugins[2].on_data_event_from_target_received,)
+    for hook_name in PluginHooks.HOOK_NAMES:
+        assert isinstance(getattr(plugin_hooks, hook_name), tuple)
+
+    routing_slip = {"calls": []}
+    asyncio.run(run_plugin_hooks(plugin_hooks.on_headers_from_target_received, routing_slip))
+    assert routing_slip["calls"] == ["first", "second"]
+
+    # values returned by sync hooks are ignored
+    asyncio.run(run_plugin_hooks((lambda routing_slip: routing_slip["calls"].append("third") or True,), routing_slip))
+    assert routing_slip["calls"] == ["first", "second", "third"]
+    assert not plugin_hooks.async_hook_names
+
+
+class AsyncPlugin(PowerProxyPlugin):
+    """Plugin with an async hook, waiting for the time given in the routing slip."""
+
+    async def on_client_identified(self, routing_slip):
+        """Run when the client has been identified."""
+        await asyncio.sleep(routing_slip["delay_seconds"])
+        routing_slip["calls"].append(self.plugin_configuration["name"])
+
+
+class SyncPlugin(PowerProxyPlugin):
+    """Plugin with a sync hook."""
+
+    def on_client_identified(self, routing_slip):
+        """Run when the client has been identified."""
+        routing_slip["calls"].append(self.plugin_configuration["name"])
+
+
+def test_async_hooks_are_awaited_in_order():
+    """Async hooks are awaited before the next hook runs."""
+    plugins = [AsyncPlugin(None, {"name": "async"}), SyncPlugin(None, {"name": "sync"})]
+    plugin_hooks = compile_plugin_hooks(plugins)
+    assert plugin_hooks.async_hook_names == frozenset(["on_client_identified"])
+    routing_slip = {"calls": [], "delay_seconds": 0.01}
+    asyncio.run(run_plugin_hooks(plugin_hooks.on_client_identified, routing_slip))
+    assert routing_slip["calls"] == ["async", "sync"]
+
+
+def test_async_hooks_time_out_as_configured():
+    """Async hooks exceeding their configured timeout are given up, and the request continues."""
+    for hook_timeout_ms in [20, {"on_client_identified": 20}]:
+        plugin_hooks = compile_plugin_hooks([AsyncPlugin(None, {"name": "async", "hook_timeout_ms": hook_timeout_ms})])
+        routing_slip = {"calls": [], "delay_seconds": 1}
+        asyncio.run(run_plugin_hooks(plugin_hooks.on_client_identified, routing_slip))
+        assert routing_slip["calls"] == []
+        routing_slip = {"calls": [], "delay_seconds": 0}
+        asyncio.run(run_plugin_hooks(plugin_hooks.on_client_identified, routing_slip))
+        assert routing_slip["calls"] == ["async"]
+
+
+class UploadingPlugin(PowerProxyPlugin):
+    """Plugin uploading in the background with a client, which it closes on shutdown."""
+
+    def __init__(self, app_configuration, plugin_configuration):
+        """Constructor."""
+        super().__init__(app_configuration, plugin_configuration)
+        self.calls = []
+
+    async def upload(self, delay_seconds):
+        """Upload after the given delay."""
+        await asyncio.sleep(delay_seconds)
+        self.calls.append(f"uploaded after {delay_seconds}s")
+
+    async def on_shutdown(self):
+        """Close the client."""
+        self.calls.append("closed")
+
+
+def test_plugins_are_shut_down_after_their_background_tasks():
+    """Plugins close their clients on shutdown, after their pending background tasks have finished."""
+    plugin = UploadingPlugin(None, {"name": "uploading"})
+
+    async def run():
+        plugin.start_background_task(plugin.upload(0.05))
+        plugin.start_background_task(plugin.upload(0.01))
+        await shut_down_plugins([plugin, PowerProxyPlugin(None, {"name": "default"})])
+
+    asyncio.run(run())
+    assert plugin.calls == ["uploaded after 0.01s", "uploaded after 0.05s", "closed"]
+    assert not plugin.background_tasks
+
+
+if __name__ == "__main__":
+    for test_name, test_function in list(globals().items()):
+        if test_name.startswith("test_") and callable(test_function):
+            test_function()
+            print(f"✅ {test_name}")
@@ -0,0 +1,122 @@
+"""
+Tests estimating the remaining capacity of targets from their rate limit headers.
+
+Runs without PowerProxy or Azure OpenAI. Run directly or via pytest.
+"""
+
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "app"))
+
+from helpers.rate_limits import (  # pylint: disable=wrong-import-position
+    RemainingCapacity,
+    deprioritize_targets_expected_to_throttle,
+)
+from helpers.routing import AoaiTarget  # pylint: disable=wrong-import-position
+
+
+def create_target(name, remaining_capacity_configuration=None):
+    """Return a target estimating its remaining capacity."""
+    aoai_target = AoaiTarget(
+        name=name, target_type="endpoint", endpoint=name, url=f"https://{name}/", endpoint_client=None
+    )
+    aoai_target.remaining_capacity = RemainingCapacity(remaining_capacity_configuration or {})
+    return aoai_target
+
+
+def test_capacity_is_unknown_without_headers():
+    """A target which has not told its remaining capacity is not expected to throttle."""
+    remaining_capacity = RemainingCapacity({})
+    remaining_capacity.record_headers({"content-type": "application/json"}, 0)
+    assert remaining_capacity.get_remaining_tokens(0) is None
+    assert not remaining_capacity.is_expected_to_throttle(1_000_000, 0)
+
+
+def test_requests_sent_since_the_latest_response_are_subtracted():
+    """The estimated tokens of requests sent after the latest response count against the remaining tokens."""
+    remaining_capacity = RemainingCapacity({})
+    remaining_capacity.record_headers(
+        {"x-ratelimit-remaining-tokens": "1000", "x-ratelimit-remaining-requests": "2"}, 0
+    )
+    assert not remaining_capacity.is_expected_to_throttle(1_000, 1)
+    remaining_capacity.record_request(600)
+    assert remaining_capacity.get_remaining_tokens(1) == 400
+    assert remaining_capacity.is_expected_to_throttle(500, 1)
+    assert not remaining_capacity.is_expected_to_throttle(400, 1)
+    remaining_capacity.record_request(100)
+    assert remaining_capacity.get_remaining_requests(1) == 0
+    assert remaining_capacity.is_expected_to_throttle(1, 1)
+
+    # the next response tells the actual remaining capacity again
+    remaining_capacity.record_headers({"x-ratelimit-remaining-tokens": "5000"}, 2)
+    assert remaining_capacity.get_remaining_tokens(2) == 5_000
+    assert remaining_capacity.get_remaining_requests(2) is None
+    assert not remaining_capacity.is_expected_to_throttle(5_000, 2)
+
+
+def test_refunded_requests_do_not_count():
+    """A request taken back, eg. a cancelled hedged request, no longer counts against the remaining capacity."""
+    remaining_capacity = RemainingCapacity({})
+    remaining_capacity.record_headers(
+        {"x-ratelimit-remaining-tokens": "1000", "x-ratelimit-remaining-requests": "2"}, 0
+    )
+    remaining_capacity.record_request(600)
+    remaining_capacity.refund_request(600)
+    assert remaining_capacity.get_remaining_tokens(1) == 1_000
+    assert remaining_capacity.get_remaining_requests(1) == 2
+
+    # requests included in the observed remaining capacity already cannot be taken back
+    mark = remaining_capacity.record_request(300)
+    remaining_capacity.record_headers({"x-ratelimit-remaining-tokens": "700"}, 2, mark)
+    remaining_capacity.refund_request(300)
+    assert remaining_capacity.get_remaining_tokens(2) == 700
+
+
+def test_requests_in_flight_count_until_their_responses_arrive():
+    """Requests sent after the request of a response still count, and responses to earlier requests are ignored."""
+    remaining_capacity = RemainingCapacity({})
+    first_mark = remaining_capacity.record_request(100)
+    second_mark = remaining_capacity.record_request(200)
+    remaining_capacity.record_request(300)
+    remaining_capacity.record_headers({"x-ratelimit-remaining-tokens": "1000"}, 0, second_mark)
+    assert remaining_capacity.get_remaining_tokens(0) == 700
+    remaining_capacity.record_headers({"x-ratelimit-remaining-tokens": "5000"}, 1, first_mark)
+    assert remaining_capacity.get_remaining_tokens(1) == 700
+
+
+def test_estimates_expire_or_replenish():
+    """Estimates expire after max_age_ms, and are replenished over time if the limits per minute are known."""
+    remaining_capacity = RemainingCapacity({"max_age_ms": 1_000})
+    remaining_capacity.record_headers({"x-ratelimit-remaining-tokens": "0"}, 0)
+    assert remaining_capacity.is_expected_to_throttle(1, 1_000)
+    assert not remaining_capacity.is_expected_to_throttle(1, 1_001)
+
+    remaining_capacity = RemainingCapacity({"max_age_ms": 60_000})
+    remaining_capacity.record_headers({"x-ratelimit-remaining-tokens": "0", "x-ratelimit-limit-tokens": "60000"}, 0)
+    assert remaining_capacity.get_remaining_tokens(500) == 500
+    assert remaining_capacity.get_remaining_tokens(60_000) == 60_000
+    remaining_capacity.record_headers({"x-ratelimit-remaining-tokens": "59000", "x-ratelimit-limit-tokens": "60000"}, 0)
+    assert remaining_capacity.get_remaining_tokens(30_000) == 60_000
+
+
+def test_targets_expected_to_throttle_are_tried_last():
+    """Targets expected to throttle the request are moved to the end, keeping the order otherwise."""
+    ptu_1, ptu_2, paygo = create_target("ptu-1"), create_target("ptu-2"), create_target("paygo")
+    paygo.remaining_capacity = None
+    candidates = (ptu_1, ptu_2, paygo)
+    assert deprioritize_targets_expected_to_throttle(candidates, 5_000, 0) is candidates
+
+    ptu_1.remaining_capacity.record_headers({"x-ratelimit-remaining-tokens": "2000"}, 0)
+    assert deprioritize_targets_expected_to_throttle(candidates, 1_000, 0) == candidates
+    assert deprioritize_targets_expected_to_throttle(candidates, 5_000, 0) == [ptu_2, paygo, ptu_1]
+
+    ptu_2.remaining_capacity.record_headers({"x-ratelimit-remaining-requests": "0"}, 0)
+    assert deprioritize_targets_expected_to_throttle(candidates, 5_000, 0) == [paygo, ptu_1, ptu_2]
+
+
+if __name__ == "__main__":
+    for test_name, test_function in list(globals().items()):
+        if test_name.startswith("test_") and callable(test_function):
+            test_function()
+            print(f"✅ {test_name}")
@@ -0,0 +1,129 @@
+"""
+Tests coalescing identical requests in flight.
+
+Runs without PowerProxy or Azure OpenAI. Run directly or via pytest.
+"""
+
+import asyncio
+import os
+import sys
+
+import httpx
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "app"))
+
+from helpers.coalescing import RequestCoalescer  # pylint: disable=wrong-import-position
+
+PATH = "openai/deployments/gpt-4o/chat/completions"
+REQUEST_BODY_DICT = {"messages": [{"role": "user", "content": "warm up"}]}
+
+
+class MockTarget:
+    """A target answering requests after a delay, counting the requests it received."""
+
+    def __init__(self, delay_seconds=0.05, exception=None):
+        """Constructor."""
+        self.delay_seconds = delay_seconds
+        self.exception = exception
+        self.requests = 0
+
+    async def get_response(self):
+        """Return the target and its response to a request."""
+        self.requests += 1
+        await asyncio.sleep(self.delay_seconds)
+        if self.exception is not None:
+            raise self.exception
+        return self, httpx.Response(
+            200,
+            headers={"content-type": "application/json", "content-encoding": "identity"},
+            content=f'{{"request": {self.requests}}}'.encode(),
+        )
+
+
+def test_identical_requests_in_flight_share_one_response():
+    """Identical requests arriving while the first is in flight get a copy of its response, without own requests."""
+
+    async def run():
+        request_coalescer = RequestCoalescer({})
+        mock_target = MockTarget()
+        key = RequestCoalescer.get_key("Team 1", "gpt-4o", PATH, "2024-10-21", REQUEST_BODY_DICT)
+        results = await asyncio.gather(
+            *[request_coalescer.get_response(key, mock_target.get_response) for _ in range(10)]
+        )
+        assert mock_target.requests == 1
+        assert [is_response_coalesced for _, _, is_response_coalesced in results] == [False] + [True] * 9
+        for aoai_target, aoai_response, _ in results:
+            assert aoai_target is mock_target
+            assert await aoai_response.aread() == b'{"request": 1}'
+        # note: the body is passed on decoded, so the copies must not tell a content encoding
+        assert all("content-encoding" not in aoai_response.headers for _, aoai_response, _ in results[1:])
+        assert request_coalescer.get_stats() == {"leaders": 1, "followers": 9, "cancelled_leaders": 0, "in_flight": 0}
+
+        # requests arriving after the response was received are sent again, as are requests with other bodies or of
+        # other clients
+        other_key = RequestCoalescer.get_key("Team 1", "gpt-4o", PATH, "2024-10-21", {**REQUEST_BODY_DICT, "seed": 1})
+        other_client_key = RequestCoalescer.get_key("Team 2", "gpt-4o", PATH, "2024-10-21", REQUEST_BODY_DICT)
+        await asyncio.gather(
+            request_coalescer.get_response(key, mock_target.get_response),
+            request_coalescer.get_response(other_key, mock_target.get_response),
+            request_coalescer.get_response(other_client_key, mock_target.get_response),
+        )
+        assert mock_target.requests == 4
+
+    asyncio.run(run())
+
+
+def test_followers_fail_like_the_leader():
+    """If the leader's request fails, its followers fail with the same exception instead of sending own requests."""
+
+    async def run():
+        request_coalescer = RequestCoalescer({})
+        mock_target = MockTarget(exception=ValueError("no capacity"))
+        results = await asyncio.gather(
+            *[request_coalescer.get_response(b"key", mock_target.get_response) for _ in range(3)],
+            return_exceptions=True,
+        )
+        assert mock_target.requests == 1
+        assert all(isinstance(result, ValueError) for result in results)
+        assert len(request_coalescer) == 0
+
+    asyncio.run(run())
+
+
+def test_follower_continues_if_the_leader_is_cancelled():
+    """If the leader is cancelled, eg. because its client disconnected, the first follower sends its request instead."""
+
+    async def run():
+        request_coalescer = RequestCoalescer({})
+        mock_target = MockTarget()
+        leader = asyncio.create_task(request_coalescer.get_response(b"key", mock_target.get_response))
+        await asyncio.sleep(0.01)
+        followers = [
+            asyncio.create_task(request_coalescer.get_response(b"key", mock_target.get_response)) for _ in range(2)
+        ]
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        results = await asyncio.gather(*followers)
+        assert mock_target.requests == 2
+        assert [is_response_coalesced for _, _, is_response_coalesced in results] == [False, True]
+        assert request_coalescer.metrics["cancelled_leaders"] == 1
+
+    asyncio.run(run())
+
+
+def test_usage_attribution():
+    """Usage is attributed to each caller by default, or to the leader only, and other attributions are rejected."""
+    assert RequestCoalescer({}).attributes_usage_to_each_caller
+    assert not RequestCoalescer({"usage_attribution": "leader"}).attributes_usage_to_each_caller
+    try:
+        RequestCoalescer({"usage_attribution": "nobody"})
+        assert False
+    except ValueError:
+        pass
+
+
+if __name__ == "__main__":
+    for test_name, test_function in list(globals().items()):
+        if test_name.startswith("test_") and callable(test_function):
+            test_function()
+            print(f"✅ {test_name}")
@@ -0,0 +1,37 @@
+"""
+Tests estimating the cost of requests in tokens, as used for scheduling them.
+
+Runs without PowerProxy or Azure OpenAI. Run directly or via pytest.
+"""
+
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "app"))
+
+from helpers.tokens import estimate_request_cost_in_tokens  # pylint: disable=wrong-import-position
+
+
+def test_cost_is_prompt_plus_requested_completion():
+    """The prompt counts with approx. 4 characters per token, plus the requested or default completion tokens."""
+    messages = [{"role": "user", "content": "x" * 100}]
+    prompt_tokens = len(str(messages)) // 4
+    assert estimate_request_cost_in_tokens({"messages": messages}) == prompt_tokens + 256
+    assert estimate_request_cost_in_tokens({"messages": messages, "max_tokens": 10}) == prompt_tokens + 10
+    assert estimate_request_cost_in_tokens({"input": "x" * 40}, default_completion_tokens=0) == 10
+
+
+def test_malformed_bodies_cost_the_default():
+    """Bodies which are no objects, or maximum tokens which are no numbers, do not fail the estimate."""
+    for request_body_dict in [None, [], ["a", "b"], "text", 42]:
+        assert estimate_request_cost_in_tokens(request_body_dict, default_completion_tokens=7) == 7
+    for max_tokens in ["many", [1], {"a": 1}, -5, float("inf"), float("nan")]:
+        assert estimate_request_cost_in_tokens({"max_tokens": max_tokens}, default_completion_tokens=7) == 7
+    assert estimate_request_cost_in_tokens({"max_completion_tokens": "x", "max_tokens": "12"}) == 12
+
+
+if __name__ == "__main__":
+    for test_name, test_function in list(globals().items()):
+        if test_name.startswith("test_") and callable(test_function):
+            test_function()
+            print(f"✅ {test_name}")
@@ -0,0 +1,102 @@
+"""
+Tests caching the responses to deterministic completions.
+
+Runs without PowerProxy or Azure OpenAI. Run directly or via pytest.
+"""
+
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "app"))
+
+from helpers.caching import ENTRY_OVERHEAD_BYTES, CacheControl, ResponseCache  # pylint: disable=wrong-import-position
+
+PATH = "openai/deployments/gpt-4o/chat/completions"
+
+
+def test_only_deterministic_completions_are_cacheable():
+    """Completions with a temperature of 0 are cacheable, other completions and other requests are not."""
+    assert ResponseCache.is_cacheable(PATH, {"messages": [], "temperature": 0})
+    assert ResponseCache.is_cacheable("openai/deployments/gpt-4o/completions", {"prompt": "x", "temperature": 0.0})
+    assert not ResponseCache.is_cacheable(PATH, {"messages": []})
+    assert not ResponseCache.is_cacheable(PATH, {"messages": [], "temperature": 0.7})
+    assert not ResponseCache.is_cacheable(PATH, {"messages": [], "temperature": False})
+    assert not ResponseCache.is_cacheable("openai/deployments/ada/embeddings", {"input": "x", "temperature": 0})
+    assert not ResponseCache.is_cacheable(PATH, None)
+
+
+def test_keys_ignore_the_order_of_keys_and_whitespace():
+    """The same request of a client gets the same key regardless of its formatting, other requests get other keys."""
+    key = ResponseCache.get_key(
+        "Team 1", "gpt-4o", PATH, "2024-10-21", {"temperature": 0, "messages": [{"content": "hi"}]}
+    )
+    for client, virtual_deployment, request_body_dict, is_same_key in [
+        ("Team 1", "gpt-4o", {"messages": [{"content": "hi"}], "temperature": 0}, True),
+        ("Team 2", "gpt-4o", {"temperature": 0, "messages": [{"content": "hi"}]}, False),
+        ("Team 1", "gpt-35", {"temperature": 0, "messages": [{"content": "hi"}]}, False),
+        ("Team 1", "gpt-4o", {"temperature": 0, "messages": [{"content": "Hi"}]}, False),
+        ("Team 1", "gpt-4o", {"temperature": 0, "messages": [{"content": "hi"}], "stream": True}, False),
+    ]:
+        assert (
+            ResponseCache.get_key(client, virtual_deployment, PATH, "2024-10-21", request_body_dict) == key
+        ) == is_same_key
+
+
+def test_least_recently_used_responses_are_evicted_beyond_max_bytes():
+    """Responses are evicted in least recently used order once the cache exceeds max_bytes."""
+    response_cache = ResponseCache({"max_bytes": 3 * (ENTRY_OVERHEAD_BYTES + 100)})
+    for key in [b"a", b"b", b"c"]:
+        response_cache.put(key, {}, b"x" * 100, 0)
+    assert len(response_cache) == 3
+    assert response_cache.get(b"a", 1) is not None
+    response_cache.put(b"d", {}, b"x" * 100, 2)
+    assert response_cache.get(b"b", 3) is None
+    assert [response_cache.get(key, 3) is not None for key in [b"a", b"c", b"d"]] == [True, True, True]
+    assert response_cache.size_in_bytes == 3 * (ENTRY_OVERHEAD_BYTES + 100)
+
+    # responses larger than max_entry_bytes are not cached
+    response_cache.put(b"e", {}, b"x" * 1_000, 4)
+    assert response_cache.get(b"e", 4) is None
+    assert response_cache.get_stats() | {"size_in_bytes": None} == {
+        "hits": 4,
+        "misses": 2,
+        "bypasses": 0,
+        "stores": 4,
+        "evictions": 1,
+        "expirations": 0,
+        "entries": 3,
+        "size_in_bytes": None,
+    }
+
+
+def test_responses_expire():
+    """Responses expire after ttl_ms, and are not taken if they are older than the max. age requested."""
+    response_cache = ResponseCache({"ttl_ms": 1_000})
+    response_cache.put(b"a", {"content-type": "application/json", "content-length": "2"}, b"{}", 0)
+    cached_response = response_cache.get(b"a", 500, max_age_ms=500)
+    assert cached_response.body == b"{}"
+    assert cached_response.headers == {"content-type": "application/json"}
+    assert response_cache.get(b"a", 600, max_age_ms=500) is None
+    assert response_cache.get(b"a", 1_000) is not None
+    assert response_cache.get(b"a", 1_001) is None
+    assert len(response_cache) == 0
+    assert response_cache.metrics["expirations"] == 1
+
+
+def test_cache_control_directives():
+    """no-cache skips the lookup, no-store skips the lookup and storing, max-age limits the age of cached responses."""
+    cache_control = CacheControl(None)
+    assert cache_control.is_lookup_allowed and cache_control.is_store_allowed and cache_control.max_age_ms is None
+    cache_control = CacheControl("No-Cache")
+    assert not cache_control.is_lookup_allowed and cache_control.is_store_allowed
+    cache_control = CacheControl("no-store")
+    assert not cache_control.is_lookup_allowed and not cache_control.is_store_allowed
+    cache_control = CacheControl("private, max-age=60")
+    assert cache_control.is_lookup_allowed and cache_control.max_age_ms == 60_000
+
+
+if __name__ == "__main__":
+    for test_name, test_function in list(globals().items()):
+        if test_name.startswith("test_") and callable(test_function):
+            test_function()
+            print(f"✅ {test_name}")
@@ -0,0 +1,73 @@
+"""
+Tests the routing slip.
+
+Runs without PowerProxy or Azure OpenAI. Run directly or via pytest.
+"""
+
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "app"))
+
+from helpers.routing_slip import NOT_PARSED, RoutingSlip  # pylint: disable=wrong-import-position
+
+
+def test_fields_not_set_are_none_and_unknown_attributes_fail():
+    """Fields which have not been set are None, while unknown attributes raise as usual, and there is no __dict__."""
+    routing_slip = RoutingSlip(None, b"", "openai/deployments/gpt-4o/chat/completions")
+    assert routing_slip.client is None
+    routing_slip.client = "Team 1"
+    assert routing_slip.client == "Team 1"
+    assert not hasattr(routing_slip, "__dict__")
+    for action in [lambda: routing_slip.unknown, lambda: setattr(routing_slip, "unknown", 1)]:
+        try:
+            action()
+            assert False, "no AttributeError raised"
+        except AttributeError:
+            pass
+
+
+def test_bodies_are_parsed_on_first_access_only():
+    """Bodies are parsed into dicts when accessed first, the same dict is returned later, and invalid JSON is None."""
+    routing_slip = RoutingSlip(None, b'{"messages": [], "stream": true}', "")
+    assert routing_slip._incoming_request_body_dict is NOT_PARSED  # pylint: disable=protected-access
+    assert routing_slip.incoming_request_body_dict is routing_slip.incoming_request_body_dict
+    assert not routing_slip.is_non_streaming_response_requested
+    routing_slip.incoming_request_body_dict["stream"] = False
+    assert routing_slip.is_non_streaming_response_requested
+
+    assert routing_slip.body_dict_from_target is None
+    routing_slip.body_from_target = b'{"usage": {"total_tokens": 3}}'
+    assert routing_slip.body_dict_from_target == {"usage": {"total_tokens": 3}}
+
+    routing_slip = RoutingSlip(None, b"not json", "")
+    assert routing_slip.incoming_request_body_dict is None
+    assert not routing_slip.is_non_streaming_response_requested
+    routing_slip.body_from_target = b"<html>"
+    assert routing_slip.body_dict_from_target is None
+
+
+def test_dict_style_access_for_existing_plugins():
+    """Fields, lazy properties and values of plugins can be accessed like in the former dict routing slip."""
+    routing_slip = RoutingSlip(None, b'{"model": "gpt-4o"}', "v1/chat/completions")
+    assert "client" not in routing_slip and routing_slip.get("client", "default") == "default"
+    routing_slip["client"] = "Team 1"
+    assert routing_slip.client == "Team 1" and routing_slip["client"] == "Team 1" and "client" in routing_slip
+    assert routing_slip["incoming_request_body_dict"] == {"model": "gpt-4o"}
+    assert routing_slip["path"] == "v1/chat/completions"
+
+    assert "my_plugin_value" not in routing_slip and routing_slip.get("my_plugin_value") is None
+    try:
+        routing_slip["my_plugin_value"]  # pylint: disable=pointless-statement
+        assert False, "no KeyError raised"
+    except KeyError:
+        pass
+    routing_slip["my_plugin_value"] = 42
+    assert routing_slip["my_plugin_value"] == 42 and "my_plugin_value" in routing_slip
+
+
+if __name__ == "__main__":
+    for test_name, test_function in list(globals().items()):
+        if test_name.startswith("test_") and callable(test_function):
+            test_function()
+            print(f"✅ {test_name}")
@@ -0,0 +1,154 @@
+"""
+Tests sharing the state of targets across worker processes with the SharedTargetStateTable.
+
+Runs multiple worker processes, like uvicorn does, without PowerProxy or Azure OpenAI. Run directly or via pytest.
+"""
+
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "app"))
+
+from helpers.circuit_breaker import CircuitBreaker  # pylint: disable=wrong-import-position
+from helpers.rate_limits import TokenBudget  # pylint: disable=wrong-import-position
+from helpers.routing import AoaiTarget  # pylint: disable=wrong-import-position
+from helpers.shared_state import SharedTargetStateTable  # pylint: disable=wrong-import-position
+
+TARGET_NAMES = ["ptu@gpt-4o@Endpoint 1", "paygo@gpt-4o@Endpoint 1"]
+
+
+def create_targets(directory):
+    """Create the targets of a worker, sharing their state via the table in the given directory."""
+    table = SharedTargetStateTable(TARGET_NAMES, directory=directory, max_workers=8)
+    targets = {}
+    for target_name in TARGET_NAMES:
+        targets[target_name] = AoaiTarget(
+            name=target_name,
+            target_type="virtual_deployment_standin",
+            endpoint="Endpoint 1",
+            url="https://mock/",
+            endpoint_client=None,
+            circuit_breaker=CircuitBreaker({}),
+            token_budget=TokenBudget(1_000_000),
+        )
+        targets[target_name].attach_shared_state(table.get_target_state(target_name))
+    return table, targets
+
+
+def run_worker(directory, commands, results):
+    """Run a worker, executing the commands it receives and putting the results into the results queue."""
+    table, targets = create_targets(directory)
+    results.put(("ready", table.worker_index))
+    while (command := commands.get()) != "exit":
+        now_ms = time.time_ns() // 1_000_000
+        match command:
+            case ("throttle", target_name, retry_after_ms):
+                targets[target_name].circuit_breaker.record_failure(now_ms, retry_after_ms)
+                results.put(("throttled", target_name))
+            case "check":
+                results.put(
+                    {
+                        target_name: (
+                            target.circuit_breaker.allows_request(now_ms),
+                            target.circuit_breaker.get_unblocked_timestamp_ms(now_ms) - now_ms,
+                        )
+                        for target_name, target in targets.items()
+                    }
+                )
+            case ("send", target_name, number_of_requests, latency_ms):
+                targets[target_name].add_outstanding_requests(number_of_requests)
+                targets[target_name].set_ewma_latency_ms(latency_ms)
+                targets[target_name].token_budget.consume(number_of_requests * 100, now_ms)
+                results.put(("sent", target_name))
+    table.close()
+
+
+def start_workers(directory, number_of_workers):
+    """Start the given number of worker processes and return their command queues, the results queue and processes."""
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    workers = []
+    for _ in range(number_of_workers):
+        commands = context.Queue()
+        process = context.Process(target=run_worker, args=(directory, commands, results))
+        process.start()
+        workers.append((commands, process))
+    worker_indexes = {results.get(timeout=30)[1] for _ in workers}
+    assert worker_indexes == set(range(number_of_workers)), "every worker owns a row of its own"
+    return workers, results
+
+
+def stop_workers(workers):
+    """Stop the given workers."""
+    for commands, process in workers:
+        if process.is_alive():
+            commands.put("exit")
+        process.join(timeout=10)
+
+
+def test_single_429_blocks_target_for_all_workers():
+    """A 429 with retry-after received by one worker blocks the target for all workers, and only that target."""
+    with tempfile.TemporaryDirectory() as directory:
+        workers, results = start_workers(directory, 4)
+        try:
+            for commands, _ in workers:
+                commands.put("check")
+            for _ in workers:
+                assert all(allows_request for allows_request, _ in results.get(timeout=10).values())
+
+            workers[0][0].put(("throttle", TARGET_NAMES[0], 60_000))
+            assert results.get(timeout=10) == ("throttled", TARGET_NAMES[0])
+
+            for commands, _ in workers:
+                commands.put("check")
+            for _ in workers:
+                target_states = results.get(timeout=10)
+                allows_request, ms_until_unblocked = target_states[TARGET_NAMES[0]]
+                assert not allows_request and 59_000 < ms_until_unblocked <= 60_000
+                assert target_states[TARGET_NAMES[1]] == (True, 0)
+        finally:
+            stop_workers(workers)
+
+
+def test_requests_in_flight_and_latencies_are_combined_across_workers():
+    """
+    Requests in flight and tokens consumed are summed and latencies averaged over all workers, and requests in flight
+    of exited workers no longer count.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        workers, results = start_workers(directory, 3)
+        try:
+            for number_of_requests, (commands, _) in enumerate(workers, start=1):
+                commands.put(("send", TARGET_NAMES[0], number_of_requests, number_of_requests * 100.0))
+            for _ in workers:
+                results.get(timeout=10)
+
+            table, targets = create_targets(directory)
+            assert targets[TARGET_NAMES[0]].outstanding_requests == 1 + 2 + 3
+            assert targets[TARGET_NAMES[0]].ewma_latency_ms == 200.0
+            # note: a minute may have begun since the tokens were consumed, so they may have faded out slightly
+            consumed_tokens = targets[TARGET_NAMES[0]].token_budget.get_consumed_tokens(time.time_ns() // 1_000_000)
+            assert 590 < consumed_tokens <= (1 + 2 + 3) * 100
+            assert targets[TARGET_NAMES[1]].token_budget.get_consumed_tokens(time.time_ns() // 1_000_000) == 0
+            assert targets[TARGET_NAMES[1]].outstanding_requests == 0
+            assert targets[TARGET_NAMES[1]].ewma_latency_ms is None
+            table.close()
+
+            # a worker which has exited without releasing its rows, eg. after a crash, is cleaned up by the next worker
+            workers[2][1].kill()
+            workers[2][1].join()
+            table, targets = create_targets(directory)
+            assert targets[TARGET_NAMES[0]].outstanding_requests == 1 + 2
+            table.close()
+        finally:
+            stop_workers(workers)
+
+
+if __name__ == "__main__":
+    for test_name, test_function in list(globals().items()):
+        if test_name.startswith("test_") and callable(test_function):
+            test_function()
+            print(f"✅ {test_name}")
@@ -0,0 +1,63 @@
+"""
+Tests counting the estimated tokens of requests against the tokens per minute configured for targets.
+
+Runs without PowerProxy or Azure OpenAI. Run directly or via pytest.
+"""
+
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "app"))
+
+from helpers.rate_limits import TokenBudget  # pylint: disable=wrong-import-position
+
+
+def test_requests_are_absorbed_until_the_budget_is_used_up():
+    """Requests fit into the budget until the tokens consumed within the last minute reach the tokens per minute."""
+    token_budget = TokenBudget(1_000)
+    assert token_budget.can_absorb(1_000, 0)
+    token_budget.consume(700, 0)
+    assert token_budget.can_absorb(300, 1)
+    assert not token_budget.can_absorb(301, 1)
+
+    # throttled requests give their tokens back
+    token_budget.consume(-200, 2)
+    assert token_budget.get_consumed_tokens(2) == 500
+
+
+def test_tokens_leave_the_budget_after_a_minute():
+    """Tokens count until the second after a minute has passed, so they are rather overestimated than underestimated."""
+    token_budget = TokenBudget(1_000)
+    token_budget.consume(800, 30_500)
+    assert token_budget.get_consumed_tokens(90_000) == 800
+    assert token_budget.get_consumed_tokens(90_999) == 800
+    assert token_budget.get_consumed_tokens(91_000) == 0
+    token_budget.consume(100, 60_000)
+    token_budget.consume(200, 150_000)
+    assert token_budget.get_consumed_tokens(150_000) == 200
+    token_budget.consume(300, 150_999)
+    assert token_budget.get_consumed_tokens(151_000) == 500
+
+
+def test_absorbable_timestamp():
+    """The time at which a request fits into the budget is when enough of the tokens consumed have left the budget."""
+    token_budget = TokenBudget(1_000)
+    assert token_budget.get_absorbable_timestamp_ms(500, 10) == 10
+    token_budget.consume(600, 30_000)
+    token_budget.consume(200, 45_000)
+    absorbable_timestamp_ms = token_budget.get_absorbable_timestamp_ms(300, 50_000)
+    assert absorbable_timestamp_ms == 91_000
+    assert token_budget.can_absorb(300, absorbable_timestamp_ms)
+    assert not token_budget.can_absorb(300, absorbable_timestamp_ms - 1)
+    assert token_budget.get_absorbable_timestamp_ms(900, 50_000) == 106_000
+
+    # requests larger than the whole budget need the whole budget
+    assert token_budget.get_absorbable_timestamp_ms(5_000, 50_000) == 106_000
+    assert token_budget.can_absorb(5_000, 106_000)
+
+
+if __name__ == "__main__":
+    for test_name, test_function in list(globals().items()):
+        if test_name.startswith("test_") and callable(test_function):
+            test_function()
+            print(f"✅ {test_name}")
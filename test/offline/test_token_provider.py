@@ -0,0 +1,168 @@
+"""
+Tests the asynchronous, cached token provider used for endpoints without key, using fake credentials.
+
+Runs without PowerProxy or Azure OpenAI. Run directly or via pytest.
+"""
+
+import asyncio
+import os
+import sys
+import threading
+import time
+from collections import namedtuple
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "app"))
+
+from helpers.credentials import AsyncTokenProvider  # pylint: disable=wrong-import-position
+
+AccessToken = namedtuple("AccessToken", ["token", "expires_on"])
+
+
+class FakeClock:
+    """A clock which only moves when told so."""
+
+    def __init__(self):
+        """Constructor."""
+        self.now = 1_000_000.0
+
+    def __call__(self):
+        """Return the current fake time."""
+        return self.now
+
+
+class FakeSyncCredential:
+    """A synchronous credential, similar to DefaultAzureCredential, which takes a while to return a token."""
+
+    def __init__(self, clock, lifetime_seconds=3600, delay_seconds=0.05):
+        """Constructor."""
+        self.clock = clock
+        self.lifetime_seconds = lifetime_seconds
+        self.delay_seconds = delay_seconds
+        self.calls = 0
+        self.thread_names = set()
+
+    def get_token(self, scope):
+        """Return a new token for the given scope."""
+        self.calls += 1
+        self.thread_names.add(threading.current_thread().name)
+        time.sleep(self.delay_seconds)
+        return AccessToken(f"{scope}-token-{self.calls}", self.clock() + self.lifetime_seconds)
+
+
+class FakeAsyncCredential:
+    """An asynchronous credential."""
+
+    def __init__(self, clock, lifetime_seconds=3600, fail=False):
+        """Constructor."""
+        self.clock = clock
+        self.lifetime_seconds = lifetime_seconds
+        self.fail = fail
+        self.calls = 0
+
+    async def get_token(self, scope):
+        """Return a new token for the given scope."""
+        self.calls += 1
+        await asyncio.sleep(0.01)
+        if self.fail:
+            raise RuntimeError("credential unavailable")
+        return AccessToken(f"{scope}-token-{self.calls}", self.clock() + self.lifetime_seconds)
+
+
+def test_concurrent_requests_share_one_refresh():
+    """Many concurrent callers without a cached token cause a single credential call, run off the event loop."""
+
+    async def run():
+        clock = FakeClock()
+        credential = FakeSyncCredential(clock)
+        token_provider = AsyncTokenProvider(credential, clock=clock)
+        tokens = await asyncio.gather(*[token_provider.get_token("scope-a") for _ in range(50)])
+        assert set(tokens) == {"scope-a-token-1"}
+        assert credential.calls == 1
+        assert threading.main_thread().name not in credential.thread_names
+        assert token_provider.metrics["cache_misses"] == 50
+        assert token_provider.metrics["refreshes"] == 1
+        assert token_provider.metrics["last_refresh_latency_ms"] >= 50
+        await token_provider.close()
+
+    asyncio.run(run())
+
+
+def test_tokens_are_cached_per_scope():
+    """Tokens are cached and served from cache, separately for each scope."""
+
+    async def run():
+        clock = FakeClock()
+        credential = FakeAsyncCredential(clock)
+        token_provider = AsyncTokenProvider(credential, clock=clock)
+        assert await token_provider.get_token("scope-a") == "scope-a-token-1"
+        assert await token_provider.get_token("scope-b") == "scope-b-token-2"
+        for _ in range(10):
+            assert await token_provider.get_token("scope-a") == "scope-a-token-1"
+        assert credential.calls == 2
+        assert token_provider.metrics["cache_hits"] == 10
+        assert token_provider.metrics["cache_misses"] == 2
+        await token_provider.close()
+
+    asyncio.run(run())
+
+
+def test_token_is_refreshed_in_background_before_expiry():
+    """A token close to expiry is still served while a single background refresh replaces it."""
+
+    async def run():
+        clock = FakeClock()
+        credential = FakeAsyncCredential(clock)
+        token_provider = AsyncTokenProvider(credential, refresh_margin_seconds=300, clock=clock)
+        assert await token_provider.get_token("scope-a") == "scope-a-token-1"
+
+        # within the refresh margin: old token is returned immediately, refresh happens once in the background
+        clock.now += 3600 - 100
+        tokens = await asyncio.gather(*[token_provider.get_token("scope-a") for _ in range(20)])
+        assert set(tokens) == {"scope-a-token-1"}
+        await asyncio.sleep(0.05)
+        assert credential.calls == 2
+        assert token_provider.metrics["background_refreshes"] == 1
+        assert await token_provider.get_token("scope-a") == "scope-a-token-2"
+        await token_provider.close()
+
+    asyncio.run(run())
+
+
+def test_expired_token_is_not_served():
+    """An expired token is never returned, callers wait for the refresh instead."""
+
+    async def run():
+        clock = FakeClock()
+        credential = FakeAsyncCredential(clock)
+        token_provider = AsyncTokenProvider(credential, clock=clock)
+        await token_provider.get_token("scope-a")
+        clock.now += 3601
+        assert await token_provider.get_token("scope-a") == "scope-a-token-2"
+        await token_provider.close()
+
+    asyncio.run(run())
+
+
+def test_failed_refresh_is_raised_and_counted():
+    """A failing credential raises for callers without cached token and is counted."""
+
+    async def run():
+        clock = FakeClock()
+        credential = FakeAsyncCredential(clock, fail=True)
+        token_provider = AsyncTokenProvider(credential, clock=clock)
+        results = await asyncio.gather(
+            *[token_provider.get_token("scope-a") for _ in range(5)], return_exceptions=True
+        )
+        assert all(isinstance(result, RuntimeError) for result in results)
+        assert credential.calls == 1
+        assert token_provider.metrics["refresh_failures"] == 1
+        await token_provider.close()
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    for test_name, test_function in list(globals().items()):
+        if test_name.startswith("test_") and callable(test_function):
+            test_function()
+            print(f"✅ {test_name}")
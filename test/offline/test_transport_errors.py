@@ -0,0 +1,78 @@
+"""
+Tests for requests failing at targets with transport errors, eg. connection resets.
+
+Runs PowerProxy in this process, with endpoints answering by simulated Azure OpenAI (the endpoints' mock setting), so
+no requests leave the machine. Run directly or via pytest.
+"""
+
+import json
+import os
+import sys
+
+from fastapi.testclient import TestClient
+
+APP_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "app")
+sys.path.append(APP_DIRECTORY)
+
+CONFIG = {
+    "clients": [{"name": "Team 1", "key": "key-of-team-1"}],
+    "aoai": {
+        "endpoints": [
+            {
+                "name": "resetting",
+                "url": "https://resetting.openai.azure.com/",
+                "key": "key-of-resetting",
+                "tokens_per_minute": 100_000,
+                "mock": {"errors": {"connection_reset_rate": 1}},
+            },
+            {
+                "name": "answering",
+                "url": "https://answering.openai.azure.com/",
+                "key": "key-of-answering",
+                "mock": True,
+            },
+        ],
+        "remaining_capacity": True,
+    },
+}
+
+
+def import_powerproxy():
+    """Import PowerProxy with the test's configuration."""
+    # note: PowerProxy loads its configuration on import, with the config schema relative to the working directory
+    os.environ["POWERPROXY_CONFIG_STRING"] = json.dumps(CONFIG)
+    working_directory = os.getcwd()
+    os.chdir(APP_DIRECTORY)
+    try:
+        import powerproxy  # pylint: disable=import-error,import-outside-toplevel
+    finally:
+        os.chdir(working_directory)
+    return powerproxy
+
+
+def test_requests_failing_with_transport_errors_do_not_count_against_capacity_and_budget():
+    """A request whose connection is reset fails over to the next target and gives its tokens back to the first."""
+    powerproxy = import_powerproxy()
+    with TestClient(powerproxy.app) as client:
+        response = client.post(
+            "/openai/deployments/gpt-4o/chat/completions?api-version=2024-10-21",
+            headers={"api-key": "key-of-team-1"},
+            json={"messages": [{"role": "user", "content": "Tell me a joke."}], "max_tokens": 100},
+        )
+        assert response.status_code == 200
+        assert powerproxy.app.state.mock_upstreams["resetting"].get_stats()["connection_resets"] == 1
+
+        resetting_target = next(
+            aoai_target for aoai_target in powerproxy.app.state.routing_table if aoai_target.name == "resetting"
+        )
+        now_ms = powerproxy.get_current_timestamp_in_ms()
+        assert resetting_target.token_budget.get_consumed_tokens(now_ms) == 0
+        assert resetting_target.remaining_capacity.requests_sent == 0
+        assert resetting_target.remaining_capacity.tokens_sent == 0
+
+
+if __name__ == "__main__":
+    for test_name, test_function in list(globals().items()):
+        if test_name.startswith("test_") and callable(test_function):
+            test_function()
+            print(f"✅ {test_name}")
@@ -0,0 +1,95 @@
+"""
+Tests the queue in which requests wait for capacity.
+
+Runs without PowerProxy or Azure OpenAI. Run directly or via pytest.
+"""
+
+import asyncio
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "app"))
+
+from helpers.waiting import (  # pylint: disable=wrong-import-position
+    CapacityWaitingQueue,
+    get_timestamp_ms,
+)
+
+
+def test_waiters_are_released_in_order_and_paced():
+    """Waiters are woken up when the target unblocks and released one by one, in the order they arrived."""
+
+    async def run():
+        waiting_queue = CapacityWaitingQueue(release_interval_ms=20)
+        now_ms = get_timestamp_ms()
+        released = []
+
+        async def wait(index):
+            assert await waiting_queue.wait(now_ms + 50, now_ms + 5_000)
+            released.append((index, get_timestamp_ms() - now_ms))
+
+        await asyncio.gather(*[wait(index) for index in range(3)])
+        assert [index for index, _ in released] == [0, 1, 2]
+        assert released[0][1] >= 45
+        assert released[2][1] - released[0][1] >= 35
+        assert waiting_queue.metrics["released"] == 3
+
+    asyncio.run(run())
+
+
+def test_waiter_times_out_at_deadline():
+    """A waiter which is not released before its deadline gives up and leaves the queue."""
+
+    async def run():
+        waiting_queue = CapacityWaitingQueue()
+        now_ms = get_timestamp_ms()
+        assert not await waiting_queue.wait(now_ms + 10_000, now_ms + 30)
+        assert len(waiting_queue) == 0
+        assert waiting_queue.metrics["timed_out"] == 1
+
+    asyncio.run(run())
+
+
+def test_full_queue_rejects_waiters():
+    """Waiters arriving at a full queue are rejected right away."""
+
+    async def run():
+        waiting_queue = CapacityWaitingQueue(max_waiting_requests=1)
+        now_ms = get_timestamp_ms()
+        first_waiter = asyncio.create_task(waiting_queue.wait(now_ms + 10_000, now_ms + 10_000))
+        await asyncio.sleep(0)
+        assert not await waiting_queue.wait(now_ms + 10_000, now_ms + 10_000)
+        assert waiting_queue.metrics["rejected"] == 1
+        assert waiting_queue.release_next()
+        assert await first_waiter
+
+    asyncio.run(run())
+
+
+def test_retrying_waiter_keeps_its_place():
+    """A released waiter which found no capacity goes back to the head of the queue."""
+
+    async def run():
+        waiting_queue = CapacityWaitingQueue()
+        now_ms = get_timestamp_ms()
+        first_waiter = asyncio.create_task(waiting_queue.wait(now_ms + 10_000, now_ms + 10_000))
+        second_waiter = asyncio.create_task(waiting_queue.wait(now_ms + 10_000, now_ms + 10_000))
+        await asyncio.sleep(0)
+        waiting_queue.release_next()
+        assert await first_waiter
+        retrying_waiter = asyncio.create_task(waiting_queue.wait(now_ms + 10_000, now_ms + 10_000, is_retry=True))
+        await asyncio.sleep(0)
+        waiting_queue.release_next()
+        assert await retrying_waiter
+        assert not second_waiter.done()
+        waiting_queue.release_next()
+        assert await second_waiter
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    for test_name, test_function in list(globals().items()):
+        if test_name.startswith("test_") and callable(test_function):
+            test_function()
+            print(f"✅ {test_name}")